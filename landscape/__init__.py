@@ -21,8 +21,11 @@ DEFAULT_SERVER_API = b"3.2"
 #  * Add new "eucalyptus-info" and "eucalyptus-info-error" messages.
 # 3.3:
 #  * Add new schema for the "registration" message, providing Juju information
+# 3.4:
+#  * Send the points of the "cpu-usage", "load-average", "memory-info",
+#    "temperature" and "network-activity" messages in a compact columnar form
 #
-SERVER_API = b"3.3"
+SERVER_API = b"3.4"
 
 # The "client-api" field of outgoing messages will be set to this value, and
 # used by the server to know which schema do the message types accepted by the
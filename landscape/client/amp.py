@@ -87,6 +87,10 @@ class ComponentConnector(object):
     @param retry_on_reconnect: If C{True} the remote object built by this
         connector will retry L{MethodCall}s that failed due to lost
         connections.
+    @param batch_window: If not C{None}, the number of seconds during which
+        the remote object built by this connector collects L{MethodCall}s
+        before sending them together in L{MethodCallBatch}es. With C{0}, the
+        calls made in the same reactor iteration are sent in a single batch.
 
     @see: L{MethodCallClientFactory}.
     """
@@ -94,10 +98,12 @@ class ComponentConnector(object):
     component = None  # Must be defined by sub-classes
     remote = RemoteObject
 
-    def __init__(self, reactor, config, retry_on_reconnect=False):
+    def __init__(self, reactor, config, retry_on_reconnect=False,
+                 batch_window=None):
         self._reactor = reactor
         self._config = config
         self._retry_on_reconnect = retry_on_reconnect
+        self._batch_window = batch_window
         self._connector = None
 
     def connect(self, max_retries=None, factor=None, quiet=False):
@@ -117,6 +123,7 @@ class ComponentConnector(object):
         factory = self.factory(self._reactor._reactor)
         factory.initialDelay = factory.delay = 0.05
         factory.retryOnReconnect = self._retry_on_reconnect
+        factory.batchWindow = self._batch_window
         factory.remote = self.remote
         factory.maxRetries = max_retries
         if factor:
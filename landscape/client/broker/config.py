@@ -1,8 +1,10 @@
 """Configuration class for the broker."""
 
 import os
+import sys
 
 from landscape.client.deployment import Configuration
+from landscape.client.broker.store import parse_message_quotas
 
 
 class BrokerConfiguration(Configuration):
@@ -30,8 +32,17 @@ class BrokerConfiguration(Configuration):
               - C{computer_title}
               - C{exchange_interval} (C{15*60})
               - C{urgent_exchange_interval} (C{1*60})
+              - C{exchange_byte_budget} (C{1024*1024})
+              - C{exchange_target_time} (C{30})
+              - C{exchange_connection} (C{"close"})
+              - C{exchange_compression} (C{"none"})
+              - C{exchange_compression_level} (C{6})
+              - C{exchange_compression_threshold} (C{1024})
               - C{http_proxy}
               - C{https_proxy}
+              - C{message_store_engine} (C{"filesystem"})
+              - C{message_store_durability} (C{"group"})
+              - C{message_store_quotas} (C{""})
         """
         parser = super(BrokerConfiguration, self).make_parser()
 
@@ -50,6 +61,38 @@ class BrokerConfiguration(Configuration):
                           type="int", metavar="INTERVAL",
                           help="The number of seconds between urgent server "
                                "exchanges.")
+        parser.add_option("--exchange-byte-budget", default=1024 * 1024,
+                          type="int", metavar="BYTES",
+                          help="The initial number of message bytes sent "
+                               "in a single exchange, adjusted afterwards "
+                               "depending on how long exchanges take.")
+        parser.add_option("--exchange-target-time", default=30, type="int",
+                          metavar="SECONDS",
+                          help="The number of seconds a single exchange "
+                               "should take at most.")
+        parser.add_option("--exchange-connection", default="close",
+                          type="choice",
+                          choices=["close", "keep-alive", "http2"],
+                          help="Whether to open a new connection to the "
+                               "server for every exchange ('close'), to keep "
+                               "it open across exchanges ('keep-alive'), or "
+                               "to keep it open and use HTTP/2 when the "
+                               "server supports it ('http2') "
+                               "(default: 'close').")
+        parser.add_option("--exchange-compression", default="none",
+                          type="choice", choices=["none", "gzip", "zstd"],
+                          help="How payloads sent to the server are "
+                               "compressed, either 'none', 'gzip' or 'zstd', "
+                               "once the server advertised the encoding "
+                               "(default: 'none').")
+        parser.add_option("--exchange-compression-level", default=6,
+                          type="int", metavar="LEVEL",
+                          help="The compression level of the payloads sent "
+                               "to the server (default: 6).")
+        parser.add_option("--exchange-compression-threshold", default=1024,
+                          type="int", metavar="BYTES",
+                          help="The size in bytes below which payloads are "
+                               "sent uncompressed (default: 1024).")
         parser.add_option("--ping-interval", default=30, type="int",
                           metavar="INTERVAL",
                           help="The number of seconds between pings.")
@@ -59,6 +102,23 @@ class BrokerConfiguration(Configuration):
                           help="The URL of the HTTPS proxy, if one is needed.")
         parser.add_option("--access-group", default="",
                           help="Suggested access group for this computer.")
+        parser.add_option("--message-store-engine", default="filesystem",
+                          type="choice",
+                          choices=["filesystem", "sqlite", "segment"],
+                          help="The storage engine used to queue outgoing "
+                               "messages, either 'filesystem', 'sqlite' or "
+                               "'segment' (default: 'filesystem').")
+        parser.add_option("--message-store-durability", default="group",
+                          type="choice",
+                          choices=["none", "group", "per-message"],
+                          help="How queued messages are synced to disk, "
+                               "either 'none', 'group' or 'per-message' "
+                               "(default: 'group').")
+        parser.add_option("--message-store-quotas", default="",
+                          metavar="QUOTAS",
+                          help="Comma separated list of per message type "
+                               "quotas, like 'computer-info:count=1, "
+                               "cpu-usage:bytes=1000000:policy=downsample'.")
         parser.add_option("--tags",
                           help="Comma separated list of tag names to be sent "
                                "to the server.")
@@ -74,11 +134,16 @@ class BrokerConfiguration(Configuration):
         """
         Load options from command line arguments and a config file.
 
-        Load the configuration with L{Configuration.load}, and then set
-        C{http_proxy} and C{https_proxy} environment variables based on
-        that config data.
+        Load the configuration with L{Configuration.load}, check the
+        C{message_store_quotas}, and then set C{http_proxy} and
+        C{https_proxy} environment variables based on that config data.
         """
         super(BrokerConfiguration, self).load(args)
+        try:
+            parse_message_quotas(self.message_store_quotas)
+        except ValueError as error:
+            sys.exit("error: invalid --message-store-quotas: %s" % error)
+
         if self.http_proxy:
             os.environ["http_proxy"] = self.http_proxy
         elif self._original_http_proxy:
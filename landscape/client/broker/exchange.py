@@ -344,7 +344,9 @@ Diagram::
 """
 import time
 import logging
+import random
 from landscape.lib.hashlib import md5
+from landscape.lib import bpickle
 
 from twisted.internet.defer import Deferred, succeed
 from twisted.python.compat import _PY3
@@ -357,6 +359,46 @@ from landscape.lib.versioning import is_version_higher, sort_versions
 from landscape import DEFAULT_SERVER_API, SERVER_API, CLIENT_API
 
 
+class ExchangeBudget(object):
+    """Adapt the number of message bytes sent in each exchange to the link.
+
+    The budget starts from the configured value, and it's adjusted after
+    every exchange depending on how long it took: it's halved or more if the
+    exchange took longer than the target time, and it's doubled if more
+    messages were pending and the exchange took less than half of it.
+
+    @param budget: The initial number of bytes.
+    @param target_time: The number of seconds an exchange should take.
+    """
+
+    minimum = 16 * 1024
+    maximum = 64 * 1024 * 1024
+
+    def __init__(self, budget, target_time):
+        self.budget = budget
+        self.target_time = target_time
+
+    def reset(self, budget):
+        """Set the budget back to the given number of bytes."""
+        self.budget = budget
+
+    def update(self, sent_bytes, elapsed, backlog):
+        """Adjust the budget given the outcome of an exchange.
+
+        @param sent_bytes: The number of message bytes that were sent.
+        @param elapsed: The number of seconds the exchange took, including
+            the time the server took to process the messages.
+        @param backlog: Whether messages were left out of the exchange.
+        """
+        if elapsed > self.target_time:
+            # Aim at the size that would have been transferred within the
+            # target time.
+            budget = int(sent_bytes * self.target_time / elapsed)
+            self.budget = max(self.minimum, min(self.budget // 2, budget))
+        elif backlog and elapsed < self.target_time / 2.0:
+            self.budget = min(self.maximum, self.budget * 2)
+
+
 class MessageExchange(object):
     """Schedule and handle message exchanges with the server.
 
@@ -375,8 +417,12 @@ class MessageExchange(object):
     # The highest server API that we are capable of speaking
     _api = SERVER_API
 
+    # The maximum number of seconds to wait after failed exchanges, unless
+    # the exchange interval or the server ask for more.
+    max_backoff = 60 * 60
+
     def __init__(self, reactor, store, transport, registration_info,
-                 exchange_store, config, max_messages=100):
+                 exchange_store, config, max_messages=None):
         """
         @param reactor: The L{LandscapeReactor} used to fire events in response
             to messages received by the server.
@@ -387,7 +433,10 @@ class MessageExchange(object):
             and `urgent_exchange_interval` parameters, respectively holding
             the time interval between subsequent exchanges of non-urgent
             messages, and the time interval between subsequent exchanges
-            of urgent messages.
+            of urgent messages, as well as the `exchange_byte_budget` and
+            `exchange_target_time` parameters used to size the exchanges.
+        @param max_messages: If not C{None}, the maximum number of messages
+            sent in a single exchange, whatever their size.
         """
         self._reactor = reactor
         self._message_store = store
@@ -397,10 +446,14 @@ class MessageExchange(object):
         self._exchange_interval = config.exchange_interval
         self._urgent_exchange_interval = config.urgent_exchange_interval
         self._max_messages = max_messages
+        self._budget = ExchangeBudget(config.exchange_byte_budget,
+                                      config.exchange_target_time)
         self._notification_id = None
         self._exchange_id = None
         self._exchanging = False
         self._urgent_exchange = False
+        self._exchange_again = False
+        self._prefetched = None
         self._client_accepted_types = set()
         self._client_accepted_types_hash = None
         self._message_handlers = {}
@@ -444,22 +497,59 @@ class MessageExchange(object):
 
         @param message: Same as in L{MessageStore.add}.
         """
+        if not self._prepare_message(message):
+            return None
+        message_id = self._message_store.add(message)
+        if urgent:
+            self.schedule_exchange(urgent=True)
+        return message_id
+
+    def send_messages(self, messages, urgent=False):
+        """Include several messages to be sent in an exchange.
+
+        The messages are stored together, in a single write to the
+        L{MessageStore}. Invalid messages are dropped on their own, see
+        L{MessageStore.add_messages}.
+
+        @param messages: A C{list} of messages, see L{MessageStore.add}.
+        @param urgent: If C{True}, an exchange with the server will be
+            scheduled urgently.
+        @return: A C{list} with the message id of each message, or C{None}
+            for the messages that got discarded or were invalid.
+        """
+        prepared = [self._prepare_message(message) for message in messages]
+        accepted = [message for message, ok in zip(messages, prepared) if ok]
+        message_ids = self._message_store.add_messages(accepted)
+        if message_ids is None:
+            message_ids = [None] * len(accepted)
+        if urgent:
+            self.schedule_exchange(urgent=True)
+        message_ids = iter(message_ids)
+        return [next(message_ids) if ok else None for ok in prepared]
+
+    def _prepare_message(self, message):
+        """Timestamp C{message}, unless it's obsolete.
+
+        @return: C{False} if the message is obsolete and must be discarded.
+        """
         if self._message_is_obsolete(message):
             logging.info(
                 "Response message with operation-id %s was discarded "
                 "because the client's secure ID has changed in the meantime"
                 % message.get('operation-id'))
-            return None
+            return False
 
         if "timestamp" not in message:
             message["timestamp"] = int(self._reactor.time())
-        message_id = self._message_store.add(message)
-        if urgent:
-            self.schedule_exchange(urgent=True)
-        return message_id
+        return True
 
     def start(self):
-        """Start scheduling exchanges. The first one will be urgent."""
+        """Start scheduling exchanges. The first one will be urgent.
+
+        If the last exchange failed before a restart, the first one still
+        waits until the time picked when backing off from the failure, see
+        L{schedule_exchange}.
+        """
         self.schedule_exchange(urgent=True)
 
     def stop(self):
@@ -520,6 +610,11 @@ class MessageExchange(object):
             self._config.urgent_exchange_interval = message["urgent-exchange"]
             logging.info("Urgent exchange interval set to %d seconds." %
                          self._config.urgent_exchange_interval)
+        if "exchange-byte-budget" in message:
+            self._config.exchange_byte_budget = message["exchange-byte-budget"]
+            self._budget.reset(self._config.exchange_byte_budget)
+            logging.info("Exchange byte budget set to %d bytes." %
+                         self._config.exchange_byte_budget)
         self._config.write()
 
     def exchange(self):
@@ -531,6 +626,11 @@ class MessageExchange(object):
         An C{exchange-done} or C{exchange-failed} reactor event will be
         emitted after a successful or failed exchange.
 
+        If more messages are pending than the exchange can carry, the ones
+        of the next exchange are read from the store while waiting for the
+        server, and the next exchange happens after the urgent interval
+        rather than the normal one.
+
         @return: A L{Deferred} that is fired when exchange has completed.
         """
         if self._exchanging:
@@ -541,6 +641,8 @@ class MessageExchange(object):
         self._reactor.fire("pre-exchange")
 
         payload = self._make_payload()
+        sent_bytes = sum(len(data) for data in payload["messages"].encoded)
+        backlog = payload["total-messages"] > len(payload["messages"])
 
         start_time = time.time()
         if self._urgent_exchange:
@@ -552,8 +654,21 @@ class MessageExchange(object):
 
         deferred = Deferred()
 
-        def exchange_completed():
-            self.schedule_exchange(force=True)
+        def exchange_completed(interval=None, backlog=False):
+            exchange_again = self._exchange_again
+            self._exchange_again = False
+            if exchange_again and interval is None:
+                # Urgent messages were queued while exchanging, deliver them
+                # right away rather than after the urgent interval.
+                self.schedule_exchange(urgent=True, force=True, interval=0)
+            elif backlog:
+                # Catch up with the messages left out of the exchange.
+                self.schedule_exchange(
+                    force=True, interval=min(
+                        self._config.urgent_exchange_interval,
+                        self._config.exchange_interval))
+            else:
+                self.schedule_exchange(force=True, interval=interval)
             self._reactor.fire("exchange-done")
             logging.info("Message exchange completed in %s.",
                          format_delta(time.time() - start_time))
@@ -567,10 +682,14 @@ class MessageExchange(object):
                     self._urgent_exchange = False
                 self._handle_result(payload, result)
                 self._message_store.record_success(int(self._reactor.time()))
+                self._budget.update(sent_bytes, time.time() - start_time,
+                                    backlog)
             else:
                 self._reactor.fire("exchange-failed")
                 logging.info("Message exchange failed.")
-            exchange_completed()
+                exchange_completed(self._back_off())
+                return
+            exchange_completed(backlog=backlog)
 
         def handle_failure(error_class, error, traceback):
             self._exchanging = False
@@ -598,21 +717,56 @@ class MessageExchange(object):
 
             self._message_store.record_failure(int(self._reactor.time()))
             logging.info("Message exchange failed.")
-            exchange_completed()
+            retry_after = None
+            if isinstance(error, HTTPCodeError):
+                retry_after = error.retry_after
+            exchange_completed(self._back_off(retry_after))
 
         self._reactor.call_in_thread(handle_result, handle_failure,
                                      self._transport.exchange, payload,
                                      self._registration_info.secure_id,
                                      self._get_exchange_token(),
                                      payload.get("server-api"))
+        if backlog and self._exchanging:
+            # While the exchange is in flight, read the messages of the next
+            # one.
+            self._prefetch_messages(len(payload["messages"]))
         return deferred
 
+    def _back_off(self, retry_after=None):
+        """Pick the number of seconds to wait after a failed exchange.
+
+        The delays grow exponentially over consecutive failures, starting
+        from the current exchange interval and capped at C{max_backoff}.
+        They're randomized with decorrelated jitter, so that clients which
+        failed at the same time, for example while the server was down,
+        don't retry all at the same time.  The state is kept in the message
+        store, so that it survives restarts.
+
+        @param retry_after: If not C{None}, the number of seconds the server
+            asked to wait before retrying.
+        """
+        if self._urgent_exchange:
+            base = self._config.urgent_exchange_interval
+        else:
+            base = self._config.exchange_interval
+        previous, retry_time = self._message_store.get_exchange_backoff()
+        delay = min(max(base, self.max_backoff),
+                    random.uniform(base, max(base, previous) * 3))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        delay = int(delay)
+        self._message_store.set_exchange_backoff(
+            delay, int(self._reactor.time()) + delay)
+        logging.info("Next exchange attempt in %d seconds.", delay)
+        return delay
+
     def is_urgent(self):
         """Return a bool showing whether there is an urgent exchange scheduled.
         """
         return self._urgent_exchange
 
-    def schedule_exchange(self, urgent=False, force=False):
+    def schedule_exchange(self, urgent=False, force=False, interval=None):
         """Schedule an exchange to happen.
 
         The exchange will occur after some time based on whether C{urgent} is
@@ -624,9 +778,22 @@ class MessageExchange(object):
             If another urgent exchange is already scheduled, nothing happens.
         @param force: If true, an exchange will necessarily be scheduled,
             even if it was already scheduled before.
+        @param interval: If not C{None}, the number of seconds after which
+            the exchange will occur, instead of the configured interval.
+
+        If an urgent exchange is requested while an exchange is in progress,
+        another one will be performed as soon as the current one completes,
+        since the messages queued in the meantime can't be part of it.
+
+        After a failed exchange, no exchange is scheduled before the time
+        picked when backing off, whatever the interval, until an exchange
+        succeeds. Otherwise an urgent message queued right after a server
+        outage would bring all the clients back at the same time.
         """
         if self._stopped:
             return
+        if self._exchanging and urgent:
+            self._exchange_again = True
         # The 'not self._exchanging' check below is currently untested.
         # It's a bit tricky to test as it is preventing rehooking 'exchange'
         # while there's a background thread doing the exchange itself.
@@ -638,14 +805,18 @@ class MessageExchange(object):
             if self._exchange_id:
                 self._reactor.cancel_call(self._exchange_id)
 
-            if self._urgent_exchange:
-                interval = self._config.urgent_exchange_interval
-            else:
-                interval = self._config.exchange_interval
+            if interval is None:
+                if self._urgent_exchange:
+                    interval = self._config.urgent_exchange_interval
+                else:
+                    interval = self._config.exchange_interval
+            retry_time = self._message_store.get_exchange_backoff()[1]
+            if retry_time is not None:
+                interval = max(interval, retry_time - self._reactor.time())
 
             if self._notification_id is not None:
                 self._reactor.cancel_call(self._notification_id)
-            notification_interval = interval - 10
+            notification_interval = max(0, interval - 10)
             self._notification_id = self._reactor.call_later(
                 notification_interval, self._notify_impending_exchange)
 
@@ -675,33 +846,85 @@ class MessageExchange(object):
     def _notify_impending_exchange(self):
         self._reactor.fire("impending-exchange")
 
+    def _prefetch_messages(self, in_flight):
+        """Read the pending messages following the C{in_flight} ones.
+
+        They're read up to twice the current byte budget, which is as much as
+        the next exchange can carry, and L{_make_payload} uses them if the
+        server acknowledges all the messages in flight and the pending
+        messages don't change in the meantime.
+        """
+        store = self._message_store
+        max_bytes = min(self._budget.maximum, self._budget.budget * 2)
+        pending = store.get_pending_message_data(
+            self._max_messages, max_bytes=max_bytes, offset=in_flight)
+        remaining = store.count_pending_messages() - in_flight
+        self._prefetched = (store.get_sequence() + in_flight,
+                            store.get_revision(), remaining, pending)
+
+    def _get_prefetched_messages(self):
+        """Return the prefetched messages fitting in the byte budget.
+
+        @return: A C{list} of C{(api, data)} tuples, or C{None} if no
+            messages were prefetched or if they aren't the pending ones
+            anymore.
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is None:
+            return None
+        sequence, revision, remaining, pending = prefetched
+        store = self._message_store
+        if (store.get_sequence() != sequence or
+                store.get_revision() != revision):
+            return None
+        if (len(pending) == remaining and
+                store.count_pending_messages() != remaining):
+            # All the pending messages were prefetched, the ones queued since
+            # then might belong to this exchange too.
+            return None
+        total_bytes = 0
+        for i, (api, data) in enumerate(pending):
+            total_bytes += len(data)
+            if i > 0 and total_bytes > self._budget.budget:
+                return pending[:i]
+        return pending
+
     def _make_payload(self):
         """Return a dict representing the complete exchange payload.
 
-        The payload will contain all pending messages eligible for
-        delivery, up to a maximum of C{max_messages} as passed to
-        the L{__init__} method.
+        The payload will contain the pending messages eligible for
+        delivery that fit in the current byte budget, up to a maximum of
+        C{max_messages} as passed to the L{__init__} method.
         """
         store = self._message_store
         accepted_types_digest = self._hash_types(store.get_accepted_types())
-        messages = store.get_pending_messages(self._max_messages)
+        pending = self._get_prefetched_messages()
+        if pending is None:
+            pending = store.get_pending_message_data(
+                self._max_messages, max_bytes=self._budget.budget)
         total_messages = store.count_pending_messages()
-        if messages:
+        if pending:
             # Each message is tagged with the API that the client was
             # using at the time the message got added to the store.  The
             # logic below will make sure that all messages which are added
             # to the payload being built will have the same api, and any
             # other messages will be postponed to the next exchange.
-            server_api = messages[0].get("api")
-            for i, message in enumerate(messages):
-                if message.get("api") != server_api:
+            server_api = pending[0][0]
+            for i, (api, data) in enumerate(pending):
+                if api != server_api:
                     break
             else:
                 i = None
             if i is not None:
-                del messages[i:]
+                del pending[i:]
         else:
             server_api = store.get_server_api()
+        # Until the server acknowledges them, the messages in the payload must
+        # stay in the store as they are.
+        store.mark_in_flight(store.get_pending_offset() + len(pending))
+        # The messages are already serialized in the store, they're sent to
+        # the server as they are.
+        messages = bpickle.EncodedList(data for api, data in pending)
         payload = {"server-api": server_api,
                    "client-api": CLIENT_API,
                    "sequence": store.get_sequence(),
@@ -746,6 +969,7 @@ class MessageExchange(object):
             next_expected += len(payload["messages"])
 
         message_store_state = got_next_expected(message_store, next_expected)
+        message_store.mark_in_flight(0)
         if message_store_state == ANCIENT:
             # The server has probably lost some data we sent it. The
             # slate has been wiped clean (by got_next_expected), now
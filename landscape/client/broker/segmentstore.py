@@ -0,0 +1,548 @@
+"""A L{MessageStore} engine keeping its messages in append-only segments.
+
+The file system based L{MessageStore} uses one file per message, which costs
+an inode and at least one disk block for every queued message. That adds up
+quickly on small disks when the client can't reach the server for a while.
+The L{SegmentMessageStore} implements the very same API and sequencing
+semantics, but appends its messages to a few large segment files instead.
+
+Each segment is a sequence of records, made of a fixed size header followed
+by an optional payload::
+
+  KIND  MESSAGE_ID  POSITION  FLAGS  PAYLOAD_LENGTH  CRC32  PAYLOAD
+
+where C{KIND} is one of:
+
+  - C{A}: a message was added, the payload holding its type, API and data;
+  - C{U}: the position in the queue or the flags of a message changed, for
+    example because it got held or unheld;
+  - C{D}: a message was deleted;
+  - C{S}: the start of a segment, recording the next message id and
+    position to use.
+
+Records are never modified once written, so the state of the store is
+rebuilt at startup by replaying all the segments in order, where later
+records win over earlier ones. A torn record left at the end of the last
+segment by a crash is detected through its checksum and truncated.
+
+Since holding, unholding and deleting messages are small records appended to
+the newest segment, the data of a message stays in the segment it was first
+written to. A segment is dropped as a whole as soon as all the messages
+added in it have been deleted, which normally happens once they all are
+older than the pending offset. Only the oldest segment is ever dropped: the
+deletion records of a newer segment may refer to messages held in older
+ones, so dropping it first would resurrect them at the next replay.
+
+The compactor takes care of old segments pinned by a few messages, like the
+ones held because of their type: when the live messages of the oldest
+segment take less than C{compaction_threshold} of its size, they are copied
+to the newest segment and the old one gets dropped. It runs every
+C{compaction_interval} seconds if the store is given a reactor.
+
+When the store is created on top of an existing file system layout, all its
+messages are converted to a segment and removed from disk. Their inode
+numbers are kept as their new message ids, so ids handed out before the
+conversion stay valid.
+"""
+import itertools
+import logging
+import os
+import struct
+import time
+import zlib
+
+from landscape.client.broker.store import (
+    MessageStore, MessageEntry, MessageIndex, HELD, BROKEN, DURABILITY_NONE,
+    DURABILITY_GROUP, DURABILITY_PER_MESSAGE)
+from landscape.lib.fs import sync_path
+
+
+ADD = b"A"
+UPDATE = b"U"
+DELETE = b"D"
+START = b"S"
+
+# The header of every record.
+RECORD = struct.Struct(">cQQBII")
+# The header of the payload of an ADD record, holding the lengths of the
+# type and API of the message that follow it.
+MESSAGE = struct.Struct(">HH")
+
+FLAG_BITS = {HELD: 1, BROKEN: 2}
+
+SEGMENT_SUFFIX = ".segment"
+
+
+def encode_flags(flags):
+    """Convert a string of message flags into a bitmask."""
+    bits = 0
+    for flag in flags:
+        bits |= FLAG_BITS[flag]
+    return bits
+
+
+def decode_flags(bits):
+    """Convert a bitmask into a sorted string of message flags."""
+    return "".join(sorted(flag for flag, bit in FLAG_BITS.items()
+                          if bits & bit))
+
+
+def encode_record(kind, message_id, position, flags="", payload=b""):
+    """Return the bytes of a segment record."""
+    header = RECORD.pack(kind, message_id, position, encode_flags(flags),
+                         len(payload), 0)
+    crc = zlib.crc32(payload, zlib.crc32(header[:-4])) & 0xffffffff
+    return header[:-4] + struct.pack(">I", crc) + payload
+
+
+def encode_message(message_type, api, data):
+    """Return the payload of an ADD record."""
+    message_type = (message_type or "").encode("utf-8")
+    api = api or b""
+    header = MESSAGE.pack(len(message_type), len(api))
+    return header + message_type + api + data
+
+
+def get_record_size(entry):
+    """Return the size of the ADD record of the given L{SegmentEntry}."""
+    return (RECORD.size + MESSAGE.size + len((entry.type or "").encode(
+        "utf-8")) + len(entry.api or b"") + entry.length)
+
+
+def has_stored_messages(directory):
+    """Tell whether C{directory} holds segments with live messages.
+
+    Only the record headers are read, the payloads are skipped.
+
+    @param directory: The directory of a L{SegmentMessageStore}.
+    """
+    segments = []
+    for filename in os.listdir(directory):
+        name, suffix = os.path.splitext(filename)
+        if suffix == SEGMENT_SUFFIX and name.isdigit():
+            segments.append(int(name))
+    live = set()
+    for segment in sorted(segments):
+        filename = os.path.join(directory, str(segment) + SEGMENT_SUFFIX)
+        with open(filename, "rb") as fd:
+            while True:
+                header = fd.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                kind, message_id, _, _, length, _ = RECORD.unpack(header)
+                if kind == ADD:
+                    live.add(message_id)
+                elif kind == DELETE:
+                    live.discard(message_id)
+                fd.seek(length, os.SEEK_CUR)
+    return bool(live)
+
+
+class SegmentEntry(MessageEntry):
+    """A L{MessageEntry} for a message stored in a segment.
+
+    The C{directory} of the entry is the number of the segment holding its
+    data and the C{number} is its position in the queue.
+
+    @ivar offset: The offset of the message data in the segment.
+    @ivar length: The length of the message data.
+    """
+
+    __slots__ = ("offset", "length")
+
+    def __init__(self, segment, position, flags, id, type, api, offset,
+                 length):
+        super(SegmentEntry, self).__init__(segment, position, flags, id,
+                                           type, api, length)
+        self.offset = offset
+        self.length = length
+
+    @property
+    def key(self):
+        return self.number
+
+
+class SegmentMessageStore(MessageStore):
+    """A L{MessageStore} keeping its messages in append-only segment files.
+
+    @param persist: a L{Persist} used to save state parameters like the
+        accepted message types, sequence, server uuid etc.
+    @param directory: the directory holding the segment files. If it contains
+        messages stored by the file system based L{MessageStore} they will be
+        converted.
+    @param directory_size: unused, accepted for compatibility with
+        L{MessageStore}.
+    @param durability: one of C{"none"}, C{"group"} or C{"per-message"}.
+    @param reactor: optionally, the reactor used to schedule the sync of
+        groups of messages and the compaction of the segments.
+    """
+
+    segment_size = 1024 * 1024
+    compaction_threshold = 0.5
+    compaction_interval = 600
+
+    def __init__(self, persist, directory, directory_size=1000,
+                 durability=DURABILITY_GROUP, reactor=None):
+        self._segments = []
+        self._segment_file = None
+        self._segment_size = 0
+        self._next_id = 0
+        self._next_position = 0
+        super(SegmentMessageStore, self).__init__(
+            persist, directory, directory_size=directory_size,
+            durability=durability, reactor=reactor)
+        if self._get_sorted_filenames():
+            self._convert_directory_layout()
+        if not self._segments:
+            self._start_segment(0)
+        if reactor is not None:
+            reactor.call_every(self.compaction_interval, self.compact)
+
+    def delete_old_messages(self):
+        """Delete messages which are unlikely to be needed in the future."""
+        entries = list(itertools.islice(self._index.pending(0),
+                                        self.get_pending_offset()))
+        self._delete_entries(entries)
+
+    def delete_all_messages(self):
+        """Remove ALL stored messages."""
+        self.set_pending_offset(0)
+        self.mark_in_flight(0)
+        self._revision += 1
+        self._unsynced = []
+        self._segment_file.close()
+        self._segment_file = None
+        for segment in self._segments:
+            os.unlink(self._get_segment_filename(segment))
+        self._index = MessageIndex()
+        next_segment = self._segments[-1] + 1
+        self._segments = []
+        self._start_segment(next_segment)
+
+    def _sync(self):
+        """Sync the records appended since the last flush.
+
+        All the records are in the newest segment, so a single sync is
+        needed no matter how many messages are waiting.
+        """
+        messages = len([kind for kind in self._unsynced if kind == ADD])
+        self._unsynced = []
+        start = time.time()
+        os.fsync(self._segment_file.fileno())
+        elapsed = time.time() - start
+        self._record_sync(messages, 1, elapsed)
+        logging.debug("Synced %d messages to disk in %.3f seconds.",
+                      messages, elapsed)
+
+    def compact(self):
+        """Copy the live messages of sparse old segments, and drop them.
+
+        Segments are compacted starting from the oldest one, and compaction
+        stops at the first segment whose live messages take more than
+        C{compaction_threshold} of its size.
+
+        @return: The number of dropped segments.
+        """
+        dropped = self._drop_dead_segments()
+        # Segments written while compacting are never compacted again.
+        newest = self._segments[-1]
+        while self._segments[0] < newest:
+            segment = self._segments[0]
+            entries = [entry for entry in self._index.walk()
+                       if entry.directory == segment]
+            size = os.path.getsize(self._get_segment_filename(segment))
+            live = sum(get_record_size(entry) for entry in entries)
+            if live > size * self.compaction_threshold:
+                break
+            self._copy_messages(entries)
+            if self._durability != DURABILITY_NONE:
+                # The copies must hit the disk before the originals go.
+                self.flush()
+            dropped += self._drop_dead_segments()
+        if dropped:
+            logging.info("Dropped %d message store segments.", dropped)
+        return dropped
+
+    def _store_message(self, message, message_data):
+        return self._store_messages([(message, message_data)])[0]
+
+    def _store_messages(self, items):
+        records = []
+        entries = []
+        for message, message_data in items:
+            flags = "" if self.accepts(message["type"]) else HELD
+            payload = encode_message(message["type"], message["api"],
+                                     message_data)
+            entry = SegmentEntry(
+                None, self._next_position, flags, self._next_id,
+                message["type"], message["api"], None, len(message_data))
+            self._next_id += 1
+            self._next_position += 1
+            records.append(encode_record(ADD, entry.id, entry.number, flags,
+                                         payload))
+            entries.append(entry)
+        self._add_entries(entries, records)
+        return [entry.id for entry in entries]
+
+    def _replace_message(self, message_id, message, message_data):
+        # The DELETE record of the replaced message goes first, since two
+        # messages can't share the same position when replaying.
+        old_entry = self._index.get(message_id)
+        entry = SegmentEntry(
+            None, old_entry.number, old_entry.flags, self._next_id,
+            message["type"], message["api"], None, len(message_data))
+        self._next_id += 1
+        self._index.remove(old_entry)
+        self._add_entries(
+            [entry],
+            [encode_record(ADD, entry.id, entry.number, entry.flags,
+                           encode_message(message["type"], message["api"],
+                                          message_data))],
+            preceding=[encode_record(DELETE, old_entry.id, old_entry.number)])
+        self._drop_dead_segments()
+        return entry.id
+
+    def _read_message(self, entry):
+        with open(self._get_segment_filename(entry.directory), "rb") as fd:
+            fd.seek(entry.offset)
+            return fd.read(entry.length)
+
+    def _remember_type(self, entry):
+        # The type of each message is part of its ADD record already.
+        pass
+
+    def _get_position(self, entry):
+        return entry.number
+
+    def _evict_messages(self, message_ids):
+        self._delete_entries([self._index.get(message_id)
+                              for message_id in message_ids])
+
+    def _delete_entries(self, entries):
+        """Append the DELETE records of the given entries, and drop them."""
+        if not entries:
+            return
+        self._append([encode_record(DELETE, entry.id, entry.number)
+                      for entry in entries])
+        for entry in entries:
+            self._index.remove(entry)
+        self._drop_dead_segments()
+
+    def _set_flags(self, entry, flags):
+        flags = "".join(sorted(set(flags)))
+        self._append([encode_record(UPDATE, entry.id, entry.number, flags)])
+        self._index.set_flags(entry, flags)
+
+    def _move_to_end(self, entry, flags):
+        """Move the message of C{entry} at the end of the queue."""
+        self._index.remove(entry)
+        entry.number = self._next_position
+        entry.flags = "".join(sorted(set(flags)))
+        self._next_position += 1
+        self._append([encode_record(UPDATE, entry.id, entry.number,
+                                    entry.flags)])
+        self._index.add(entry)
+
+    def _add_entries(self, entries, records, preceding=()):
+        """Append the ADD C{records} and index their C{entries}.
+
+        The segment and offset of each entry are filled in.
+
+        @param preceding: Other records to append before the ADD ones, in
+            the same write.
+        """
+        self._roll_segment()
+        offset = self._segment_size + sum(len(record) for record in preceding)
+        for entry, record in zip(entries, records):
+            entry.directory = self._segments[-1]
+            entry.offset = offset + len(record) - entry.length
+            offset += len(record)
+        self._append(list(preceding) + records, roll=False)
+        for entry in entries:
+            self._index.add(entry)
+
+    def _copy_messages(self, entries):
+        """Copy the data of the given entries to the newest segment."""
+        records = []
+        for entry in entries:
+            payload = encode_message(entry.type, entry.api,
+                                     self._read_message(entry))
+            records.append(encode_record(ADD, entry.id, entry.number,
+                                         entry.flags, payload))
+        for entry in entries:
+            self._index.remove(entry)
+        self._add_entries(entries, records)
+
+    def _append(self, records, roll=True):
+        """Append the given C{records} to the newest segment."""
+        if roll:
+            self._roll_segment()
+        data = b"".join(records)
+        self._segment_file.write(data)
+        # Flush the Python buffer, so the data can be read back.
+        self._segment_file.flush()
+        self._segment_size += len(data)
+        if self._durability == DURABILITY_PER_MESSAGE:
+            start = time.time()
+            os.fsync(self._segment_file.fileno())
+            self._record_sync(
+                len([record for record in records if record[:1] == ADD]), 1,
+                time.time() - start)
+        elif self._durability == DURABILITY_GROUP:
+            self._unsynced.extend(record[:1] for record in records)
+            self._schedule_flush()
+
+    def _roll_segment(self):
+        """Start a new segment if the newest one is full."""
+        if self._segment_size >= self.segment_size:
+            if self._durability != DURABILITY_NONE:
+                self.flush()
+            self._segment_file.close()
+            self._segment_file = None
+            self._start_segment(self._segments[-1] + 1)
+
+    def _start_segment(self, segment):
+        """Create a new segment, and open it for appending."""
+        filename = self._get_segment_filename(segment)
+        self._segments.append(segment)
+        self._index.add_directory(segment)
+        self._segment_file = open(filename, "ab")
+        self._segment_size = 0
+        self._append([encode_record(START, self._next_id,
+                                    self._next_position)], roll=False)
+        if self._durability != DURABILITY_NONE:
+            self.flush()
+            sync_path(self._directory)
+
+    def _drop_dead_segments(self):
+        """Drop the oldest segments not holding any message anymore.
+
+        @return: The number of dropped segments.
+        """
+        dropped = 0
+        while (len(self._segments) > 1 and
+               not self._index.count_directory(self._segments[0])):
+            segment = self._segments.pop(0)
+            os.unlink(self._get_segment_filename(segment))
+            self._index.remove_directory(segment)
+            dropped += 1
+        return dropped
+
+    def _get_segment_filename(self, segment):
+        return self._message_dir(str(segment) + SEGMENT_SUFFIX)
+
+    def _get_segment_numbers(self):
+        segments = []
+        for filename in os.listdir(self._directory):
+            name, suffix = os.path.splitext(filename)
+            if suffix == SEGMENT_SUFFIX and name.isdigit():
+                segments.append(int(name))
+        return sorted(segments)
+
+    def _build_index(self):
+        """Build the L{MessageIndex} by replaying all the segments."""
+        index = MessageIndex()
+        segments = self._get_segment_numbers()
+        for segment in segments:
+            index.add_directory(segment)
+            self._replay_segment(index, segment, segment == segments[-1])
+        self._segments = segments
+        if segments:
+            filename = self._get_segment_filename(segments[-1])
+            self._segment_file = open(filename, "ab")
+            self._segment_size = os.path.getsize(filename)
+        return index
+
+    def _replay_segment(self, index, segment, last):
+        """Apply the records of a segment to the given C{index}."""
+        filename = self._get_segment_filename(segment)
+        with open(filename, "rb") as fd:
+            content = fd.read()
+        position = 0
+        while position < len(content):
+            end = position + RECORD.size
+            if end > len(content):
+                break
+            (kind, message_id, message_position, bits, length,
+             crc) = RECORD.unpack_from(content, position)
+            payload = content[end:end + length]
+            header = content[position:end - 4]
+            if (len(payload) < length or
+                    zlib.crc32(payload, zlib.crc32(header)) & 0xffffffff !=
+                    crc):
+                break
+            self._apply_record(index, segment, end, kind, message_id,
+                               message_position, decode_flags(bits), payload)
+            position = end + length
+        if position < len(content):
+            logging.warning("Found a corrupted record at offset %d of %s.",
+                            position, filename)
+            if last:
+                # This is most likely a record that was being written when
+                # the client died, drop it so new records are readable.
+                with open(filename, "r+b") as fd:
+                    fd.truncate(position)
+
+    def _apply_record(self, index, segment, offset, kind, message_id,
+                      position, flags, payload):
+        entry = index.get(message_id)
+        if kind == START:
+            self._next_id = max(self._next_id, message_id)
+            self._next_position = max(self._next_position, position)
+            return
+        if entry is not None:
+            index.remove(entry)
+        if kind == ADD:
+            type_length, api_length = MESSAGE.unpack_from(payload)
+            start = MESSAGE.size + type_length + api_length
+            message_type = payload[MESSAGE.size:MESSAGE.size + type_length]
+            api = payload[MESSAGE.size + type_length:start]
+            entry = SegmentEntry(
+                segment, position, flags, message_id,
+                message_type.decode("utf-8") or None, api or None,
+                offset + start, len(payload) - start)
+        elif kind == UPDATE and entry is not None:
+            entry.number = position
+            entry.flags = flags
+        else:
+            return
+        index.add(entry)
+        self._next_id = max(self._next_id, message_id + 1)
+        self._next_position = max(self._next_position, position + 1)
+
+    def _convert_directory_layout(self):
+        """Move the messages of the file system layout to a segment.
+
+        The legacy files are only removed once all the messages are written,
+        so the ones already in the index were converted by an interrupted
+        run, and are skipped.
+        """
+        legacy_index = MessageStore._build_index(self)
+        if not self._segments:
+            self._start_segment(0)
+        messages = ((entry, data) for entry, data
+                    in self._read_directory_layout(legacy_index)
+                    if self._index.get(entry.id) is None)
+        count = 0
+        while True:
+            entries = []
+            records = []
+            for entry, data in itertools.islice(messages,
+                                                self.group_commit_size):
+                self._next_id = max(self._next_id, entry.id + 1)
+                entries.append(SegmentEntry(
+                    None, self._next_position, entry.flags, entry.id,
+                    entry.type, entry.api, None, len(data)))
+                records.append(encode_record(
+                    ADD, entry.id, self._next_position, entry.flags,
+                    encode_message(entry.type, entry.api, data)))
+                self._next_position += 1
+            if not entries:
+                break
+            self._add_entries(entries, records)
+            count += len(entries)
+        if self._durability != DURABILITY_NONE:
+            self.flush()
+        self._remove_directory_layout(legacy_index)
+        logging.info("Converted %d messages to message store segments.",
+                     count)
@@ -189,7 +189,8 @@ class BrokerServer(object):
             with C{get_session_id} before attempting to send a message.
         @param urgent: If C{True}, exchange urgently, otherwise exchange
             during the next regularly scheduled exchange.
-        @return: The message identifier created when queuing C{message}.
+        @return: The message identifier created when queuing C{message},
+            once the message is synced to disk.
         """
         if isinstance(session_id, bool) and message["type"] in (
                 "operation-result", "change-packages-result"):
@@ -211,7 +212,32 @@ class BrokerServer(object):
             raise RuntimeError(
                 "Session ID must be set before attempting to send a message")
         if self._message_store.is_valid_session_id(session_id):
-            return self._exchanger.send(message, urgent=urgent)
+            message_id = self._exchanger.send(message, urgent=urgent)
+            return self._message_store.when_synced(message_id)
+
+    @remote
+    def send_messages(self, messages, session_id, urgent=False):
+        """Queue several C{messages} for delivery at the next exchange.
+
+        This is equivalent to calling L{send_message} for each message, but
+        the messages are stored in a single batch. A message which doesn't
+        conform to its schema is dropped without affecting the others.
+
+        @param messages: A C{list} of message C{dict}s, see L{send_message}.
+        @param session_id: A session ID, see L{send_message}.
+        @param urgent: If C{True}, exchange urgently, otherwise exchange
+            during the next regularly scheduled exchange.
+        @return: The C{list} of message identifiers created when queuing
+            C{messages}, holding C{None} for the dropped ones, once the
+            messages are synced to disk.
+        """
+        if session_id is None:
+            raise RuntimeError(
+                "Session ID must be set before attempting to send a message")
+        if self._message_store.is_valid_session_id(session_id):
+            message_ids = self._exchanger.send_messages(messages,
+                                                        urgent=urgent)
+            return self._message_store.when_synced(message_ids)
 
     @remote
     def is_message_pending(self, message_id):
@@ -254,6 +280,14 @@ class BrokerServer(object):
         """Return the uuid of the Landscape server we're pointing at."""
         return self._message_store.get_server_uuid()
 
+    @remote
+    def get_eviction_stats(self):
+        """Return the messages evicted from the queue because of quotas.
+
+        @see: L{MessageStore.get_eviction_stats}
+        """
+        return self._message_store.get_eviction_stats()
+
     @remote
     def register_client_accepted_message_type(self, type):
         """Register a new message type which can be accepted by this client.
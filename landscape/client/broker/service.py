@@ -10,7 +10,8 @@ from landscape.client.broker.transport import HTTPTransport
 from landscape.client.broker.exchange import MessageExchange
 from landscape.client.broker.exchangestore import ExchangeStore
 from landscape.client.broker.ping import Pinger
-from landscape.client.broker.store import get_default_message_store
+from landscape.client.broker.store import (
+    get_default_message_store, parse_message_quotas)
 from landscape.client.broker.server import BrokerServer
 
 
@@ -37,6 +38,8 @@ class BrokerService(LandscapeService):
         registration.
 
     @param config: A L{BrokerConfiguration}.
+    @raises MessageStoreError: If the configured C{message_store_engine}
+        can't read the messages already stored.
     """
 
     transport_factory = HTTPTransport
@@ -49,9 +52,18 @@ class BrokerService(LandscapeService):
         super(BrokerService, self).__init__(config)
 
         self.transport = self.transport_factory(
-            self.reactor, config.url, config.ssl_public_key)
+            self.reactor, config.url, config.ssl_public_key,
+            connection=config.exchange_connection,
+            compression=config.exchange_compression,
+            compression_level=config.exchange_compression_level,
+            compression_threshold=config.exchange_compression_threshold)
         self.message_store = get_default_message_store(
-            self.persist, config.message_store_path)
+            self.persist, config.message_store_path,
+            engine=config.message_store_engine,
+            durability=config.message_store_durability, reactor=self.reactor)
+        quotas = parse_message_quotas(config.message_store_quotas)
+        for message_type, quota in sorted(quotas.items()):
+            self.message_store.set_quota(message_type, quota)
         self.identity = Identity(self.config, self.persist)
         exchange_store = ExchangeStore(self.config.exchange_store_path)
         self.exchanger = MessageExchange(
@@ -85,6 +97,8 @@ class BrokerService(LandscapeService):
         deferred = self.publisher.stop()
         self.exchanger.stop()
         self.pinger.stop()
+        self.transport.close()
+        self.message_store.flush()
         super(BrokerService, self).stopService()
         return deferred
 
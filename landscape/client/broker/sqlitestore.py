@@ -0,0 +1,374 @@
+"""A L{MessageStore} engine backed by a single SQLite database.
+
+The file system based L{MessageStore} keeps every message in its own file and
+recomputes its state by listing and sorting directories, which gets slow when
+the store holds a large backlog of messages. The L{SQLiteMessageStore}
+implements the very same API and sequencing semantics, but keeps all messages
+in one SQLite database running in WAL mode:
+
+  - messages are kept in order by an indexed C{position} column, which plays
+    the role of the numbered file names of the file system layout;
+  - the held and broken flags are columns instead of file name suffixes;
+  - the message type and API are columns, so holding and unholding messages
+    never requires decoding their payload;
+  - message ids are real primary keys instead of inode numbers.
+
+The durability level maps onto SQLite's own syncing: C{"per-message"} syncs
+every transaction (C{PRAGMA synchronous=FULL}), C{"group"} lets the WAL be
+synced at checkpoints (C{PRAGMA synchronous=NORMAL}) and C{"none"} never syncs
+(C{PRAGMA synchronous=OFF}). A batch of messages added with L{add_messages}
+is always written in a single transaction.
+
+When the store is created on top of an existing file system layout, all its
+messages are imported in the database and removed from disk. Their inode
+numbers are kept as their new message ids, so ids handed out before the
+migration stay valid.
+"""
+import logging
+import os
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from landscape.lib import bpickle
+from landscape.lib.store import with_cursor
+from landscape.lib.versioning import is_version_higher
+from landscape.client.broker.store import (
+    MessageStore, MessageIndex, HELD, BROKEN, DURABILITY_NONE,
+    DURABILITY_GROUP, DURABILITY_PER_MESSAGE, decode_legacy_message,
+    is_well_formed)
+
+
+SYNCHRONOUS_PRAGMAS = {
+    DURABILITY_NONE: "OFF",
+    DURABILITY_GROUP: "NORMAL",
+    DURABILITY_PER_MESSAGE: "FULL",
+}
+
+
+class SQLiteMessageStore(MessageStore):
+    """A L{MessageStore} keeping its messages in a SQLite database.
+
+    @param persist: a L{Persist} used to save state parameters like the
+        accepted message types, sequence, server uuid etc.
+    @param directory: the directory holding the database file. If it contains
+        messages stored by the file system based L{MessageStore} they will be
+        migrated to the database.
+    @param directory_size: unused, accepted for compatibility with
+        L{MessageStore}.
+    @param durability: one of C{"none"}, C{"group"} or C{"per-message"}.
+    @param reactor: unused, accepted for compatibility with L{MessageStore}.
+    """
+
+    _db = None
+    database_name = "messages.sqlite"
+
+    def __init__(self, persist, directory, directory_size=1000,
+                 durability=DURABILITY_GROUP, reactor=None):
+        super(SQLiteMessageStore, self).__init__(
+            persist, directory, directory_size=directory_size,
+            durability=durability, reactor=reactor)
+        self._filename = self._message_dir(self.database_name)
+        if self._get_sorted_filenames():
+            self._migrate_directory_layout()
+
+    def _ensure_schema(self):
+        ensure_message_schema(self._db)
+        self._db.execute(
+            "PRAGMA synchronous=%s" % SYNCHRONOUS_PRAGMAS[self._durability])
+
+    @with_cursor
+    def count_pending_messages(self, cursor):
+        """Return the number of pending messages."""
+        cursor.execute(
+            "SELECT COUNT(*) FROM message WHERE held=0 AND broken=0")
+        return max(0, cursor.fetchone()[0] - self.get_pending_offset())
+
+    @with_cursor
+    def _get_pending(self, cursor, max, decode=True, max_bytes=None,
+                     offset=0):
+        accepted_types = self.get_accepted_types()
+        server_api = self.get_server_api()
+        cursor.execute(
+            "SELECT id, position, type, api, data FROM message "
+            "WHERE held=0 AND broken=0 ORDER BY position LIMIT -1 OFFSET ?",
+            (self.get_pending_offset() + offset,))
+        messages = []
+        held = []
+        broken = []
+        total_bytes = 0
+        for id, position, type, api, data in cursor:
+            if max is not None and len(messages) >= max:
+                break
+            unknown_type = type not in accepted_types
+            unknown_api = not is_version_higher(server_api, bytes(api))
+            if unknown_type or unknown_api:
+                held.append((id,))
+                continue
+            data = bytes(data)
+            if (max_bytes is not None and messages and
+                    total_bytes + len(data) > max_bytes):
+                break
+            if not decode:
+                if not is_well_formed(data):
+                    logging.error("Found a corrupted message, skipping it.")
+                    broken.append((id,))
+                    continue
+                messages.append((bytes(api), data, None))
+                total_bytes += len(data)
+                continue
+            try:
+                # don't reinterpret messages that are meant to be sent out
+                message = bpickle.loads_lazy(data, as_is=True)
+            except ValueError as e:
+                logging.exception(e)
+                broken.append((id,))
+            else:
+                messages.append(
+                    (bytes(api), data, decode_legacy_message(message)))
+                total_bytes += len(data)
+        cursor.executemany("UPDATE message SET held=1 WHERE id=?", held)
+        cursor.executemany("UPDATE message SET broken=1 WHERE id=?", broken)
+        return messages
+
+    @with_cursor
+    def delete_old_messages(self, cursor):
+        """Delete messages which are unlikely to be needed in the future."""
+        cursor.execute(
+            "DELETE FROM message WHERE id IN (SELECT id FROM message "
+            "WHERE held=0 AND broken=0 ORDER BY position LIMIT ?)",
+            (self.get_pending_offset(),))
+
+    @with_cursor
+    def delete_all_messages(self, cursor):
+        """Remove ALL stored messages."""
+        self.set_pending_offset(0)
+        self.mark_in_flight(0)
+        self._revision += 1
+        cursor.execute("DELETE FROM message")
+
+    @with_cursor
+    def is_pending(self, cursor, message_id):
+        """Return bool indicating if C{message_id} still hasn't been delivered.
+
+        @param message_id: Identifier returned by the L{add()} method.
+        """
+        cursor.execute(
+            "SELECT position, held, broken FROM message WHERE id=?",
+            (message_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        position, held, broken = row
+        if broken:
+            return False
+        if held:
+            return True
+        cursor.execute(
+            "SELECT COUNT(*) FROM message "
+            "WHERE held=0 AND broken=0 AND position < ?", (position,))
+        return cursor.fetchone()[0] >= self.get_pending_offset()
+
+    @with_cursor
+    def _get_usage(self, cursor, message_type):
+        cursor.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM message "
+            "WHERE type=?", (message_type,))
+        return cursor.fetchone()
+
+    @with_cursor
+    def _get_evictable_messages(self, cursor, message_type):
+        cursor.execute(
+            "SELECT id, LENGTH(data), position FROM message WHERE type=? AND "
+            "(held=1 OR broken=1 OR position >= ?) AND position < "
+            "(SELECT MAX(position) FROM message WHERE type=?) "
+            "ORDER BY position",
+            (message_type, self._get_first_evictable_position(cursor),
+             message_type))
+        return cursor.fetchall()
+
+    @with_cursor
+    def _get_newest_position(self, cursor, message_type):
+        cursor.execute(
+            "SELECT MAX(position) FROM message WHERE type=?", (message_type,))
+        return cursor.fetchone()[0]
+
+    @with_cursor
+    def _get_replaceable_message(self, cursor, message_type):
+        cursor.execute(
+            "SELECT id FROM message WHERE type=? AND broken=0 AND "
+            "(held=1 OR position >= ?) AND position = "
+            "(SELECT MAX(position) FROM message WHERE type=?)",
+            (message_type, self._get_first_evictable_position(cursor),
+             message_type))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def _get_first_evictable_position(self, cursor):
+        """Return the position of the first active message which was never
+        handed out for delivery, or C{None}.
+
+        Active messages are evictable only if they come after both the
+        pending offset and the messages marked as in flight.
+        """
+        cursor.execute(
+            "SELECT position FROM message WHERE held=0 AND broken=0 "
+            "ORDER BY position LIMIT 1 OFFSET ?",
+            (self._get_protected_offset(),))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    @with_cursor
+    def _replace_message(self, cursor, message_id, message, message_data):
+        # Rows are updated in place, so the message keeps its id.
+        cursor.execute(
+            "UPDATE message SET api=?, data=? WHERE id=?",
+            (sqlite3.Binary(message["api"]), sqlite3.Binary(message_data),
+             message_id))
+        return message_id
+
+    @with_cursor
+    def _evict_messages(self, cursor, message_ids):
+        cursor.executemany("DELETE FROM message WHERE id=?",
+                           [(message_id,) for message_id in message_ids])
+
+    def _store_message(self, message, message_data):
+        return self._store_messages([(message, message_data)])[0]
+
+    def _store_messages(self, items):
+        start = time.time()
+        message_ids = self._insert_messages(items)
+        # With the "per-message" level the commit of the transaction is
+        # where SQLite syncs the database.
+        fsyncs = int(self._durability == DURABILITY_PER_MESSAGE)
+        self._record_sync(len(items), fsyncs, time.time() - start)
+        return message_ids
+
+    @with_cursor
+    def _insert_messages(self, cursor, items):
+        # All the messages are inserted in a single transaction, which gets
+        # committed (and synced to disk) only once.
+        message_ids = []
+        for message, message_data in items:
+            held = not self.accepts(message["type"])
+            cursor.execute(
+                "INSERT INTO message (position, type, api, held, data) "
+                "SELECT COALESCE(MAX(position), -1) + 1, ?, ?, ?, ? "
+                "FROM message",
+                (message["type"], sqlite3.Binary(message["api"]), int(held),
+                 sqlite3.Binary(message_data)))
+            message_ids.append(cursor.lastrowid)
+        return message_ids
+
+    @with_cursor
+    def _reprocess_holding(self, cursor):
+        """
+        Unhold accepted messages left behind, and hold unaccepted
+        pending messages.
+
+        Only the C{type} column is looked at, so no message gets decoded.
+        """
+        accepted_types = self.get_accepted_types()
+        cursor.execute(
+            "SELECT id, type FROM message WHERE held=1 AND broken=0 "
+            "ORDER BY position")
+        unhold = [(id,) for id, type in cursor.fetchall()
+                  if type in accepted_types]
+        cursor.execute(
+            "SELECT id, type FROM message WHERE held=0 AND broken=0 "
+            "ORDER BY position LIMIT -1 OFFSET ?",
+            (self.get_pending_offset(),))
+        hold = [(id,) for id, type in cursor.fetchall()
+                if type not in accepted_types]
+        cursor.executemany("UPDATE message SET held=1 WHERE id=?", hold)
+        # Unheld messages are moved at the end of the queue, in the same
+        # order they had before.
+        cursor.executemany(
+            "UPDATE message SET held=0, position=(SELECT MAX(position) + 1 "
+            "FROM message) WHERE id=?", unhold)
+
+    def _migrate_directory_layout(self):
+        """Import the messages of the file system layout in the database."""
+        count = self._import_messages(self._read_directory_layout(self._index))
+        self._remove_directory_layout(self._index)
+        self._index = MessageIndex()
+        logging.info("Migrated %d messages to %s.", count, self._filename)
+
+    @with_cursor
+    def _import_messages(self, cursor, messages):
+        """Insert the given messages, skipping the ones already imported.
+
+        The legacy files are only removed once the import is committed, so
+        some of them might have been imported by an interrupted migration.
+        """
+        cursor.execute("SELECT COALESCE(MAX(position), -1) FROM message")
+        position = cursor.fetchone()[0]
+        cursor.execute("SELECT id FROM message")
+        imported = set(id for id, in cursor.fetchall())
+        count = 0
+        for entry, data in messages:
+            if entry.id in imported:
+                continue
+            position += 1
+            count += 1
+            api = None if entry.api is None else sqlite3.Binary(entry.api)
+            cursor.execute(
+                "INSERT INTO message (id, position, type, api, held, broken,"
+                " data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry.id, position, entry.type, api,
+                 int(HELD in entry.flags), int(BROKEN in entry.flags),
+                 sqlite3.Binary(data)))
+        return count
+
+
+def has_stored_messages(directory):
+    """Tell whether C{directory} holds a database with stored messages.
+
+    @param directory: The directory of a L{SQLiteMessageStore}.
+    """
+    filename = os.path.join(directory, SQLiteMessageStore.database_name)
+    if not os.path.exists(filename):
+        return False
+    db = sqlite3.connect(filename)
+    try:
+        cursor = db.execute("SELECT COUNT(*) FROM message")
+        return cursor.fetchone()[0] > 0
+    except sqlite3.OperationalError:
+        # The database was created but the schema never got there.
+        return False
+    finally:
+        db.close()
+
+
+def ensure_message_schema(db):
+    """Create all tables needed by a L{SQLiteMessageStore}.
+
+    @param db: A connection to a SQLite database.
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS message"
+            " (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  position INTEGER NOT NULL, type TEXT, api BLOB,"
+            "  held INTEGER NOT NULL DEFAULT 0,"
+            "  broken INTEGER NOT NULL DEFAULT 0, data BLOB NOT NULL)")
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS message_position_idx ON "
+            "message(position)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS message_pending_idx ON "
+            "message(held, broken, position)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS message_type_idx ON "
+            "message(type, position)")
+    except (sqlite3.OperationalError, sqlite3.DatabaseError):
+        cursor.close()
+        db.rollback()
+    else:
+        cursor.close()
+        db.commit()
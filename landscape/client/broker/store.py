@@ -92,22 +92,48 @@ system and L{landscape.lib.message.got_next_expected} to check how the
 strategy for updating the pending offset and the sequence is implemented.
 """
 
+import bisect
+import heapq
 import itertools
 import logging
 import os
+import time
 import uuid
 
+from twisted.internet.defer import Deferred
 from twisted.python.compat import iteritems
+from twisted.python.failure import Failure
 
 from landscape import DEFAULT_SERVER_API
 from landscape.lib import bpickle
-from landscape.lib.fs import create_binary_file, read_binary_file
+from landscape.lib.fs import create_binary_file, read_binary_file, sync_path
+from landscape.lib.schema import InvalidError
 from landscape.lib.versioning import sort_versions, is_version_higher
 
 
 HELD = "h"
 BROKEN = "b"
 
+# The name of the file recording the type of the messages of a directory.
+# Older clients walking the message directories skip the ".tmp" files, so
+# they can still read the store after a downgrade.
+TYPES_FILENAME = "types.tmp"
+
+# Durability levels of the message store, see L{MessageStore}.
+DURABILITY_NONE = "none"
+DURABILITY_GROUP = "group"
+DURABILITY_PER_MESSAGE = "per-message"
+DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_GROUP, DURABILITY_PER_MESSAGE)
+
+# Eviction policies of the message quotas, see L{MessageQuota}.
+EVICT_OLDEST = "drop-oldest"
+EVICT_DOWNSAMPLE = "downsample"
+EVICTION_POLICIES = (EVICT_OLDEST, EVICT_DOWNSAMPLE)
+
+
+class MessageStoreError(Exception):
+    """Raised when a message store can't be opened safely."""
+
 
 class MessageStore(object):
     """A message store which stores its messages in a file system hierarchy.
@@ -122,9 +148,37 @@ class MessageStore(object):
     incremented when successfully receiving messages from the server, in the
     very same way described above but with the roles inverted.
 
+    Messages written with the C{"group"} durability level are synced to disk
+    in batches: the writes arriving within C{group_commit_window} seconds, or
+    up to C{group_commit_size} of them, are flushed together and every
+    directory they touched is synced only once. L{add} returns before the
+    batch is synced, so callers acknowledging a message to someone else wait
+    for L{when_synced} first. With C{"per-message"} each message is synced
+    before L{add} returns, and with C{"none"} the store never syncs and
+    relies on the operating system to flush its writes.
+
+    The type and API of each message are also appended to a C{types} file
+    in its directory, so that holding and unholding messages after a restart
+    doesn't require decoding them. The file is just a cache: messages missing
+    from it are decoded once, as needed.
+
+    Message types can be given a L{MessageQuota} with L{set_quota}, in
+    which case the messages of that type exceeding it are evicted as soon
+    as a new one is added, according to the policy of the quota. Messages
+    marked with L{mark_in_flight} are never evicted, and the newest message
+    of a type is always kept.
+
+    Similarly, a message whose schema is declared with C{coalesce=True}
+    replaces in place the newest message of the same type, as long as it
+    isn't marked as in flight, instead of being appended.
+
     @param persist: a L{Persist} used to save state parameters like the
         accepted message types, sequence, server uuid etc.
     @param directory: base of the file system hierarchy
+    @param durability: one of C{"none"}, C{"group"} or C{"per-message"}.
+    @param reactor: the reactor used to schedule the sync of a group of
+        messages. It's required by the C{"group"} durability level, stores
+        without one must select another level.
     """
 
     # The initial message API version that we use to communicate with the
@@ -134,18 +188,42 @@ class MessageStore(object):
     # in case the server supports it.
     _api = DEFAULT_SERVER_API
 
-    def __init__(self, persist, directory, directory_size=1000):
+    group_commit_size = 100
+    group_commit_window = 0.05
+
+    def __init__(self, persist, directory, directory_size=1000,
+                 durability=DURABILITY_GROUP, reactor=None):
+        assert durability in DURABILITY_LEVELS
+        assert durability != DURABILITY_GROUP or reactor is not None, (
+            "The group durability level needs a reactor.")
         self._directory = directory
         self._directory_size = directory_size
+        self._durability = durability
+        self._reactor = reactor
+        self._unsynced = []
+        self._sync_call = None
+        self._sync_waiters = []
+        self._revision = 0
+        self._types_file = None
+        self._types_directory = None
+        self._quotas = {}
+        self._eviction_stats = {}
+        self._sync_stats = {"batches": 0, "messages": 0, "max-batch-size": 0,
+                            "fsyncs": 0, "fsync-time": 0.0,
+                            "max-fsync-time": 0.0}
         self._schemas = {}
+        # The schema applied to messages of a type for a server API.
+        self._selected_schemas = {}
         self._original_persist = persist
         self._persist = persist.root_at("message-store")
         message_dir = self._message_dir()
         if not os.path.isdir(message_dir):
             os.makedirs(message_dir)
+        self._index = self._build_index()
 
     def commit(self):
         """Persist metadata to disk."""
+        self.flush()
         self._original_persist.save()
 
     def set_accepted_types(self, types):
@@ -157,6 +235,7 @@ class MessageStore(object):
         """
         assert type(types) in (tuple, list, set)
         self._persist.set("accepted-types", sorted(set(types)))
+        self._revision += 1
         self._reprocess_holding()
 
     def get_accepted_types(self):
@@ -227,6 +306,8 @@ class MessageStore(object):
         All messages added to the store after calling this method will be
         tagged with the given server API version.
         """
+        if server_api != self.get_server_api():
+            self._revision += 1
         self._persist.set("server_api", server_api)
 
     def get_exchange_token(self):
@@ -253,59 +334,130 @@ class MessageStore(object):
         """Increment the current pending offset by C{val}."""
         self.set_pending_offset(self.get_pending_offset() + val)
 
+    def get_in_flight_offset(self):
+        """Get the offset past the last message handed out for delivery."""
+        return self._persist.get("in_flight_offset", 0)
+
+    def mark_in_flight(self, offset):
+        """Mark the messages before C{offset} as handed out for delivery.
+
+        Those messages might be in flight until the server acknowledges them,
+        so they're neither evicted nor replaced by a coalesced message. The
+        offset is relative to the same message as the pending offset, and
+        it is persisted so the messages stay protected across restarts.
+
+        @param offset: The offset past the last message of the payload being
+            sent, or 0 once the exchange is over.
+        """
+        self._persist.set("in_flight_offset", offset)
+
     def count_pending_messages(self):
         """Return the number of pending messages."""
-        return sum(1 for x in self._walk_pending_messages())
+        return max(0, self._index.count_active() - self.get_pending_offset())
+
+    def get_revision(self):
+        """Return a number which changes when pending messages do.
+
+        It changes whenever pending messages are replaced, evicted, held or
+        released, or deleted altogether, but not when messages are queued
+        after them or delivered.
+        """
+        return self._revision
 
     def get_pending_messages(self, max=None):
         """Get any pending messages that aren't being held, up to max."""
+        return [message for api, data, message in self._get_pending(max)]
+
+    def get_pending_message_data(self, max=None, max_bytes=None, offset=0):
+        """Get the bpickled data of the pending messages, up to max.
+
+        This is like L{get_pending_messages}, except that messages whose
+        type and API are already known don't get decoded.
+
+        @param max_bytes: If not C{None}, stop before the total size of the
+            returned data exceeds it.  The first pending message is always
+            returned, whatever its size.
+        @param offset: The number of pending messages to skip, for example
+            the ones of the exchange in flight.
+        @return: A C{list} of C{(api, data)} tuples.
+        """
+        return [(api, data) for api, data, message
+                in self._get_pending(max, decode=False, max_bytes=max_bytes,
+                                     offset=offset)]
+
+    def _get_pending(self, max, decode=True, max_bytes=None, offset=0):
+        """Walk the pending messages, holding and flagging them as needed.
+
+        @param decode: Whether to decode all messages, or only the ones
+            whose type and API are still unknown.
+        @param max_bytes: The maximum total size of the returned data.
+        @param offset: The number of pending messages to skip.
+        @return: A C{list} of C{(api, data, message)} tuples, where
+            C{message} is C{None} if it wasn't decoded.
+        """
         accepted_types = self.get_accepted_types()
         server_api = self.get_server_api()
         messages = []
-        for filename in self._walk_pending_messages():
+        total_bytes = 0
+        for entry in self._index.pending(self.get_pending_offset() + offset):
             if max is not None and len(messages) >= max:
                 break
-            data = read_binary_file(self._message_dir(filename))
+            if entry.type is not None and (
+                    entry.type not in accepted_types or
+                    not is_version_higher(server_api, entry.api)):
+                # We already know that the message must be held, there's no
+                # need to read it.
+                self._add_flags(entry, HELD)
+                continue
+            data = self._read_message(entry)
+            if (max_bytes is not None and messages and
+                    total_bytes + len(data) > max_bytes):
+                break
+            if not decode and entry.type is not None:
+                if not is_well_formed(data):
+                    logging.error("Found a corrupted message, skipping it.")
+                    self._add_flags(entry, BROKEN)
+                    continue
+                messages.append((entry.api, data, None))
+                total_bytes += len(data)
+                continue
             try:
-                # don't reinterpret messages that are meant to be sent out
-                message = bpickle.loads(data, as_is=True)
+                # don't reinterpret messages that are meant to be sent out,
+                # and only decode what's needed of them
+                message = decode_legacy_message(
+                    bpickle.loads_lazy(data, as_is=True))
+                message_type, message_api = message["type"], message["api"]
             except ValueError as e:
                 logging.exception(e)
-                self._add_flags(filename, BROKEN)
+                self._add_flags(entry, BROKEN)
             else:
-                if u"type" not in message:
-                    # Special case to decode keys for messages which were
-                    # serialized by py27 prior to py3 upgrade, and having
-                    # implicit byte message keys. Message may still get
-                    # rejected by the server, but it won't block the client
-                    # broker. (lp: #1718689)
-                    message = {
-                        (k if isinstance(k, str) else k.decode("ascii")): v
-                        for k, v in message.items()}
-                    message[u"type"] = message[u"type"].decode("ascii")
-
-                unknown_type = message["type"] not in accepted_types
-                unknown_api = not is_version_higher(server_api, message["api"])
+                self._index.set_type(entry, message_type, message_api)
+                self._remember_type(entry)
+                unknown_type = message_type not in accepted_types
+                unknown_api = not is_version_higher(server_api, message_api)
                 if unknown_type or unknown_api:
-                    self._add_flags(filename, HELD)
+                    self._add_flags(entry, HELD)
                 else:
-                    messages.append(message)
+                    messages.append((message_api, data, message))
+                    total_bytes += len(data)
         return messages
 
     def delete_old_messages(self):
         """Delete messages which are unlikely to be needed in the future."""
-        for fn in itertools.islice(self._walk_messages(exclude=HELD + BROKEN),
-                                   self.get_pending_offset()):
-            os.unlink(fn)
-            containing_dir = os.path.split(fn)[0]
-            if not os.listdir(containing_dir):
-                os.rmdir(containing_dir)
+        for entry in list(itertools.islice(self._index.pending(0),
+                                           self.get_pending_offset())):
+            self._delete_entry(entry)
 
     def delete_all_messages(self):
         """Remove ALL stored messages."""
         self.set_pending_offset(0)
-        for filename in self._walk_messages():
-            os.unlink(filename)
+        self.mark_in_flight(0)
+        self._revision += 1
+        for entry in self._index.walk():
+            os.unlink(self._get_filename(entry))
+            self._index.remove(entry)
+        for dirname in self._get_sorted_filenames():
+            self._remove_types_file(int(dirname))
 
     def add_schema(self, schema):
         """Add a schema to be applied to messages of the given type.
@@ -316,28 +468,41 @@ class MessageStore(object):
         api = schema.api if schema.api else self._api
         schemas = self._schemas.setdefault(schema.type, {})
         schemas[api] = schema
+        self._selected_schemas.clear()
 
     def is_pending(self, message_id):
         """Return bool indicating if C{message_id} still hasn't been delivered.
 
         @param message_id: Identifier returned by the L{add()} method.
         """
-        i = 0
-        pending_offset = self.get_pending_offset()
-        for filename in self._walk_messages(exclude=BROKEN):
-            flags = self._get_flags(filename)
-            if ((HELD in flags or i >= pending_offset) and
-                os.stat(filename).st_ino == message_id
-                ):
-                return True
-            if BROKEN not in flags and HELD not in flags:
-                i += 1
-        return False
+        entry = self._index.get(message_id)
+        if entry is None or BROKEN in entry.flags:
+            return False
+        if HELD in entry.flags:
+            return True
+        return self._index.rank(entry) >= self.get_pending_offset()
+
+    def get_exchange_backoff(self):
+        """Get the state of the backoff after failed exchanges.
+
+        @return: A C{(delay, retry_time)} tuple with the number of seconds
+            waited after the last failed exchange and the time of the next
+            attempt, or C{(0, None)} if the last exchange didn't fail.
+        """
+        return (self._persist.get("exchange-backoff", 0),
+                self._persist.get("exchange-retry-time"))
+
+    def set_exchange_backoff(self, delay, retry_time):
+        """Set the state of the backoff after a failed exchange."""
+        self._persist.set("exchange-backoff", delay)
+        self._persist.set("exchange-retry-time", retry_time)
 
     def record_success(self, timestamp):
         """Record a successful exchange."""
         self._persist.remove("first-failure-time")
         self._persist.remove("blackhole-messages")
+        self._persist.remove("exchange-backoff")
+        self._persist.remove("exchange-retry-time")
 
     def record_failure(self, timestamp):
         """
@@ -373,6 +538,70 @@ class MessageStore(object):
             logging.debug("Dropped message, awaiting resync.")
             return
 
+        message = self._coerce_message(message)
+        message_data = bpickle.dumps(message)
+        message_id = self._coalesce_message(message, message_data)
+        if message_id is None:
+            message_id = self._store_message(message, message_data)
+        self._enforce_quota(message["type"])
+        return message_id
+
+    def add_messages(self, messages):
+        """Queue several messages for delivery at once.
+
+        Each message is validated on its own: the ones which don't conform
+        to their schema are logged and dropped, while the others are queued.
+
+        @param messages: A C{list} of messages, as accepted by L{add}.
+        @return: A C{list} with the message_id of each message, or C{None}
+            for the messages which were invalid. C{None} is returned instead
+            of the list if the messages were all rejected, awaiting a resync.
+        """
+        for message in messages:
+            assert "type" in message
+        if self._persist.get("blackhole-messages"):
+            logging.debug("Dropped %d messages, awaiting resync.",
+                          len(messages))
+            return
+        message_ids = [None] * len(messages)
+        items = []
+        for i, message in enumerate(messages):
+            try:
+                message = self._coerce_message(message)
+            except InvalidError as error:
+                logging.error("Dropped an invalid %s message: %s",
+                              message["type"], error)
+                continue
+            items.append((i, message, bpickle.dumps(message)))
+        batch = []
+
+        def store_batch():
+            stored_ids = self._store_messages(
+                [(message, message_data) for _, message, message_data
+                 in batch])
+            for (i, _, _), message_id in zip(batch, stored_ids):
+                message_ids[i] = message_id
+            del batch[:]
+
+        for i, message, message_data in items:
+            if self._is_coalesced(message["type"]):
+                # Store what comes before first, so the message to replace
+                # can be found and the order of the messages is kept.
+                store_batch()
+                message_id = self._coalesce_message(message, message_data)
+                if message_id is None:
+                    message_id = self._store_message(message, message_data)
+                message_ids[i] = message_id
+            else:
+                batch.append((i, message, message_data))
+        if batch:
+            store_batch()
+        for message_type in set(message["type"] for _, message, _ in items):
+            self._enforce_quota(message_type)
+        return message_ids
+
+    def _coerce_message(self, message):
+        """Tag C{message} with an API version and apply its schema."""
         server_api = self.get_server_api()
 
         if "api" not in message:
@@ -380,75 +609,573 @@ class MessageStore(object):
 
         # We apply the schema with the highest API version that is greater
         # or equal to the API version the message is tagged with.
-        schemas = self._schemas[message["type"]]
-        for api in sort_versions(schemas.keys()):
-            if is_version_higher(server_api, api):
-                schema = schemas[api]
-                break
-        message = schema.coerce(message)
+        key = (message["type"], server_api)
+        schema = self._selected_schemas.get(key)
+        if schema is None:
+            schemas = self._schemas[message["type"]]
+            for api in sort_versions(schemas.keys()):
+                if is_version_higher(server_api, api):
+                    schema = schemas[api]
+                    break
+            self._selected_schemas[key] = schema
+        return schema.coerce(message)
+
+    def _is_coalesced(self, message_type):
+        """Whether a message of the given type replaces a pending one."""
+        return any(schema.coalesce
+                   for schema in self._schemas[message_type].values())
+
+    def _coalesce_message(self, message, message_data):
+        """Replace the pending message superseded by C{message}, if any.
+
+        @return: The message id of the replacing message, or C{None} if no
+            message was replaced and C{message} is still to be stored.
+        """
+        if not self._is_coalesced(message["type"]):
+            return None
+        message_id = self._get_replaceable_message(message["type"])
+        if message_id is None:
+            return None
+        logging.debug("Replacing a pending %s message.", message["type"])
+        self._revision += 1
+        return self._replace_message(message_id, message, message_data)
+
+    def _get_replaceable_message(self, message_type):
+        """Return the id of the message a new one of C{message_type} can
+        replace, or C{None}.
+
+        That's the newest message of the type, if it's neither broken nor
+        before the offset marked with L{mark_in_flight}.
+        """
+        entry = self._index.newest_of_type(message_type)
+        if entry is None or BROKEN in entry.flags:
+            return None
+        if not self._is_evictable(entry, self._get_protected_offset()):
+            return None
+        return entry.id
 
-        message_data = bpickle.dumps(message)
+    def _replace_message(self, message_id, message, message_data):
+        """Overwrite the message with the given id, keeping its position.
 
-        filename = self._get_next_message_filename()
+        @return: The new message id of the message.
+        """
+        old_entry = self._index.get(message_id)
+        filename = self._get_filename(old_entry)
+        self._write_message_file(filename, message_data)
+        self._index.remove(old_entry)
+        entry = MessageEntry(old_entry.directory, old_entry.number,
+                             old_entry.flags, os.stat(filename).st_ino,
+                             message["type"], message["api"],
+                             len(message_data))
+        self._index.add(entry)
+        self._remember_type(entry)
+        if self._durability == DURABILITY_GROUP:
+            self._unsynced.append(entry)
+            self._schedule_flush()
+        return entry.id
+
+    def _write_message_file(self, filename, message_data):
+        """Atomically write C{message_data} to C{filename}."""
         temp_path = filename + ".tmp"
-        create_binary_file(temp_path, message_data)
+        per_message = self._durability == DURABILITY_PER_MESSAGE
+        if per_message:
+            start = time.time()
+        create_binary_file(temp_path, message_data, sync=per_message)
         os.rename(temp_path, filename)
+        if per_message:
+            sync_path(os.path.dirname(filename))
+            self._record_sync(1, 2, time.time() - start)
 
-        if not self.accepts(message["type"]):
-            filename = self._set_flags(filename, HELD)
+    def _store_message(self, message, message_data):
+        """Write the already coerced and bpickled message to the store.
+
+        @return: The message id of the stored message.
+        """
+        directory, number = self._get_next_message_key()
+        filename = self._message_dir(str(directory), str(number))
+        self._write_message_file(filename, message_data)
 
         # For now we use the inode as the message id, as it will work
         # correctly even faced with holding/unholding.  It will break
         # if the store is copied over for some reason, but this shouldn't
-        # present an issue given the current uses.  In the future we
-        # should have a nice transactional storage (e.g. sqlite) which
-        # will offer a more strong primary key.
-        message_id = os.stat(filename).st_ino
+        # present an issue given the current uses.  See SQLiteMessageStore
+        # for an engine offering a stronger primary key.
+        entry = MessageEntry(directory, number, "", os.stat(filename).st_ino,
+                             message["type"], message["api"],
+                             len(message_data))
+        self._index.add(entry)
+        self._remember_type(entry)
 
-        return message_id
+        if not self.accepts(message["type"]):
+            self._set_flags(entry, HELD)
+
+        if self._durability == DURABILITY_GROUP:
+            self._unsynced.append(entry)
+            self._schedule_flush()
+
+        return entry.id
+
+    def _schedule_flush(self):
+        """Flush the unsynced messages if enough of them are waiting.
 
-    def _get_next_message_filename(self):
-        message_dirs = self._get_sorted_filenames()
-        if message_dirs:
-            newest_dir = message_dirs[-1]
+        Otherwise make sure that they'll be flushed at the end of the group
+        commit window.
+        """
+        if len(self._unsynced) >= self.group_commit_size:
+            self.flush()
+        elif self._reactor is not None and self._sync_call is None:
+            self._sync_call = self._reactor.call_later(
+                self.group_commit_window, self.flush)
+
+    def when_synced(self, result):
+        """Return C{result} once the messages added so far are on disk.
+
+        @return: C{result} itself if no message is waiting to be synced,
+            otherwise a L{Deferred} firing with it after the next flush.
+        """
+        if not self._unsynced:
+            return result
+        deferred = Deferred()
+        self._sync_waiters.append(deferred)
+        return deferred.addCallback(lambda ignored: result)
+
+    def flush(self):
+        """Sync to disk the messages added since the last flush.
+
+        The L{Deferred}s returned by L{when_synced} fire afterwards, or fail
+        if the messages couldn't be synced.
+        """
+        if self._sync_call is not None:
+            self._reactor.cancel_call(self._sync_call)
+            self._sync_call = None
+        if not self._unsynced:
+            return
+        waiters, self._sync_waiters = self._sync_waiters, []
+        try:
+            self._sync()
+        except Exception:
+            failure = Failure()
+            for deferred in waiters:
+                deferred.errback(failure)
+            raise
+        for deferred in waiters:
+            deferred.callback(None)
+
+    def _sync(self):
+        """Sync the messages waiting to be synced.
+
+        The data of each message is synced first, and then the directories
+        holding them, each of them only once.
+        """
+        entries, self._unsynced = self._unsynced, []
+        start = time.time()
+        fsyncs = 0
+        directories = set()
+        for entry in entries:
+            if self._index.get(entry.id) is not entry:
+                # The message was deleted in the meantime.
+                continue
+            filename = self._get_filename(entry)
+            sync_path(filename)
+            directories.add(os.path.dirname(filename))
+            fsyncs += 1
+        for directory in directories:
+            sync_path(directory)
+            fsyncs += 1
+        elapsed = time.time() - start
+        self._record_sync(len(entries), fsyncs, elapsed)
+        logging.debug("Synced %d messages to disk in %.3f seconds.",
+                      len(entries), elapsed)
+
+    def get_sync_stats(self):
+        """Return counters about the messages synced to disk so far.
+
+        @return: A C{dict} with the number of synced C{batches} and
+            C{messages}, the C{max-batch-size}, the number of C{fsyncs} and
+            their total and maximum latency per batch, C{fsync-time} and
+            C{max-fsync-time}, in seconds.
+        """
+        return dict(self._sync_stats)
+
+    def set_quota(self, message_type, quota):
+        """Bound the number and size of the stored messages of a type.
+
+        @param message_type: The type of the messages to bound.
+        @param quota: A L{MessageQuota}, or C{None} to remove the quota.
+        """
+        if quota is None:
+            self._quotas.pop(message_type, None)
         else:
-            os.makedirs(self._message_dir("0"))
-            newest_dir = "0"
-
-        message_filenames = self._get_sorted_filenames(newest_dir)
-        if not message_filenames:
-            filename = self._message_dir(newest_dir, "0")
-        elif len(message_filenames) < self._directory_size:
-            filename = str(int(message_filenames[-1].split("_")[0]) + 1)
-            filename = self._message_dir(newest_dir, filename)
+            self._quotas[message_type] = quota
+            self._enforce_quota(message_type)
+
+    def get_quota(self, message_type):
+        """Return the L{MessageQuota} of C{message_type}, or C{None}."""
+        return self._quotas.get(message_type)
+
+    def get_eviction_stats(self):
+        """Return counters about the messages evicted because of quotas.
+
+        @return: A C{dict} mapping message types to C{dict}s with the number
+            of evicted C{messages} and their total size in C{bytes}.
+        """
+        return dict((message_type, dict(stats))
+                    for message_type, stats in iteritems(self._eviction_stats))
+
+    def _enforce_quota(self, message_type):
+        """Evict messages of C{message_type} until its quota is honored."""
+        quota = self._quotas.get(message_type)
+        if quota is None:
+            return
+        count, size = self._get_usage(message_type)
+        if not quota.is_exceeded(count, size):
+            return
+        evictable = self._get_evictable_messages(message_type)
+        if quota.policy == EVICT_DOWNSAMPLE:
+            victims = self._downsample(
+                quota, count, size, list(evictable),
+                self._get_newest_position(message_type))
         else:
-            newest_dir = self._message_dir(str(int(newest_dir) + 1))
-            os.makedirs(newest_dir)
-            filename = os.path.join(newest_dir, "0")
+            victims = []
+            for id, message_size, position in evictable:
+                if not quota.is_exceeded(count, size):
+                    break
+                victims.append((id, message_size))
+                count -= 1
+                size -= message_size
+        if not victims:
+            return
+        self._revision += 1
+        self._evict_messages([id for id, message_size in victims])
+        stats = self._eviction_stats.setdefault(
+            message_type, {"messages": 0, "bytes": 0})
+        stats["messages"] += len(victims)
+        stats["bytes"] += sum(message_size for id, message_size in victims)
+        logging.info("Evicted %d %s messages over their quota.",
+                     len(victims), message_type)
+
+    def _downsample(self, quota, count, size, evictable, newest_position):
+        """Pick the messages to evict to honor C{quota} by thinning a series.
+
+        The message whose neighbours are the closest to each other is
+        evicted first, until the quota is honored, so the messages left are
+        spread evenly over the whole span of the series. Ties go to the
+        older messages. The oldest message is only evicted last, when it's
+        the only evictable one left.
+
+        @param evictable: The C{(message_id, size, position)} tuples of the
+            evictable messages, in queue order.
+        @param newest_position: The position of the newest message of the
+            series, which is never evicted.
+        @return: A C{list} of C{(message_id, size)} tuples.
+        """
+        positions = [position for id, message_size, position in evictable]
+        positions.append(newest_position)
+        # The evictable messages are kept in a linked list, so that evicting
+        # one of them only changes the gaps of its two neighbours. The gaps
+        # are kept in a heap, and the entries made stale by an eviction are
+        # skipped when they come up.
+        previous = list(range(-1, len(evictable)))
+        following = list(range(1, len(positions) + 1))
+        gaps = [(positions[index + 1] - positions[index - 1], index)
+                for index in range(1, len(evictable))]
+        heapq.heapify(gaps)
+        left = len(evictable)
+        victims = []
+        while left and quota.is_exceeded(count, size):
+            index = 0
+            while gaps:
+                gap, candidate = heapq.heappop(gaps)
+                if (previous[candidate] is not None and
+                        gap == self._get_gap(positions, previous, following,
+                                             candidate)):
+                    index = candidate
+                    break
+            id, message_size, position = evictable[index]
+            before, after = previous[index], following[index]
+            if before >= 0:
+                following[before] = after
+            previous[after] = before
+            previous[index] = None
+            for neighbour in (before, after):
+                if 0 < neighbour < len(evictable):
+                    heapq.heappush(gaps, (self._get_gap(
+                        positions, previous, following, neighbour), neighbour))
+            victims.append((id, message_size))
+            left -= 1
+            count -= 1
+            size -= message_size
+        return victims
+
+    def _get_gap(self, positions, previous, following, index):
+        """Return the span between the neighbours of a message in a series.
+
+        See L{_downsample} for the parameters.
+        """
+        return positions[following[index]] - positions[previous[index]]
 
-        return filename
+    def _get_usage(self, message_type):
+        """Return the number and total size of the messages of a type."""
+        return (self._index.count_type(message_type),
+                self._index.size_type(message_type))
 
-    def _walk_pending_messages(self):
-        """Walk the files which are definitely pending."""
-        pending_offset = self.get_pending_offset()
-        for i, filename in enumerate(
-                self._walk_messages(exclude=HELD + BROKEN)):
-            if i >= pending_offset:
-                yield filename
+    def _get_evictable_messages(self, message_type):
+        """Generate the messages of a type which can be evicted.
+
+        Those are the messages which were never handed out for delivery,
+        plus the held and broken ones, except for the newest message.
+
+        @return: A generator of C{(message_id, size, position)} tuples, in
+            queue order. See L{_get_position} for the positions.
+        """
+        offset = self._get_protected_offset()
+        entries = itertools.islice(self._index.of_type(message_type),
+                                   self._index.count_type(message_type) - 1)
+        for entry in entries:
+            if self._is_evictable(entry, offset):
+                yield entry.id, entry.size, self._get_position(entry)
+
+    def _get_newest_position(self, message_type):
+        """Return the position of the newest message of a type."""
+        return self._get_position(self._index.newest_of_type(message_type))
+
+    def _get_position(self, entry):
+        """Return the position of C{entry} among all the stored messages.
+
+        Positions grow as messages are added, and the distance between two
+        of them tells roughly how many messages were added in between. It's
+        only approximate across directories, since the numbers of a
+        directory keep growing past C{directory_size} when some of its
+        messages got deleted before it was filled.
+        """
+        return entry.directory * self._directory_size + entry.number
+
+    def _get_protected_offset(self):
+        """Return the offset of the first active message which was never
+        handed out for delivery.
+
+        Active messages before it are either delivered already, or part of
+        a payload which might still be in flight.
+        """
+        return max(self.get_pending_offset(), self.get_in_flight_offset())
+
+    def _is_evictable(self, entry, offset):
+        """Whether C{entry} was never handed out for delivery.
+
+        @param offset: The offset returned by L{_get_protected_offset}.
+        """
+        if not entry.is_active():
+            return True
+        return self._index.rank(entry) >= offset
+
+    def _evict_messages(self, message_ids):
+        """Delete the messages with the given ids."""
+        for message_id in message_ids:
+            entry = self._index.get(message_id)
+            if entry.type is not None and self._index.count_directory(
+                    entry.directory) > 1:
+                # The number of the message could be reused, so its record
+                # in the types file must not be trusted anymore.
+                self._forget_type(entry)
+            self._delete_entry(entry)
+
+    def _delete_entry(self, entry):
+        """Delete the message of C{entry}, and its directory if emptied."""
+        os.unlink(self._get_filename(entry))
+        self._index.remove(entry)
+        if not self._index.count_directory(entry.directory):
+            self._remove_types_file(entry.directory)
+            containing_dir = self._message_dir(str(entry.directory))
+            if not os.listdir(containing_dir):
+                os.rmdir(containing_dir)
+                self._index.remove_directory(entry.directory)
+
+    def _record_sync(self, messages, fsyncs, elapsed):
+        stats = self._sync_stats
+        stats["batches"] += 1
+        stats["messages"] += messages
+        stats["max-batch-size"] = max(stats["max-batch-size"], messages)
+        stats["fsyncs"] += fsyncs
+        stats["fsync-time"] += elapsed
+        stats["max-fsync-time"] = max(stats["max-fsync-time"], elapsed)
+
+    def _store_messages(self, items):
+        """Write several already coerced and bpickled messages to the store.
+
+        @param items: A C{list} of C{(message, message_data)} tuples.
+        @return: The list of message ids of the stored messages.
+        """
+        return [self._store_message(message, message_data)
+                for message, message_data in items]
+
+    def _get_next_message_key(self):
+        """Return the directory and file numbers to use for a new message."""
+        newest_dir = self._index.get_newest_directory()
+        if newest_dir is None:
+            newest_dir = 0
+            self._create_directory(newest_dir)
+
+        count = self._index.count_directory(newest_dir)
+        if count == 0:
+            return newest_dir, 0
+        elif count < self._directory_size:
+            # The newest directory isn't empty, so the last message in the
+            # index is stored in it.
+            return newest_dir, self._index.last().number + 1
+        else:
+            newest_dir += 1
+            self._create_directory(newest_dir)
+            return newest_dir, 0
+
+    def _create_directory(self, directory):
+        """Create the numbered directory that will hold the next messages."""
+        os.makedirs(self._message_dir(str(directory)))
+        self._index.add_directory(directory)
+        if self._durability != DURABILITY_NONE:
+            sync_path(self._message_dir())
+
+    def _build_index(self):
+        """Build the L{MessageIndex} of the messages found on disk.
+
+        This is the only time the message directories get listed, after that
+        the index is kept up to date as messages are added, renamed and
+        deleted.
+        """
+        index = MessageIndex()
+        for message_dir in self._get_sorted_filenames():
+            index.add_directory(int(message_dir))
+            types = self._read_types_file(message_dir)
+            for filename in self._get_sorted_filenames(message_dir):
+                path = self._message_dir(message_dir, filename)
+                number = int(filename.split("_")[0])
+                stat = os.stat(path)
+                entry = MessageEntry(int(message_dir), number,
+                                     self._get_flags(filename), stat.st_ino,
+                                     size=stat.st_size)
+                # Only trust the recorded type if the file is the same one,
+                # since numbers get reused when directories are recreated.
+                if types.get(number, (None,))[0] == entry.id:
+                    entry.type, entry.api = types[number][1:]
+                index.add(entry)
+        return index
+
+    def _read_types_file(self, message_dir):
+        """Return the types recorded in the C{types} file of a directory.
+
+        @return: A C{dict} mapping message numbers to C{(inode, type, api)}
+            tuples, where later records win over earlier ones.
+        """
+        types = {}
+        path = self._message_dir(message_dir, TYPES_FILENAME)
+        if not os.path.isfile(path):
+            return types
+        for line in read_binary_file(path).splitlines():
+            fields = line.split()
+            if len(fields) != 4:
+                # Most likely a line cut short by a crash.
+                continue
+            number, inode, message_type, api = fields
+            types[int(number)] = (int(inode), message_type.decode("ascii"),
+                                  api)
+        return types
+
+    def _remember_type(self, entry):
+        """Record the type and API of C{entry} in its C{types} file."""
+        record = "%d %d %s " % (entry.number, entry.id, entry.type)
+        self._write_types_record(entry.directory, record.encode("ascii") +
+                                 entry.api + b"\n")
+
+    def _forget_type(self, entry):
+        """Invalidate the record of C{entry} in its C{types} file.
+
+        The record is overridden by one with an inode that no file has.
+        """
+        record = "%d 0 - -\n" % (entry.number,)
+        self._write_types_record(entry.directory, record.encode("ascii"))
+
+    def _write_types_record(self, directory, record):
+        if self._types_directory != directory:
+            if self._types_file is not None:
+                self._types_file.close()
+            self._types_file = open(self._message_dir(
+                str(directory), TYPES_FILENAME), "ab")
+            self._types_directory = directory
+        self._types_file.write(record)
+        self._types_file.flush()
+
+    def _remove_types_file(self, directory):
+        """Remove the C{types} file of the given directory, if any."""
+        if self._types_directory == directory:
+            self._types_file.close()
+            self._types_file = None
+            self._types_directory = None
+        path = self._message_dir(str(directory), TYPES_FILENAME)
+        if os.path.isfile(path):
+            os.unlink(path)
+
+    def _read_message(self, entry):
+        """Return the bpickled data of the message of C{entry}."""
+        return read_binary_file(self._get_filename(entry))
+
+    def _read_directory_layout(self, index):
+        """Generate the messages stored in the numbered directories.
+
+        This is used by the other storage engines to convert an existing
+        file system layout.
+
+        @param index: The L{MessageIndex} of the file system layout, as
+            built by L{MessageStore._build_index}.
+        @return: A generator of C{(entry, data)} tuples, in queue order. The
+            generated entries are copies of the ones in C{index} with their
+            type and API filled in, and with the messages that can't be
+            decoded flagged as broken.
+        """
+        for entry in index.walk():
+            data = read_binary_file(self._get_filename(entry))
+            flags = entry.flags
+            message_type = api = None
+            try:
+                message = decode_legacy_message(
+                    bpickle.loads_lazy(data, as_is=True))
+                message_type = message["type"]
+                api = message["api"]
+            except (ValueError, KeyError):
+                flags = "".join(sorted(set(flags + BROKEN)))
+            yield MessageEntry(entry.directory, entry.number, flags,
+                               entry.id, message_type, api), data
+
+    def _remove_directory_layout(self, index):
+        """Remove all the numbered directories and the messages they hold.
+
+        @param index: The L{MessageIndex} of the file system layout.
+        """
+        for entry in index.walk():
+            os.unlink(self._get_filename(entry))
+        for dirname in self._get_sorted_filenames():
+            self._remove_types_file(int(dirname))
+            os.rmdir(self._message_dir(dirname))
 
     def _walk_messages(self, exclude=None):
         if exclude:
             exclude = set(exclude)
-        message_dirs = self._get_sorted_filenames()
-        for message_dir in message_dirs:
-            for filename in self._get_sorted_filenames(message_dir):
-                flags = set(self._get_flags(filename))
-                if (not exclude or not exclude & flags):
-                    yield self._message_dir(message_dir, filename)
+        for entry in self._index.walk():
+            if not exclude or not exclude & set(entry.flags):
+                yield self._get_filename(entry)
+
+    def _get_filename(self, entry, flags=None):
+        """Return the path of the file holding the message of C{entry}."""
+        if flags is None:
+            flags = entry.flags
+        filename = str(entry.number)
+        if flags:
+            filename += "_" + flags
+        return self._message_dir(str(entry.directory), filename)
 
     def _get_sorted_filenames(self, dir=""):
+        # Only consider numbered entries, skipping temporary files and
+        # any other file that may live in the store directory.
         message_files = [x for x in os.listdir(self._message_dir(dir))
-                         if not x.endswith(".tmp")]
+                         if x.split("_")[0].isdigit()]
         message_files.sort(key=lambda x: int(x.split("_")[0]))
         return message_files
 
@@ -459,29 +1186,50 @@ class MessageStore(object):
         """
         Unhold accepted messages left behind, and hold unaccepted
         pending messages.
+
+        The decisions are based on the message types kept in the index, so
+        only messages whose type was never seen need to be decoded. They're
+        then applied in bulk, renaming files without rewriting them.
         """
         offset = 0
         pending_offset = self.get_pending_offset()
         accepted_types = self.get_accepted_types()
-        for old_filename in self._walk_messages():
-            flags = self._get_flags(old_filename)
-            try:
-                message = bpickle.loads(read_binary_file(old_filename))
-            except ValueError as e:
-                logging.exception(e)
-                if HELD not in flags:
-                    offset += 1
+        hold = []
+        unhold = []
+        for entry in self._index.walk():
+            flags = entry.flags
+            if entry.type is None:
+                message = None
+                if BROKEN not in flags:
+                    # Messages known to be broken aren't read again.
+                    try:
+                        message = decode_legacy_message(bpickle.loads_lazy(
+                            self._read_message(entry), as_is=True))
+                        message_type = message["type"]
+                        message_api = message["api"]
+                    except ValueError as e:
+                        logging.exception(e)
+                        message = None
+                if message is None:
+                    if HELD not in flags:
+                        offset += 1
+                    continue
+                self._index.set_type(entry, message_type, message_api)
+                self._remember_type(entry)
+            accepted = entry.type in accepted_types
+            if HELD in flags:
+                if accepted:
+                    unhold.append(entry)
             else:
-                accepted = message["type"] in accepted_types
-                if HELD in flags:
-                    if accepted:
-                        new_filename = self._get_next_message_filename()
-                        os.rename(old_filename, new_filename)
-                        self._set_flags(new_filename, set(flags) - set(HELD))
-                else:
-                    if not accepted and offset >= pending_offset:
-                        self._set_flags(old_filename, set(flags) | set(HELD))
-                    offset += 1
+                if not accepted and offset >= pending_offset:
+                    hold.append(entry)
+                offset += 1
+        for entry in hold:
+            self._set_flags(entry, set(entry.flags) | set(HELD))
+        # Unheld messages are moved at the end of the queue, in the same
+        # order they had before.
+        for entry in unhold:
+            self._move_to_end(entry, set(entry.flags) - set(HELD))
 
     def _get_flags(self, path):
         basename = os.path.basename(path)
@@ -489,16 +1237,23 @@ class MessageStore(object):
             return basename.split("_")[1]
         return ""
 
-    def _set_flags(self, path, flags):
-        dirname, basename = os.path.split(path)
-        new_path = os.path.join(dirname, basename.split("_")[0])
-        if flags:
-            new_path += "_" + "".join(sorted(set(flags)))
-        os.rename(path, new_path)
-        return new_path
+    def _set_flags(self, entry, flags):
+        flags = "".join(sorted(set(flags)))
+        os.rename(self._get_filename(entry), self._get_filename(entry, flags))
+        self._index.set_flags(entry, flags)
+
+    def _add_flags(self, entry, flags):
+        self._set_flags(entry, entry.flags + flags)
 
-    def _add_flags(self, path, flags):
-        self._set_flags(path, self._get_flags(path) + flags)
+    def _move_to_end(self, entry, flags):
+        """Move the message of C{entry} at the end of the queue."""
+        old_filename = self._get_filename(entry)
+        self._index.remove(entry)
+        entry.directory, entry.number = self._get_next_message_key()
+        entry.flags = "".join(sorted(set(flags)))
+        os.rename(old_filename, self._get_filename(entry))
+        self._index.add(entry)
+        self._remember_type(entry)
 
     def get_session_id(self, scope=None):
         """Generate a unique session identifier, persist it and return it.
@@ -544,12 +1299,344 @@ class MessageStore(object):
         self._persist.set("session-ids", new_session_ids)
 
 
-def get_default_message_store(*args, **kwargs):
+class MessageEntry(object):
+    """A message tracked by a L{MessageIndex}.
+
+    @ivar directory: The number of the directory holding the message file.
+    @ivar number: The number of the message file within its directory.
+    @ivar flags: The flags of the message, such as L{HELD} or L{BROKEN}.
+    @ivar id: The message id, i.e. the inode of the message file.
+    @ivar type: The message type, or C{None} if it's not known yet.
+    @ivar api: The message API, or C{None} if it's not known yet.
+    @ivar size: The size of the bpickled message, in bytes.
+    """
+
+    __slots__ = ("directory", "number", "flags", "id", "type", "api", "size")
+
+    def __init__(self, directory, number, flags, id, type=None, api=None,
+                 size=0):
+        self.directory = directory
+        self.number = number
+        self.flags = flags
+        self.id = id
+        self.type = type
+        self.api = api
+        self.size = size
+
+    @property
+    def key(self):
+        """The sort key of the message, giving its position in the queue."""
+        return (self.directory, self.number)
+
+    def is_active(self):
+        """Whether the message is neither held nor broken."""
+        return HELD not in self.flags and BROKEN not in self.flags
+
+
+class MessageIndex(object):
+    """An ordered in-memory index of the messages of a L{MessageStore}.
+
+    Entries are sorted by their L{MessageEntry.key}, which is the order in
+    which messages get delivered. The keys of active entries, i.e. the ones
+    that are neither held nor broken, are also kept in a separate sorted
+    list, so that the position of a message relative to the pending offset
+    can be found with a binary search instead of a walk.
+
+    The keys of the entries whose type is known are kept sorted by type as
+    well, together with the total size of the messages of each type.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._active = []
+        self._entries = {}
+        self._ids = {}
+        self._directories = {}
+        self._types = {}
+        self._type_sizes = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, entry):
+        """Add a L{MessageEntry} to the index."""
+        key = entry.key
+        _insert(self._keys, key)
+        if entry.is_active():
+            _insert(self._active, key)
+        self._entries[key] = entry
+        self._ids[entry.id] = entry
+        self._directories[entry.directory] = self.count_directory(
+            entry.directory) + 1
+        if entry.type is not None:
+            self._add_type(entry)
+
+    def remove(self, entry):
+        """Remove a L{MessageEntry} from the index."""
+        key = entry.key
+        _delete(self._keys, key)
+        if entry.is_active():
+            _delete(self._active, key)
+        del self._entries[key]
+        if self._ids.get(entry.id) is entry:
+            del self._ids[entry.id]
+        self._directories[entry.directory] -= 1
+        if entry.type is not None:
+            _delete(self._types[entry.type], key)
+            self._type_sizes[entry.type] -= entry.size
+
+    def set_flags(self, entry, flags):
+        """Change the flags of C{entry}, updating the active entries."""
+        was_active = entry.is_active()
+        entry.flags = flags
+        if was_active and not entry.is_active():
+            _delete(self._active, entry.key)
+        elif not was_active and entry.is_active():
+            _insert(self._active, entry.key)
+
+    def set_type(self, entry, type, api):
+        """Set the type and API of an entry, once they're known."""
+        if entry.type is None:
+            entry.type = type
+            entry.api = api
+            if self._entries.get(entry.key) is entry:
+                self._add_type(entry)
+
+    def _add_type(self, entry):
+        _insert(self._types.setdefault(entry.type, []), entry.key)
+        self._type_sizes[entry.type] = self.size_type(entry.type) + entry.size
+
+    def get(self, id):
+        """Return the L{MessageEntry} with the given id, or C{None}."""
+        return self._ids.get(id)
+
+    def last(self):
+        """Return the last L{MessageEntry} in the queue, or C{None}."""
+        if not self._keys:
+            return None
+        return self._entries[self._keys[-1]]
+
+    def walk(self):
+        """Return a list of all entries, in queue order."""
+        return [self._entries[key] for key in self._keys]
+
+    def pending(self, offset):
+        """Generate the active entries starting at the given C{offset}.
+
+        Flags of the generated entries can be safely changed while walking.
+        """
+        position = offset
+        while position < len(self._active):
+            key = self._active[position]
+            yield self._entries[key]
+            if (position < len(self._active) and
+                    self._active[position] == key):
+                position += 1
+
+    def of_type(self, type):
+        """Generate the entries of the given C{type}, in queue order."""
+        for key in list(self._types.get(type, ())):
+            yield self._entries[key]
+
+    def newest_of_type(self, type):
+        """Return the newest entry of the given C{type}, or C{None}."""
+        keys = self._types.get(type)
+        if not keys:
+            return None
+        return self._entries[keys[-1]]
+
+    def count_type(self, type):
+        """Return the number of entries of the given C{type}."""
+        return len(self._types.get(type, ()))
+
+    def size_type(self, type):
+        """Return the total size of the entries of the given C{type}."""
+        return self._type_sizes.get(type, 0)
+
+    def count_active(self):
+        """Return the number of entries which are neither held nor broken."""
+        return len(self._active)
+
+    def rank(self, entry):
+        """Return the number of active entries preceding C{entry}."""
+        return bisect.bisect_left(self._active, entry.key)
+
+    def add_directory(self, directory):
+        """Track a message directory, possibly empty."""
+        self._directories.setdefault(directory, 0)
+
+    def remove_directory(self, directory):
+        """Stop tracking an empty message directory."""
+        del self._directories[directory]
+
+    def get_newest_directory(self):
+        """Return the number of the newest directory, or C{None}."""
+        if not self._directories:
+            return None
+        return max(self._directories)
+
+    def count_directory(self, directory):
+        """Return the number of messages stored in C{directory}."""
+        return self._directories.get(directory, 0)
+
+
+def _insert(keys, key):
+    """Insert C{key} in the sorted C{keys} list, appending when possible."""
+    if not keys or key > keys[-1]:
+        keys.append(key)
+    else:
+        bisect.insort(keys, key)
+
+
+def _delete(keys, key):
+    """Delete C{key} from the sorted C{keys} list."""
+    del keys[bisect.bisect_left(keys, key)]
+
+
+class MessageQuota(object):
+    """A bound on the number and size of the stored messages of a type.
+
+    @ivar max_count: The maximum number of messages, or C{None}.
+    @ivar max_bytes: The maximum total size of the messages, or C{None}.
+    @ivar policy: How to pick the messages to evict when the quota is
+        exceeded. With C{"drop-oldest"} the oldest messages are evicted,
+        while with C{"downsample"} the messages are thinned evenly over the
+        whole series, so the ones left cover the same time span with a
+        coarser resolution.
+    """
+
+    def __init__(self, max_count=None, max_bytes=None, policy=EVICT_OLDEST):
+        assert policy in EVICTION_POLICIES
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+    def __eq__(self, other):
+        return (isinstance(other, MessageQuota) and
+                (self.max_count, self.max_bytes, self.policy) ==
+                (other.max_count, other.max_bytes, other.policy))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<MessageQuota max_count=%r max_bytes=%r policy=%r>" % (
+            self.max_count, self.max_bytes, self.policy)
+
+    def is_exceeded(self, count, size):
+        """Whether C{count} messages taking C{size} bytes exceed the quota."""
+        return ((self.max_count is not None and count > self.max_count) or
+                (self.max_bytes is not None and size > self.max_bytes))
+
+
+def parse_message_quotas(spec):
+    """Parse the quotas of the C{message_store_quotas} option.
+
+    The option is a comma separated list of quotas, each made of a message
+    type followed by colon separated C{count}, C{bytes} and C{policy}
+    settings, for example::
+
+      computer-info:count=1, cpu-usage:count=500:policy=downsample
+
+    @return: A C{dict} mapping message types to L{MessageQuota}s.
+    @raise ValueError: If C{spec} is malformed.
+    """
+    quotas = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        fields = item.split(":")
+        settings = {}
+        for field in fields[1:]:
+            name, sep, value = field.partition("=")
+            if not sep or name not in ("count", "bytes", "policy"):
+                raise ValueError("Invalid message quota %r" % item)
+            settings[name] = value
+        policy = settings.get("policy", EVICT_OLDEST)
+        if policy not in EVICTION_POLICIES:
+            raise ValueError("Invalid eviction policy %r" % policy)
+        quotas[fields[0]] = MessageQuota(
+            max_count=int(settings["count"]) if "count" in settings else None,
+            max_bytes=int(settings["bytes"]) if "bytes" in settings else None,
+            policy=policy)
+    return quotas
+
+
+def is_well_formed(data):
+    """Check that C{data} is a complete bpickled message, without decoding it.
+
+    The structure of the serialized dict is walked, as L{bpickle.LazyDict}
+    does, so that files truncated, zeroed or damaged by a crash are caught
+    before they're sent as they are.
+    """
+    if data[:1] != b"d":
+        return False
+    try:
+        return bpickle._skip(data, 0) == len(data)
+    except ValueError:
+        return False
+
+
+def decode_legacy_message(message):
+    """Decode the keys of a message loaded with C{as_is=True}, if needed.
+
+    This is a special case for messages which were serialized by py27 prior
+    to py3 upgrade, and having implicit byte message keys. Message may still
+    get rejected by the server, but it won't block the client broker.
+    (lp: #1718689)
+    """
+    if u"type" not in message:
+        message = {
+            (k if isinstance(k, str) else k.decode("ascii")): v
+            for k, v in message.items()}
+        message[u"type"] = message[u"type"].decode("ascii")
+    return message
+
+
+def check_message_store_engine(directory, engine):
+    """Check that the messages in C{directory} can be read by C{engine}.
+
+    @raises MessageStoreError: If C{directory} holds messages stored by
+        the L{SQLiteMessageStore} or L{SegmentMessageStore} engines and
+        another engine is selected.
+    """
+    from landscape.client.broker import sqlitestore, segmentstore
+    detectors = {"sqlite": sqlitestore.has_stored_messages,
+                 "segment": segmentstore.has_stored_messages}
+    if not os.path.isdir(directory):
+        return
+    for other_engine, has_stored_messages in sorted(detectors.items()):
+        if other_engine != engine and has_stored_messages(directory):
+            raise MessageStoreError(
+                "The message store in %s holds messages of the %r engine, "
+                "which can't be read by the %r engine. Set "
+                "message_store_engine back to %r, or remove the stored "
+                "messages." % (directory, other_engine, engine,
+                               other_engine))
+
+
+def get_default_message_store(persist, directory, engine="filesystem",
+                              **kwargs):
     """
     Get a L{MessageStore} object with all Landscape message schemas added.
+
+    @param engine: The storage engine to use, either C{"filesystem"} (the
+        default) for a L{MessageStore}, C{"sqlite"} for a
+        L{SQLiteMessageStore} or C{"segment"} for a L{SegmentMessageStore}.
+    @raises MessageStoreError: If C{directory} holds messages stored by
+        the L{SQLiteMessageStore} or L{SegmentMessageStore} engines and
+        another engine is selected. Messages of the file system layout are
+        migrated by those engines instead.
     """
     from landscape.message_schemas.server_bound import message_schemas
-    store = MessageStore(*args, **kwargs)
+    from landscape.client.broker import sqlitestore, segmentstore
+    engines = {"filesystem": MessageStore,
+               "sqlite": sqlitestore.SQLiteMessageStore,
+               "segment": segmentstore.SegmentMessageStore}
+    store_class = engines[engine]
+    check_message_store_engine(directory, engine)
+    store = store_class(persist, directory, **kwargs)
     for schema in message_schemas:
         store.add_schema(schema)
     return store
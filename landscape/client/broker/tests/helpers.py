@@ -89,7 +89,8 @@ class ExchangeHelper(BrokerConfigurationHelper):
         test_case.persist_filename = test_case.makePersistFile()
         test_case.persist = Persist(filename=test_case.persist_filename)
         test_case.mstore = get_default_message_store(
-            test_case.persist, test_case.config.message_store_path)
+            test_case.persist, test_case.config.message_store_path,
+            durability="per-message")
         test_case.identity = Identity(test_case.config, test_case.persist)
         test_case.transport = FakeTransport(None, test_case.config.url,
                                             test_case.config.ssl_public_key)
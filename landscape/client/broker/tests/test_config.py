@@ -86,6 +86,42 @@ class ConfigurationTests(LandscapeTest):
         self.assertEqual(configuration.exchange_interval, 34)
         self.assertEqual(configuration.ping_interval, 6)
 
+    def test_default_exchange_byte_budget(self):
+        """
+        Exchanges start with a budget of 1MB of messages, and should take
+        at most 30 seconds.
+        """
+        configuration = BrokerConfiguration()
+        self.assertEqual(1024 * 1024, configuration.exchange_byte_budget)
+        self.assertEqual(30, configuration.exchange_target_time)
+
+    def test_exchange_byte_budget_is_int(self):
+        """
+        The 'exchange_byte_budget' and 'exchange_target_time' values
+        specified in the configuration file are converted to integers.
+        """
+        filename = self.makeFile("[client]\n"
+                                 "exchange_byte_budget = 4096\n"
+                                 "exchange_target_time = 5\n")
+
+        configuration = BrokerConfiguration()
+        configuration.load(["--config", filename, "--url", "whatever"])
+
+        self.assertEqual(4096, configuration.exchange_byte_budget)
+        self.assertEqual(5, configuration.exchange_target_time)
+
+    def test_default_exchange_connection(self):
+        """By default a new connection is used for every exchange."""
+        configuration = BrokerConfiguration()
+        self.assertEqual("close", configuration.exchange_connection)
+
+    def test_default_exchange_compression(self):
+        """By default payloads aren't compressed."""
+        configuration = BrokerConfiguration()
+        self.assertEqual("none", configuration.exchange_compression)
+        self.assertEqual(6, configuration.exchange_compression_level)
+        self.assertEqual(1024, configuration.exchange_compression_threshold)
+
     def test_tag_handling(self):
         """
         The 'tags' value specified in the configuration file is not converted
@@ -124,3 +160,73 @@ class ConfigurationTests(LandscapeTest):
 
         self.assertEqual(configuration.url,
                          "https://landscape.canonical.com/message-system")
+
+    def test_default_message_store_engine(self):
+        """By default messages are stored in the file system."""
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual("filesystem", configuration.message_store_engine)
+
+    def test_message_store_engine(self):
+        """
+        The 'message_store_engine' value specified in the configuration file
+        selects the storage engine of the message store.
+        """
+        filename = self.makeFile("[client]\n"
+                                 "message_store_engine = sqlite\n")
+
+        configuration = BrokerConfiguration()
+        configuration.load(["--config", filename, "--url", "whatever"])
+
+        self.assertEqual("sqlite", configuration.message_store_engine)
+
+    def test_default_message_store_durability(self):
+        """By default messages are synced to disk in groups."""
+        configuration = BrokerConfiguration()
+        configuration.load(["--url", "whatever"])
+        self.assertEqual("group", configuration.message_store_durability)
+
+    def test_message_store_durability(self):
+        """
+        The 'message_store_durability' value specified in the configuration
+        file selects how messages are synced to disk.
+        """
+        filename = self.makeFile("[client]\n"
+                                 "message_store_durability = per-message\n")
+
+        configuration = BrokerConfiguration()
+        configuration.load(["--config", filename, "--url", "whatever"])
+
+        self.assertEqual("per-message",
+                         configuration.message_store_durability)
+
+    def test_message_store_quotas(self):
+        """
+        The 'message_store_quotas' value specified in the configuration
+        file bounds the queued messages of some types.
+        """
+        filename = self.makeFile("[client]\n"
+                                 "message_store_quotas = computer-info:"
+                                 "count=1\n")
+
+        configuration = BrokerConfiguration()
+        configuration.load(["--config", filename, "--url", "whatever"])
+
+        self.assertEqual("computer-info:count=1",
+                         configuration.message_store_quotas)
+
+    def test_invalid_message_store_quotas(self):
+        """
+        An invalid 'message_store_quotas' value is reported as a
+        configuration error.
+        """
+        filename = self.makeFile("[client]\n"
+                                 "message_store_quotas = computer-info:"
+                                 "count=one\n")
+
+        configuration = BrokerConfiguration()
+        error = self.assertRaises(
+            SystemExit, configuration.load,
+            ["--config", filename, "--url", "whatever"])
+        self.assertIn("error: invalid --message-store-quotas",
+                      str(error))
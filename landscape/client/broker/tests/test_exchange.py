@@ -8,9 +8,9 @@ from landscape.lib.schema import Int
 from landscape.message_schemas.message import Message
 from landscape.client.broker.config import BrokerConfiguration
 from landscape.client.broker.exchange import (
-        get_accepted_types_diff, MessageExchange)
+        get_accepted_types_diff, ExchangeBudget, MessageExchange)
 from landscape.client.broker.transport import FakeTransport
-from landscape.client.broker.store import MessageStore
+from landscape.client.broker.store import MessageQuota, MessageStore
 from landscape.client.broker.ping import Pinger
 from landscape.client.broker.registration import RegistrationHandler
 from landscape.client.tests.helpers import (
@@ -19,6 +19,52 @@ from landscape.client.broker.tests.helpers import ExchangeHelper
 from landscape.client.broker.server import BrokerServer
 
 
+class ExchangeBudgetTest(LandscapeTest):
+
+    def test_shrink_on_slow_exchange(self):
+        """
+        If an exchange takes longer than the target time, the budget is
+        reduced to what would have been sent within the target time.
+        """
+        budget = ExchangeBudget(1000000, 10)
+        budget.update(1000000, 40, True)
+        self.assertEqual(250000, budget.budget)
+
+    def test_shrink_at_least_by_half(self):
+        """
+        If an exchange of a few bytes takes longer than the target time, the
+        budget is at least halved, but it doesn't get below the minimum.
+        """
+        budget = ExchangeBudget(1000000, 10)
+        budget.update(1000, 11, False)
+        self.assertEqual(ExchangeBudget.minimum, budget.budget)
+        budget = ExchangeBudget(1000000, 10)
+        budget.update(1000000, 11, False)
+        self.assertEqual(500000, budget.budget)
+
+    def test_grow_on_fast_exchange_with_backlog(self):
+        """
+        If an exchange was quick and messages were left out, the budget is
+        doubled, up to the maximum.
+        """
+        budget = ExchangeBudget(1000000, 10)
+        budget.update(1000000, 1, True)
+        self.assertEqual(2000000, budget.budget)
+        budget = ExchangeBudget(ExchangeBudget.maximum, 10)
+        budget.update(1000000, 1, True)
+        self.assertEqual(ExchangeBudget.maximum, budget.budget)
+
+    def test_unchanged(self):
+        """
+        The budget doesn't change if there's no backlog or if the exchange
+        took more than half of the target time.
+        """
+        budget = ExchangeBudget(1000000, 10)
+        budget.update(1000, 1, False)
+        budget.update(1000000, 6, True)
+        self.assertEqual(1000000, budget.budget)
+
+
 class MessageExchangeTest(LandscapeTest):
 
     helpers = [ExchangeHelper]
@@ -121,6 +167,46 @@ class MessageExchangeTest(LandscapeTest):
         self.assertMessages(self.transport.payloads[0]["messages"],
                             [{"type": "empty"}])
 
+    def test_send_urgent_while_exchanging(self):
+        """
+        If an urgent message is sent while an exchange is in progress,
+        another exchange is performed right after the current one completes.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        exchange = self.transport.exchange
+
+        def send_while_exchanging(*args, **kwargs):
+            self.transport.exchange = exchange
+            self.exchanger.send({"type": "empty"}, urgent=True)
+            return exchange(*args, **kwargs)
+
+        self.transport.exchange = send_while_exchanging
+        self.exchanger.exchange()
+        self.assertEqual(1, len(self.transport.payloads))
+        self.assertMessages(self.transport.payloads[0]["messages"], [])
+        self.reactor.advance(0)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "empty"}])
+
+    def test_send_while_exchanging(self):
+        """
+        Non-urgent messages sent while an exchange is in progress wait for
+        the next regular exchange.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        exchange = self.transport.exchange
+
+        def send_while_exchanging(*args, **kwargs):
+            self.transport.exchange = exchange
+            self.exchanger.send({"type": "empty"})
+            return exchange(*args, **kwargs)
+
+        self.transport.exchange = send_while_exchanging
+        self.exchanger.exchange()
+        self.reactor.advance(self.config.urgent_exchange_interval)
+        self.assertEqual(1, len(self.transport.payloads))
+
     def test_send_urgent_wont_reschedule(self):
         """
         If an urgent exchange is already scheduled, adding another
@@ -145,6 +231,39 @@ class MessageExchangeTest(LandscapeTest):
         self.mstore.add_pending_offset(1)
         self.assertFalse(self.mstore.is_pending(message_id))
 
+    def test_send_messages(self):
+        """
+        The send_messages method queues several messages, which show up in
+        the next exchange.
+        """
+        self.mstore.set_accepted_types(["empty", "resynchronize"])
+        message_ids = self.exchanger.send_messages(
+            [{"type": "empty"}, {"type": "resynchronize"}])
+        self.assertTrue(all(self.mstore.is_pending(message_id)
+                            for message_id in message_ids))
+        self.assertFalse(self.exchanger.is_urgent())
+        self.exchanger.exchange()
+        self.assertEqual(len(self.transport.payloads), 1)
+        messages = self.transport.payloads[0]["messages"]
+        self.assertEqual(messages, [{"type": "empty",
+                                     "timestamp": 0,
+                                     "api": b"3.2"},
+                                    {"type": "resynchronize",
+                                     "timestamp": 0,
+                                     "api": b"3.2"}])
+
+    def test_send_messages_urgent(self):
+        """
+        Sending several messages with the urgent flag schedules an urgent
+        exchange.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.exchanger.send_messages([{"type": "empty"}], urgent=True)
+        self.wait_for_exchange(urgent=True)
+        self.assertEqual(len(self.transport.payloads), 1)
+        self.assertMessages(self.transport.payloads[0]["messages"],
+                            [{"type": "empty"}])
+
     def test_wb_include_accepted_types(self):
         """
         Every payload from the client needs to specify an ID which
@@ -154,6 +273,43 @@ class MessageExchangeTest(LandscapeTest):
         self.assertIn("accepted-types", payload)
         self.assertEqual(payload["accepted-types"], md5(b"").digest())
 
+    def test_wb_payload_messages_not_reencoded(self):
+        """
+        The messages in the payload are the serialized ones read from the
+        store, they're not decoded and encoded again.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        data = self.mstore.get_pending_message_data()[0][1]
+        with mock.patch("landscape.lib.bpickle.loads") as loads:
+            payload = self.exchanger._make_payload()
+        self.assertFalse(loads.called)
+        self.assertEqual([data], payload["messages"].encoded)
+
+    def test_payload_messages_are_marked_in_flight(self):
+        """
+        The messages included in a payload are marked as in flight in the
+        store, until the exchange succeeds.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.mstore.add({"type": "empty"})
+        self.exchanger._make_payload()
+        self.assertEqual(2, self.mstore.get_in_flight_offset())
+        self.exchanger.exchange()
+        self.assertEqual(0, self.mstore.get_in_flight_offset())
+
+    def test_failed_exchange_keeps_messages_in_flight(self):
+        """
+        If an exchange fails the messages of its payload stay marked as in
+        flight, since the server might have got them anyway.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.transport.exchange = lambda *args, **kwargs: None
+        self.exchanger.exchange()
+        self.assertEqual(1, self.mstore.get_in_flight_offset())
+
     def test_handle_message_sets_accepted_types(self):
         """
         An incoming "accepted-types" message should set the accepted
@@ -229,7 +385,8 @@ class MessageExchangeTest(LandscapeTest):
 
         def handler(message):
             persist = Persist(filename=self.persist_filename)
-            store = MessageStore(persist, self.config.message_store_path)
+            store = MessageStore(persist, self.config.message_store_path,
+                                 durability="per-message")
             self.assertEqual(store.get_pending_offset(), 1)
             self.assertEqual(store.get_sequence(), 1)
             handled.append(True)
@@ -249,7 +406,8 @@ class MessageExchangeTest(LandscapeTest):
 
         def handler(message):
             Persist(filename=self.persist_filename)
-            store = MessageStore(self.persist, self.config.message_store_path)
+            store = MessageStore(self.persist, self.config.message_store_path,
+                                 durability="per-message")
             self.assertEqual(store.get_server_sequence(),
                              self.message_counter)
             self.message_counter += 1
@@ -578,7 +736,8 @@ class MessageExchangeTest(LandscapeTest):
         self.exchanger.exchange()
         # Check that the change was persisted
         persist = Persist(filename=self.persist_filename)
-        store = MessageStore(persist, self.config.message_store_path)
+        store = MessageStore(persist, self.config.message_store_path,
+                             durability="per-message")
         self.assertIs(None, store.get_exchange_token())
 
     def test_include_total_messages_none(self):
@@ -615,6 +774,169 @@ class MessageExchangeTest(LandscapeTest):
         exchanger.exchange()
         self.assertEqual(self.transport.payloads[0]["total-messages"], 2)
 
+    def test_exchange_with_backlog_uses_urgent_interval(self):
+        """
+        If messages were left out of an exchange, the next one happens after
+        the urgent interval, until the backlog is gone.
+        """
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=1)
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.wait_for_exchange(urgent=True)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertEqual(1, self.transport.payloads[1]["total-messages"])
+        self.wait_for_exchange(urgent=True)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.wait_for_exchange(delta=-self.config.urgent_exchange_interval)
+        self.assertEqual(3, len(self.transport.payloads))
+
+    def test_exchange_byte_budget(self):
+        """
+        The messages sent in a single exchange fit in the byte budget, the
+        remaining ones are sent in the next exchanges.
+        """
+        self.config.exchange_byte_budget = 1
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config)
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.mstore.add({"type": "empty"})
+        exchanger.exchange()
+        self.assertEqual(1, len(self.transport.payloads[0]["messages"]))
+        self.assertEqual(2, self.transport.payloads[0]["total-messages"])
+
+    def test_exchange_byte_budget_grows_with_backlog(self):
+        """
+        If messages were left out of a fast exchange, the byte budget is
+        doubled for the next one.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.mstore.add({"type": "empty"})
+        self.mstore.add({"type": "empty"})
+        budget = self.exchanger._budget.budget
+        self.exchanger._budget.budget = 1
+        self.exchanger.exchange()
+        self.assertEqual(2, self.exchanger._budget.budget)
+        self.exchanger._budget.budget = budget
+        self.exchanger.exchange()
+        self.assertEqual(budget, self.exchanger._budget.budget)
+
+    def exchange_in_flight(self, exchanger):
+        """
+        Start an exchange with C{exchanger}, returning a function which
+        completes it.
+        """
+        calls = []
+        with mock.patch.object(self.reactor, "call_in_thread",
+                               side_effect=lambda *args: calls.append(args)):
+            exchanger.exchange()
+        [(callback, errback, f, payload, secure_id, token, api)] = calls
+        return lambda: self.reactor.call_in_thread(
+            callback, errback, f, payload, secure_id, token, api)
+
+    def test_prefetch_next_messages(self):
+        """
+        While an exchange with a backlog is in flight, the messages of the
+        next exchange are read from the store, and the next exchange sends
+        them without reading them again.
+        """
+        self.mstore.set_accepted_types(["data"])
+        for i in range(3):
+            self.mstore.add({"type": "data", "data": i})
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=2)
+        with mock.patch.object(self.mstore, "get_pending_message_data",
+                               wraps=self.mstore.get_pending_message_data
+                               ) as get_pending_mock:
+            complete = self.exchange_in_flight(exchanger)
+            self.assertEqual(2, get_pending_mock.call_count)
+            self.assertEqual(2, get_pending_mock.call_args[1]["offset"])
+            complete()
+            exchanger.exchange()
+            self.assertEqual(2, get_pending_mock.call_count)
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "data", "data": 2}])
+        self.assertEqual(2, self.transport.payloads[1]["sequence"])
+
+    def test_prefetched_messages_fit_in_byte_budget(self):
+        """
+        The prefetched messages are cut to the byte budget of the exchange
+        sending them.
+        """
+        self.mstore.set_accepted_types(["data"])
+        for i in range(4):
+            self.mstore.add({"type": "data", "data": i})
+        self.exchanger._budget.budget = 1
+        complete = self.exchange_in_flight(self.exchanger)
+        complete()
+        self.exchanger._budget.budget = 1
+        self.exchanger.exchange()
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "data", "data": 1}])
+
+    def test_prefetched_messages_with_changed_messages(self):
+        """
+        The prefetched messages are read again if the pending messages
+        changed while the exchange was in flight.
+        """
+        self.mstore.set_accepted_types(["data"])
+        self.mstore.set_quota("data", MessageQuota(max_count=2))
+        self.mstore.add({"type": "data", "data": 0})
+        self.mstore.add({"type": "data", "data": 1})
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=1)
+        complete = self.exchange_in_flight(exchanger)
+        self.mstore.add({"type": "data", "data": 2})
+        complete()
+        exchanger.exchange()
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "data", "data": 2}])
+
+    def test_prefetched_messages_with_messages_queued_in_flight(self):
+        """
+        If all the pending messages were prefetched, the messages queued
+        while the exchange was in flight are part of the next exchange too.
+        """
+        self.mstore.set_accepted_types(["data"])
+        self.mstore.add({"type": "data", "data": 0})
+        self.mstore.add({"type": "data", "data": 1})
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=1)
+        complete = self.exchange_in_flight(exchanger)
+        complete()
+        exchanger._max_messages = 2
+        self.mstore.add({"type": "data", "data": 2})
+        exchanger.exchange()
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "data", "data": 1},
+                             {"type": "data", "data": 2}])
+
+    def test_prefetched_messages_after_failed_exchange(self):
+        """
+        The prefetched messages aren't used if the server didn't get the
+        messages in flight.
+        """
+        self.mstore.set_accepted_types(["data"])
+        self.mstore.add({"type": "data", "data": 0})
+        self.mstore.add({"type": "data", "data": 1})
+        exchanger = MessageExchange(self.reactor, self.mstore, self.transport,
+                                    self.identity, self.exchange_store,
+                                    self.config, max_messages=1)
+        complete = self.exchange_in_flight(exchanger)
+        self.transport.responses.append(PyCurlError(7, "Connection refused"))
+        complete()
+        exchanger.exchange()
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "data", "data": 0}])
+
     def test_impending_exchange(self):
         """
         A reactor event is emitted shortly (10 seconds) before an exchange
@@ -712,6 +1034,107 @@ class MessageExchangeTest(LandscapeTest):
         self.wait_for_exchange(urgent=True)
         self.assertTrue(self.transport.payloads)
 
+    def test_backoff_after_failure(self):
+        """
+        After a failed exchange, the next one happens after a random delay
+        between the exchange interval and three times the previous delay.
+        """
+        self.log_helper.ignore_errors(RuntimeError)
+        self.transport.responses.append(RuntimeError("Failed."))
+        self.transport.responses.append(RuntimeError("Failed."))
+        interval = self.config.exchange_interval
+        with mock.patch("random.uniform", return_value=interval * 2) as rand:
+            self.exchanger.exchange()
+            rand.assert_called_once_with(interval, interval * 3)
+        self.assertEqual((interval * 2, interval * 2),
+                         self.mstore.get_exchange_backoff())
+        self.reactor.advance(interval * 2 - 1)
+        self.assertEqual(1, len(self.transport.payloads))
+        with mock.patch("random.uniform", return_value=interval * 3) as rand:
+            self.reactor.advance(1)
+            rand.assert_called_once_with(interval, interval * 6)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertEqual(interval * 3, self.mstore.get_exchange_backoff()[0])
+
+    def test_backoff_is_capped(self):
+        """
+        The delay after failed exchanges is capped to C{max_backoff}.
+        """
+        self.transport.responses.append(RuntimeError("Failed."))
+        self.mstore.set_exchange_backoff(10 * 60 * 60, 0)
+        self.exchanger.exchange()
+        self.assertEqual(self.exchanger.max_backoff,
+                         self.mstore.get_exchange_backoff()[0])
+
+    def test_backoff_honours_retry_after(self):
+        """
+        If the server asked to wait before retrying, the next exchange
+        doesn't happen before that.
+        """
+        error = HTTPCodeError(503, "", retry_after=5000)
+        self.transport.responses.append(error)
+        with mock.patch("random.uniform", return_value=1000):
+            self.exchanger.exchange()
+        self.assertEqual(5000, self.mstore.get_exchange_backoff()[0])
+        self.reactor.advance(4999)
+        self.assertEqual(1, len(self.transport.payloads))
+        self.reactor.advance(1)
+        self.assertEqual(2, len(self.transport.payloads))
+
+    def test_backoff_reset_on_success(self):
+        """
+        A successful exchange clears the backoff state.
+        """
+        self.transport.responses.append(RuntimeError("Failed."))
+        self.exchanger.exchange()
+        self.assertNotEqual((0, None), self.mstore.get_exchange_backoff())
+        self.exchanger.exchange()
+        self.assertEqual((0, None), self.mstore.get_exchange_backoff())
+
+    def test_start_after_failure(self):
+        """
+        If the broker is restarted while backing off from a failed
+        exchange, the first exchange still waits for the picked time.
+        """
+        self.mstore.set_exchange_backoff(600, self.reactor.time() + 300)
+        self.exchanger.start()
+        self.reactor.advance(299)
+        self.assertEqual(0, len(self.transport.payloads))
+        self.reactor.advance(1)
+        self.assertEqual(1, len(self.transport.payloads))
+
+    def test_urgent_exchange_while_backing_off(self):
+        """
+        Queuing an urgent message while backing off from a failed exchange
+        doesn't make the next exchange happen any earlier.
+        """
+        self.mstore.set_accepted_types(["empty"])
+        self.transport.responses.append(RuntimeError("Failed."))
+        with mock.patch("random.uniform", return_value=1000):
+            self.exchanger.exchange()
+        self.exchanger.send({"type": "empty"}, urgent=True)
+        self.assertTrue(self.exchanger.is_urgent())
+        self.reactor.advance(999)
+        self.assertEqual(1, len(self.transport.payloads))
+        self.reactor.advance(1)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "empty"}])
+
+    def test_urgent_exchange_after_backoff_reset(self):
+        """
+        Once an exchange succeeds, urgent exchanges happen after the urgent
+        interval again.
+        """
+        self.transport.responses.append(RuntimeError("Failed."))
+        with mock.patch("random.uniform", return_value=1000):
+            self.exchanger.exchange()
+        self.reactor.advance(1000)
+        self.assertEqual(2, len(self.transport.payloads))
+        self.exchanger.schedule_exchange(urgent=True)
+        self.reactor.advance(self.config.urgent_exchange_interval)
+        self.assertEqual(3, len(self.transport.payloads))
+
     def test_exchange_failed_fires_correctly(self):
         """
         Ensure that the exchange-failed event is fired if the
@@ -765,6 +1188,23 @@ class MessageExchangeTest(LandscapeTest):
         self.assertEqual(new_config.exchange_interval, 5678)
         self.assertEqual(new_config.urgent_exchange_interval, 1234)
 
+    def test_set_exchange_byte_budget(self):
+        """
+        The byte budget of the exchanges can be set by the server with a
+        C{set-intervals} message, and it's persisted in the configuration.
+        """
+        server_message = [{"type": "set-intervals",
+                           "exchange-byte-budget": 4096}]
+        self.transport.responses.append(server_message)
+
+        self.exchanger.exchange()
+
+        self.assertEqual(4096, self.config.exchange_byte_budget)
+        self.assertEqual(4096, self.exchanger._budget.budget)
+        new_config = BrokerConfiguration()
+        new_config.load_configuration_file(self.config_filename)
+        self.assertEqual(4096, new_config.exchange_byte_budget)
+
     def test_set_intervals_with_urgent_exchange_only(self):
         server_message = [{"type": "set-intervals", "urgent-exchange": 1234}]
         self.transport.responses.append(server_message)
@@ -994,6 +1434,26 @@ class MessageExchangeTest(LandscapeTest):
         self.assertEqual(len(ids_after), len(ids_before) - 1)
         self.assertNotIn('234567', ids_after)
 
+    def test_send_messages_discards_obsolete_response_messages(self):
+        """
+        Obsolete response messages passed to send_messages are discarded,
+        while the other messages are queued as usual.
+        """
+        self.transport.responses.append(
+            [{"type": "type-R", "operation-id": 234567}])
+        self.exchanger.exchange()
+        self.identity.secure_id = 'brand-new'
+
+        self.mstore.set_accepted_types(["empty", "resynchronize"])
+        [obsolete_id, message_id] = self.exchanger.send_messages(
+            [{"type": "resynchronize", "operation-id": 234567},
+             {"type": "empty"}])
+        self.assertIs(None, obsolete_id)
+        self.assertTrue(self.mstore.is_pending(message_id))
+        self.exchanger.exchange()
+        self.assertMessages(self.transport.payloads[1]["messages"],
+                            [{"type": "empty"}])
+
     def test_error_exchanging_causes_failed_exchange(self):
         """
         If a traceback occurs whilst exchanging, the 'exchange-failed'
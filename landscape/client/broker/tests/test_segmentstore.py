@@ -0,0 +1,488 @@
+import os
+
+import mock
+
+from twisted.python.compat import intToBytes
+
+from landscape.lib.persist import Persist
+from landscape.lib.schema import Bytes
+from landscape.lib.testing import FakeReactor
+from landscape.message_schemas.message import Message
+from landscape.client.broker.store import (
+    MessageStore, MessageQuota, MessageStoreError,
+    get_default_message_store)
+from landscape.client.broker.segmentstore import SegmentMessageStore
+
+from landscape.client.tests.helpers import LandscapeTest
+
+
+class SegmentMessageStoreTest(LandscapeTest):
+
+    def setUp(self):
+        super(SegmentMessageStoreTest, self).setUp()
+        self.temp_dir = self.makeDir()
+        self.persist_filename = self.makeFile()
+        self.store = self.create_store()
+
+    def create_store(self, factory=SegmentMessageStore, segment_size=None,
+                     **kwargs):
+        if "reactor" not in kwargs:
+            kwargs.setdefault("durability", "per-message")
+        persist = Persist(filename=self.persist_filename)
+        store = factory(persist, self.temp_dir, 20, **kwargs)
+        if segment_size is not None:
+            store.segment_size = segment_size
+        store.set_accepted_types(["empty", "data", "resynchronize"])
+        store.add_schema(Message("empty", {}))
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.add_schema(Message("unaccepted", {"data": Bytes()}))
+        store.add_schema(Message("resynchronize", {}))
+        return store
+
+    def get_segments(self):
+        return sorted(name for name in os.listdir(self.temp_dir)
+                      if name.endswith(".segment"))
+
+    def test_messages_are_stored_in_segments(self):
+        """
+        Messages are appended to a segment file, and not kept in the
+        numbered directories used by L{MessageStore}.
+        """
+        for i in range(10):
+            self.store.add({"type": "data", "data": b"A thing"})
+        self.assertEqual(["0.segment"], os.listdir(self.temp_dir))
+
+    def test_one_message(self):
+        self.store.add(dict(type="data", data=b"A thing"))
+        messages = self.store.get_pending_messages(200)
+        self.assertMessages(messages,
+                            [{"type": "data",
+                              "data": b"A thing",
+                              "api": b"3.2"}])
+
+    def test_message_ids_are_increasing(self):
+        id1 = self.store.add({"type": "empty"})
+        id2 = self.store.add({"type": "empty"})
+        self.assertTrue(id2 > id1)
+
+    def test_messages_survive_restarts(self):
+        """
+        The state of the store is rebuilt by replaying the segments, including
+        held and unheld messages.
+        """
+        for i in range(10):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.store.set_pending_offset(2)
+        self.store.set_accepted_types(["data", "unaccepted"])
+        self.store.commit()
+        store = self.create_store()
+        store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [intToBytes(i) for i in [4, 6, 8, 1, 3, 5, 7, 9]],
+            [m["data"] for m in store.get_pending_messages()])
+
+    def test_message_ids_survive_restarts(self):
+        """Message ids are never reused, even after a restart."""
+        message_id = self.store.add({"type": "empty"})
+        self.store.delete_all_messages()
+        store = self.create_store()
+        self.assertTrue(store.add({"type": "empty"}) > message_id)
+
+    def test_max_pending(self):
+        for i in range(10):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        il = [m["data"] for m in self.store.get_pending_messages(5)]
+        self.assertEqual(il, [intToBytes(i) for i in [0, 1, 2, 3, 4]])
+
+    def test_offset(self):
+        self.store.set_pending_offset(5)
+        for i in range(15):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        il = [m["data"] for m in self.store.get_pending_messages(5)]
+        self.assertEqual(il, [intToBytes(i) for i in [5, 6, 7, 8, 9]])
+
+    def test_count_pending_messages(self):
+        self.assertEqual(self.store.count_pending_messages(), 0)
+        for i in range(5):
+            self.store.add({"type": "empty"})
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.assertEqual(self.store.count_pending_messages(), 5)
+        self.store.set_pending_offset(2)
+        self.assertEqual(self.store.count_pending_messages(), 3)
+
+    def test_add_messages(self):
+        """
+        L{SegmentMessageStore.add_messages} appends all the messages to the
+        segment at once.
+        """
+        message_ids = self.store.add_messages(
+            [{"type": "data", "data": intToBytes(i)} for i in range(3)])
+        self.assertEqual(3, len(set(message_ids)))
+        self.assertEqual(
+            [intToBytes(i) for i in range(3)],
+            [m["data"] for m in self.store.get_pending_messages()])
+
+    def test_delete_old_messages(self):
+        for i in range(5):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        self.store.set_pending_offset(3)
+        self.store.delete_old_messages()
+        self.store.set_pending_offset(0)
+        il = [m["data"] for m in self.store.get_pending_messages()]
+        self.assertEqual(il, [intToBytes(i) for i in [3, 4]])
+        store = self.create_store()
+        il = [m["data"] for m in store.get_pending_messages()]
+        self.assertEqual(il, [intToBytes(i) for i in [3, 4]])
+
+    def test_delete_old_messages_does_not_delete_held(self):
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.store.add({"type": "empty"})
+        self.store.set_pending_offset(1)
+        self.store.delete_old_messages()
+        self.store.set_accepted_types(["empty", "unaccepted"])
+        self.store.set_pending_offset(0)
+        messages = self.store.get_pending_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["type"], "unaccepted")
+
+    def test_delete_old_messages_drops_segments(self):
+        """
+        Old segments are dropped as soon as all the messages they hold are
+        deleted.
+        """
+        store = self.create_store(segment_size=100)
+        for i in range(10):
+            store.add(dict(type="data", data=intToBytes(i)))
+        segments = self.get_segments()
+        self.assertTrue(len(segments) > 3)
+        store.set_pending_offset(5)
+        store.delete_old_messages()
+        self.assertTrue(len(self.get_segments()) < len(segments))
+        self.assertNotIn("0.segment", self.get_segments())
+        store.set_pending_offset(0)
+        store = self.create_store()
+        self.assertEqual([intToBytes(i) for i in range(5, 10)],
+                         [m["data"] for m in store.get_pending_messages()])
+
+    def test_held_messages_pin_segments(self):
+        """
+        A segment holding a held message isn't dropped, since the message is
+        still needed.
+        """
+        store = self.create_store(segment_size=100)
+        store.add({"type": "unaccepted", "data": b"blah"})
+        for i in range(10):
+            store.add(dict(type="data", data=intToBytes(i)))
+        store.set_pending_offset(10)
+        store.delete_old_messages()
+        self.assertIn("0.segment", self.get_segments())
+        store.set_accepted_types(["unaccepted"])
+        store.set_pending_offset(0)
+        self.assertEqual([b"blah"],
+                         [m["data"] for m in store.get_pending_messages()])
+
+    def test_compact(self):
+        """
+        The compactor copies the live messages of sparse old segments to the
+        newest one, and drops them.
+        """
+        store = self.create_store(segment_size=200)
+        held_id = store.add({"type": "unaccepted", "data": b"blah"})
+        for i in range(10):
+            store.add(dict(type="data", data=intToBytes(i)))
+        store.set_pending_offset(10)
+        store.delete_old_messages()
+        self.assertIn("0.segment", self.get_segments())
+        self.assertTrue(store.compact() > 0)
+        self.assertNotIn("0.segment", self.get_segments())
+        self.assertTrue(store.is_pending(held_id))
+        store = self.create_store()
+        store.set_accepted_types(["unaccepted"])
+        store.set_pending_offset(0)
+        self.assertEqual([b"blah"],
+                         [m["data"] for m in store.get_pending_messages()])
+
+    def test_compact_keeps_dense_segments(self):
+        """Segments mostly holding live messages are left alone."""
+        store = self.create_store(segment_size=200)
+        for i in range(10):
+            store.add(dict(type="data", data=intToBytes(i)))
+        segments = self.get_segments()
+        self.assertEqual(0, store.compact())
+        self.assertEqual(segments, self.get_segments())
+
+    def test_compaction_is_scheduled(self):
+        """If a reactor is given, the store is compacted periodically."""
+        reactor = FakeReactor()
+        store = self.create_store(reactor=reactor, segment_size=200)
+        store.add({"type": "unaccepted", "data": b"blah"})
+        for i in range(10):
+            store.add(dict(type="data", data=intToBytes(i)))
+        store.set_pending_offset(10)
+        store.delete_old_messages()
+        reactor.advance(store.compaction_interval)
+        self.assertNotIn("0.segment", self.get_segments())
+
+    def test_delete_all_messages(self):
+        self.store.set_accepted_types(["empty"])
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.store.add({"type": "empty"})
+        self.store.set_pending_offset(1)
+        self.store.delete_all_messages()
+        self.store.set_accepted_types(["empty", "unaccepted"])
+        self.assertEqual(self.store.get_pending_offset(), 0)
+        self.assertEqual(self.store.get_pending_messages(), [])
+        self.assertEqual(["1.segment"], self.get_segments())
+
+    def test_unaccepted_reaccepted(self):
+        for i in range(10):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.store.set_pending_offset(2)
+        self.store.set_accepted_types(["data", "unaccepted"])
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [4, 6, 8, 1, 3, 5, 7, 9]])
+
+    def test_accepted_unaccepted_old(self):
+        for i in range(10):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.store.set_pending_offset(2)
+        self.store.set_accepted_types(["unaccepted"])
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [1, 3, 5, 7, 9]])
+        self.store.set_pending_offset(0)
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [1, 3, 5, 7, 9]])
+        self.store.set_accepted_types(["data", "unaccepted"])
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i)
+                              for i in [1, 3, 5, 7, 9, 0, 2, 4, 6, 8]])
+
+    def test_is_pending(self):
+        self.store.add({"type": "empty"})
+        message_id = self.store.add({"type": "empty"})
+        self.assertTrue(self.store.is_pending(message_id))
+        self.store.add_pending_offset(1)
+        self.assertTrue(self.store.is_pending(message_id))
+        self.store.add_pending_offset(1)
+        self.assertFalse(self.store.is_pending(message_id))
+
+    def test_torn_record_is_truncated(self):
+        """
+        A partially written record at the end of the newest segment is
+        discarded, and new records are appended after the last good one.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.commit()
+        filename = os.path.join(self.temp_dir, "0.segment")
+        size = os.path.getsize(filename)
+        with open(filename, "ab") as fd:
+            fd.write(b"A\x00\x00\x00")
+        store = self.create_store()
+        self.assertEqual(size, os.path.getsize(filename))
+        self.assertIn("Found a corrupted record", self.logfile.getvalue())
+        store.add({"type": "data", "data": b"2"})
+        store = self.create_store()
+        self.assertEqual([b"1", b"2"],
+                         [m["data"] for m in store.get_pending_messages()])
+
+    def test_group_durability(self):
+        """
+        With the C{"group"} durability level all the records waiting to be
+        synced are flushed with a single sync of the newest segment.
+        """
+        store = self.create_store(reactor=FakeReactor())
+        store.add_messages([{"type": "empty"}, {"type": "empty"}])
+        store.add({"type": "empty"})
+        stats = store.get_sync_stats()
+        store.flush()
+        new_stats = store.get_sync_stats()
+        self.assertEqual(stats["batches"] + 1, new_stats["batches"])
+        self.assertEqual(stats["fsyncs"] + 1, new_stats["fsyncs"])
+        self.assertEqual(stats["messages"] + 3, new_stats["messages"])
+
+    def test_convert_directory_layout(self):
+        """
+        Messages stored by a L{MessageStore} are converted to a segment,
+        keeping their order, flags and ids, and they're removed from disk.
+        """
+        store = self.create_store(factory=MessageStore)
+        ids = [store.add(dict(type=["data", "unaccepted"][i % 2],
+                              data=intToBytes(i)))
+               for i in range(30)]
+        store.set_pending_offset(2)
+        store.commit()
+        store = self.create_store()
+        self.assertEqual(["0.segment"], os.listdir(self.temp_dir))
+        self.assertEqual(
+            [intToBytes(i) for i in range(4, 30, 2)],
+            [m["data"] for m in store.get_pending_messages()])
+        self.assertFalse(store.is_pending(ids[2]))
+        self.assertTrue(store.is_pending(ids[4]))
+        self.assertTrue(store.is_pending(ids[1]))
+        store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [intToBytes(i) for i in list(range(4, 30, 2)) +
+             list(range(1, 30, 2))],
+            [m["data"] for m in store.get_pending_messages()])
+        self.assertNotIn(store.add({"type": "empty"}), ids)
+
+    def test_interrupted_conversion(self):
+        """
+        If the conversion is interrupted before the legacy files are
+        removed, it's done again without adding the same messages twice.
+        """
+        store = self.create_store(factory=MessageStore)
+        for i in range(3):
+            store.add({"type": "data", "data": intToBytes(i)})
+        store.commit()
+        with mock.patch.object(SegmentMessageStore, "_remove_directory_layout",
+                               side_effect=OSError("Killed")):
+            self.assertRaises(OSError, self.create_store)
+        store = self.create_store()
+        self.assertEqual(["0.segment"], os.listdir(self.temp_dir))
+        self.assertEqual(
+            [intToBytes(i) for i in range(3)],
+            [m["data"] for m in store.get_pending_messages()])
+        store = self.create_store()
+        self.assertEqual(3, store.count_pending_messages())
+
+    def test_convert_broken_messages(self):
+        """Broken messages are converted as such."""
+        store = self.create_store(factory=MessageStore)
+        store.add({"type": "data", "data": b"1"})
+        store.add({"type": "data", "data": b"2"})
+        with open(os.path.join(self.temp_dir, "0", "0"), "w") as fh:
+            fh.write("bpickle will break reading this")
+        store = self.create_store()
+        self.assertEqual([{"type": "data", "data": b"2", "api": b"3.2"}],
+                         store.get_pending_messages())
+
+    def test_get_default_message_store(self):
+        """
+        The C{"segment"} engine of L{get_default_message_store} selects a
+        L{SegmentMessageStore}.
+        """
+        persist = Persist(filename=self.persist_filename)
+        store = get_default_message_store(
+            persist, self.makeDir(), engine="segment",
+            durability="per-message")
+        self.assertIsInstance(store, SegmentMessageStore)
+
+    def test_get_default_message_store_with_segment_messages(self):
+        """
+        L{get_default_message_store} refuses to open a store holding
+        messages of the C{"segment"} engine with another engine, since they
+        would never be delivered.
+        """
+        self.store.add({"type": "empty"})
+        persist = Persist(filename=self.persist_filename)
+        for engine in ("filesystem", "sqlite"):
+            error = self.assertRaises(
+                MessageStoreError, get_default_message_store, persist,
+                self.temp_dir, engine=engine)
+            self.assertIn("'segment' engine", str(error))
+        self.assertEqual(["0.segment"], os.listdir(self.temp_dir))
+
+    def test_get_default_message_store_with_deleted_messages(self):
+        """
+        Segments whose messages were all deleted don't prevent another
+        engine from being used.
+        """
+        self.store.add({"type": "empty"})
+        self.store.get_pending_messages()
+        self.store.add_pending_offset(1)
+        self.store.delete_old_messages()
+        persist = Persist(filename=self.persist_filename)
+        store = get_default_message_store(persist, self.temp_dir,
+                                          durability="per-message")
+        self.assertIsInstance(store, MessageStore)
+
+    def test_count_quota(self):
+        """
+        The oldest messages of a type exceeding its quota are evicted, but
+        not the ones marked as in flight.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=2))
+        self.store.add({"type": "data", "data": b"0"})
+        self.store.mark_in_flight(1)
+        for i in range(1, 4):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.add({"type": "empty"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"0"},
+                             {"type": "data", "data": b"3"},
+                             {"type": "empty"}])
+        self.assertEqual(
+            2, self.store.get_eviction_stats()["data"]["messages"])
+
+    def test_downsample_quota(self):
+        """
+        With the C{"downsample"} policy the message of the type whose
+        neighbours are the closest is evicted, keeping the oldest and the
+        newest ones.
+        """
+        self.store.set_quota("data", MessageQuota(max_bytes=4 * 39,
+                                                  policy="downsample"))
+        for i in range(5):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"0"},
+                             {"type": "data", "data": b"2"},
+                             {"type": "data", "data": b"3"},
+                             {"type": "data", "data": b"4"}])
+
+    def test_coalesced_message_replaces_pending_one(self):
+        """
+        A message whose schema is coalesced replaces the pending message of
+        the same type in place, also after a restart.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot", "empty"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.add({"type": "empty"})
+        message_id = self.store.add({"type": "snapshot", "data": b"2"})
+        self.assertTrue(self.store.is_pending(message_id))
+        # The snapshot gets held and unheld while creating the new store.
+        store = self.create_store()
+        store.add_schema(Message("snapshot", {"data": Bytes()}))
+        store.set_accepted_types(["snapshot", "empty"])
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "empty"},
+                             {"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_replaces_read_one(self):
+        """
+        Reading a pending message, for example to check whether any is left,
+        doesn't prevent it from being replaced.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.assertEqual(1, len(self.store.get_pending_messages(1)))
+        self.store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_keeps_in_flight_one_after_restart(self):
+        """
+        A message marked as in flight is still not replaced after a restart.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.commit()
+        store = self.create_store()
+        store.add_schema(Message("snapshot", {"data": Bytes()},
+                                 coalesce=True))
+        store.set_accepted_types(["snapshot"])
+        store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"1"},
+                             {"type": "snapshot", "data": b"2"}])
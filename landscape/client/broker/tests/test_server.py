@@ -5,6 +5,7 @@ from mock import Mock
 from twisted.internet.defer import succeed, fail
 
 from landscape.client.manager.manager import FAILED
+from landscape.client.broker.store import MessageQuota
 from landscape.client.tests.helpers import (
         LandscapeTest, DEFAULT_ACCEPTED_TYPES)
 from landscape.client.broker.tests.helpers import (
@@ -72,6 +73,23 @@ class BrokerServerTest(LandscapeTest):
         self.assertMessages(self.mstore.get_pending_messages(), [message])
         self.assertFalse(self.exchanger.is_urgent())
 
+    def test_send_message_with_group_durability(self):
+        """
+        With the C{"group"} durability level L{BrokerServer.send_message}
+        returns the message identifier only after the message is synced.
+        """
+        self.mstore._durability = "group"
+        self.mstore._reactor = self.reactor
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        result = self.broker.send_message({"type": "test"}, session_id)
+        message_ids = []
+        result.addCallback(message_ids.append)
+        self.assertEqual([], message_ids)
+        self.reactor.advance(self.mstore.group_commit_window)
+        self.assertEqual(1, self.mstore.get_sync_stats()["messages"])
+        self.assertEqual(1, len(message_ids))
+
     def test_send_message_with_urgent(self):
         """
         The L{BrokerServer.send_message} can optionally specify the urgency
@@ -107,6 +125,63 @@ class BrokerServerTest(LandscapeTest):
         self.assertRaises(
             RuntimeError, self.broker.send_message, message, None)
 
+    def test_send_messages(self):
+        """
+        The L{BrokerServer.send_messages} method forwards several messages to
+        the broker's exchanger at once.
+        """
+        messages = [{"type": "test"}, {"type": "test"}]
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        message_ids = self.broker.send_messages(messages, session_id)
+        self.assertEqual(2, len(message_ids))
+        self.assertMessages(self.mstore.get_pending_messages(), messages)
+        self.assertFalse(self.exchanger.is_urgent())
+
+    def test_send_messages_with_group_durability(self):
+        """
+        With the C{"group"} durability level L{BrokerServer.send_messages}
+        returns the message identifiers only after the messages are synced.
+        """
+        self.mstore._durability = "group"
+        self.mstore._reactor = self.reactor
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        result = self.broker.send_messages([{"type": "test"}] * 2, session_id)
+        results = []
+        result.addCallback(results.append)
+        self.assertEqual([], results)
+        self.reactor.advance(self.mstore.group_commit_window)
+        [message_ids] = results
+        self.assertEqual(2, len(message_ids))
+
+    def test_send_messages_with_urgent(self):
+        """
+        The L{BrokerServer.send_messages} can optionally specify the urgency
+        of the messages.
+        """
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        self.broker.send_messages([{"type": "test"}], session_id, urgent=True)
+        self.assertTrue(self.exchanger.is_urgent())
+
+    def test_send_messages_wont_send_with_invalid_session_id(self):
+        """
+        The L{BrokerServer.send_messages} call silently drops messages that
+        have invalid session ids.
+        """
+        self.mstore.set_accepted_types(["test"])
+        self.assertIs(
+            None, self.broker.send_messages([{"type": "test"}], "Not Valid"))
+        self.assertMessages(self.mstore.get_pending_messages(), [])
+
+    def test_send_messages_with_none_as_session_id_raises(self):
+        """
+        Calling C{send_messages} without a session id raises an error.
+        """
+        self.assertRaises(
+            RuntimeError, self.broker.send_messages, [{"type": "test"}], None)
+
     def test_send_message_with_old_release_upgrader(self):
         """
         If we receive a message from an old release-upgrader process that
@@ -262,6 +337,17 @@ class BrokerServerTest(LandscapeTest):
         self.mstore.set_server_uuid("the-uuid")
         self.assertEqual(self.broker.get_server_uuid(), "the-uuid")
 
+    def test_get_eviction_stats(self):
+        """
+        The L{BrokerServer.get_eviction_stats} method returns the counters
+        of the messages evicted from the message store.
+        """
+        self.mstore.set_quota("resynchronize", MessageQuota(max_count=1))
+        self.mstore.add({"type": "resynchronize"})
+        self.mstore.add({"type": "resynchronize"})
+        self.assertEqual(1, self.broker.get_eviction_stats()["resynchronize"][
+            "messages"])
+
     def test_register_client_accepted_message_type(self):
         """
         The L{BrokerServer.register_client_accepted_message_type} method can
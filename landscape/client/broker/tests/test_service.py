@@ -7,7 +7,11 @@ from landscape.client.broker.tests.helpers import BrokerConfigurationHelper
 from landscape.client.broker.service import BrokerService
 from landscape.client.broker.transport import HTTPTransport
 from landscape.client.broker.amp import RemoteBrokerConnector
+from landscape.client.broker.sqlitestore import SQLiteMessageStore
+from landscape.client.broker.store import MessageQuota, MessageStoreError
+from landscape.lib.persist import Persist
 from landscape.lib.testing import FakeReactor
+from landscape.message_schemas.message import Message
 
 
 class BrokerServiceTest(LandscapeTest):
@@ -37,12 +41,77 @@ class BrokerServiceTest(LandscapeTest):
         self.assertTrue(isinstance(self.service.transport, HTTPTransport))
         self.assertEqual(self.service.transport.get_url(), self.config.url)
 
+    def test_transport_connection(self):
+        """
+        The way the C{transport} handles connections is selected with the
+        C{exchange_connection} configuration option.
+        """
+        self.assertEqual("close", self.service.transport._connection)
+        self.config.exchange_connection = "keep-alive"
+        service = BrokerService(self.config)
+        self.assertEqual("keep-alive", service.transport._connection)
+
+    def test_transport_compression(self):
+        """
+        The compression of the payloads sent by the C{transport} is selected
+        with the C{exchange_compression} configuration option.
+        """
+        self.config.exchange_compression = "gzip"
+        service = BrokerService(self.config)
+        self.assertEqual("gzip", service.transport._compression)
+
     def test_message_store(self):
         """
         A L{BrokerService} instance has a proper C{message_store} attribute.
         """
         self.assertEqual(self.service.message_store.get_accepted_types(), ())
 
+    def test_message_store_engine(self):
+        """
+        The engine of the C{message_store} is selected with the
+        C{message_store_engine} configuration option.
+        """
+        self.config.message_store_engine = "sqlite"
+        service = BrokerService(self.config)
+        self.assertIsInstance(service.message_store, SQLiteMessageStore)
+
+    def test_message_store_engine_with_other_engine_messages(self):
+        """
+        Selecting a C{message_store_engine} which can't read the messages
+        already stored makes creating the service fail.
+        """
+        store = SQLiteMessageStore(
+            Persist(), self.config.message_store_path,
+            durability="per-message")
+        store.set_accepted_types(["empty"])
+        store.add_schema(Message("empty", {}))
+        store.add({"type": "empty"})
+        error = self.assertRaises(
+            MessageStoreError, BrokerService, self.config)
+        self.assertIn("'sqlite' engine", str(error))
+
+    def test_message_store_durability(self):
+        """
+        The durability level of the C{message_store} is selected with the
+        C{message_store_durability} configuration option.
+        """
+        self.config.message_store_durability = "per-message"
+        service = BrokerService(self.config)
+        self.assertEqual("per-message", service.message_store._durability)
+
+    def test_message_store_quotas(self):
+        """
+        The quotas of the C{message_store} are set with the
+        C{message_store_quotas} configuration option.
+        """
+        self.config.message_store_quotas = (
+            "computer-info:count=1, cpu-usage:bytes=1000:policy=downsample")
+        service = BrokerService(self.config)
+        self.assertEqual(MessageQuota(max_count=1),
+                         service.message_store.get_quota("computer-info"))
+        self.assertEqual(MessageQuota(max_bytes=1000, policy="downsample"),
+                         service.message_store.get_quota("cpu-usage"))
+
     def test_identity(self):
         """
         A L{BrokerService} instance has a proper C{identity} attribute.
@@ -75,6 +144,7 @@ class BrokerServiceTest(LandscapeTest):
         self.service.exchanger.start = Mock()
         self.service.pinger.start = Mock()
         self.service.exchanger.stop = Mock()
+        self.service.transport.close = Mock()
 
         self.service.startService()
         reactor = FakeReactor()
@@ -87,3 +157,4 @@ class BrokerServiceTest(LandscapeTest):
         self.service.exchanger.start.assert_called_with()
         self.service.pinger.start.assert_called_with()
         self.service.exchanger.stop.assert_called_with()
+        self.service.transport.close.assert_called_with()
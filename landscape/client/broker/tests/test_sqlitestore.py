@@ -0,0 +1,513 @@
+import os
+import sqlite3
+
+import mock
+
+from twisted.python.compat import intToBytes
+
+from landscape.lib import bpickle
+from landscape.lib.persist import Persist
+from landscape.lib.schema import Bytes
+from landscape.lib.testing import FakeReactor
+from landscape.message_schemas.message import Message
+from landscape.client.broker.store import (
+    MessageStore, MessageQuota, MessageStoreError,
+    get_default_message_store)
+from landscape.client.broker.sqlitestore import SQLiteMessageStore
+
+from landscape.client.tests.helpers import LandscapeTest
+
+
+class SQLiteMessageStoreTest(LandscapeTest):
+
+    def setUp(self):
+        super(SQLiteMessageStoreTest, self).setUp()
+        self.temp_dir = self.makeDir()
+        self.persist_filename = self.makeFile()
+        self.store = self.create_store()
+
+    def create_store(self, factory=SQLiteMessageStore, **kwargs):
+        if "reactor" not in kwargs:
+            kwargs.setdefault("durability", "per-message")
+        persist = Persist(filename=self.persist_filename)
+        store = factory(persist, self.temp_dir, 20, **kwargs)
+        store.set_accepted_types(["empty", "data", "resynchronize"])
+        store.add_schema(Message("empty", {}))
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.add_schema(Message("unaccepted", {"data": Bytes()}))
+        store.add_schema(Message("resynchronize", {}))
+        return store
+
+    def break_message(self, message_id):
+        """Corrupt the payload of the message with the given id."""
+        db = sqlite3.connect(os.path.join(self.temp_dir, "messages.sqlite"))
+        db.execute("UPDATE message SET data=? WHERE id=?",
+                   (b"bpickle will break reading this", message_id))
+        db.commit()
+        db.close()
+
+    def test_messages_are_stored_in_the_database(self):
+        """
+        Messages are kept in a single database file, and not in the numbered
+        directories used by L{MessageStore}.
+        """
+        self.store.add({"type": "data", "data": b"A thing"})
+        self.assertEqual(["messages.sqlite"],
+                         [name for name in os.listdir(self.temp_dir)
+                          if not name.startswith("messages.sqlite-")])
+
+    def test_one_message(self):
+        self.store.add(dict(type="data", data=b"A thing"))
+        messages = self.store.get_pending_messages(200)
+        self.assertMessages(messages,
+                            [{"type": "data",
+                              "data": b"A thing",
+                              "api": b"3.2"}])
+
+    def test_message_ids_are_increasing(self):
+        """Message ids are the primary keys of the stored messages."""
+        id1 = self.store.add({"type": "empty"})
+        id2 = self.store.add({"type": "empty"})
+        self.assertTrue(id2 > id1)
+
+    def test_messages_survive_restarts(self):
+        self.store.add(dict(type="data", data=b"A thing"))
+        store = self.create_store()
+        self.assertEqual([b"A thing"],
+                         [m["data"] for m in store.get_pending_messages()])
+
+    def test_add_messages(self):
+        """
+        L{SQLiteMessageStore.add_messages} stores the messages after the ones
+        already queued, keeping their order.
+        """
+        self.store.add({"type": "empty"})
+        message_ids = self.store.add_messages(
+            [{"type": "data", "data": intToBytes(i)} for i in range(3)])
+        self.assertEqual(3, len(message_ids))
+        self.assertEqual(
+            [intToBytes(i) for i in range(3)],
+            [m["data"] for m in self.store.get_pending_messages()
+             if m["type"] == "data"])
+
+    def test_add_messages_are_atomic(self):
+        """
+        The messages passed to L{SQLiteMessageStore.add_messages} are stored
+        in a single transaction, so if storing one of them fails none of them
+        is stored.
+        """
+        class FailingStore(SQLiteMessageStore):
+
+            def _store_messages(self, items):
+                # The API of the last message can't be stored.
+                items.append(({"type": "empty", "api": None}, b""))
+                return super(FailingStore, self)._store_messages(items)
+
+        store = self.create_store(factory=FailingStore)
+        self.assertRaises(TypeError, store.add_messages,
+                          [{"type": "empty"}, {"type": "empty"}])
+        self.assertEqual([], store.get_pending_messages())
+
+    def test_durability(self):
+        """
+        The durability level of the store selects how the SQLite database
+        syncs its transactions.
+        """
+        for durability, synchronous in [("none", 0), ("group", 1),
+                                        ("per-message", 2)]:
+            store = self.create_store(durability=durability,
+                                      reactor=FakeReactor())
+            store.add({"type": "empty"})
+            [[value]] = store._db.execute("PRAGMA synchronous").fetchall()
+            self.assertEqual(synchronous, value)
+
+    def test_sync_stats(self):
+        """
+        Each batch of messages is written, and synced, in a single
+        transaction.
+        """
+        store = self.create_store(durability="per-message")
+        store.add({"type": "empty"})
+        store.add_messages([{"type": "empty"}, {"type": "empty"}])
+        stats = store.get_sync_stats()
+        self.assertEqual(2, stats["batches"])
+        self.assertEqual(3, stats["messages"])
+        self.assertEqual(2, stats["max-batch-size"])
+        self.assertEqual(2, stats["fsyncs"])
+
+    def test_max_pending(self):
+        for i in range(10):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        il = [m["data"] for m in self.store.get_pending_messages(5)]
+        self.assertEqual(il, [intToBytes(i) for i in [0, 1, 2, 3, 4]])
+
+    def test_offset(self):
+        self.store.set_pending_offset(5)
+        for i in range(15):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        il = [m["data"] for m in self.store.get_pending_messages(5)]
+        self.assertEqual(il, [intToBytes(i) for i in [5, 6, 7, 8, 9]])
+
+    def test_get_pending_message_data_with_offset(self):
+        """
+        L{SQLiteMessageStore.get_pending_message_data} skips the given number
+        of pending messages.
+        """
+        self.store.set_pending_offset(5)
+        for i in range(15):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        il = [bpickle.loads(data)["data"] for api, data
+              in self.store.get_pending_message_data(2, offset=3)]
+        self.assertEqual(il, [intToBytes(i) for i in [8, 9]])
+
+    def test_count_pending_messages(self):
+        self.assertEqual(self.store.count_pending_messages(), 0)
+        for i in range(5):
+            self.store.add({"type": "empty"})
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.assertEqual(self.store.count_pending_messages(), 5)
+        self.store.set_pending_offset(2)
+        self.assertEqual(self.store.count_pending_messages(), 3)
+
+    def test_delete_old_messages(self):
+        for i in range(5):
+            self.store.add(dict(type="data", data=intToBytes(i)))
+        self.store.set_pending_offset(3)
+        self.store.delete_old_messages()
+        self.store.set_pending_offset(0)
+        il = [m["data"] for m in self.store.get_pending_messages()]
+        self.assertEqual(il, [intToBytes(i) for i in [3, 4]])
+
+    def test_delete_old_messages_does_not_delete_held(self):
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.store.add({"type": "empty"})
+        self.store.set_pending_offset(1)
+        self.store.delete_old_messages()
+        self.store.set_accepted_types(["empty", "unaccepted"])
+        self.store.set_pending_offset(0)
+        messages = self.store.get_pending_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["type"], "unaccepted")
+
+    def test_delete_all_messages(self):
+        self.store.set_accepted_types(["empty"])
+        self.store.add({"type": "unaccepted", "data": b"blah"})
+        self.store.add({"type": "empty"})
+        self.store.set_pending_offset(1)
+        self.store.delete_all_messages()
+        self.store.set_accepted_types(["empty", "unaccepted"])
+        self.assertEqual(self.store.get_pending_offset(), 0)
+        self.assertEqual(self.store.get_pending_messages(), [])
+
+    def test_unaccepted_with_offset(self):
+        for i in range(10):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.store.set_pending_offset(2)
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [4, 6, 8]])
+
+    def test_unaccepted_reaccepted(self):
+        for i in range(10):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.store.set_pending_offset(2)
+        self.store.set_accepted_types(["data", "unaccepted"])
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [4, 6, 8, 1, 3, 5, 7, 9]])
+
+    def test_accepted_unaccepted_old(self):
+        for i in range(10):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.store.set_pending_offset(2)
+        self.store.set_accepted_types(["unaccepted"])
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [1, 3, 5, 7, 9]])
+        self.store.set_pending_offset(0)
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i) for i in [1, 3, 5, 7, 9]])
+        self.store.set_accepted_types(["data", "unaccepted"])
+        il = [m["data"] for m in self.store.get_pending_messages(20)]
+        self.assertEqual(il, [intToBytes(i)
+                              for i in [1, 3, 5, 7, 9, 0, 2, 4, 6, 8]])
+
+    def test_messages_with_unknown_api_are_held(self):
+        """
+        Messages tagged with an API higher than the current server API are
+        held until the server API gets upgraded.
+        """
+        self.store.add({"type": "empty", "api": b"3.3"})
+        self.assertEqual([], self.store.get_pending_messages())
+        self.store.set_server_api(b"3.3")
+        self.store.set_accepted_types(["empty"])
+        self.assertEqual([{"type": "empty", "api": b"3.3"}],
+                         self.store.get_pending_messages())
+
+    def test_broken_messages(self):
+        """Broken messages are logged and skipped."""
+        self.log_helper.ignore_errors(ValueError)
+        message_id = self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "data", "data": b"2"})
+        self.break_message(message_id)
+        messages = self.store.get_pending_messages()
+        self.assertEqual(messages, [{"type": "data", "data": b"2",
+                                     "api": b"3.2"}])
+        self.assertIn("ValueError", self.logfile.getvalue())
+        self.assertFalse(self.store.is_pending(message_id))
+        self.assertEqual(1, self.store.count_pending_messages())
+
+    def test_get_pending_message_data(self):
+        """
+        L{SQLiteMessageStore.get_pending_message_data} returns the
+        serialized pending messages along with their API.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "unaccepted", "data": b"2"})
+        [(api, data)] = self.store.get_pending_message_data()
+        self.assertEqual(b"3.2", api)
+        self.assertEqual({"type": "data", "data": b"1", "api": b"3.2"},
+                         bpickle.loads(data))
+
+    def test_get_pending_message_data_with_max_bytes(self):
+        """
+        L{SQLiteMessageStore.get_pending_message_data} stops before the
+        size of the returned data exceeds C{max_bytes}.
+        """
+        for i in range(3):
+            self.store.add({"type": "data", "data": b"x" * 100})
+        size = len(self.store.get_pending_message_data(1)[0][1])
+        self.assertEqual(
+            2, len(self.store.get_pending_message_data(max_bytes=size * 2)))
+        self.assertEqual(
+            1, len(self.store.get_pending_message_data(max_bytes=1)))
+
+    def test_get_pending_message_data_with_damaged_message(self):
+        """
+        Messages damaged in the middle of their data are flagged as broken
+        by L{SQLiteMessageStore.get_pending_message_data}, rather than being
+        sent as they are.
+        """
+        self.log_helper.ignore_errors("Found a corrupted message")
+        message_id = self.store.add({"type": "data", "data": b"hello world"})
+        self.store.add({"type": "data", "data": b"2"})
+        db = sqlite3.connect(os.path.join(self.temp_dir, "messages.sqlite"))
+        [(data,)] = db.execute("SELECT data FROM message WHERE id=?",
+                               (message_id,)).fetchall()
+        db.execute("UPDATE message SET data=? WHERE id=?",
+                   (bytes(data).replace(b"s11:", b"s99:"), message_id))
+        db.commit()
+        db.close()
+        [(api, data)] = self.store.get_pending_message_data()
+        self.assertEqual({"type": "data", "data": b"2", "api": b"3.2"},
+                         bpickle.loads(data))
+        self.assertIn("Found a corrupted message", self.logfile.getvalue())
+
+    def test_is_pending(self):
+        self.store.add({"type": "empty"})
+        message_id = self.store.add({"type": "empty"})
+        self.assertTrue(self.store.is_pending(message_id))
+        self.store.add_pending_offset(1)
+        self.assertTrue(self.store.is_pending(message_id))
+        self.store.add_pending_offset(1)
+        self.assertFalse(self.store.is_pending(message_id))
+
+    def test_is_pending_with_held_message(self):
+        self.store.set_accepted_types(["empty"])
+        message_id = self.store.add({"type": "data", "data": b"A thing"})
+        self.store.add({"type": "empty"})
+        self.store.add_pending_offset(1)
+        self.assertTrue(self.store.is_pending(message_id))
+
+    def test_is_pending_with_unknown_id(self):
+        self.assertFalse(self.store.is_pending(123))
+
+    def test_migrate_directory_layout(self):
+        """
+        Messages stored by a L{MessageStore} are migrated to the database,
+        keeping their order, flags and ids, and they're removed from disk.
+        """
+        store = self.create_store(factory=MessageStore)
+        ids = [store.add(dict(type=["data", "unaccepted"][i % 2],
+                              data=intToBytes(i)))
+               for i in range(30)]
+        store.set_pending_offset(2)
+        store.commit()
+        store = self.create_store()
+        self.assertEqual(["messages.sqlite"],
+                         [name for name in os.listdir(self.temp_dir)
+                          if not name.startswith("messages.sqlite-")])
+        self.assertEqual(
+            [intToBytes(i) for i in range(4, 30, 2)],
+            [m["data"] for m in store.get_pending_messages()])
+        self.assertFalse(store.is_pending(ids[2]))
+        self.assertTrue(store.is_pending(ids[4]))
+        self.assertTrue(store.is_pending(ids[1]))
+        store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [intToBytes(i) for i in list(range(4, 30, 2)) +
+             list(range(1, 30, 2))],
+            [m["data"] for m in store.get_pending_messages()])
+        new_id = store.add({"type": "empty"})
+        self.assertNotIn(new_id, ids)
+
+    def test_interrupted_migration(self):
+        """
+        If the migration is interrupted before the legacy files are removed,
+        it's done again without importing the same messages twice.
+        """
+        store = self.create_store(factory=MessageStore)
+        for i in range(3):
+            store.add({"type": "data", "data": intToBytes(i)})
+        store.commit()
+        with mock.patch.object(SQLiteMessageStore, "_remove_directory_layout",
+                               side_effect=OSError("Killed")):
+            self.assertRaises(OSError, self.create_store)
+        store = self.create_store()
+        self.assertEqual(["messages.sqlite"],
+                         [name for name in os.listdir(self.temp_dir)
+                          if not name.startswith("messages.sqlite-")])
+        self.assertEqual(
+            [intToBytes(i) for i in range(3)],
+            [m["data"] for m in store.get_pending_messages()])
+
+    def test_migrate_broken_messages(self):
+        """Broken messages are migrated as such."""
+        store = self.create_store(factory=MessageStore)
+        store.add({"type": "data", "data": b"1"})
+        store.add({"type": "data", "data": b"2"})
+        with open(os.path.join(self.temp_dir, "0", "0"), "w") as fh:
+            fh.write("bpickle will break reading this")
+        store = self.create_store()
+        self.assertEqual([{"type": "data", "data": b"2", "api": b"3.2"}],
+                         store.get_pending_messages())
+
+    def test_get_default_message_store(self):
+        """
+        The storage engine used by L{get_default_message_store} can be
+        selected with the C{engine} parameter.
+        """
+        persist = Persist(filename=self.persist_filename)
+        store = get_default_message_store(
+            persist, self.temp_dir, engine="sqlite",
+            durability="per-message")
+        self.assertIsInstance(store, SQLiteMessageStore)
+        store.set_accepted_types(["resynchronize"])
+        store.add({"type": "resynchronize"})
+        self.assertEqual(1, store.count_pending_messages())
+
+    def test_get_default_message_store_with_sqlite_messages(self):
+        """
+        L{get_default_message_store} refuses to open a store holding
+        messages of the C{"sqlite"} engine with another engine, since they
+        would never be delivered.
+        """
+        self.store.add({"type": "empty"})
+        persist = Persist(filename=self.persist_filename)
+        for engine in ("filesystem", "segment"):
+            error = self.assertRaises(
+                MessageStoreError, get_default_message_store, persist,
+                self.temp_dir, engine=engine)
+            self.assertIn("'sqlite' engine", str(error))
+        self.assertFalse(
+            [name for name in os.listdir(self.temp_dir)
+             if name.endswith(".segment")])
+
+    def test_get_default_message_store_with_empty_database(self):
+        """
+        A database without messages doesn't prevent another engine from
+        being used.
+        """
+        self.store.add({"type": "empty"})
+        self.store.delete_all_messages()
+        persist = Persist(filename=self.persist_filename)
+        store = get_default_message_store(persist, self.temp_dir,
+                                          durability="per-message")
+        self.assertIsInstance(store, MessageStore)
+
+    def test_count_quota(self):
+        """
+        The oldest messages of a type exceeding its quota are evicted, but
+        not the ones marked as in flight.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=2))
+        self.store.add({"type": "data", "data": b"0"})
+        self.store.mark_in_flight(1)
+        for i in range(1, 4):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.add({"type": "empty"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"0"},
+                             {"type": "data", "data": b"3"},
+                             {"type": "empty"}])
+        self.assertEqual(
+            2, self.store.get_eviction_stats()["data"]["messages"])
+
+    def test_downsample_quota(self):
+        """
+        With the C{"downsample"} policy the message of the type whose
+        neighbours are the closest is evicted, keeping the oldest and the
+        newest ones.
+        """
+        self.store.set_quota("data", MessageQuota(max_bytes=4 * 39,
+                                                  policy="downsample"))
+        for i in range(5):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"0"},
+                             {"type": "data", "data": b"2"},
+                             {"type": "data", "data": b"3"},
+                             {"type": "data", "data": b"4"}])
+
+    def test_coalesced_message_replaces_pending_one(self):
+        """
+        A message whose schema is coalesced replaces the pending message of
+        the same type in place, also after a restart.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot", "empty"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.add({"type": "empty"})
+        message_id = self.store.add({"type": "snapshot", "data": b"2"})
+        self.assertTrue(self.store.is_pending(message_id))
+        # The snapshot gets held and unheld while creating the new store.
+        store = self.create_store()
+        store.add_schema(Message("snapshot", {"data": Bytes()}))
+        store.set_accepted_types(["snapshot", "empty"])
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "empty"},
+                             {"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_replaces_read_one(self):
+        """
+        Reading a pending message, for example to check whether any is left,
+        doesn't prevent it from being replaced.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.assertEqual(1, len(self.store.get_pending_messages(1)))
+        self.store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_keeps_in_flight_one_after_restart(self):
+        """
+        A message marked as in flight is still not replaced after a restart.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.commit()
+        store = self.create_store()
+        store.add_schema(Message("snapshot", {"data": Bytes()},
+                                 coalesce=True))
+        store.set_accepted_types(["snapshot"])
+        store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"1"},
+                             {"type": "snapshot", "data": b"2"}])
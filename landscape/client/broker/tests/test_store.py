@@ -4,11 +4,16 @@ import mock
 
 from twisted.python.compat import intToBytes
 
+from landscape.lib import bpickle
 from landscape.lib.bpickle import dumps
 from landscape.lib.persist import Persist
+from landscape.lib.testing import FakeReactor
 from landscape.lib.schema import InvalidError, Int, Bytes, Unicode
+from landscape.lib.series import decode_series
 from landscape.message_schemas.message import Message
-from landscape.client.broker.store import MessageStore
+from landscape.message_schemas.server_bound import CPU_USAGE, CPU_USAGE_3_4
+from landscape.client.broker.store import (
+    MessageStore, MessageQuota, TYPES_FILENAME, parse_message_quotas)
 
 from landscape.client.tests.helpers import LandscapeTest
 
@@ -21,9 +26,11 @@ class MessageStoreTest(LandscapeTest):
         self.persist_filename = self.makeFile()
         self.store = self.create_store()
 
-    def create_store(self):
+    def create_store(self, **kwargs):
+        if "reactor" not in kwargs:
+            kwargs.setdefault("durability", "per-message")
         persist = Persist(filename=self.persist_filename)
-        store = MessageStore(persist, self.temp_dir, 20)
+        store = MessageStore(persist, self.temp_dir, 20, **kwargs)
         store.set_accepted_types(["empty", "data", "resynchronize"])
         store.add_schema(Message("empty", {}))
         store.add_schema(Message("empty2", {}))
@@ -262,12 +269,171 @@ class MessageStoreTest(LandscapeTest):
         self.logfile.seek(0)
         self.logfile.truncate()
 
-        # Unholding will also load the message.
+        # Unholding doesn't need to load the message again, since its type
+        # is known by the index.
         self.store.set_accepted_types([])
         self.store.set_accepted_types(["empty", "empty2"])
 
+        self.assertNotIn("invalid literal for int()", self.logfile.getvalue())
+        self.assertEqual(self.store.get_pending_messages(),
+                         [{"type": "empty2", "api": b"3.2"}])
+
+    def test_get_pending_message_data(self):
+        """
+        L{MessageStore.get_pending_message_data} returns the serialized
+        pending messages along with their API.
+        """
+        self.store.add({"type": "data", "data": b"A thing"})
+        self.store.add({"type": "unaccepted", "data": b"Held"})
+        self.store.add({"type": "empty", "api": b"3.1"})
+        [(api1, data1), (api2, data2)] = self.store.get_pending_message_data()
+        self.assertEqual(b"3.2", api1)
+        self.assertEqual({"type": "data", "data": b"A thing", "api": b"3.2"},
+                         bpickle.loads(data1))
+        self.assertEqual(b"3.1", api2)
+        self.assertEqual({"type": "empty", "api": b"3.1"},
+                         bpickle.loads(data2))
+
+    def test_get_pending_message_data_with_max_bytes(self):
+        """
+        L{MessageStore.get_pending_message_data} stops before the size of
+        the returned data exceeds C{max_bytes}, but always returns at least
+        one message.
+        """
+        for i in range(3):
+            self.store.add({"type": "data", "data": b"x" * 100})
+        size = len(self.store.get_pending_message_data(1)[0][1])
+        self.assertEqual(
+            2, len(self.store.get_pending_message_data(max_bytes=size * 2)))
+        self.assertEqual(
+            1, len(self.store.get_pending_message_data(max_bytes=1)))
+
+    def test_get_pending_message_data_with_offset(self):
+        """
+        L{MessageStore.get_pending_message_data} skips the given number of
+        pending messages.
+        """
+        for data in [b"A", b"B", b"C"]:
+            self.store.add({"type": "data", "data": data})
+        self.store.set_pending_offset(1)
+        [(api, data)] = self.store.get_pending_message_data(offset=1)
+        self.assertEqual(b"C", bpickle.loads(data)["data"])
+
+    def test_revision(self):
+        """
+        The revision of the store changes when pending messages change, but
+        not when messages are queued after them.
+        """
+        revision = self.store.get_revision()
+        self.store.add({"type": "data", "data": b"A"})
+        self.assertEqual(revision, self.store.get_revision())
+        self.store.set_accepted_types(["data"])
+        self.assertNotEqual(revision, self.store.get_revision())
+        revision = self.store.get_revision()
+        self.store.delete_all_messages()
+        self.assertNotEqual(revision, self.store.get_revision())
+
+    def test_wb_get_pending_message_data_with_broken_message(self):
+        """
+        Messages whose type is known aren't decoded by
+        L{MessageStore.get_pending_message_data}, but badly truncated ones
+        are still detected and flagged as broken.
+        """
+        self.log_helper.ignore_errors("Found a corrupted message")
+        self.store.set_accepted_types(["empty", "empty2"])
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "empty2"})
+        filename = os.path.join(self.temp_dir, "0", "0")
+        with open(filename, "wb") as fh:
+            fh.write(b"d")
+        [(api, data)] = self.store.get_pending_message_data()
+        self.assertEqual({"type": "empty2", "api": b"3.2"},
+                         bpickle.loads(data))
+        self.assertIn("Found a corrupted message", self.logfile.getvalue())
+        self.assertEqual(1, self.store.count_pending_messages())
+
+    def test_wb_get_pending_message_data_with_damaged_message(self):
+        """
+        Messages whose type is known but whose data is damaged in the middle
+        are flagged as broken by L{MessageStore.get_pending_message_data},
+        rather than being sent as they are.
+        """
+        self.log_helper.ignore_errors("Found a corrupted message")
+        self.store.set_accepted_types(["data"])
+        self.store.add({"type": "data", "data": b"hello world"})
+        self.store.add({"type": "data", "data": b"2"})
+        filename = os.path.join(self.temp_dir, "0", "0")
+        with open(filename, "rb") as fh:
+            data = fh.read()
+        with open(filename, "wb") as fh:
+            fh.write(data.replace(b"s11:", b"s99:"))
+        [(api, data)] = self.store.get_pending_message_data()
+        self.assertEqual({"type": "data", "data": b"2", "api": b"3.2"},
+                         bpickle.loads(data))
+        self.assertIn("Found a corrupted message", self.logfile.getvalue())
+
+    def test_wb_unholding_loads_unknown_messages(self):
+        """
+        Messages found on disk without a recorded type, for example because
+        they were stored by an older client, are loaded when unholding.
+        """
+        self.log_helper.ignore_errors(ValueError)
+        self.store.add({"type": "empty"})
+        filename = os.path.join(self.temp_dir, "0", "0")
+        with open(filename, "w") as fh:
+            fh.write("bpickle will break reading this")
+        os.unlink(os.path.join(self.temp_dir, "0", TYPES_FILENAME))
+
+        store = self.create_store()
+        store.set_accepted_types(["empty", "empty2"])
+
         self.assertIn("invalid literal for int()", self.logfile.getvalue())
 
+    def test_types_file_is_skipped_by_older_clients(self):
+        """
+        The file recording the message types has a C{.tmp} suffix, so older
+        clients, which skip the temporary files of the message directories,
+        don't mistake it for a message after a downgrade.
+        """
+        self.store.add({"type": "empty"})
+        filenames = os.listdir(os.path.join(self.temp_dir, "0"))
+        self.assertEqual(["0"], [filename for filename in filenames
+                                 if not filename.endswith(".tmp")])
+
+    def test_wb_message_types_survive_restarts(self):
+        """
+        The types of the messages are recorded on disk, so holding and
+        unholding messages after a restart doesn't require loading them.
+        """
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "data", "data": b"A thing"})
+        store = self.create_store()
+        with mock.patch.object(store, "_read_message") as read_message:
+            store.set_accepted_types(["data"])
+            store.set_accepted_types(["empty"])
+            self.assertEqual([], read_message.mock_calls)
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "empty"}])
+        store.set_accepted_types(["empty", "data"])
+        store = self.create_store()
+        self.assertEqual(["empty", "data"],
+                         [entry.type for entry in store._index.walk()])
+
+    def test_wb_recorded_types_of_replaced_files_are_ignored(self):
+        """
+        A recorded type is only used if the message file is the very same
+        one it was recorded for, otherwise the message gets loaded.
+        """
+        self.store.add({"type": "empty"})
+        filename = os.path.join(self.temp_dir, "0", "0")
+        with open(filename + ".new", "wb") as fh:
+            fh.write(dumps({"type": "data", "data": b"A thing",
+                            "api": b"3.2"}))
+        os.rename(filename + ".new", filename)
+        store = self.create_store()
+        self.assertEqual(["data"],
+                         [entry.type for entry in store._index.walk()])
+
     def test_wb_delete_messages_with_broken(self):
         self.log_helper.ignore_errors(ValueError)
         self.store.add({"type": "data", "data": b"1"})
@@ -359,6 +525,39 @@ class MessageStoreTest(LandscapeTest):
         self.assertRaises(InvalidError,
                           self.store.add, {"type": "data", "data": 3})
 
+    def test_add_messages(self):
+        """
+        L{MessageStore.add_messages} queues several messages at once, and
+        returns their ids.
+        """
+        message_ids = self.store.add_messages(
+            [{"type": "data", "data": b"1"}, {"type": "empty"}])
+        self.assertEqual(2, len(message_ids))
+        self.assertTrue(all(self.store.is_pending(message_id)
+                            for message_id in message_ids))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"1"},
+                             {"type": "empty"}])
+
+    def test_add_messages_coercion(self):
+        """
+        The messages passed to L{MessageStore.add_messages} which don't
+        conform to their schema are logged and dropped, without preventing
+        the other ones from being queued.
+        """
+        self.log_helper.ignore_errors("Dropped an invalid")
+        message_ids = self.store.add_messages(
+            [{"type": "empty"}, {"type": "data", "data": 3},
+             {"type": "data", "data": b"2"}])
+        self.assertIs(None, message_ids[1])
+        self.assertTrue(self.store.is_pending(message_ids[0]))
+        self.assertTrue(self.store.is_pending(message_ids[2]))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "empty"},
+                             {"type": "data", "data": b"2"}])
+        self.assertIn("Dropped an invalid data message",
+                      self.logfile.getvalue())
+
     def test_coercion_ignores_custom_api(self):
         """
         If a custom 'api' key is specified in the message, it should
@@ -410,6 +609,39 @@ class MessageStoreTest(LandscapeTest):
             self.store.get_pending_messages(),
             [{"type": "data", "api": b"3.2", "data": b"foo"}])
 
+    def test_schema_added_after_coercion(self):
+        """
+        The schema applied to messages of a type is looked up again when a
+        new schema is added.
+        """
+        self.store.set_server_api(b"3.3")
+        self.store.add({"type": "data", "data": b"foo"})
+        self.store.add_schema(Message("data", {"data": Int()}, api=b"3.3"))
+        self.store.add({"type": "data", "data": 123})
+        self.assertEqual(
+            [{"type": "data", "api": b"3.3", "data": b"foo"},
+             {"type": "data", "api": b"3.3", "data": 123}],
+            self.store.get_pending_messages())
+
+    def test_metric_message_is_compacted_for_new_servers(self):
+        """
+        The points of metric messages are sent in the compact columnar form
+        only if the server speaks API 3.4, and as plain tuples otherwise.
+        """
+        self.store.set_accepted_types(["cpu-usage"])
+        self.store.add_schema(CPU_USAGE)
+        self.store.add_schema(CPU_USAGE_3_4)
+        points = [(300, 1.0), (330, 0.5)]
+        self.store.set_server_api(b"3.3")
+        self.store.add({"type": "cpu-usage", "cpu-usages": list(points)})
+        self.store.set_server_api(b"3.4")
+        self.store.add({"type": "cpu-usage", "cpu-usages": list(points)})
+        [old, new] = self.store.get_pending_messages()
+        self.assertEqual(points, old["cpu-usages"])
+        self.assertEqual(300, new["cpu-usages"]["start"])
+        self.assertEqual(30, new["cpu-usages"]["step"])
+        self.assertEqual(points, decode_series(new["cpu-usages"], "f"))
+
     def test_count_pending_messages(self):
         """It is possible to get the total number of pending messages."""
         self.assertEqual(self.store.count_pending_messages(), 0)
@@ -424,14 +656,16 @@ class MessageStoreTest(LandscapeTest):
         demand.
         """
         filename = self.makeFile()
-        store = MessageStore(Persist(filename=filename), self.temp_dir)
+        store = MessageStore(Persist(filename=filename), self.temp_dir,
+                             durability="per-message")
         store.set_accepted_types(["foo", "bar"])
 
         self.assertFalse(os.path.exists(filename))
         store.commit()
         self.assertTrue(os.path.exists(filename))
 
-        store = MessageStore(Persist(filename=filename), self.temp_dir)
+        store = MessageStore(Persist(filename=filename), self.temp_dir,
+                             durability="per-message")
         self.assertEqual(set(store.get_accepted_types()),
                          set(["foo", "bar"]))
 
@@ -470,6 +704,41 @@ class MessageStoreTest(LandscapeTest):
         self.store.add_pending_offset(1)
         self.assertFalse(self.store.is_pending(id))
 
+    def test_index_is_built_at_startup(self):
+        """
+        The index of the messages is rebuilt from disk when the store is
+        created, preserving order, flags and message ids.
+        """
+        ids = [self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                   data=intToBytes(i)))
+               for i in range(30)]
+        self.store.set_pending_offset(2)
+        self.store.commit()
+        store = self.create_store()
+        self.assertEqual(13, store.count_pending_messages())
+        self.assertFalse(store.is_pending(ids[2]))
+        self.assertTrue(store.is_pending(ids[4]))
+        self.assertTrue(store.is_pending(ids[1]))
+        store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [intToBytes(i) for i in list(range(4, 30, 2)) +
+             list(range(1, 30, 2))],
+            [m["data"] for m in store.get_pending_messages()])
+
+    def test_wb_index_avoids_listing_directories(self):
+        """
+        Once the store is created, adding, counting, walking and checking
+        messages is served by the index, without listing directories.
+        """
+        with mock.patch("os.listdir") as listdir:
+            for i in range(30):
+                message_id = self.store.add(dict(type="data",
+                                                 data=intToBytes(i)))
+            self.assertEqual(30, self.store.count_pending_messages())
+            self.assertEqual(5, len(self.store.get_pending_messages(5)))
+            self.assertTrue(self.store.is_pending(message_id))
+            self.assertEqual([], listdir.mock_calls)
+
     def test_is_pending_with_held_message(self):
         self.store.set_accepted_types(["empty"])
         id = self.store.add({"type": "data", "data": b"A thing"})
@@ -589,6 +858,17 @@ class MessageStoreTest(LandscapeTest):
         self.assertFalse(self.store.is_valid_session_id(hwinfo_session_id))
         self.assertTrue(self.store.is_valid_session_id(package_session_id))
 
+    def test_exchange_backoff(self):
+        """
+        The state of the backoff after failed exchanges is persisted, and
+        it's cleared by a successful exchange.
+        """
+        self.assertEqual((0, None), self.store.get_exchange_backoff())
+        self.store.set_exchange_backoff(60, 123)
+        self.assertEqual((60, 123), self.store.get_exchange_backoff())
+        self.store.record_success(124)
+        self.assertEqual((0, None), self.store.get_exchange_backoff())
+
     def test_record_failure_sets_first_failure_time(self):
         """first-failure-time recorded when calling record_failure()."""
         self.store.record_failure(123)
@@ -621,6 +901,17 @@ class MessageStoreTest(LandscapeTest):
         self.assertIn("DEBUG: Dropped message, awaiting resync.",
                       self.logfile.getvalue())
 
+    def test_add_messages_after_discarded_following_one_week(self):
+        """
+        L{MessageStore.add_messages} drops messages as well when the store
+        is waiting for a resync.
+        """
+        self.store.record_failure(0)
+        self.store.record_failure((7 * 24 * 60 * 60) + 1)
+        self.assertIs(None, self.store.add_messages([{"type": "empty"}]))
+        self.assertIn("DEBUG: Dropped 1 messages, awaiting resync.",
+                      self.logfile.getvalue())
+
     def test_after_clearing_blackhole_messages_are_accepted_again(self):
         """After a successful exchange, messages are accepted again."""
         self.store.record_failure(0)
@@ -647,6 +938,7 @@ class MessageStoreTest(LandscapeTest):
             fh.write(dumps({b"type": b"data",
                             b"data": b"A thing",
                             b"api": b"3.2"}))
+        self.store = self.create_store()
         [message] = self.store.get_pending_messages()
         # message keys are decoded
         self.assertIn(u"type", message)
@@ -654,3 +946,431 @@ class MessageStoreTest(LandscapeTest):
         self.assertIsInstance(message[u"api"], bytes)  # api is bytes
         self.assertEqual(u"data", message[u"type"])  # message type is decoded
         self.assertEqual(b"A thing", message[u"data"])  # other are kept as-is
+
+    @mock.patch("landscape.client.broker.store.sync_path")
+    def test_no_durability(self, sync_path_mock):
+        """
+        With the C{"none"} durability level messages are never synced to
+        disk.
+        """
+        store = self.create_store(durability="none")
+        store.add({"type": "empty"})
+        store.commit()
+        self.assertEqual(0, sync_path_mock.call_count)
+        self.assertEqual(0, store.get_sync_stats()["batches"])
+
+    def test_per_message_durability(self):
+        """
+        With the C{"per-message"} durability level every message is synced
+        to disk, along with its directory, before L{MessageStore.add}
+        returns.
+        """
+        store = self.create_store(durability="per-message")
+        store.add({"type": "empty"})
+        store.add({"type": "empty"})
+        stats = store.get_sync_stats()
+        self.assertEqual(2, stats["batches"])
+        self.assertEqual(2, stats["messages"])
+        self.assertEqual(1, stats["max-batch-size"])
+        self.assertEqual(4, stats["fsyncs"])
+
+    @mock.patch("os.fsync")
+    def test_group_durability(self, fsync_mock):
+        """
+        With the C{"group"} durability level messages are synced together
+        when C{group_commit_size} of them are waiting, syncing their
+        directory only once.
+        """
+        store = self.create_store(reactor=FakeReactor())
+        store.group_commit_size = 3
+        store.add({"type": "empty"})
+        store.add({"type": "empty"})
+        calls = fsync_mock.call_count
+        self.assertEqual(0, store.get_sync_stats()["batches"])
+        store.add({"type": "empty"})
+        self.assertEqual(calls + 4, fsync_mock.call_count)
+        stats = store.get_sync_stats()
+        self.assertEqual(1, stats["batches"])
+        self.assertEqual(3, stats["messages"])
+        self.assertEqual(3, stats["max-batch-size"])
+        self.assertEqual(4, stats["fsyncs"])
+
+    def test_group_durability_window(self):
+        """
+        If a reactor is given, messages waiting to be synced are synced after
+        C{group_commit_window} seconds.
+        """
+        reactor = FakeReactor()
+        store = self.create_store(reactor=reactor)
+        store.add({"type": "empty"})
+        store.add({"type": "empty"})
+        reactor.advance(store.group_commit_window)
+        self.assertEqual(1, store.get_sync_stats()["batches"])
+        self.assertEqual(2, store.get_sync_stats()["messages"])
+        reactor.advance(store.group_commit_window)
+        self.assertEqual(1, store.get_sync_stats()["batches"])
+
+    def test_group_durability_without_reactor(self):
+        """
+        Without a reactor nothing would sync a group which isn't full, so
+        the C{"group"} durability level can't be selected.
+        """
+        self.assertRaises(AssertionError, self.create_store,
+                          durability="group")
+
+    def test_when_synced(self):
+        """
+        L{MessageStore.when_synced} returns a L{Deferred} firing with the
+        given result once the messages waiting to be synced are flushed.
+        """
+        reactor = FakeReactor()
+        store = self.create_store(reactor=reactor)
+        message_id = store.add({"type": "empty"})
+        results = []
+        store.when_synced(message_id).addCallback(results.append)
+        self.assertEqual([], results)
+        reactor.advance(store.group_commit_window)
+        self.assertEqual([message_id], results)
+
+    def test_when_synced_without_unsynced_messages(self):
+        """
+        If no message is waiting to be synced L{MessageStore.when_synced}
+        returns the given result right away.
+        """
+        store = self.create_store(durability="per-message")
+        message_id = store.add({"type": "empty"})
+        self.assertEqual(message_id, store.when_synced(message_id))
+
+    @mock.patch("os.fsync")
+    def test_when_synced_with_sync_error(self, fsync_mock):
+        """
+        If the messages can't be synced the L{Deferred} returned by
+        L{MessageStore.when_synced} fails.
+        """
+        store = self.create_store(reactor=FakeReactor())
+        deferred = store.when_synced(store.add({"type": "empty"}))
+        fsync_mock.side_effect = OSError("No space left")
+        self.assertRaises(OSError, store.flush)
+        self.failureResultOf(deferred).trap(OSError)
+
+    def test_commit_syncs_messages(self):
+        """L{MessageStore.commit} syncs the messages waiting to be synced."""
+        store = self.create_store(reactor=FakeReactor())
+        store.add({"type": "empty"})
+        self.assertEqual(0, store.get_sync_stats()["messages"])
+        store.commit()
+        self.assertEqual(1, store.get_sync_stats()["messages"])
+
+    def test_flush_skips_deleted_messages(self):
+        """
+        Messages deleted before being synced are skipped by
+        L{MessageStore.flush}.
+        """
+        store = self.create_store(reactor=FakeReactor())
+        store.add({"type": "empty"})
+        store.add({"type": "unaccepted", "data": b"blah"})
+        store.delete_all_messages()
+        store.flush()
+        self.assertEqual(0, store.get_sync_stats()["fsyncs"])
+
+    def test_count_quota(self):
+        """
+        When the messages of a type exceed their count quota, the oldest
+        ones are evicted as soon as a new one is added.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=2))
+        for i in range(4):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.add({"type": "empty"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"2"},
+                             {"type": "data", "data": b"3"},
+                             {"type": "empty"}])
+        self.assertEqual({"data": {"messages": 2, "bytes": 2 * 39}},
+                         self.store.get_eviction_stats())
+
+    def test_bytes_quota(self):
+        """
+        The messages of a type are evicted when their total size exceeds
+        their bytes quota, but the newest message is always kept.
+        """
+        self.store.set_quota("data", MessageQuota(max_bytes=60))
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "data", "data": b"2" * 100})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"2" * 100}])
+
+    def test_quota_keeps_delivered_messages(self):
+        """
+        Messages which were marked as in flight are never evicted, since the
+        server might be processing them.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=1))
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.add({"type": "data", "data": b"2"})
+        self.store.add({"type": "data", "data": b"3"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"1"},
+                             {"type": "data", "data": b"3"}])
+
+    def test_quota_evicts_messages_only_read(self):
+        """
+        Reading the pending messages doesn't protect them from eviction, only
+        L{MessageStore.mark_in_flight} does.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=1))
+        self.store.add({"type": "data", "data": b"1"})
+        self.assertEqual(1, len(self.store.get_pending_messages(1)))
+        self.store.add({"type": "data", "data": b"2"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"2"}])
+
+    def test_in_flight_offset_is_persisted(self):
+        """
+        The in flight offset is saved in the persist, so messages in flight
+        before a restart stay protected from eviction.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.commit()
+        store = self.create_store()
+        self.assertEqual(1, store.get_in_flight_offset())
+        store.set_quota("data", MessageQuota(max_count=1))
+        store.add({"type": "data", "data": b"2"})
+        store.add({"type": "data", "data": b"3"})
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "data", "data": b"1"},
+                             {"type": "data", "data": b"3"}])
+
+    def test_delete_all_messages_resets_in_flight_offset(self):
+        """Deleting all messages also resets the in flight offset."""
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.delete_all_messages()
+        self.assertEqual(0, self.store.get_in_flight_offset())
+
+    def test_quota_removes_emptied_directories(self):
+        """
+        Message directories emptied by evictions are removed, along with
+        their types file.
+        """
+        for i in range(21):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.assertEqual(["0", "1"], sorted(os.listdir(self.temp_dir)))
+        self.store.set_quota("data", MessageQuota(max_count=1))
+        self.store.add({"type": "data", "data": b"21"})
+        self.assertEqual(["1"], os.listdir(self.temp_dir))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"21"}])
+
+    def test_wb_quota_invalidates_recorded_types(self):
+        """
+        The recorded type of an evicted message is invalidated, so it's not
+        trusted for a new file with the same number.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=1))
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "data", "data": b"2"})
+        types = self.store._read_types_file("0")
+        self.assertEqual(0, types[1][0])
+        self.assertEqual("data", types[2][1])
+
+    def test_quota_evicts_held_messages(self):
+        """Held messages are evicted like pending ones."""
+        self.store.set_quota("unaccepted", MessageQuota(max_count=1))
+        self.store.add({"type": "unaccepted", "data": b"1"})
+        self.store.add({"type": "unaccepted", "data": b"2"})
+        self.store.set_accepted_types(["unaccepted"])
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "unaccepted", "data": b"2"}])
+
+    def test_downsample_quota(self):
+        """
+        With the C{"downsample"} policy the message whose neighbours are the
+        closest is evicted, the older one on ties, so the ones left span the
+        same time with a coarser resolution.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=4,
+                                                  policy="downsample"))
+        for i in range(5):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"0"},
+                             {"type": "data", "data": b"2"},
+                             {"type": "data", "data": b"3"},
+                             {"type": "data", "data": b"4"}])
+
+    def test_downsample_quota_spacing(self):
+        """
+        With the C{"downsample"} policy the messages left are spread over
+        the whole time span of the series, none of the gaps between them
+        getting much wider than the others.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=8,
+                                                  policy="downsample"))
+        for i in range(1, 40):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        times = [int(message["data"])
+                 for message in self.store.get_pending_messages()]
+        self.assertEqual(8, len(times))
+        self.assertEqual([1, 39], [times[0], times[-1]])
+        gaps = [newer - older for older, newer in zip(times, times[1:])]
+        average = (39 - 1) / 7.0
+        for gap in gaps:
+            self.assertTrue(average / 2 <= gap <= average * 2, gaps)
+
+    def test_downsample_quota_keeps_series_ends(self):
+        """
+        With the C{"downsample"} policy the oldest message of a series is
+        only evicted once all the messages in the middle are gone, and the
+        newest one never is.
+        """
+        for i in range(20):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.set_quota("data", MessageQuota(max_count=2,
+                                                  policy="downsample"))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"0"},
+                             {"type": "data", "data": b"19"}])
+        self.store.set_quota("data", MessageQuota(max_count=1,
+                                                  policy="downsample"))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"19"}])
+
+    def test_set_quota_enforces_it(self):
+        """A new quota is enforced right away on the stored messages."""
+        for i in range(3):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.set_quota("data", MessageQuota(max_count=1))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "data", "data": b"2"}])
+
+    def test_quota_after_restart(self):
+        """Messages stored before a restart count against the quota."""
+        self.store.add({"type": "data", "data": b"1"})
+        store = self.create_store()
+        store.set_quota("data", MessageQuota(max_count=1))
+        store.add({"type": "data", "data": b"2"})
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "data", "data": b"2"}])
+
+    def test_add_messages_with_quota(self):
+        """Quotas are enforced once per type by L{MessageStore.add_messages}.
+        """
+        self.store.set_quota("data", MessageQuota(max_count=1))
+        self.store.add_messages([{"type": "data", "data": b"1"},
+                                 {"type": "empty"},
+                                 {"type": "data", "data": b"2"}])
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "empty"},
+                             {"type": "data", "data": b"2"}])
+
+    def test_parse_message_quotas(self):
+        """
+        L{parse_message_quotas} parses the value of the
+        C{message_store_quotas} option.
+        """
+        self.assertEqual(
+            {"computer-info": MessageQuota(max_count=1),
+             "cpu-usage": MessageQuota(max_count=10, max_bytes=1000,
+                                       policy="downsample")},
+            parse_message_quotas(
+                "computer-info:count=1, "
+                "cpu-usage:count=10:bytes=1000:policy=downsample"))
+        self.assertEqual({}, parse_message_quotas(""))
+        self.assertRaises(ValueError, parse_message_quotas, "data:size=1")
+        self.assertRaises(ValueError, parse_message_quotas,
+                          "data:policy=random")
+
+    def test_coalesced_message_replaces_pending_one(self):
+        """
+        A message whose schema is coalesced replaces the pending message of
+        the same type in place, instead of being appended.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot", "empty"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.add({"type": "empty"})
+        message_id = self.store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"2"},
+                             {"type": "empty"}])
+        self.assertTrue(self.store.is_pending(message_id))
+        # The snapshot gets held and unheld while creating the new store.
+        store = self.create_store()
+        store.add_schema(Message("snapshot", {"data": Bytes()}))
+        store.set_accepted_types(["snapshot", "empty"])
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "empty"},
+                             {"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_replaces_read_one(self):
+        """
+        Reading a pending message, for example to check whether any is left,
+        doesn't prevent it from being replaced.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.assertEqual(1, len(self.store.get_pending_messages(1)))
+        self.store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_keeps_in_flight_one_after_restart(self):
+        """
+        A message marked as in flight is still not replaced after a restart.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.commit()
+        store = self.create_store()
+        store.add_schema(Message("snapshot", {"data": Bytes()},
+                                 coalesce=True))
+        store.set_accepted_types(["snapshot"])
+        store.add({"type": "snapshot", "data": b"2"})
+        self.assertMessages(store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"1"},
+                             {"type": "snapshot", "data": b"2"}])
+
+    def test_coalesced_message_keeps_delivered_one(self):
+        """
+        A message marked as in flight is never replaced, since the server
+        might be processing it.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot"])
+        self.store.add({"type": "snapshot", "data": b"1"})
+        self.store.mark_in_flight(1)
+        self.store.add({"type": "snapshot", "data": b"2"})
+        self.store.add({"type": "snapshot", "data": b"3"})
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"1"},
+                             {"type": "snapshot", "data": b"3"}])
+
+    def test_add_messages_coalesces_messages(self):
+        """
+        L{MessageStore.add_messages} coalesces the messages of a batch,
+        keeping the order of the others.
+        """
+        self.store.add_schema(Message("snapshot", {"data": Bytes()},
+                                      coalesce=True))
+        self.store.set_accepted_types(["snapshot", "data"])
+        message_ids = self.store.add_messages(
+            [{"type": "snapshot", "data": b"1"},
+             {"type": "data", "data": b"A"},
+             {"type": "snapshot", "data": b"2"},
+             {"type": "data", "data": b"B"}])
+        self.assertEqual(4, len(message_ids))
+        self.assertMessages(self.store.get_pending_messages(),
+                            [{"type": "snapshot", "data": b"2"},
+                             {"type": "data", "data": b"A"},
+                             {"type": "data", "data": b"B"}])
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
+import zlib
 
 from landscape import VERSION
-from landscape.client.broker.transport import HTTPTransport
+from landscape.client.broker.transport import (
+    COMPRESSION_GZIP, CONNECTION_HTTP2,
+    CONNECTION_KEEP_ALIVE, HTTPTransport, compress_chunks,
+    parse_accept_encoding, parse_retry_after)
 from landscape.lib import bpickle
-from landscape.lib.fetch import PyCurlError
+from landscape.lib.fetch import HTTPCodeError, PyCurlError
 from landscape.lib.testing import LogKeeperHelper
 
 from landscape.client.tests.helpers import LandscapeTest
@@ -38,6 +42,113 @@ class DataCollectingResource(resource.Resource):
         return bpickle.dumps("Great.")
 
 
+class CompressionAcceptingResource(DataCollectingResource):
+    """Advertise gzip compressed requests, and record their encodings."""
+
+    def __init__(self):
+        DataCollectingResource.__init__(self)
+        self.encodings = []
+
+    def render(self, request):
+        self.encodings.append(request.getHeader("content-encoding"))
+        request.setHeader("Accept-Encoding", "gzip")
+        return DataCollectingResource.render(self, request)
+
+
+class CompressionRejectingResource(CompressionAcceptingResource):
+    """Advertise gzip compressed requests, but fail them.
+
+    @param accepted: The number of compressed requests to accept before
+        failing them.
+    """
+
+    def __init__(self, code=415, accepted=0):
+        CompressionAcceptingResource.__init__(self)
+        self.code = code
+        self.accepted = accepted
+
+    def render(self, request):
+        if request.getHeader("content-encoding"):
+            if self.accepted:
+                self.accepted -= 1
+            else:
+                self.encodings.append(request.getHeader("content-encoding"))
+                request.setResponseCode(self.code)
+                request.setHeader("Connection", "close")
+                return b""
+        return CompressionAcceptingResource.render(self, request)
+
+
+class UnavailableResource(DataCollectingResource):
+
+    def render(self, request):
+        request.setResponseCode(503)
+        request.setHeader("Retry-After", "42")
+        request.setHeader("Connection", "close")
+        return b""
+
+
+class CompressChunksTest(LandscapeTest):
+
+    def test_gzip(self):
+        """
+        L{compress_chunks} compresses the given byte strings as a whole
+        with gzip.
+        """
+        compressed = compress_chunks([b"foo", b"bar" * 100], "gzip", 6)
+        self.assertEqual(b"foo" + b"bar" * 100,
+                         zlib.decompress(b"".join(compressed),
+                                         16 + zlib.MAX_WBITS))
+
+
+class ParseRetryAfterTest(LandscapeTest):
+
+    def test_seconds(self):
+        """L{parse_retry_after} returns a number of seconds as it is."""
+        self.assertEqual(120, parse_retry_after(
+            [b"HTTP/1.1 503 Service Unavailable\r\n",
+             b"Retry-After: 120\r\n"], 0))
+
+    def test_date(self):
+        """
+        L{parse_retry_after} converts a date to the number of seconds from
+        the given current time.
+        """
+        self.assertEqual(60, parse_retry_after(
+            [b"retry-after: Thu, 01 Jan 1970 00:02:00 GMT\r\n"], 60))
+
+    def test_missing(self):
+        """L{parse_retry_after} returns C{None} without a valid header."""
+        self.assertIs(None, parse_retry_after([b"Server: foo\r\n"], 0))
+        self.assertIs(None, parse_retry_after([b"Retry-After: soon\r\n"], 0))
+
+
+class ParseAcceptEncodingTest(LandscapeTest):
+
+    def test_encodings(self):
+        """
+        L{parse_accept_encoding} returns the encodings listed in the header,
+        skipping the ones with a quality of 0.
+        """
+        self.assertEqual({"gzip", "zstd"}, parse_accept_encoding(
+            [b"HTTP/1.1 200 OK\r\n",
+             b"Accept-Encoding: GZip, zstd;q=0.5, br;q=0\r\n"]))
+
+    def test_last_response(self):
+        """
+        Only the headers of the last response are considered, like the ones
+        following a redirect.
+        """
+        self.assertIs(None, parse_accept_encoding(
+            [b"HTTP/1.1 302 Found\r\n",
+             b"Accept-Encoding: gzip\r\n",
+             b"HTTP/1.1 200 OK\r\n"]))
+
+    def test_missing(self):
+        """L{parse_accept_encoding} returns C{None} without the header."""
+        self.assertIs(None, parse_accept_encoding([b"Server: foo\r\n"]))
+
+
 class HTTPTransportTest(LandscapeTest):
 
     helpers = [LogKeeperHelper]
@@ -105,6 +216,303 @@ class HTTPTransportTest(LandscapeTest):
         """
         return self.request_with_payload(payload=u"проба")
 
+    def test_keep_alive(self):
+        """
+        With a C{keep-alive} connection the same curl handle is used for all
+        exchanges, so its connection can be reused, and the timings of the
+        exchanges are logged.
+        """
+        resource = DataCollectingResource()
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = HTTPTransport(
+            None, "http://localhost:%d/" % (port.getHost().port,),
+            connection=CONNECTION_KEEP_ALIVE)
+        self.addCleanup(transport.close)
+        curls = []
+
+        def exchange():
+            transport.exchange("HI", computer_id="34", message_api="X.Y")
+            curls.append(transport._persistent_curl)
+
+        result = deferToThread(exchange)
+        result.addCallback(lambda ignored: deferToThread(exchange))
+
+        def got_result(ignored):
+            self.assertIsNot(None, curls[0])
+            self.assertIs(curls[0], curls[1])
+            self.assertEqual(bpickle.loads(resource.content), "HI")
+            self.assertIn("Exchange timings: connect", self.logfile.getvalue())
+        result.addCallback(got_result)
+        return result
+
+    def test_close(self):
+        """
+        L{HTTPTransport.close} closes the curl handle kept across exchanges.
+        """
+        transport = HTTPTransport(None, "http://localhost/",
+                                  connection=CONNECTION_HTTP2)
+        curl = transport._get_persistent_curl()
+        self.assertIs(curl, transport._get_persistent_curl())
+        transport.close()
+        self.assertIs(None, transport._persistent_curl)
+        self.assertIsNot(curl, transport._get_persistent_curl())
+        transport.close()
+
+    def test_close_during_exchange(self):
+        """
+        L{HTTPTransport.close} doesn't wait for an exchange in progress, the
+        curl handle is closed once the transfer is over.
+        """
+        transport = HTTPTransport(None, "http://localhost/",
+                                  connection=CONNECTION_KEEP_ALIVE)
+        closed = []
+
+        def fetch(curl, payload, headers, **kwargs):
+            # The lock is held by _curl, this would hang if close blocked.
+            transport.close()
+            closed.append(transport._persistent_curl is None)
+            return b"data"
+
+        transport._fetch = fetch
+        curl, data = transport._curl(b"payload", None, None, b"X.Y")
+        self.assertEqual([False], closed)
+        self.assertEqual(b"data", data)
+        self.assertIs(None, transport._persistent_curl)
+        self.assertFalse(transport._closing)
+
+    def test_close_while_releasing_after_exchange(self):
+        """
+        If L{HTTPTransport.close} is called once the exchange thread is done
+        with the curl handle, but before it released the lock, the handle
+        is still closed.
+        """
+        transport = HTTPTransport(None, "http://localhost/",
+                                  connection=CONNECTION_KEEP_ALIVE)
+        transport._fetch = lambda curl, payload, headers, **kwargs: b"data"
+        lock = transport._lock
+        flagged = []
+
+        class RacingLock(object):
+
+            def acquire(self, blocking=True):
+                return lock.acquire(blocking)
+
+            def release(self):
+                if transport._persistent_curl is not None:
+                    # The lock is still held, so close() can only flag the
+                    # request.
+                    transport.close()
+                    flagged.append(transport._persistent_curl is not None)
+                lock.release()
+
+            __enter__ = acquire
+
+            def __exit__(self, *exc_info):
+                self.release()
+
+        transport._lock = RacingLock()
+        curl, data = transport._curl(b"payload", None, None, b"X.Y")
+        self.assertEqual(b"data", data)
+        self.assertEqual([True], flagged)
+        self.assertIs(None, transport._persistent_curl)
+        self.assertFalse(transport._closing)
+
+    def exchange_with(self, resource, payloads, **kwargs):
+        """Exchange the given C{payloads} in turn with C{resource}.
+
+        @return: A L{Deferred} firing with the transport and the responses.
+        """
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = HTTPTransport(
+            None, "http://localhost:%d/" % (port.getHost().port,), **kwargs)
+
+        def exchange(payloads, responses):
+            if not payloads:
+                return (transport, responses)
+            result = deferToThread(transport.exchange, payloads[0],
+                                   computer_id="34", message_api="X.Y")
+            result.addCallback(
+                lambda response: exchange(payloads[1:],
+                                          responses + [response]))
+            return result
+
+        return exchange(payloads, [])
+
+    def test_compression(self):
+        """
+        Once the server advertised the encoding, payloads larger than the
+        compression threshold are compressed, and the sizes of both the raw
+        and the compressed payloads are logged.
+        """
+        resource = CompressionAcceptingResource()
+        payload = "HI" * 100
+        result = self.exchange_with(
+            resource, [payload, payload], compression=COMPRESSION_GZIP,
+            compression_threshold=100)
+
+        def got_result(ignored):
+            self.assertEqual([None, "gzip"], resource.encodings)
+            content = zlib.decompress(resource.content, 16 + zlib.MAX_WBITS)
+            self.assertEqual(payload, bpickle.loads(content))
+            self.assertIn("Sent 205 bytes (%d bytes gzip compressed)"
+                          % len(resource.content), self.logfile.getvalue())
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_not_advertised(self):
+        """
+        Payloads aren't compressed if the server didn't advertise the
+        encoding.
+        """
+        resource = DataCollectingResource()
+        result = self.exchange_with(
+            resource, ["HI", "HI"], compression=COMPRESSION_GZIP,
+            compression_threshold=0)
+
+        def got_result(ignored):
+            get_header = resource.request.requestHeaders.getRawHeaders
+            self.assertIs(None, get_header("content-encoding"))
+            self.assertEqual("HI", bpickle.loads(resource.content))
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_threshold(self):
+        """
+        Payloads smaller than the compression threshold are sent as they
+        are.
+        """
+        resource = CompressionAcceptingResource()
+        result = self.exchange_with(
+            resource, ["HI", "HI"], compression=COMPRESSION_GZIP,
+            compression_threshold=1000)
+
+        def got_result(ignored):
+            self.assertEqual([None, None], resource.encodings)
+            self.assertEqual("HI", bpickle.loads(resource.content))
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_rejected(self):
+        """
+        If the server rejects the first compressed payload, it's sent again
+        uncompressed, and compression is disabled for the server URL.
+        """
+        resource = CompressionRejectingResource()
+        result = self.exchange_with(
+            resource, ["HI", "HI", "HI"], compression=COMPRESSION_GZIP,
+            compression_threshold=0)
+
+        def got_result(result):
+            transport, responses = result
+            self.assertEqual(["Great."] * 3, responses)
+            self.assertEqual([None, "gzip", None, None], resource.encodings)
+            self.assertEqual("HI", bpickle.loads(resource.content))
+            self.assertIn("failed a gzip compressed payload with HTTP code "
+                          "415", self.logfile.getvalue())
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_failed(self):
+        """
+        A 400 Bad Request replied to the first compressed payload disables
+        compression for the server URL as well.
+        """
+        resource = CompressionRejectingResource(code=400)
+        result = self.exchange_with(
+            resource, ["HI", "HI", "HI"], compression=COMPRESSION_GZIP,
+            compression_threshold=0)
+
+        def got_result(result):
+            transport, responses = result
+            self.assertEqual(["Great."] * 3, responses)
+            self.assertEqual([None, "gzip", None, None], resource.encodings)
+            self.assertIn("failed a gzip compressed payload with HTTP code "
+                          "400", self.logfile.getvalue())
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_unavailable(self):
+        """
+        Other errors replied to the first compressed payload, like a 503
+        during an outage, are raised as they are, so that the exchange backs
+        off, and compression stays enabled.
+        """
+        self.log_helper.ignore_errors(HTTPCodeError)
+        resource = CompressionRejectingResource(code=503)
+        result = self.exchange_with(
+            resource, ["HI"], compression=COMPRESSION_GZIP,
+            compression_threshold=0)
+
+        def exchange(result):
+            transport, responses = result
+            result = deferToThread(transport.exchange, "HI",
+                                   computer_id="34", message_api="X.Y")
+            result.addCallbacks(lambda ignored: self.fail(), got_error,
+                                errbackArgs=(transport,))
+            return result
+
+        def got_error(failure, transport):
+            failure.trap(HTTPCodeError)
+            self.assertEqual(503, failure.value.http_code)
+            self.assertEqual([None, "gzip"], resource.encodings)
+            resource.accepted = 1
+            return deferToThread(transport.exchange, "HI",
+                                 computer_id="34", message_api="X.Y")
+
+        def got_result(response):
+            self.assertEqual("Great.", response)
+            self.assertEqual([None, "gzip", "gzip"], resource.encodings)
+
+        result.addCallback(exchange)
+        result.addCallback(got_result)
+        return result
+
+    def test_compression_failed_after_success(self):
+        """
+        Once a compressed payload went through, errors other than 415 are
+        raised as they are, without disabling compression.
+        """
+        self.log_helper.ignore_errors(HTTPCodeError)
+        resource = CompressionRejectingResource(code=500, accepted=1)
+        result = self.exchange_with(
+            resource, ["HI", "HI", "HI"], compression=COMPRESSION_GZIP,
+            compression_threshold=0)
+
+        def got_error(failure):
+            failure.trap(HTTPCodeError)
+            self.assertEqual(500, failure.value.http_code)
+            self.assertEqual([None, "gzip", "gzip"], resource.encodings)
+
+        result.addCallbacks(lambda ignored: self.fail(), got_error)
+        return result
+
+    def test_retry_after(self):
+        """
+        If the server replies with an error and a C{Retry-After} header,
+        the raised L{HTTPCodeError} holds the hint.
+        """
+        self.log_helper.ignore_errors(HTTPCodeError)
+        resource = UnavailableResource()
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = HTTPTransport(
+            None, "http://localhost:%d/" % (port.getHost().port,))
+        result = deferToThread(transport.exchange, "HI", computer_id="34",
+                               message_api="X.Y")
+
+        def got_error(failure):
+            failure.trap(HTTPCodeError)
+            self.assertEqual(503, failure.value.http_code)
+            self.assertEqual(42, failure.value.retry_after)
+
+        result.addCallbacks(lambda ignored: self.fail(), got_error)
+        return result
+
     def test_ssl_verification_positive(self):
         """
         The client transport should complete an upload of messages to
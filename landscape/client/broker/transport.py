@@ -2,29 +2,161 @@
 import time
 import logging
 import pprint
+import threading
 import uuid
+import zlib
+from email.utils import mktime_tz, parsedate_tz
 
 import pycurl
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from twisted.python.compat import unicode, _PY3
 
 from landscape.lib import bpickle
-from landscape.lib.fetch import fetch
+from landscape.lib.fetch import fetch, HTTPCodeError
 from landscape.lib.format import format_delta
 from landscape import SERVER_API, VERSION
 
 
+CONNECTION_CLOSE = "close"
+CONNECTION_KEEP_ALIVE = "keep-alive"
+CONNECTION_HTTP2 = "http2"
+
+# For how long name resolutions are cached by persistent connections.
+DNS_CACHE_TIMEOUT = 5 * 60
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+
+def compress_chunks(chunks, encoding, level):
+    """Compress a sequence of byte strings.
+
+    @param chunks: The byte strings to compress, as a whole.
+    @param encoding: The content encoding to use, either C{COMPRESSION_GZIP}
+        or C{COMPRESSION_ZSTD}.
+    @param level: The compression level.
+    @return: A C{list} of compressed byte strings.
+    """
+    if encoding == COMPRESSION_ZSTD:
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        compressor = zlib.compressobj(
+            min(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = [compressor.compress(chunk) for chunk in chunks]
+    compressed.append(compressor.flush())
+    return [chunk for chunk in compressed if chunk]
+
+
+def parse_retry_after(header_lines, now):
+    """Get the number of seconds to wait from a C{Retry-After} header.
+
+    @param header_lines: The raw header lines of an HTTP response.
+    @param now: The current time, used if the header holds a date.
+    @return: The number of seconds, or C{None} if the header is missing or
+        invalid.
+    """
+    for line in header_lines:
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() != "retry-after":
+            continue
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        date = parsedate_tz(value)
+        if date is not None:
+            return max(0, int(mktime_tz(date) - now))
+    return None
+
+
+def parse_accept_encoding(header_lines):
+    """Get the content encodings a server accepts in requests.
+
+    Servers advertise them with an C{Accept-Encoding} response header.
+
+    @param header_lines: The raw header lines of an HTTP response. If they
+        hold several responses, for example because of redirects, only the
+        last one is considered.
+    @return: A C{frozenset} of content encodings, or C{None} if the header
+        is missing.
+    """
+    encodings = None
+    for line in header_lines:
+        line = line.decode("latin-1")
+        if line.startswith("HTTP/"):
+            encodings = None
+            continue
+        name, _, value = line.partition(":")
+        if name.strip().lower() != "accept-encoding":
+            continue
+        encodings = set(encodings or ())
+        for item in value.split(","):
+            coding, _, params = item.partition(";")
+            coding = coding.strip().lower()
+            quality = params.replace(" ", "").lower().partition("q=")[2]
+            try:
+                refused = float(quality) == 0 if quality else False
+            except ValueError:
+                refused = False
+            if coding and not refused:
+                encodings.add(coding)
+        encodings = frozenset(encodings)
+    return encodings
+
+
 class HTTPTransport(object):
     """Transport makes a request to exchange message data over HTTP.
 
     @param url: URL of the remote Landscape server message system.
     @param pubkey: SSH public key used for secure communication.
+    @param connection: Either C{CONNECTION_CLOSE}, to use a new connection
+        for every exchange, C{CONNECTION_KEEP_ALIVE}, to keep using the same
+        connection, TLS session and name resolution across exchanges, or
+        C{CONNECTION_HTTP2}, which also negotiates HTTP/2 with the server
+        when possible.
+    @param compression: The encoding used to compress the payloads, either
+        C{COMPRESSION_NONE}, C{COMPRESSION_GZIP} or C{COMPRESSION_ZSTD}.
+        Payloads are only compressed once the server advertised the encoding
+        in the C{Accept-Encoding} header of a response. If the server fails
+        the first compressed payload, or rejects a later one as an
+        unsupported media type, the payload is sent again uncompressed, and
+        compression is disabled for that server URL.
+    @param compression_level: The compression level.
+    @param compression_threshold: Payloads smaller than this number of
+        bytes are sent uncompressed.
     """
 
-    def __init__(self, reactor, url, pubkey=None):
+    def __init__(self, reactor, url, pubkey=None,
+                 connection=CONNECTION_CLOSE, compression=COMPRESSION_NONE,
+                 compression_level=6, compression_threshold=1024):
         self._reactor = reactor
         self._url = url
         self._pubkey = pubkey
+        self._connection = connection
+        if compression == COMPRESSION_ZSTD and zstandard is None:
+            logging.warning("The zstandard module is not available, "
+                            "compressing payloads with gzip instead.")
+            compression = COMPRESSION_GZIP
+        self._compression = compression
+        self._compression_level = compression_level
+        self._compression_threshold = compression_threshold
+        # The request encodings advertised by each server URL, the URLs
+        # which accepted a compressed payload, and the ones which didn't.
+        self._server_encodings = {}
+        self._compressed_urls = set()
+        self._uncompressed_urls = set()
+        self._persistent_curl = None
+        # Exchanges are performed in threads, and a curl handle can't be
+        # used by more than one of them at the same time.
+        self._lock = threading.Lock()
+        # Set when the transport is closed during an exchange, the handle is
+        # then closed by the exchange thread once the transfer is over.
+        self._closing = False
 
     def get_url(self):
         """Get the URL of the remote message system."""
@@ -34,7 +166,8 @@ class HTTPTransport(object):
         """Set the URL of the remote message system."""
         self._url = url
 
-    def _curl(self, payload, computer_id, exchange_token, message_api):
+    def _curl(self, payload, computer_id, exchange_token, message_api,
+              content_encoding=None):
         # There are a few "if _PY3" checks below, because for Python 3 we
         # want to convert a number of values from bytes to string, before
         # assigning them to the headers.
@@ -51,9 +184,112 @@ class HTTPTransport(object):
             if _PY3 and isinstance(exchange_token, bytes):
                 exchange_token = exchange_token.decode("ascii")
             headers["X-Exchange-Token"] = str(exchange_token)
-        curl = pycurl.Curl()
-        return (curl, fetch(self._url, post=True, data=payload,
-                            headers=headers, cainfo=self._pubkey, curl=curl))
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        if self._connection == CONNECTION_CLOSE:
+            curl = pycurl.Curl()
+            data = self._fetch(curl, payload, headers)
+            return (curl, data)
+        try:
+            with self._lock:
+                curl = self._get_persistent_curl()
+                data = self._fetch(curl, payload, headers,
+                                   dns_cache_timeout=DNS_CACHE_TIMEOUT)
+        finally:
+            # close() may have been called while the lock was held, up to
+            # right before it was released.
+            self._close_if_requested()
+        return (curl, data)
+
+    def _fetch(self, curl, payload, headers, **kwargs):
+        """Post the payload with the given curl handle.
+
+        If the server replies with an HTTP error, the C{retry_after} hint it
+        may have given is set on the raised L{HTTPCodeError}.
+        """
+        header_lines = []
+        curl.setopt(pycurl.HEADERFUNCTION, header_lines.append)
+        try:
+            data = fetch(self._url, post=True, data=payload, headers=headers,
+                         cainfo=self._pubkey, curl=curl, **kwargs)
+        except HTTPCodeError as error:
+            error.retry_after = parse_retry_after(header_lines, time.time())
+            raise
+        encodings = parse_accept_encoding(header_lines)
+        if encodings is not None:
+            self._server_encodings[self._url] = encodings
+        self._log_timings(curl)
+        return data
+
+    def _get_persistent_curl(self):
+        """Get the curl handle shared by all exchanges.
+
+        Resetting the handle clears the options set by the last exchange,
+        while keeping its open connections and its caches of TLS sessions
+        and name resolutions.
+        """
+        if self._persistent_curl is None:
+            self._persistent_curl = pycurl.Curl()
+        else:
+            self._persistent_curl.reset()
+        if self._connection == CONNECTION_HTTP2:
+            # Negotiate HTTP/2 over TLS, falling back to HTTP/1.1.
+            version = getattr(pycurl, "CURL_HTTP_VERSION_2TLS",
+                              getattr(pycurl, "CURL_HTTP_VERSION_2_0", None))
+            if version is not None:
+                self._persistent_curl.setopt(pycurl.HTTP_VERSION, version)
+        return self._persistent_curl
+
+    def close(self):
+        """Close the connection kept open across exchanges, if any.
+
+        This is called from the reactor thread, so it doesn't wait for an
+        exchange in progress: the connection is then closed by the exchange
+        thread once its transfer is over.
+        """
+        self._closing = True
+        self._close_if_requested()
+
+    def _close_if_requested(self):
+        """Close the curl handle if L{close} was called, unless it's in use.
+
+        The request is flagged before trying to take the lock, and the
+        exchange threads check the flag after releasing it, so whichever
+        comes last closes the handle.
+        """
+        while self._closing and self._lock.acquire(False):
+            try:
+                if self._closing:
+                    self._close_persistent_curl()
+            finally:
+                self._lock.release()
+
+    def _close_persistent_curl(self):
+        """Close the curl handle kept across exchanges, if any.
+
+        The caller must hold C{self._lock}.
+        """
+        self._closing = False
+        if self._persistent_curl is not None:
+            self._persistent_curl.close()
+            self._persistent_curl = None
+
+    def _log_timings(self, curl):
+        """Log how long the phases of the last exchange took."""
+        try:
+            connects = curl.getinfo(pycurl.NUM_CONNECTS)
+            connect_time = curl.getinfo(pycurl.CONNECT_TIME)
+            tls_time = curl.getinfo(pycurl.APPCONNECT_TIME)
+            pretransfer_time = curl.getinfo(pycurl.PRETRANSFER_TIME)
+            total_time = curl.getinfo(pycurl.TOTAL_TIME)
+        except (pycurl.error, ValueError):
+            return
+        logging.info(
+            "Exchange timings: connect %s, TLS %s, transfer %s (%s).",
+            format_delta(connect_time),
+            format_delta(max(0, tls_time - connect_time) if tls_time else 0),
+            format_delta(total_time - pretransfer_time),
+            "new connection" if connects else "reused connection")
 
     def exchange(self, payload, computer_id=None, exchange_token=None,
                  message_api=SERVER_API):
@@ -73,20 +309,30 @@ class HTTPTransport(object):
         @note: This code is thread safe (HOPEFULLY).
 
         """
-        spayload = bpickle.dumps(payload)
+        # Serialize the payload in chunks, so that the already encoded
+        # messages are sent as they are, without building a single large
+        # byte string.
+        spayload = list(bpickle.dumps_chunks(payload))
         start_time = time.time()
         if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
             logging.debug("Sending payload:\n%s", pprint.pformat(payload))
+        size = sum(len(chunk) for chunk in spayload)
         try:
-            curly, data = self._curl(spayload, computer_id, exchange_token,
-                                     message_api)
+            content_encoding, sent, data = self._send(
+                spayload, size, computer_id, exchange_token, message_api)
         except Exception:
             logging.exception("Error contacting the server at %s." % self._url)
             raise
         else:
-            logging.info("Sent %d bytes and received %d bytes in %s.",
-                         len(spayload), len(data),
-                         format_delta(time.time() - start_time))
+            if content_encoding:
+                logging.info("Sent %d bytes (%d bytes %s compressed) and "
+                             "received %d bytes in %s.", size, sent,
+                             content_encoding, len(data),
+                             format_delta(time.time() - start_time))
+            else:
+                logging.info("Sent %d bytes and received %d bytes in %s.",
+                             size, len(data),
+                             format_delta(time.time() - start_time))
 
         try:
             response = bpickle.loads(data)
@@ -100,12 +346,64 @@ class HTTPTransport(object):
 
         return response
 
+    def _get_compression(self, url, size):
+        """Return the encoding to compress a payload of C{size} bytes with
+        for the given server C{url}, or C{None} to send it uncompressed."""
+        if (self._compression == COMPRESSION_NONE or
+                size < self._compression_threshold or
+                url in self._uncompressed_urls):
+            return None
+        if self._compression not in self._server_encodings.get(url, ()):
+            return None
+        return self._compression
+
+    def _send(self, spayload, size, computer_id, exchange_token,
+              message_api):
+        """Send the serialized payload, compressing it if needed.
+
+        @return: A tuple with the content encoding of the request body, or
+            C{None} if it wasn't compressed, the number of bytes actually
+            sent and the data received.
+        """
+        url = self._url
+        compression = self._get_compression(url, size)
+        if compression is not None:
+            body = compress_chunks(
+                spayload, compression, self._compression_level)
+            try:
+                curly, data = self._curl(body, computer_id, exchange_token,
+                                         message_api, compression)
+            except HTTPCodeError as error:
+                # 415 Unsupported Media Type is how a server rejects the
+                # compressed body, and some reply 400 Bad Request until they
+                # proved to handle it. Other errors, like a 503 during an
+                # outage, are left to the usual exchange backoff.
+                if error.http_code != 415 and (
+                        error.http_code != 400 or
+                        url in self._compressed_urls):
+                    raise
+                logging.warning("The server at %s failed a %s compressed "
+                                "payload with HTTP code %d, sending payloads "
+                                "uncompressed.", url, compression,
+                                error.http_code)
+                self._uncompressed_urls.add(url)
+            else:
+                self._compressed_urls.add(url)
+                return (compression, sum(len(chunk) for chunk in body), data)
+        curly, data = self._curl(spayload, computer_id, exchange_token,
+                                 message_api)
+        return (None, size, data)
+
 
 class FakeTransport(object):
     """Fake transport for testing purposes."""
 
-    def __init__(self, reactor=None, url=None, pubkey=None):
+    def __init__(self, reactor=None, url=None, pubkey=None,
+                 connection=CONNECTION_CLOSE, compression=COMPRESSION_NONE,
+                 compression_level=6, compression_threshold=1024):
         self._pubkey = pubkey
+        self._connection = connection
+        self._compression = compression
         self.payloads = []
         self.responses = []
         self._current_response = 0
@@ -123,8 +421,13 @@ class FakeTransport(object):
     def set_url(self, url):
         self._url = url
 
+    def close(self):
+        pass
+
     def exchange(self, payload, computer_id=None, exchange_token=None,
                  message_api=SERVER_API):
+        # Record the payload as the server would receive it.
+        payload = bpickle.loads(b"".join(bpickle.dumps_chunks(payload)))
         self.payloads.append(payload)
         self.computer_id = computer_id
         self.exchange_token = exchange_token
@@ -24,7 +24,7 @@ from landscape.lib.twisted_util import gather_results
 from landscape.lib.fetch import fetch, FetchError
 from landscape.lib.fs import create_binary_file
 from landscape.lib.bootstrap import BootstrapList, BootstrapDirectory
-from landscape.lib.persist import Persist
+from landscape.lib.persist import JournaledPersist
 from landscape.client.reactor import LandscapeReactor
 from landscape.client.broker.registration import RegistrationError
 from landscape.client.broker.config import BrokerConfiguration
@@ -754,7 +754,7 @@ def is_registered(config):
     """Return whether the client is already registered."""
     persist_filename = os.path.join(
         config.data_path, "{}.bpickle".format(BrokerService.service_name))
-    persist = Persist(filename=persist_filename)
+    persist = JournaledPersist(filename=persist_filename)
     identity = Identity(config, persist)
     return bool(identity.secure_id)
 
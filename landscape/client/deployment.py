@@ -7,7 +7,7 @@ from twisted.logger import globalLogBeginner
 from landscape import VERSION
 from landscape.lib import logging
 from landscape.lib.config import BaseConfiguration as _BaseConfiguration
-from landscape.lib.persist import Persist
+from landscape.lib.persist import JournaledPersist
 
 from landscape.client.upgraders import UPGRADE_MANAGERS
 
@@ -147,10 +147,11 @@ class Configuration(BaseConfiguration):
 def get_versioned_persist(service):
     """Get a L{Persist} database with upgrade rules applied.
 
-    Load a L{Persist} database for the given C{service} and upgrade or
-    mark as current, as necessary.
+    Load a database for the given C{service}, using its C{persist_factory}
+    or L{JournaledPersist}, and upgrade or mark as current, as necessary.
     """
-    persist = Persist(filename=service.persist_filename)
+    persist_factory = getattr(service, "persist_factory", JournaledPersist)
+    persist = persist_factory(filename=service.persist_filename)
     upgrade_manager = UPGRADE_MANAGERS[service.service_name]
     if os.path.exists(service.persist_filename):
         upgrade_manager.apply(persist)
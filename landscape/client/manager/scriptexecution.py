@@ -18,7 +18,7 @@ from twisted.python.compat import unicode
 from landscape import VERSION
 from landscape.constants import UBUNTU_PATH
 from landscape.lib.fetch import fetch_async, HTTPCodeError
-from landscape.lib.persist import Persist
+from landscape.lib.persist import JournaledPersist
 from landscape.lib.scriptcontent import build_script
 from landscape.lib.user import get_user_info
 from landscape.client.manager.plugin import ManagerPlugin, SUCCEEDED, FAILED
@@ -268,7 +268,7 @@ class ScriptExecutionPlugin(ManagerPlugin, ScriptRunnerMixin):
         old_umask = os.umask(0o022)
 
         if attachments:
-            persist = Persist(
+            persist = JournaledPersist(
                 filename=os.path.join(self.registry.config.data_path,
                                       "broker.bpickle"))
             persist = persist.root_at("registration")
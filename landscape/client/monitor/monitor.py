@@ -1,5 +1,6 @@
 """The Landscape monitor plugin system."""
 
+import logging
 import os
 
 from landscape.client.broker.client import BrokerClient
@@ -26,7 +27,9 @@ class Monitor(BrokerClient):
     def flush(self):
         """Flush data to disk."""
         if self.persist_filename:
-            self.persist.save(self.persist_filename)
+            size = self.persist.save(self.persist_filename)
+            if size:
+                logging.debug("Flushed %d bytes of monitor data.", size)
 
     def exchange(self):
         """Call C{exchange} on all plugins."""
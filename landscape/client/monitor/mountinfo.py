@@ -69,11 +69,23 @@ class MountInfo(MonitorPlugin):
         return None
 
     def send_messages(self, urgent=False):
-        for message in self.create_messages():
-            d = self.registry.broker.send_message(
-                message, self._session_id, urgent=urgent)
-            if message["type"] == "mount-info":
-                d.addCallback(lambda x: self.persist_mount_info())
+        messages = self.create_messages()
+        if not messages:
+            return
+        d = self.registry.broker.send_messages(
+            messages, self._session_id, urgent=urgent)
+        if any(message["type"] == "mount-info" for message in messages):
+            d.addCallback(self._mount_info_sent, messages)
+
+    def _mount_info_sent(self, message_ids, messages):
+        # The broker drops invalid messages one by one, only record the mount
+        # info if its message made it to the queue. The identifiers come in
+        # the same order as the messages, with None for the dropped ones.
+        if not message_ids:
+            return
+        for message, message_id in zip(messages, message_ids):
+            if message["type"] == "mount-info" and message_id is not None:
+                self.persist_mount_info()
 
     def exchange(self):
         self.registry.broker.call_if_accepted("mount-info",
@@ -104,7 +116,7 @@ class MountInfo(MonitorPlugin):
                 free_space = int(step_data[1])
                 self._free_space.append((timestamp, mount_point, free_space))
 
-            prev_mount_info = self._persist.get(("mount-info", mount_point))
+            prev_mount_info = self._persist.view(("mount-info", mount_point))
             if not prev_mount_info or prev_mount_info != mount_info:
                 if mount_info not in [m for t, m in self._mount_info]:
                     self._mount_info.append((now, mount_info))
@@ -4,6 +4,7 @@ import os
 
 from twisted.python.reflect import namedClass
 
+from landscape.lib.persist import ShardedPersist
 from landscape.client.service import LandscapeService, run_landscape_service
 from landscape.client.monitor.config import MonitorConfiguration
 from landscape.client.monitor.monitor import Monitor
@@ -18,6 +19,9 @@ class MonitorService(LandscapeService):
     """
 
     service_name = Monitor.name
+    # Plugins keep their state under their own persist_name, and some of
+    # them, like the users snapshot, can grow large.
+    persist_factory = ShardedPersist
 
     def __init__(self, config):
         self.persist_filename = os.path.join(
@@ -56,9 +56,10 @@ class Temperature(MonitorPlugin):
         return messages
 
     def send_messages(self, urgent):
-        for message in self.create_messages():
-            self.registry.broker.send_message(
-                message, self._session_id, urgent=urgent)
+        messages = self.create_messages()
+        if messages:
+            self.registry.broker.send_messages(
+                messages, self._session_id, urgent=urgent)
 
     def exchange(self, urgent=False):
         self.registry.broker.call_if_accepted("temperature",
@@ -119,6 +119,7 @@ class AptPreferencesTest(LandscapeTest):
                           sub_preferences_filename: u"foo"})
         for filename in messages[0]["data"]:
             self.assertTrue(isinstance(filename, unicode))
+        self.mstore.mark_in_flight(1)
 
         # Remove all APT preferences data from the system
         os.remove(main_preferences_filename)
@@ -172,6 +173,8 @@ class AptPreferencesTest(LandscapeTest):
         self.makeFile(path=preferences_filename, content="crap")
         self.mstore.set_accepted_types(["apt-preferences"])
         self.plugin.run()
+        # Send out the first message, or the second one would replace it.
+        self.mstore.mark_in_flight(1)
         self.reactor.fire("resynchronize", scopes=["package"])
         self.plugin.run()
         messages = self.mstore.get_pending_messages()
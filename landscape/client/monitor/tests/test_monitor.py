@@ -29,6 +29,18 @@ class MonitorTest(LandscapeTest):
         persist.load(self.monitor.persist_filename)
         self.assertEqual(persist.get("a"), 1)
 
+    def test_flush_without_changes(self):
+        """
+        The L{Monitor.flush} method doesn't write the persist database again
+        if nothing changed.
+        """
+        self.monitor.persist.set("a", 1)
+        self.monitor.flush()
+        self.monitor.flush()
+        stats = self.monitor.persist.get_save_stats()
+        self.assertEqual(1, stats["saves"])
+        self.assertEqual(1, stats["skipped-saves"])
+
     def test_flush_after_exchange(self):
         """
         The L{Monitor.exchange} method flushes the monitor after
@@ -48,7 +60,7 @@ class MonitorTest(LandscapeTest):
         The L{Monitor.flush} method gets called every C{flush_interval}
         seconds, and perists data to the disk.
         """
-        self.monitor.persist.save = Mock()
+        self.monitor.persist.save = Mock(return_value=0)
         self.reactor.advance(self.config.flush_interval * 3)
         self.monitor.persist.save.assert_called_with(
             self.monitor.persist_filename)
@@ -535,13 +535,14 @@ addr=ennui 0 0
 
         self.reactor.advance(plugin.run_interval)
 
-        with mock.patch.object(self.remote, "send_message"):
+        with mock.patch.object(self.remote, "send_messages"):
             self.reactor.fire(
                 ("message-type-acceptance-changed", "mount-info"),
                 True)
-            self.remote.send_message.assert_called_with(
+            self.remote.send_messages.assert_called_once_with(
                 mock.ANY, mock.ANY, urgent=True)
-            self.assertEqual(self.remote.send_message.call_count, 2)
+            [messages, _] = self.remote.send_messages.call_args[0]
+            self.assertEqual(2, len(messages))
 
     def test_persist_timing(self):
         """Mount info are only persisted when exchange happens.
@@ -581,6 +582,78 @@ addr=ennui 0 0
         message3 = plugin.create_mount_info_message()
         self.assertIdentical(message3, None)
 
+    def test_invalid_message_does_not_drop_the_others(self):
+        """
+        If one of the messages sent by the plugin is invalid, the broker only
+        drops that one and the mount info is still queued and persisted.
+        """
+        self.log_helper.ignore_errors("Dropped an invalid")
+        self.mstore.set_accepted_types(["mount-info", "free-space"])
+        plugin = self.get_mount_info(
+            statvfs=statvfs_result_fixture, create_time=self.reactor.time)
+        self.monitor.add(plugin)
+        plugin.run()
+        invalid = {"type": "free-space", "free-space": "invalid"}
+        with mock.patch.object(plugin, "create_free_space_message",
+                               return_value=invalid):
+            plugin.exchange()
+        messages = self.mstore.get_pending_messages()
+        self.assertEqual(["mount-info"],
+                         [message["type"] for message in messages])
+        self.assertIsNot(None, plugin._persist.get(("mount-info", "/")))
+        self.assertIn("Dropped an invalid free-space message",
+                      self.logfile.getvalue())
+
+    def reverse_messages(self, plugin, invalid_mount_info=False):
+        """
+        Make C{plugin} send its mount info message after the free space one,
+        optionally making it invalid.
+        """
+        create_messages = plugin.create_messages
+
+        def reversed_messages():
+            mount_info, free_space = create_messages()
+            if invalid_mount_info:
+                mount_info["mount-info"] = "invalid"
+            return [free_space, mount_info]
+
+        plugin.create_messages = reversed_messages
+
+    def test_mount_info_persisted_when_not_first(self):
+        """
+        The mount info is persisted once its message is queued, wherever it
+        is in the batch sent to the broker.
+        """
+        self.mstore.set_accepted_types(["mount-info", "free-space"])
+        plugin = self.get_mount_info(
+            statvfs=statvfs_result_fixture, create_time=self.reactor.time)
+        self.monitor.add(plugin)
+        self.reactor.advance(self.monitor.step_size * 2)
+        self.reverse_messages(plugin)
+        plugin.exchange()
+        messages = self.mstore.get_pending_messages()
+        self.assertEqual(["free-space", "mount-info"],
+                         [message["type"] for message in messages])
+        self.assertIsNot(None, plugin._persist.get(("mount-info", "/")))
+
+    def test_mount_info_not_persisted_when_dropped(self):
+        """
+        If the mount info message is dropped by the broker, the mount info
+        isn't persisted, even if the other messages of the batch are queued.
+        """
+        self.log_helper.ignore_errors("Dropped an invalid")
+        self.mstore.set_accepted_types(["mount-info", "free-space"])
+        plugin = self.get_mount_info(
+            statvfs=statvfs_result_fixture, create_time=self.reactor.time)
+        self.monitor.add(plugin)
+        self.reactor.advance(self.monitor.step_size * 2)
+        self.reverse_messages(plugin, invalid_mount_info=True)
+        plugin.exchange()
+        messages = self.mstore.get_pending_messages()
+        self.assertEqual(["free-space"],
+                         [message["type"] for message in messages])
+        self.assertIs(None, plugin._persist.get(("mount-info", "/")))
+
     def test_exchange_limits_exchanged_free_space_messages(self):
         """
         In order not to overload the server, the client should stagger the
@@ -1,5 +1,8 @@
+import os
+
 from mock import Mock
 
+from landscape.lib.persist import Persist, ShardedPersist
 from landscape.lib.testing import FakeReactor
 from landscape.client.tests.helpers import (
         LandscapeTest, FakeBrokerServiceHelper)
@@ -31,6 +34,13 @@ class MonitorServiceTest(LandscapeTest):
         """
         self.assertEqual(len(self.service.plugins), len(ALL_PLUGINS))
 
+    def test_persist(self):
+        """
+        The monitor persist keeps the state of each plugin in its own file.
+        """
+        self.assertIsInstance(self.service.persist, ShardedPersist)
+        self.assertIs(self.service.persist, self.service.monitor.persist)
+
     def test_get_plugins(self):
         """
         If the C{--monitor-plugins} command line option is specified, only the
@@ -77,3 +87,20 @@ class MonitorServiceTest(LandscapeTest):
         self.service.monitor.flush.assert_called_once_with()
         self.service.connector.disconnect.assert_called_once_with()
         self.service.publisher.stop.assert_called_once_with()
+
+    def test_stop_service_compacts_sharded_persist(self):
+        """
+        When the service stops, the whole monitor persist is written to its
+        single file, which older clients can load after a downgrade. The
+        directory is kept, so the next start doesn't rewrite the state of
+        every plugin.
+        """
+        self.service.monitor = Mock()
+        self.service.connector = Mock()
+        self.service.publisher = Mock()
+        self.service.persist.set("plugin", 1)
+        self.service.stopService()
+        persist = Persist(filename=self.service.persist_filename)
+        self.assertEqual(1, persist.get("plugin"))
+        self.assertTrue(
+            os.path.isdir(self.service.persist_filename + ".shards"))
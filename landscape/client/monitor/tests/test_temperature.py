@@ -149,10 +149,10 @@ class TemperatureTestWithSampleData(ThermalZoneTest, LandscapeTest):
 
         self.reactor.advance(plugin.registry.step_size)
 
-        with mock.patch.object(self.remote, "send_message"):
+        with mock.patch.object(self.remote, "send_messages"):
             self.reactor.fire(("message-type-acceptance-changed",
                                "temperature"), True)
-            self.remote.send_message.assert_called_once_with(
+            self.remote.send_messages.assert_called_once_with(
                 mock.ANY, mock.ANY, urgent=True)
 
     def test_no_message_if_not_accepted(self):
@@ -104,6 +104,8 @@ Prompt=never
         data.
         """
         self.plugin.run()
+        # Send out the first message, or the second one would replace it.
+        self.mstore.mark_in_flight(1)
         self.reactor.fire("resynchronize", scopes=["package"])
         self.plugin.run()
         messages = self.mstore.get_pending_messages()
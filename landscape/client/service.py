@@ -5,6 +5,7 @@ from twisted.application.service import Application, Service
 from twisted.application.app import startApplication
 
 from landscape.lib.logging import rotate_logs
+from landscape.lib.persist import JournaledPersist
 from landscape.client.reactor import LandscapeReactor
 from landscape.client.deployment import get_versioned_persist, init_logging
 
@@ -16,6 +17,7 @@ class LandscapeService(Service, object):
 
     @cvar service_name: The lower-case name of the service. This is used to
         generate the bpickle and the Unix socket filenames.
+    @cvar persist_factory: The L{Persist} class used for C{persist}.
     @ivar config: A L{Configuration} object.
     @ivar reactor: A L{LandscapeReactor} object.
     @ivar persist: A L{Persist} object, if C{persist_filename} is defined.
@@ -23,6 +25,7 @@ class LandscapeService(Service, object):
         by instances of sub-classes.
     """
     reactor_factory = LandscapeReactor
+    persist_factory = JournaledPersist
     persist_filename = None
 
     def __init__(self, config):
@@ -45,6 +48,10 @@ class LandscapeService(Service, object):
         # We don't need to call port.stopListening(), because the reactor
         # shutdown sequence will do that for us.
         Service.stopService(self)
+        if self.persist_filename:
+            # Fold the journal, if any, back into the database file, which
+            # older clients and tools reading the persist can then load.
+            self.persist.compact(self.persist_filename)
         logging.info("%s stopped with config %s" % (
             self.service_name.capitalize(), self.config.get_config_filename()))
 
@@ -80,9 +80,12 @@ class LandscapeTest(MessageTestCase, testing.TwistedTestCase,
     def makePersistFile(self, *args, **kwargs):
         """Return a temporary filename to be used by a L{Persist} object.
 
-        The possible .old persist file is cleaned up after the test.
+        The possible .old persist file and journal are cleaned up after the
+        test.
         """
-        return self.makeFile(*args, backupsuffix=".old", **kwargs)
+        path = self.makeFile(*args, backupsuffix=".old", **kwargs)
+        self.addCleanup(self._clean_file, path + ".journal")
+        return path
 
 
 class LandscapeIsolatedTest(LandscapeTest):
@@ -120,7 +123,9 @@ class FakeBrokerServiceHelper(object):
             "account_name = some_account\n"
             "ping_url = http://localhost:91910\n"
             "data_path = %s\n"
-            "log_dir = %s\n" % (test_case.data_path, log_dir))
+            "log_dir = %s\n"
+            "message_store_durability = per-message\n" % (
+                test_case.data_path, log_dir))
 
         bootstrap_list.bootstrap(data_path=test_case.data_path,
                                  log_dir=log_dir)
@@ -148,6 +148,20 @@ class ComponentConnectorTest(LandscapeTest):
         remote = self.successResultOf(deferred)
         self.assertEqual(1.0, remote._factory.factor)
 
+    def test_connect_with_batch_window(self):
+        """
+        If a C{batch_window} is given to the L{ComponentConnector}, then the
+        associated protocol factory will be set to that value.
+        """
+        component = TestComponent()
+        publisher = ComponentPublisher(component, self.reactor, self.config)
+        publisher.start()
+        connector = TestComponentConnector(self.reactor, self.config,
+                                           batch_window=0)
+        deferred = connector.connect()
+        remote = self.successResultOf(deferred)
+        self.assertEqual(0, remote._factory.batchWindow)
+
     def test_disconnect(self):
         """
         It is possible to call L{ComponentConnector.disconnect} multiple times,
@@ -1,6 +1,9 @@
+import os
+
 import mock
 
 from landscape.lib.fs import read_text_file, create_text_file
+from landscape.lib.persist import JournaledPersist, Persist
 
 from landscape.client.deployment import (
     BaseConfiguration, Configuration, get_versioned_persist,
@@ -272,3 +275,41 @@ class GetVersionedPersistTest(LandscapeTest):
                              {"monitor": mock_monitor}):
             persist = get_versioned_persist(FakeService())
             mock_monitor.apply.assert_called_with(persist)
+
+    def test_journaled(self):
+        """
+        The service persist is saved incrementally, as it's flushed often.
+        """
+
+        class FakeService(object):
+            persist_filename = self.makePersistFile(content="")
+            service_name = "monitor"
+
+        with mock.patch.dict("landscape.client.upgraders.UPGRADE_MANAGERS",
+                             {"monitor": mock.Mock()}):
+            persist = get_versioned_persist(FakeService())
+        self.assertIsInstance(persist, JournaledPersist)
+        self.assertTrue(
+            os.path.isfile(FakeService.persist_filename + ".journal"))
+
+    def test_journaled_readable_after_crash(self):
+        """
+        A plain L{Persist}, like the one of an older client, loads all the
+        changes saved to the service persist, even if the service dies
+        before compacting it on stop.
+        """
+
+        class FakeService(object):
+            persist_filename = self.makePersistFile(content="")
+            service_name = "monitor"
+
+        with mock.patch.dict("landscape.client.upgraders.UPGRADE_MANAGERS",
+                             {"monitor": mock.Mock()}):
+            persist = get_versioned_persist(FakeService())
+        persist.set("foo", "bar")
+        persist.save()
+        persist.set("baz", 1)
+        persist.save()
+        persist = Persist(filename=FakeService.persist_filename)
+        self.assertEqual("bar", persist.get("foo"))
+        self.assertEqual(1, persist.get("baz"))
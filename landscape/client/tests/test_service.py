@@ -4,6 +4,7 @@ import signal
 from twisted.internet import reactor
 from twisted.internet.task import deferLater
 
+from landscape.lib.persist import Persist
 from landscape.lib.testing import FakeReactor
 from landscape.client.deployment import Configuration
 from landscape.client.service import LandscapeService
@@ -44,6 +45,26 @@ class LandscapeServiceTest(LandscapeTest):
         service = PersistService(self.config)
         self.assertEqual(service.persist.filename, service.persist_filename)
 
+    def test_stop_compacts_persist(self):
+        """
+        When the service stops, the whole persist is written to a single
+        file, which a plain L{Persist} can load.
+        """
+
+        class PersistService(TestService):
+            persist_filename = self.makePersistFile(content="")
+
+        service = PersistService(self.config)
+        service.persist.set("a", 1)
+        service.persist.save()
+        service.persist.set("b", 2)
+        service.persist.save()
+        service.startService()
+        service.stopService()
+        persist = Persist(filename=service.persist_filename)
+        self.assertEqual(1, persist.get("a"))
+        self.assertEqual(2, persist.get("b"))
+
     def test_no_persist_without_filename(self):
         """
         If no {persist_filename} attribute is defined, no C{persist} attribute
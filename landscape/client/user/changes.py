@@ -24,8 +24,10 @@ class UserChanges(object):
 
     def _refresh(self):
         """Load the previous snapshot and update current data."""
-        self._old_users = self._persist.get("users", {})
-        self._old_groups = self._persist.get("groups", {})
+        # The old snapshot is only compared with the new data, and replaced
+        # by it rather than changed, so it doesn't need to be copied.
+        self._old_users = self._persist.view("users", {})
+        self._old_groups = self._persist.view("groups", {})
         self._new_users = self._create_index(
             "username", self._provider.get_users())
         self._new_groups = self._create_index(
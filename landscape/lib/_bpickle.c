@@ -0,0 +1,714 @@
+/*
+ * Compiled implementation of the bpickle codec.
+ *
+ * landscape.lib.bpickle uses these functions when this module is built,
+ * falling back to its pure-Python codec otherwise, so the output of
+ * dumps() and the results of loads() must be exactly the ones of the
+ * pure-Python functions, down to the sorting of dict keys.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <string.h>
+
+#if PY_MAJOR_VERSION < 3
+#error "The compiled bpickle codec requires Python 3."
+#endif
+
+
+typedef struct {
+    char *data;
+    Py_ssize_t length;
+    Py_ssize_t size;
+} Buffer;
+
+
+static int
+buffer_grow(Buffer *buffer, Py_ssize_t extra)
+{
+    Py_ssize_t size;
+    char *data;
+
+    if (buffer->length + extra <= buffer->size)
+        return 0;
+    size = buffer->size ? buffer->size : 256;
+    while (size < buffer->length + extra) {
+        if (size > PY_SSIZE_T_MAX / 2) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        size *= 2;
+    }
+    data = PyMem_Realloc(buffer->data, size);
+    if (data == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    buffer->data = data;
+    buffer->size = size;
+    return 0;
+}
+
+
+static int
+buffer_write(Buffer *buffer, const char *data, Py_ssize_t length)
+{
+    if (buffer_grow(buffer, length) < 0)
+        return -1;
+    memcpy(buffer->data + buffer->length, data, length);
+    buffer->length += length;
+    return 0;
+}
+
+
+static int
+buffer_write_char(Buffer *buffer, char c)
+{
+    if (buffer_grow(buffer, 1) < 0)
+        return -1;
+    buffer->data[buffer->length++] = c;
+    return 0;
+}
+
+
+/* Write a "<code><length>:<data>" string. */
+static int
+buffer_write_string(Buffer *buffer, char code, const char *data,
+                    Py_ssize_t length)
+{
+    char header[32];
+    int header_length;
+
+    header_length = PyOS_snprintf(header, sizeof(header), "%c%zd:",
+                                  code, length);
+    if (buffer_write(buffer, header, header_length) < 0)
+        return -1;
+    return buffer_write(buffer, data, length);
+}
+
+
+static int encode(Buffer *buffer, PyObject *obj, PyObject *table);
+
+
+static int
+encode_int(Buffer *buffer, PyObject *obj)
+{
+    char data[32];
+    int length, overflow;
+    long long value;
+    PyObject *text;
+    const char *digits;
+    Py_ssize_t digits_length;
+
+    value = PyLong_AsLongLongAndOverflow(obj, &overflow);
+    if (value == -1 && PyErr_Occurred())
+        return -1;
+    if (!overflow) {
+        length = PyOS_snprintf(data, sizeof(data), "i%lld;", value);
+        return buffer_write(buffer, data, length);
+    }
+    text = PyObject_Str(obj);
+    if (text == NULL)
+        return -1;
+    digits = PyUnicode_AsUTF8AndSize(text, &digits_length);
+    if (digits == NULL
+            || buffer_write_char(buffer, 'i') < 0
+            || buffer_write(buffer, digits, digits_length) < 0
+            || buffer_write_char(buffer, ';') < 0) {
+        Py_DECREF(text);
+        return -1;
+    }
+    Py_DECREF(text);
+    return 0;
+}
+
+
+static int
+encode_float(Buffer *buffer, PyObject *obj)
+{
+    char *text;
+    int result;
+
+    /* This is how float.__repr__ formats its value. */
+    text = PyOS_double_to_string(PyFloat_AS_DOUBLE(obj), 'r', 0,
+                                 Py_DTSF_ADD_DOT_0, NULL);
+    if (text == NULL)
+        return -1;
+    result = buffer_write_char(buffer, 'f');
+    if (result == 0)
+        result = buffer_write(buffer, text, strlen(text));
+    if (result == 0)
+        result = buffer_write_char(buffer, ';');
+    PyMem_Free(text);
+    return result;
+}
+
+
+static int
+encode_sequence(Buffer *buffer, char code, PyObject *obj, PyObject *table)
+{
+    Py_ssize_t i;
+    PyObject *item;
+    int result;
+
+    if (buffer_write_char(buffer, code) < 0)
+        return -1;
+    for (i = 0; i < PySequence_Fast_GET_SIZE(obj); i++) {
+        item = PySequence_Fast_GET_ITEM(obj, i);
+        Py_INCREF(item);
+        result = encode(buffer, item, table);
+        Py_DECREF(item);
+        if (result < 0)
+            return -1;
+    }
+    return buffer_write_char(buffer, ';');
+}
+
+
+static int
+encode_dict(Buffer *buffer, PyObject *obj, PyObject *table)
+{
+    Py_ssize_t i;
+    PyObject *keys, *key, *value;
+
+    keys = PyDict_Keys(obj);
+    if (keys == NULL)
+        return -1;
+    if (PyList_Sort(keys) < 0 || buffer_write_char(buffer, 'd') < 0)
+        goto error;
+    for (i = 0; i < PyList_GET_SIZE(keys); i++) {
+        key = PyList_GET_ITEM(keys, i);
+        value = PyDict_GetItemWithError(obj, key);
+        if (value == NULL) {
+            if (!PyErr_Occurred())
+                PyErr_SetObject(PyExc_KeyError, key);
+            goto error;
+        }
+        Py_INCREF(value);
+        if (encode(buffer, key, table) < 0
+                || encode(buffer, value, table) < 0) {
+            Py_DECREF(value);
+            goto error;
+        }
+        Py_DECREF(value);
+    }
+    Py_DECREF(keys);
+    return buffer_write_char(buffer, ';');
+
+error:
+    Py_DECREF(keys);
+    return -1;
+}
+
+
+/* Encode an object of a type not built in, like EncodedList, with the
+ * function registered for it in the pure-Python dumps table. */
+static int
+encode_other(Buffer *buffer, PyObject *obj, PyObject *table)
+{
+    PyObject *function = NULL, *data;
+    int result;
+
+    if (table != Py_None) {
+        function = PyDict_GetItemWithError(table, (PyObject *)Py_TYPE(obj));
+        if (function == NULL && PyErr_Occurred())
+            return -1;
+    }
+    if (function == NULL) {
+        PyErr_Format(PyExc_ValueError, "Unsupported type: %R",
+                     (PyObject *)Py_TYPE(obj));
+        return -1;
+    }
+    data = PyObject_CallFunctionObjArgs(function, obj, NULL);
+    if (data == NULL)
+        return -1;
+    if (!PyBytes_Check(data)) {
+        PyErr_Format(PyExc_TypeError, "%R didn't return bytes", function);
+        Py_DECREF(data);
+        return -1;
+    }
+    result = buffer_write(buffer, PyBytes_AS_STRING(data),
+                          PyBytes_GET_SIZE(data));
+    Py_DECREF(data);
+    return result;
+}
+
+
+static int
+encode(Buffer *buffer, PyObject *obj, PyObject *table)
+{
+    PyTypeObject *type = Py_TYPE(obj);
+    const char *data;
+    Py_ssize_t length;
+    int result;
+
+    /* Like the pure-Python codec, only the exact types are supported, and
+     * not their subclasses. */
+    if (obj == Py_None)
+        return buffer_write_char(buffer, 'n');
+    if (type == &PyBool_Type)
+        return buffer_write(buffer, obj == Py_True ? "b1" : "b0", 2);
+    if (type == &PyLong_Type)
+        return encode_int(buffer, obj);
+    if (type == &PyFloat_Type)
+        return encode_float(buffer, obj);
+    if (type == &PyBytes_Type)
+        return buffer_write_string(buffer, 's', PyBytes_AS_STRING(obj),
+                                   PyBytes_GET_SIZE(obj));
+    if (type == &PyUnicode_Type) {
+        data = PyUnicode_AsUTF8AndSize(obj, &length);
+        if (data == NULL)
+            return -1;
+        return buffer_write_string(buffer, 'u', data, length);
+    }
+    if (type != &PyList_Type && type != &PyTuple_Type
+            && type != &PyDict_Type)
+        return encode_other(buffer, obj, table);
+
+    if (Py_EnterRecursiveCall(" while encoding a bpickle"))
+        return -1;
+    if (type == &PyList_Type)
+        result = encode_sequence(buffer, 'l', obj, table);
+    else if (type == &PyTuple_Type)
+        result = encode_sequence(buffer, 't', obj, table);
+    else
+        result = encode_dict(buffer, obj, table);
+    Py_LeaveRecursiveCall();
+    return result;
+}
+
+
+static PyObject *
+bpickle_dumps(PyObject *self, PyObject *args)
+{
+    PyObject *obj, *table = Py_None, *result = NULL;
+    Buffer buffer = {NULL, 0, 0};
+
+    if (!PyArg_ParseTuple(args, "O|O:dumps", &obj, &table))
+        return NULL;
+    if (table != Py_None && !PyDict_Check(table)) {
+        PyErr_SetString(PyExc_TypeError, "the dumps table must be a dict");
+        return NULL;
+    }
+    if (encode(&buffer, obj, table) == 0)
+        result = PyBytes_FromStringAndSize(buffer.data, buffer.length);
+    PyMem_Free(buffer.data);
+    return result;
+}
+
+
+typedef struct {
+    const char *data;
+    Py_ssize_t length;
+    int as_is;
+} Decoder;
+
+
+static PyObject *decode(Decoder *decoder, Py_ssize_t *pos);
+
+
+static PyObject *
+unknown_type(Decoder *decoder, Py_ssize_t pos)
+{
+    PyObject *code;
+
+    code = PyBytes_FromStringAndSize(
+        decoder->data + pos, pos < decoder->length ? 1 : 0);
+    if (code != NULL) {
+        PyErr_Format(PyExc_ValueError, "Unknown type character: %R", code);
+        Py_DECREF(code);
+    }
+    return NULL;
+}
+
+
+/* Return the position of the first C{c} from C{pos} on, or -1 with
+ * ValueError set, like bytes.index does. */
+static Py_ssize_t
+find(Decoder *decoder, Py_ssize_t pos, char c)
+{
+    const char *found;
+
+    if (pos < decoder->length) {
+        found = memchr(decoder->data + pos, c, decoder->length - pos);
+        if (found != NULL)
+            return found - decoder->data;
+    }
+    PyErr_SetString(PyExc_ValueError, "subsection not found");
+    return -1;
+}
+
+
+/* Parse the integer between C{start} and C{end} like int() would. */
+static PyObject *
+parse_int(Decoder *decoder, Py_ssize_t start, Py_ssize_t end)
+{
+    const char *data = decoder->data + start;
+    Py_ssize_t length = end - start, i = 0;
+    long long value = 0;
+    PyObject *text, *result;
+
+    if (length > 0 && data[0] == '-')
+        i++;
+    if (length > i && length - i <= 18) {
+        for (; i < length && data[i] >= '0' && data[i] <= '9'; i++)
+            value = value * 10 + (data[i] - '0');
+        if (i == length)
+            return PyLong_FromLongLong(data[0] == '-' ? -value : value);
+    }
+    /* Anything but plain digits, including big numbers, is left to int(). */
+    text = PyBytes_FromStringAndSize(data, length);
+    if (text == NULL)
+        return NULL;
+    result = PyNumber_Long(text);
+    Py_DECREF(text);
+    return result;
+}
+
+
+static PyObject *
+decode_bool(Decoder *decoder, Py_ssize_t *pos)
+{
+    PyObject *value, *result;
+
+    value = parse_int(decoder, *pos + 1,
+                      *pos + 2 <= decoder->length ? *pos + 2 : *pos + 1);
+    if (value == NULL)
+        return NULL;
+    result = PyBool_FromLong(PyObject_IsTrue(value));
+    Py_DECREF(value);
+    *pos += 2;
+    return result;
+}
+
+
+static PyObject *
+decode_int(Decoder *decoder, Py_ssize_t *pos)
+{
+    Py_ssize_t end;
+    PyObject *result;
+
+    end = find(decoder, *pos, ';');
+    if (end < 0)
+        return NULL;
+    result = parse_int(decoder, *pos + 1, end);
+    *pos = end + 1;
+    return result;
+}
+
+
+static PyObject *
+decode_float(Decoder *decoder, Py_ssize_t *pos)
+{
+    Py_ssize_t end, length;
+    const char *data = decoder->data + *pos + 1;
+    char text[64], *text_end;
+    double value;
+    PyObject *bytes, *result;
+
+    end = find(decoder, *pos, ';');
+    if (end < 0)
+        return NULL;
+    length = end - *pos - 1;
+    *pos = end + 1;
+    if (length > 0 && length < (Py_ssize_t)sizeof(text)
+            && memchr(data, '\0', length) == NULL) {
+        memcpy(text, data, length);
+        text[length] = '\0';
+        value = PyOS_string_to_double(text, &text_end, NULL);
+        if (value == -1.0 && PyErr_Occurred())
+            PyErr_Clear();
+        else if (text_end == text + length)
+            return PyFloat_FromDouble(value);
+    }
+    /* Leave anything unusual to float(), to get the same result. */
+    bytes = PyBytes_FromStringAndSize(data, length);
+    if (bytes == NULL)
+        return NULL;
+    result = PyFloat_FromString(bytes);
+    Py_DECREF(bytes);
+    return result;
+}
+
+
+/* Find the data of a "<code><length>:<data>" string, which is truncated if
+ * it goes past the end, as slicing does. */
+static int
+decode_string(Decoder *decoder, Py_ssize_t *pos, const char **data,
+              Py_ssize_t *length)
+{
+    Py_ssize_t colon, start;
+    PyObject *value;
+
+    colon = find(decoder, *pos, ':');
+    if (colon < 0)
+        return -1;
+    value = parse_int(decoder, *pos + 1, colon);
+    if (value == NULL)
+        return -1;
+    *length = PyLong_AsSsize_t(value);
+    Py_DECREF(value);
+    if (*length == -1 && PyErr_Occurred()) {
+        if (!PyErr_ExceptionMatches(PyExc_OverflowError))
+            return -1;
+        PyErr_Clear();
+    }
+    /* Lengths which can't be right, like the ones too big to be addressed,
+       are reported like the pure-Python codec does. */
+    if (*length < 0) {
+        PyErr_SetString(PyExc_ValueError, "Corrupted data");
+        return -1;
+    }
+    start = colon + 1;
+    *data = decoder->data + start;
+    if (*length > decoder->length - start) {
+        *length = decoder->length - start;
+        *pos = decoder->length + 1;
+    }
+    else
+        *pos = start + *length;
+    return 0;
+}
+
+
+static PyObject *
+decode_sequence(Decoder *decoder, Py_ssize_t *pos)
+{
+    PyObject *result, *item;
+
+    result = PyList_New(0);
+    if (result == NULL)
+        return NULL;
+    (*pos)++;
+    while (*pos >= decoder->length || decoder->data[*pos] != ';') {
+        item = decode(decoder, pos);
+        if (item == NULL || PyList_Append(result, item) < 0) {
+            Py_XDECREF(item);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(item);
+    }
+    (*pos)++;
+    return result;
+}
+
+
+static PyObject *
+decode_dict(Decoder *decoder, Py_ssize_t *pos)
+{
+    PyObject *result, *key = NULL, *value = NULL, *text;
+
+    result = PyDict_New();
+    if (result == NULL)
+        return NULL;
+    (*pos)++;
+    while (*pos >= decoder->length || decoder->data[*pos] != ';') {
+        key = decode(decoder, pos);
+        if (key == NULL)
+            goto error;
+        value = decode(decoder, pos);
+        if (value == NULL)
+            goto error;
+        if (!decoder->as_is && PyBytes_Check(key)) {
+            /* Although the wire format of dictionary keys is ASCII bytes,
+             * the code actually expects them to be strings. */
+            text = PyUnicode_DecodeASCII(PyBytes_AS_STRING(key),
+                                         PyBytes_GET_SIZE(key), NULL);
+            if (text == NULL)
+                goto error;
+            Py_DECREF(key);
+            key = text;
+        }
+        if (PyDict_SetItem(result, key, value) < 0)
+            goto error;
+        Py_CLEAR(key);
+        Py_CLEAR(value);
+    }
+    (*pos)++;
+    return result;
+
+error:
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_DECREF(result);
+    return NULL;
+}
+
+
+static PyObject *
+decode(Decoder *decoder, Py_ssize_t *pos)
+{
+    const char *data;
+    Py_ssize_t length;
+    PyObject *result;
+
+    if (*pos >= decoder->length)
+        return unknown_type(decoder, *pos);
+    switch (decoder->data[*pos]) {
+    case 'n':
+        *pos += 1;
+        Py_RETURN_NONE;
+    case 'b':
+        return decode_bool(decoder, pos);
+    case 'i':
+        return decode_int(decoder, pos);
+    case 'f':
+        return decode_float(decoder, pos);
+    case 's':
+        if (decode_string(decoder, pos, &data, &length) < 0)
+            return NULL;
+        return PyBytes_FromStringAndSize(data, length);
+    case 'u':
+        if (decode_string(decoder, pos, &data, &length) < 0)
+            return NULL;
+        return PyUnicode_DecodeUTF8(data, length, NULL);
+    case 'l':
+    case 't':
+    case 'd':
+        break;
+    default:
+        return unknown_type(decoder, *pos);
+    }
+
+    if (Py_EnterRecursiveCall(" while decoding a bpickle"))
+        return NULL;
+    if (decoder->data[*pos] == 'd')
+        result = decode_dict(decoder, pos);
+    else if (decoder->data[*pos] == 'l')
+        result = decode_sequence(decoder, pos);
+    else {
+        result = decode_sequence(decoder, pos);
+        if (result != NULL)
+            Py_SETREF(result, PyList_AsTuple(result));
+    }
+    Py_LeaveRecursiveCall();
+    return result;
+}
+
+
+/* Return the position right after the object serialized at C{pos}, or -1
+ * with an exception set. */
+static Py_ssize_t
+skip(Decoder *decoder, Py_ssize_t pos)
+{
+    const char *data;
+    Py_ssize_t length;
+
+    if (pos >= decoder->length) {
+        unknown_type(decoder, pos);
+        return -1;
+    }
+    switch (decoder->data[pos]) {
+    case 'n':
+        return pos + 1;
+    case 'b':
+        return pos + 2;
+    case 'i':
+    case 'f':
+        pos = find(decoder, pos, ';');
+        return pos < 0 ? -1 : pos + 1;
+    case 's':
+    case 'u':
+        if (decode_string(decoder, &pos, &data, &length) < 0)
+            return -1;
+        return pos;
+    case 'l':
+    case 't':
+    case 'd':
+        break;
+    default:
+        unknown_type(decoder, pos);
+        return -1;
+    }
+
+    if (Py_EnterRecursiveCall(" while decoding a bpickle"))
+        return -1;
+    pos++;
+    while (pos >= decoder->length || decoder->data[pos] != ';') {
+        pos = skip(decoder, pos);
+        if (pos < 0)
+            break;
+    }
+    Py_LeaveRecursiveCall();
+    return pos < 0 ? -1 : pos + 1;
+}
+
+
+static PyObject *
+bpickle_skip(PyObject *self, PyObject *args)
+{
+    Py_buffer view;
+    Decoder decoder;
+    Py_ssize_t pos;
+
+    if (!PyArg_ParseTuple(args, "y*n:skip", &view, &pos))
+        return NULL;
+    decoder.data = view.buf;
+    decoder.length = view.len;
+    decoder.as_is = 0;
+    if (pos < 0)
+        pos = view.len;
+    pos = skip(&decoder, pos);
+    PyBuffer_Release(&view);
+    if (pos < 0)
+        return NULL;
+    return PyLong_FromSsize_t(pos);
+}
+
+
+static PyObject *
+bpickle_loads(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"byte_string", "as_is", NULL};
+    Py_buffer view;
+    int as_is = 0;
+    Decoder decoder;
+    Py_ssize_t pos = 0;
+    PyObject *result;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|p:loads", keywords,
+                                     &view, &as_is))
+        return NULL;
+    if (view.len == 0) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "Can't load empty string");
+        return NULL;
+    }
+    decoder.data = view.buf;
+    decoder.length = view.len;
+    decoder.as_is = as_is;
+    result = decode(&decoder, &pos);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+
+static PyMethodDef bpickle_methods[] = {
+    {"dumps", bpickle_dumps, METH_VARARGS,
+     "dumps(obj, table=None)\n\nSerialize obj, using the functions of the "
+     "given dumps table for the types which aren't built in."},
+    {"loads", (PyCFunction)(void (*)(void))bpickle_loads,
+     METH_VARARGS | METH_KEYWORDS,
+     "loads(byte_string, as_is=False)\n\nLoad a serialized byte_string."},
+    {"skip", bpickle_skip, METH_VARARGS,
+     "skip(byte_string, pos)\n\nReturn the position right after the object "
+     "serialized at pos."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef bpickle_module = {
+    PyModuleDef_HEAD_INIT,
+    "landscape.lib._bpickle",
+    "Compiled implementation of the bpickle codec.",
+    -1,
+    bpickle_methods
+};
+
+
+PyMODINIT_FUNC
+PyInit__bpickle(void)
+{
+    return PyModule_Create(&bpickle_module);
+}
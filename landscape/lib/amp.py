@@ -46,15 +46,17 @@ for more details about the Twisted AMP protocol.
 """
 from uuid import uuid4
 
-from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.defer import Deferred, fail, maybeDeferred, succeed
 from twisted.internet.protocol import ServerFactory, ReconnectingClientFactory
 from twisted.python.failure import Failure
-from twisted.python.compat import xrange
+from twisted.python.compat import xrange, nativeString
 
 from twisted.protocols.amp import (
-    Argument, String, Integer, Command, AMP, MAX_VALUE_LENGTH, CommandLocator)
+    Argument, String, Integer, Command, AMP, MAX_VALUE_LENGTH, CommandLocator,
+    UNKNOWN_ERROR_CODE, UnknownRemoteError)
 
 from landscape.lib import bpickle
+from landscape.lib.log import log_failure
 
 
 class MethodCallArgument(Argument):
@@ -74,6 +76,32 @@ class MethodCallArgument(Argument):
         return type(inObject) in bpickle.dumps_table
 
 
+class MethodCallResults(MethodCallArgument):
+    """A bpickle-compatible argument spanning several AMP values.
+
+    The serialized value is split in pieces of at most C{MAX_VALUE_LENGTH}
+    bytes, stored under the keys C{name}, C{name.1}, C{name.2} and so on, so
+    the results of a whole L{MethodCallBatch} are not bound by the size of a
+    single AMP value.
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        data = self.toString(objects[nativeString(name)])
+        strings[name] = data[:MAX_VALUE_LENGTH]
+        offsets = xrange(MAX_VALUE_LENGTH, len(data), MAX_VALUE_LENGTH)
+        for index, offset in enumerate(offsets, 1):
+            strings[name + (".%d" % index).encode("ascii")] = data[
+                offset:offset + MAX_VALUE_LENGTH]
+
+    def fromBox(self, name, strings, objects, proto):
+        parts = [strings[name]]
+        key = name + b".1"
+        while key in strings:
+            parts.append(strings[key])
+            key = name + (".%d" % len(parts)).encode("ascii")
+        objects[nativeString(name)] = self.fromString(b"".join(parts))
+
+
 class MethodCallError(Exception):
     """Raised when a L{MethodCall} command fails."""
 
@@ -128,6 +156,48 @@ class MethodCallChunk(Command):
     errors = {MethodCallError: b"METHOD_CALL_ERROR"}
 
 
+class MethodCallBatch(Command):
+    """Call several methods of the object exposed by a server in one go.
+
+    The methods are invoked in order, without waiting for each other, and the
+    response carries the results of the calls that completed right away.
+
+    The command arguments have the following semantics:
+
+    - C{calls}: A BPickled list of C{(method, arguments)} tuples, where
+      C{method} and C{arguments} have the same meaning as in L{MethodCall}.
+
+    The C{results} of the response is a list holding a C{(success, value)}
+    tuple for each call, where C{value} is either the return value of the
+    method or, if C{success} is C{False}, the C{(code, description)} of the
+    error, as AMP would report it for a single command. If C{success} is
+    C{None} the call is still in progress and C{value} is the sequence to
+    pass to L{MethodCallBatchResult} to wait for it.
+    """
+
+    arguments = [(b"calls", String())]
+
+    response = [(b"results", MethodCallResults())]
+
+    errors = {MethodCallError: b"METHOD_CALL_ERROR"}
+
+
+class MethodCallBatchResult(Command):
+    """Wait for a call of a L{MethodCallBatch} which didn't complete at once.
+
+    The command arguments have the following semantics:
+
+    - C{sequence}: The integer given for the call in the response of the
+      L{MethodCallBatch}.
+    """
+
+    arguments = [(b"sequence", Integer())]
+
+    response = [(b"result", MethodCallArgument())]
+
+    errors = {MethodCallError: b"METHOD_CALL_ERROR"}
+
+
 class MethodCallReceiver(CommandLocator):
     """Expose methods of a local object over AMP.
 
@@ -140,7 +210,8 @@ class MethodCallReceiver(CommandLocator):
         CommandLocator.__init__(self)
         self._object = obj
         self._methods = methods
-        self._pending_chunks = {}
+        self._decoders = {}
+        self._pending_results = {}
 
     @MethodCall.responder
     def receive_method_call(self, sequence, method, arguments):
@@ -159,15 +230,87 @@ class MethodCallReceiver(CommandLocator):
            by one or more L{MethodCallChunk}s, C{arguments} is the last chunk
            of data.
         """
-        chunks = self._pending_chunks.pop(sequence, None)
-        if chunks is not None:
+        decoder = self._decoders.pop(sequence, None)
+        if decoder is None:
+            # Pass the the arguments as-is without reinterpreting strings.
+            args, kwargs = bpickle.loads(arguments, as_is=True)
+        else:
             # We got some L{MethodCallChunk}s before, this is the last.
-            chunks.append(arguments)
-            arguments = b"".join(chunks)
+            [(args, kwargs)] = decoder.decode(arguments, final=True)
+
+        return self._call_method(method, args, kwargs)
+
+    @MethodCallBatch.responder
+    def receive_method_call_batch(self, calls):
+        """Call several of the object's methods with the given arguments.
+
+        @param calls: A bpickle'd list of C{(method, arguments)} tuples, see
+            L{receive_method_call}.
+        """
+        def record(result, outcome):
+            outcome.append(result)
+            return result
+
+        results = []
+        for method, arguments in bpickle.loads(calls, as_is=True):
+            args, kwargs = bpickle.loads(arguments, as_is=True)
+            deferred = maybeDeferred(self._call_method, method, args, kwargs)
+            outcome = []
+            deferred.addBoth(record, outcome)
+            if not outcome:
+                # Don't hold the whole batch back for a slow call, the
+                # sender will wait for it with a L{MethodCallBatchResult}.
+                sequence = uuid4().int
+                self._pending_results[sequence] = deferred
+                results.append((None, sequence))
+            elif isinstance(outcome[0], Failure):
+                deferred.addErrback(lambda failure: None)
+                results.append((False, self._get_error(outcome[0])))
+            else:
+                results.append((True, outcome[0]["result"]))
+        return {"results": results}
+
+    @MethodCallBatchResult.responder
+    def receive_method_call_batch_result(self, sequence):
+        """Wait for the result of a call of a L{MethodCallBatch}.
+
+        @param sequence: The integer identifying the call, as given in the
+            response of the L{MethodCallBatch}.
+        """
+        deferred = self._pending_results.pop(sequence, None)
+        if deferred is None:
+            raise MethodCallError("Unknown method call %d" % sequence)
+        return deferred
+
+    def _get_error(self, failure):
+        """Return the C{(code, description)} of a failed call of a batch.
 
-        # Pass the the arguments as-is without reinterpreting strings.
-        args, kwargs = bpickle.loads(arguments, as_is=True)
+        Like AMP does for the failures of a single command, only the errors
+        declared by L{MethodCallBatch} are described, while the other ones
+        are logged and reported as unknown.
+        """
+        for error_type, code in MethodCallBatch.errors.items():
+            if failure.check(error_type):
+                return code, str(failure.value)
+        log_failure(failure, "Batched method call failed")
+        return UNKNOWN_ERROR_CODE, "Unknown Error"
+
+    def forget_pending_results(self):
+        """Drop the results of the L{MethodCallBatch} calls still pending.
+
+        This is called when the connection is lost, since the sender can't
+        wait for them anymore. The failures of those calls are logged, as
+        they wouldn't be reported otherwise.
+        """
+        pending, self._pending_results = self._pending_results, {}
+        for deferred in pending.values():
+            deferred.addErrback(log_failure, "Batched method call failed")
 
+    def _call_method(self, method, args, kwargs):
+        """Call the object's C{method} with the given arguments.
+
+        @return: A C{Deferred} firing with the response of the L{MethodCall}.
+        """
         # We encoded the method name in `send_method_call` and have to decode
         # it here again.
         method = method.decode("utf-8")
@@ -191,10 +334,17 @@ class MethodCallReceiver(CommandLocator):
     def receive_method_call_chunk(self, sequence, chunk):
         """Receive a part of a multi-chunk L{MethodCall}.
 
-        Add the received C{chunk} to the buffer of the L{MethodCall} identified
-        by C{sequence}.
+        Feed the received C{chunk} to the decoder of the arguments of the
+        L{MethodCall} identified by C{sequence}, which decodes them as they
+        come in rather than buffering all the chunks. The decoder is dropped
+        if the C{chunk} is corrupted, since the call can't succeed anymore.
         """
-        self._pending_chunks.setdefault(sequence, []).append(chunk)
+        decoder = self._decoders.pop(sequence, None)
+        if decoder is None:
+            # Decode the arguments as-is, without reinterpreting strings.
+            decoder = bpickle.IncrementalDecoder(as_is=True)
+        decoder.decode(chunk)
+        self._decoders[sequence] = decoder
         return {"result": sequence}
 
     def _check_result(self, result):
@@ -219,6 +369,12 @@ class MethodCallSender(object):
     timeout = 60
 
     _chunk_size = MAX_VALUE_LENGTH
+    # The number of L{MethodCallChunk}s sent ahead of the acknowledgement of
+    # the previous ones.
+    _chunk_window = 4
+    # Arguments holding up to this number of items are serialized in one go,
+    # larger ones item by item, without building a single large byte string.
+    _chunk_items = 1000
 
     def __init__(self, protocol, clock):
         self._protocol = protocol
@@ -265,35 +421,188 @@ class MethodCallSender(object):
             invoked on the remote object. If the remote method itself returns
             a deferred, we fire with the callback value of such deferred.
         """
-        arguments = bpickle.dumps((args, kwargs))
-        sequence = uuid4().int
+        # The arguments are fully serialized before returning, so changing
+        # them afterwards doesn't affect the call.
+        chunks = list(self._split_chunks(
+            bpickle.dumps_chunks((args, kwargs), self._chunk_items)))
         # As we send the method name to remote, we need bytes.
-        method = method.encode("utf-8")
+        return self._send_arguments(method.encode("utf-8"), chunks)
 
-        # Split the given arguments in one or more chunks
-        chunks = [arguments[i:i + self._chunk_size]
-                  for i in xrange(0, len(arguments), self._chunk_size)]
+    def send_method_calls(self, calls):
+        """Send several method calls, packing them in L{MethodCallBatch}es.
 
-        result = Deferred()
-        if len(chunks) > 1:
-            # If we have N chunks, send the first N-1 as MethodCallChunk's
-            for chunk in chunks[:-1]:
+        Calls are grouped in as few L{MethodCallBatch} commands as the size
+        of their arguments allows, while calls with arguments too big to be
+        batched are sent with their own L{MethodCall}.
+
+        @param calls: A list of C{(method, args, kwargs)} tuples, see
+            L{send_method_call}.
+
+        @return: A list of C{Deferred}s, one for each call, firing like the
+            one returned by L{send_method_call}. The ones of the calls whose
+            arguments can't be serialized fail right away, without affecting
+            the other calls.
+        """
+        results = [None] * len(calls)
+        serialized = []
+        for index, (method, args, kwargs) in enumerate(calls):
+            try:
+                arguments = bpickle.dumps((args, kwargs))
+            except ValueError:
+                results[index] = fail()
+                continue
+            serialized.append((index, method.encode("utf-8"), arguments))
+        sent = self.send_serialized_method_calls(
+            [(method, arguments) for _, method, arguments in serialized])
+        for (index, _, _), result in zip(serialized, sent):
+            results[index] = result
+        return results
+
+    def send_serialized_method_calls(self, calls):
+        """Send several method calls whose arguments are serialized already.
+
+        @param calls: A list of C{(method, arguments)} tuples, where
+            C{method} is the encoded name of the method and C{arguments} the
+            bpickle'd C{(args, kwargs)} tuple to pass to it.
+
+        @return: A list of C{Deferred}s, see L{send_method_calls}.
+        """
+        results = []
+        batch = []
+        size = 0
+        for method, arguments in calls:
+            # Account for the bpickle framing of the batch entry as well.
+            call_size = len(method) + len(arguments) + 32
+            if call_size > self._chunk_size // 2:
+                results.extend(self._send_batch(batch))
+                results.append(self._send_arguments(
+                    method, list(self._split_chunks([arguments]))))
+                batch = []
+                size = 0
+                continue
+            if size + call_size > self._chunk_size:
+                results.extend(self._send_batch(batch))
+                batch = []
+                size = 0
+            batch.append((method, arguments))
+            size += call_size
+        results.extend(self._send_batch(batch))
+        return results
+
+    def _send_batch(self, batch):
+        """Send a L{MethodCallBatch} with the given C{(method, arguments)}.
+
+        @return: A list of C{Deferred}s, one for each call in the batch.
+        """
+        if len(batch) < 2:
+            return [self._send_arguments(method, [arguments])
+                    for method, arguments in batch]
+
+        deferreds = [Deferred() for _ in batch]
 
-                def create_send_chunk(sequence, chunk):
-                    send_chunk = (lambda x: self._protocol.callRemote(
-                        MethodCallChunk, sequence=sequence, chunk=chunk))
-                    return send_chunk
+        def handle_response(response):
+            for deferred, (success, value) in zip(deferreds,
+                                                  response["results"]):
+                if success is None:
+                    result = self._call_remote_with_timeout(
+                        MethodCallBatchResult, sequence=value)
+                    result.addCallback(lambda response: response["result"])
+                    result.chainDeferred(deferred)
+                elif success:
+                    deferred.callback(value)
+                else:
+                    deferred.errback(self._get_batch_error(*value))
+
+        def handle_failure(failure):
+            for deferred in deferreds:
+                deferred.errback(failure)
+
+        result = self._call_remote_with_timeout(
+            MethodCallBatch, calls=bpickle.dumps(batch))
+        result.addCallbacks(handle_response, handle_failure)
+        return deferreds
 
-                result.addCallback(create_send_chunk(sequence, chunk))
+    def _get_batch_error(self, code, description):
+        """Return the exception of a failed call of a L{MethodCallBatch}.
+
+        It's the one AMP raises for the same error of a single command.
+        """
+        for error_type, error_code in MethodCallBatch.errors.items():
+            if code == error_code:
+                return error_type(description)
+        return UnknownRemoteError(description)
+
+    def _split_chunks(self, data):
+        """Regroup the pieces of serialized C{data} in chunks.
+
+        @param data: An iterable of byte strings, like the one returned by
+            L{bpickle.dumps_chunks}.
+        @return: An iterator over chunks of C{self._chunk_size} bytes, except
+            the last one which may be shorter.
+        """
+        size = self._chunk_size
+        buffer = bytearray()
+        for piece in data:
+            if len(buffer) + len(piece) < size:
+                buffer += piece
+                continue
+            view = memoryview(piece)
+            offset = size - len(buffer)
+            buffer += view[:offset]
+            yield bytes(buffer)
+            while len(piece) - offset >= size:
+                yield view[offset:offset + size].tobytes()
+                offset += size
+            buffer = bytearray(view[offset:])
+        if buffer:
+            yield bytes(buffer)
+
+    def _send_arguments(self, method, chunks):
+        """Send a L{MethodCall} with bpickle'd arguments split in C{chunks}.
+
+        All the chunks but the last one are sent as L{MethodCallChunk}s, only
+        as the peer acknowledges the previous ones, keeping at most
+        C{_chunk_window} of them in flight.
+
+        @param method: The name of the remote method, encoded as bytes.
+        @param chunks: A C{list} of the chunks of the bpickle'd
+            C{(args, kwargs)} tuple, each at most C{_chunk_size} bytes long.
+        """
+        sequence = uuid4().int
+        result = Deferred()
+        # The index of the chunk to send next and the number of sent chunks
+        # not yet acknowledged.
+        state = {"index": 0, "in_flight": 0}
+        last = len(chunks) - 1
+
+        def send_chunks():
+            while (not result.called and state["index"] < last and
+                   state["in_flight"] < self._chunk_window):
+                chunk = chunks[state["index"]]
+                state["index"] += 1
+                state["in_flight"] += 1
+                deferred = self._protocol.callRemote(
+                    MethodCallChunk, sequence=sequence, chunk=chunk)
+                deferred.addCallbacks(handle_ack, handle_failure)
+            if (not result.called and state["index"] == last and
+                    state["in_flight"] == 0):
+                chunk = chunks[last]
+                state["index"] += 1
+                deferred = self._call_remote_with_timeout(
+                    MethodCall, sequence=sequence, method=method,
+                    arguments=chunk)
+                deferred.addCallback(lambda response: response["result"])
+                deferred.chainDeferred(result)
+
+        def handle_ack(response):
+            state["in_flight"] -= 1
+            send_chunks()
 
-        def send_last_chunk(ignored):
-            chunk = chunks[-1]
-            return self._call_remote_with_timeout(
-                MethodCall, sequence=sequence, method=method, arguments=chunk)
+        def handle_failure(failure):
+            if not result.called:
+                result.errback(failure)
 
-        result.addCallback(send_last_chunk)
-        result.addCallback(lambda response: response["result"])
-        result.callback(None)
+        send_chunks()
         return result
 
 
@@ -303,6 +612,10 @@ class MethodCallServerProtocol(AMP):
     def __init__(self, obj, methods):
         AMP.__init__(self, locator=MethodCallReceiver(obj, methods))
 
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        self.locator.forget_pending_results()
+
 
 class MethodCallClientProtocol(AMP):
     """Send L{MethodCall} commands over the wire using the AMP protocol."""
@@ -331,6 +644,8 @@ class RemoteObject(object):
         """
         self._sender = None
         self._pending_requests = {}
+        self._batch = []
+        self._batch_call = None
         self._factory = factory
         self._factory.notifyOnConnect(self._handle_connect)
 
@@ -350,14 +665,48 @@ class RemoteObject(object):
         return send_method_call
 
     def _send_method_call(self, method, args, kwargs, deferred, call=None):
-        """Send a L{MethodCall} command, adding callbacks to handle retries."""
+        """Send a L{MethodCall} command, adding callbacks to handle retries.
+
+        If the factory has a C{batchWindow}, the call is queued instead and
+        sent along with any other call made in the meantime. Its arguments
+        are serialized right away though, so that the caller gets the error
+        if they can't be, rather than the whole batch failing later on.
+        """
+        if self._factory.batchWindow is not None:
+            arguments = bpickle.dumps((args, kwargs))
+            self._batch.append((method, args, kwargs, arguments, deferred,
+                                call))
+            if self._batch_call is None:
+                self._batch_call = self._factory.clock.callLater(
+                    self._factory.batchWindow, self._send_batch)
+            return
+
         result = self._sender.send_method_call(method=method,
                                                args=args,
                                                kwargs=kwargs)
+        self._add_handlers(result, method, args, kwargs, deferred, call)
+        self._flush_fake_connection()
+
+    def _send_batch(self):
+        """Send the method calls queued during the last C{batchWindow}."""
+        self._batch_call = None
+        batch = self._batch
+        self._batch = []
+        results = self._sender.send_serialized_method_calls(
+            [(method.encode("utf-8"), arguments)
+             for method, _, _, arguments, _, _ in batch])
+        for result, (method, args, kwargs, _, deferred, call) in zip(results,
+                                                                     batch):
+            self._add_handlers(result, method, args, kwargs, deferred, call)
+        self._flush_fake_connection()
+
+    def _add_handlers(self, result, method, args, kwargs, deferred, call):
+        """Relay the C{result} of a sent method call to C{deferred}."""
         result.addCallback(self._handle_result, deferred, call=call)
         result.addErrback(self._handle_failure, method, args, kwargs,
                           deferred, call=call)
 
+    def _flush_fake_connection(self):
         if self._factory.fake_connection is not None:
             # Transparently flush the connection after a send_method_call
             # invocation letting tests simulate a synchronous transport.
@@ -484,6 +833,9 @@ class MethodCallClientFactory(ReconnectingClientFactory):
     @param retryTimeout: A timeout for retrying requests, if the remote object
         can't perform them again successfully within this number of seconds,
         they will errback with a L{MethodCallError}.
+    @ivar batchWindow: If not C{None}, the number of seconds during which
+        the remote object collects method calls before sending them together
+        in L{MethodCallBatch} commands.
     """
 
     factor = 1.6180339887498948
@@ -494,6 +846,7 @@ class MethodCallClientFactory(ReconnectingClientFactory):
 
     retryOnReconnect = False
     retryTimeout = None
+    batchWindow = None
 
     # XXX support exposing fake asynchronous connections created by tests, so
     # they can be flushed transparently and emulate a synchronous behavior. See
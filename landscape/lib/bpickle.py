@@ -32,8 +32,15 @@ This file is modified from the original to work with python3, but should be
 wire compatible and behave the same way (bugs notwithstanding).
 """
 
+import sys
+
 from twisted.python.compat import _PY3
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+
 dumps_table = {}
 loads_table = {}
 
@@ -54,6 +61,8 @@ def loads(byte_string, _lt=loads_table, as_is=False):
     """
     if not byte_string:
         raise ValueError("Can't load empty string")
+    if isinstance(byte_string, memoryview):
+        byte_string = byte_string.tobytes()
     try:
         # To avoid python3 turning byte_string[0] into an int,
         # we slice the bytestring instead.
@@ -64,6 +73,369 @@ def loads(byte_string, _lt=loads_table, as_is=False):
         raise ValueError("Corrupted data")
 
 
+def dumps_chunks(obj, limit=None):
+    """Generate the serialized form of C{obj} in chunks.
+
+    The chunks joined together are the same as C{dumps(obj)}, but dicts are
+    serialized one value at a time, lists and tuples one item at a time if
+    they hold other containers, and the items of an L{EncodedList} are
+    generated as they are, so no large byte string has to be built.
+
+    @param limit: If given, containers holding at most this number of items,
+        nested ones included, are serialized in one go, which is a lot faster
+        for objects made of many small containers.
+    """
+    if isinstance(obj, EncodedList):
+        yield b"l"
+        for data in obj.encoded:
+            yield data
+        yield b";"
+    elif (limit is not None and isinstance(obj, (dict, list, tuple)) and
+          not _holds_more(obj, limit)):
+        yield dumps(obj)
+    elif isinstance(obj, dict):
+        yield b"d"
+        for key in sorted(obj.keys()):
+            yield dumps(key)
+            for chunk in dumps_chunks(obj[key], limit):
+                yield chunk
+        yield b";"
+    elif isinstance(obj, (list, tuple)):
+        yield b"l" if isinstance(obj, list) else b"t"
+        for item in obj:
+            if isinstance(item, (dict, list, tuple)):
+                for chunk in dumps_chunks(item, limit):
+                    yield chunk
+            else:
+                yield dumps(item)
+        yield b";"
+    else:
+        yield dumps(obj)
+
+
+def _holds_more(obj, limit):
+    """Whether C{obj} holds more than C{limit} items, nested ones included.
+
+    The items are counted only until the C{limit} is reached.
+    """
+    containers = [obj]
+    count = 0
+    while containers:
+        obj = containers.pop()
+        if isinstance(obj, dict):
+            obj = obj.values()
+        count += len(obj)
+        if count > limit:
+            return True
+        containers.extend([item for item in obj
+                           if isinstance(item, (dict, list, tuple))])
+    return False
+
+
+def dump(obj, fileobj, buffer_size=65536, limit=1000):
+    """Serialize C{obj} to a file, without building it all in memory.
+
+    The chunks generated by L{dumps_chunks} are written as soon as they add
+    up to C{buffer_size} bytes.
+
+    @param fileobj: Anything with a C{write} method, like a file or the
+        result of C{socket.makefile("wb")}.
+    @param limit: Passed to L{dumps_chunks}, so that small containers are
+        serialized in one go.
+    """
+    chunks = []
+    size = 0
+    for chunk in dumps_chunks(obj, limit):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            fileobj.write(b"".join(chunks))
+            chunks = []
+            size = 0
+    if chunks:
+        fileobj.write(b"".join(chunks))
+
+
+def load(fileobj, as_is=False):
+    """Load an object serialized to a file with L{dump}."""
+    return loads(fileobj.read(), as_is=as_is)
+
+
+class IncrementalDecoder(object):
+    """Decode a stream of serialized objects, as chunks of it come in.
+
+    The objects are the ones serialized one after the other in the stream,
+    for example by several calls to L{dump}. Lists, tuples and dicts which
+    are still incomplete are decoded item by item, so only the data of the
+    item being received is kept around, rather than the data of the whole
+    object.
+
+    @param as_is: Don't reinterpret dict keys as str.
+    """
+
+    def __init__(self, as_is=False):
+        self._as_is = as_is
+        self._chunks = []
+        self._size = 0
+        # The number of bytes needed to complete the item being received,
+        # if known, so that a large string isn't scanned for every chunk.
+        self._needed = 0
+        # The (code, items) of the containers being decoded, innermost last.
+        self._stack = []
+
+    def decode(self, data, final=False):
+        """Feed a chunk of the stream to the decoder.
+
+        @param data: The next chunk of the stream.
+        @param final: Whether this is the last chunk, in which case
+            C{ValueError} is raised if it doesn't complete the last object.
+        @return: The C{list} of the objects completed so far.
+        """
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+        if not final and self._size < self._needed:
+            return []
+        data = b"".join(self._chunks)
+        objects = []
+        pos = self._decode(data, objects)
+        rest = data[pos:]
+        self._chunks = [rest] if rest else []
+        self._size = len(rest)
+        if final and (rest or self._stack):
+            raise ValueError("Corrupted data")
+        return objects
+
+    def _decode(self, data, objects):
+        """Decode as many items of C{data} as possible.
+
+        @return: The position of the first item which is still incomplete.
+        """
+        view = memoryview(data)
+        stack = self._stack
+        pos = 0
+        self._needed = 0
+        while pos < len(data):
+            code = data[pos:pos+1]
+            if code == b";" and stack:
+                code, items = stack.pop()
+                self._add(self._close(code, items), objects)
+                pos += 1
+                continue
+            try:
+                end = _skip(data, pos)
+            except ValueError:
+                end = None
+            if end is not None and end <= len(data):
+                self._add(loads(view[pos:end], as_is=self._as_is), objects)
+                pos = end
+            elif code == b"l" or code == b"t" or code == b"d":
+                stack.append((code, []))
+                pos += 1
+            else:
+                if code == b"s" or code == b"u":
+                    colon = data.find(b":", pos)
+                    if colon != -1:
+                        length = int(data[pos+1:colon])
+                        self._needed = colon + 1 + length - pos
+                break
+        return pos
+
+    def _add(self, value, objects):
+        if self._stack:
+            self._stack[-1][1].append(value)
+        else:
+            objects.append(value)
+
+    def _close(self, code, items):
+        if code == b"l":
+            return items
+        if code == b"t":
+            return tuple(items)
+        if len(items) % 2:
+            raise ValueError("Corrupted data")
+        result = {}
+        for i in range(0, len(items), 2):
+            key = items[i]
+            if _PY3 and not self._as_is and isinstance(key, bytes):
+                key = key.decode("ascii")
+            result[key] = items[i + 1]
+        return result
+
+
+class EncodedList(object):
+    """A list whose items are already serialized.
+
+    It's serialized as a regular list by L{dumps}, just by joining the
+    serialized items, while its items are deserialized only if they're
+    accessed.
+
+    @ivar encoded: The C{list} of serialized items.
+    """
+
+    def __init__(self, encoded):
+        self.encoded = list(encoded)
+
+    def __len__(self):
+        return len(self.encoded)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [loads(data) for data in self.encoded[index]]
+        return loads(self.encoded[index])
+
+    def __iter__(self):
+        for data in self.encoded:
+            yield loads(data)
+
+    def __eq__(self, other):
+        if isinstance(other, EncodedList):
+            return self.encoded == other.encoded
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _Span(object):
+    """The position of a value of a L{LazyDict} yet to be deserialized."""
+
+    __slots__ = ("start", "end")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class LazyDict(MutableMapping):
+    """A dict whose values are deserialized only when they're accessed.
+
+    Only the keys are deserialized upfront, the serialized values are just
+    skipped over and then deserialized from a C{memoryview} of the original
+    data, which the compiled codec does without copying it. Note that this
+    means that a value which can't be deserialized is only reported when
+    it's accessed.
+
+    @param byte_string: The serialized dict, see L{loads_lazy}.
+    @param as_is: Don't reinterpret dict keys as str.
+    """
+
+    def __init__(self, byte_string, as_is=False):
+        self._data = byte_string
+        self._view = memoryview(byte_string)
+        self._as_is = as_is
+        # Whether the serialized data still matches the dict, which is
+        # then serialized by just returning it.
+        self._pristine = as_is
+        self._items = {}
+        pos = 1
+        while byte_string[pos:pos+1] != b";":
+            end = _skip(byte_string, pos)
+            key = loads(self._view[pos:end], as_is=True)
+            if _PY3 and not as_is and isinstance(key, bytes):
+                key = key.decode("ascii")
+            pos = _skip(byte_string, end)
+            self._items[key] = _Span(end, pos)
+        self._end = pos + 1
+
+    def __getitem__(self, key):
+        value = self._items[key]
+        if type(value) is _Span:
+            value = loads(self._view[value.start:value.end],
+                          as_is=self._as_is)
+            if type(value) not in _immutable_types:
+                self._pristine = False
+            self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._pristine = False
+
+    def __delitem__(self, key):
+        del self._items[key]
+        self._pristine = False
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+
+def loads_lazy(byte_string, as_is=False):
+    """Load a serialized byte_string, deferring the decoding of dict values.
+
+    If the serialized object is a dict, a L{LazyDict} is returned, whose
+    values are decoded only when they're accessed. This is handy when only a
+    few values of a large dict are needed, like the type of a message.
+    Otherwise this is the same as L{loads}.
+
+    @param byte_string: the serialized data
+    @param as_is: don't reinterpret dict keys as str
+    """
+    if byte_string[0:1] == b"d":
+        return LazyDict(byte_string, as_is=as_is)
+    return loads(byte_string, as_is=as_is)
+
+
+def _skip(bytestring, pos):
+    """Return the position right after the object serialized at C{pos}."""
+    code = bytestring[pos:pos+1]
+    if code == b"i" or code == b"f":
+        return bytestring.index(b";", pos) + 1
+    if code == b"s" or code == b"u":
+        startpos, length = _string_span(bytestring, pos)
+        # Strings going past the end all end right after it.
+        return min(startpos + length, len(bytestring) + 1)
+    if code == b"b":
+        return pos + 2
+    if code == b"n":
+        return pos + 1
+    if code == b"l" or code == b"t" or code == b"d":
+        pos += 1
+        while bytestring[pos:pos+1] != b";":
+            pos = _skip(bytestring, pos)
+        return pos + 1
+    raise ValueError("Unknown type character: %s" % code)
+
+
+def _string_span(bytestring, pos):
+    """Return the start position and the length of the string at C{pos}.
+
+    @raise ValueError: If the length is negative or too big to be right.
+    """
+    startpos = bytestring.index(b":", pos) + 1
+    length = int(bytestring[pos+1:startpos-1])
+    if not 0 <= length <= sys.maxsize:
+        raise ValueError("Corrupted data")
+    return startpos, length
+
+
+def dumps_encoded_list(obj):
+    return b"l" + b"".join(obj.encoded) + b";"
+
+
+def dumps_lazy_dict(obj):
+    if not obj._pristine:
+        return dumps_dict(dict(obj))
+    if type(obj._data) is bytes and len(obj._data) == obj._end:
+        return obj._data
+    return obj._view[:obj._end].tobytes()
+
+
 def dumps_bool(obj):
     return ("b%d" % int(obj)
             ).encode("utf-8")
@@ -128,14 +500,14 @@ def loads_float(bytestring, pos, as_is=False):
 
 
 def loads_bytes(bytestring, pos, as_is=False):
-    startpos = bytestring.index(b":", pos)+1
-    endpos = startpos+int(bytestring[pos+1:startpos-1])
+    startpos, length = _string_span(bytestring, pos)
+    endpos = startpos+length
     return bytestring[startpos:endpos], endpos
 
 
 def loads_unicode(bytestring, pos, as_is=False):
-    startpos = bytestring.index(b":", pos)+1
-    endpos = startpos+int(bytestring[pos+1:startpos-1])
+    startpos, length = _string_span(bytestring, pos)
+    endpos = startpos+length
     return bytestring[startpos:endpos].decode("utf-8"), endpos
 
 
@@ -187,8 +559,12 @@ dumps_table.update({
     dict: dumps_dict,
     type(None): dumps_none,
     bytes: dumps_bytes,
+    EncodedList: dumps_encoded_list,
+    LazyDict: dumps_lazy_dict,
 })
 
+_immutable_types = (bool, int, float, bytes, type(None), type(u""))
+
 
 loads_table.update({
     b"b": loads_bool,
@@ -215,3 +591,35 @@ else:
     dumps_table.update({
         str: dumps_unicode,
         })
+
+
+# The pure-Python codec, which is what's used when the compiled one isn't
+# available.
+py_dumps = dumps
+py_loads = loads
+py_skip = _skip
+
+try:
+    from landscape.lib import _bpickle
+except ImportError:
+    _bpickle = None
+else:
+    def dumps(obj, _dt=dumps_table):
+        if _dt is not dumps_table:
+            return py_dumps(obj, _dt)
+        # Only the types which aren't built in are looked up in the table.
+        return _bpickle.dumps(obj, _dt)
+
+    def loads(byte_string, _lt=loads_table, as_is=False):
+        """Load a serialized byte_string.
+
+        @param byte_string: the serialized data
+        @param _lt: the conversion map, if it's not the default one the
+            pure-Python codec is used
+        @param as_is: don't reinterpret dict keys as str
+        """
+        if _lt is not loads_table:
+            return py_loads(byte_string, _lt, as_is=as_is)
+        return _bpickle.loads(byte_string, as_is=as_is)
+
+    _skip = _bpickle.skip
@@ -14,10 +14,16 @@ class FetchError(Exception):
 
 
 class HTTPCodeError(FetchError):
+    """The server replied with an HTTP code other than 200.
 
-    def __init__(self, http_code, body):
+    @ivar retry_after: The number of seconds the server asked to wait before
+        retrying, if known.
+    """
+
+    def __init__(self, http_code, body, retry_after=None):
         self.http_code = http_code
         self.body = body
+        self.retry_after = retry_after
 
     def __str__(self):
         return "Server returned HTTP code %d" % self.http_code
@@ -44,14 +50,45 @@ class PyCurlError(FetchError):
         return self._message
 
 
+class ChunkedInput(object):
+    """A file-like object reading from a sequence of byte strings.
+
+    @param chunks: The byte strings to read from, in order. They're not
+        joined together, so large data doesn't have to be copied.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = [chunk for chunk in chunks if chunk]
+        self._index = 0
+        self._offset = 0
+        self.size = sum(len(chunk) for chunk in self._chunks)
+
+    def read(self, size=-1):
+        """Read up to C{size} bytes, or all the remaining ones."""
+        result = []
+        while self._index < len(self._chunks) and size != 0:
+            chunk = self._chunks[self._index]
+            end = len(chunk) if size < 0 else self._offset + size
+            data = chunk[self._offset:end]
+            result.append(data)
+            if size > 0:
+                size -= len(data)
+            self._offset += len(data)
+            if self._offset >= len(chunk):
+                self._index += 1
+                self._offset = 0
+        return b"".join(result)
+
+
 def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
           connect_timeout=30, total_timeout=600, insecure=False, follow=True,
-          user_agent=None, proxy=None):
+          user_agent=None, proxy=None, dns_cache_timeout=0):
     """Retrieve a URL and return the content.
 
     @param url: The url to be fetched.
     @param post: If true, the POST method will be used (defaults to GET).
-    @param data: Data to be sent to the server as the POST content.
+    @param data: Data to be sent to the server as the POST content. It can
+        also be a C{list} of byte strings, which are sent one after the other.
     @param headers: Dictionary of header => value entries to be used on the
         request.
     @param curl: A pycurl.Curl instance to use. If not provided, one will be
@@ -63,11 +100,18 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     @param follow: If True, follow HTTP redirects (default True).
     @param user_agent: The user-agent to set in the request.
     @param proxy: The proxy url to use for the request.
+    @param dns_cache_timeout: The number of seconds name resolutions are
+        kept in the cache of C{curl} (default 0, meaning not at all).
     """
     import pycurl
-    if not isinstance(data, bytes):
-        data = data.encode("utf-8")
-    output = io.BytesIO(data)
+    if isinstance(data, list):
+        output = ChunkedInput(data)
+        size = output.size
+    else:
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        output = io.BytesIO(data)
+        size = len(data)
     input = io.BytesIO()
 
     if curl is None:
@@ -80,8 +124,8 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     if post:
         curl.setopt(pycurl.POST, True)
 
-        if data:
-            curl.setopt(pycurl.POSTFIELDSIZE, len(data))
+        if size:
+            curl.setopt(pycurl.POSTFIELDSIZE, size)
             curl.setopt(pycurl.READFUNCTION, output.read)
 
     if cainfo and url.startswith("https:"):
@@ -109,7 +153,7 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     curl.setopt(pycurl.LOW_SPEED_TIME, total_timeout)
     curl.setopt(pycurl.NOSIGNAL, 1)
     curl.setopt(pycurl.WRITEFUNCTION, input.write)
-    curl.setopt(pycurl.DNS_CACHE_TIMEOUT, 0)
+    curl.setopt(pycurl.DNS_CACHE_TIMEOUT, dns_cache_timeout)
     curl.setopt(pycurl.ENCODING, b"gzip,deflate")
 
     try:
@@ -17,14 +17,33 @@ def create_text_file(path, content):
     create_binary_file(path, content.encode("utf-8"))
 
 
-def create_binary_file(path, content):
+def create_binary_file(path, content, sync=False):
     """Create a file with the given binary content.
 
     @param path: The path to the file.
     @param content: The content to be written in the file.
+    @param sync: If C{True}, flush the content to disk before returning.
     """
     with open(path, "wb") as fd:
         fd.write(content)
+        if sync:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+
+def sync_path(path):
+    """Flush to disk the data of the given file or directory.
+
+    Syncing a directory makes the creation, removal and renaming of the
+    entries it contains durable.
+
+    @param path: The path to the file or directory.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def append_text_file(path, content):
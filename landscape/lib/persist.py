@@ -22,17 +22,34 @@ import os
 import sys
 import copy
 import re
+import shutil
+import struct
+import zlib
 
 from twisted.python.compat import StringType  # Py2: basestring, Py3: str
 
+try:
+    from collections.abc import Mapping, Sequence
+    from urllib.parse import quote, unquote
+except ImportError:  # Python 2
+    from collections import Mapping, Sequence
+    from urllib import quote, unquote
 
-__all__ = ["Persist", "PickleBackend", "BPickleBackend",
+from landscape.lib import bpickle
+from landscape.lib.fs import sync_path
+
+
+__all__ = ["Persist", "JournaledPersist", "ShardedPersist",
+           "PickleBackend", "BPickleBackend",
            "path_string_to_tuple", "path_tuple_to_string", "RootedPersist",
-           "PersistError", "PersistReadOnlyError"]
+           "DictView", "ListView", "PersistError", "PersistReadOnlyError"]
 
 
 NOTHING = object()
 
+# Past this many changed paths, the whole database is considered changed.
+MAX_MODIFIED_PATHS = 1000
+
 
 class PersistError(Exception):
     pass
@@ -65,9 +82,9 @@ class Persist(object):
         @param backend: The backend to use. If none is specified,
             L{BPickleBackend} will be used.
         @param filename: The default filename to save to and load from. If
-            specified, and the file exists, it will be immediately
-            loaded. Specifying this will also allow L{save} to be called
-            without any arguments to save the persist.
+            specified, and the file or its C{.old} backup exists, it will
+            be immediately loaded. Specifying this will also allow L{save}
+            to be called without any arguments to save the persist.
         """
         if backend is None:
             backend = BPickleBackend()
@@ -76,10 +93,18 @@ class Persist(object):
         self._softmap = {}
         self._weakmap = {}
         self._readonly = False
-        self._modified = False
+        # The paths changed since the last reset_modified(), and the count
+        # of changes which was saved to or loaded from _saved_filepath.
+        self._modified_paths = set()
+        self._changes = 0
+        self._saved_filepath = None
+        self._saved_changes = 0
+        self._save_stats = {"saves": 0, "skipped-saves": 0,
+                            "bytes-written": 0, "last-bytes-written": 0}
         self._config = self
         self.filename = filename
-        if filename is not None and os.path.exists(filename):
+        if filename is not None and (os.path.exists(filename) or
+                                     os.path.exists(filename + ".old")):
             self.load(filename)
 
     def _get_readonly(self):
@@ -89,14 +114,37 @@ class Persist(object):
         self._readonly = bool(flag)
 
     def _get_modified(self):
-        return self._modified
+        return bool(self._modified_paths)
 
     readonly = property(_get_readonly, _set_readonly)
     modified = property(_get_modified)
 
     def reset_modified(self):
         """Set the database status as non-modified."""
-        self._modified = False
+        self._modified_paths = set()
+
+    def is_modified(self, path):
+        """
+        Whether the value at C{path}, or anything below it, possibly changed
+        since the last L{reset_modified}.
+        """
+        if isinstance(path, StringType):
+            path = path_string_to_tuple(path)
+        for modified in self._modified_paths:
+            length = min(len(path), len(modified))
+            if path[:length] == modified[:length]:
+                return True
+        return False
+
+    def _modify(self, path):
+        self._changes += 1
+        paths = self._modified_paths
+        if () in paths:
+            return
+        if len(paths) >= MAX_MODIFIED_PATHS:
+            paths.clear()
+            path = ()
+        paths.add(path)
 
     def assert_writable(self):
         """Assert if the object is writable
@@ -108,6 +156,7 @@ class Persist(object):
 
     def load(self, filepath):
         """Load a persisted database."""
+        self._saved_filepath = None
 
         def load_old():
             filepathold = filepath + ".old"
@@ -118,7 +167,7 @@ class Persist(object):
                 # warning("Broken configuration file at %s" % filepath)
                 # warning("Trying backup at %s" % filepathold)
                 try:
-                    self._hardmap = self._backend.load(filepathold)
+                    self._load_file(filepathold)
                 except Exception:
                     raise PersistError("Broken configuration file at %s" %
                                        filepathold)
@@ -134,32 +183,97 @@ class Persist(object):
             load_old()
             return
         try:
-            self._hardmap = self._backend.load(filepath)
+            self._load_file(filepath)
         except Exception:
             if load_old():
                 return
             raise PersistError("Broken configuration file at %s" % filepath)
 
+    def _load_file(self, filepath):
+        """Replace the persistent options with the ones in C{filepath}."""
+        self._hardmap = self._backend.load(filepath)
+        self._saved_filepath = filepath
+        self._saved_changes = self._changes
+
     def save(self, filepath=None):
         """Save the persist to the given C{filepath}.
 
         If None is specified, then the filename passed during construction will
         be used.
 
-        If the destination file already exists, it will be renamed
-        to C{<filepath>.old}.
+        Nothing is written if there were no changes since the persist was
+        last saved to or loaded from C{filepath}, and the file is still there.
+
+        The persist is written to C{<filepath>.new} and synced to disk first,
+        so that C{filepath} is never left half written. If the destination
+        file already exists, it's then kept as C{<filepath>.old} before the
+        new file replaces it.
+
+        @return: The number of bytes written, C{0} if nothing was.
+        """
+        filepath = self._get_filepath(filepath)
+        if (filepath == self._saved_filepath and
+                self._changes == self._saved_changes and
+                os.path.isfile(filepath)):
+            self._save_stats["skipped-saves"] += 1
+            return 0
+        return self._write(filepath)
+
+    def compact(self, filepath=None):
+        """Write the whole database to C{filepath}, as a single file.
+
+        This is the format every L{Persist} can load, so the file can still
+        be read by older clients and by tools which don't know about the
+        incremental formats of the subclasses.
         """
+        return self._write(self._get_filepath(filepath))
+
+    def _write(self, filepath):
+        size = self._write_file(filepath, self._hardmap)
+        self._saved_filepath = filepath
+        self._saved_changes = self._changes
+        self._record_save(size)
+        return size
+
+    def _write_file(self, filepath, map):
+        """Atomically write C{map} to C{filepath}, returning its size."""
+        dirname = os.path.dirname(filepath)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        temp = filepath + ".new"
+        self._backend.save(temp, map)
+        sync_path(temp)
+        size = os.path.getsize(temp)
+        if os.path.isfile(filepath):
+            # Keep the previous version as a backup without moving it away,
+            # so that filepath exists at all times.
+            _link(filepath, filepath + ".old")
+        os.rename(temp, filepath)
+        sync_path(dirname or os.curdir)
+        return size
+
+    def _record_save(self, size):
+        stats = self._save_stats
+        stats["saves"] += 1
+        stats["bytes-written"] += size
+        stats["last-bytes-written"] = size
+
+    def get_save_stats(self):
+        """Return counters about the saves made so far.
+
+        @return: A C{dict} with the number of C{saves} which wrote to disk,
+            of C{skipped-saves} because nothing changed, and the number of
+            bytes written by all saves, C{bytes-written}, and by the last
+            one, C{last-bytes-written}.
+        """
+        return dict(self._save_stats)
+
+    def _get_filepath(self, filepath):
         if filepath is None:
             if self.filename is None:
                 raise PersistError("Need a filename!")
             filepath = self.filename
-        filepath = os.path.expanduser(filepath)
-        if os.path.isfile(filepath):
-            os.rename(filepath, filepath + ".old")
-        dirname = os.path.dirname(filepath)
-        if dirname and not os.path.isdir(dirname):
-            os.makedirs(dirname)
-        self._backend.save(filepath, self._hardmap)
+        return os.path.expanduser(filepath)
 
     def _traverse(self, obj, path, default=NOTHING, setvalue=NOTHING):
         if setvalue is not NOTHING:
@@ -249,6 +363,19 @@ class Persist(object):
             return default
         return self._backend.copy(value)
 
+    def view(self, path, default=None, soft=False, hard=False, weak=False):
+        """Like L{get}, but return a read-only view instead of a copy.
+
+        Dicts and lists are returned as L{DictView}s and L{ListView}s,
+        which avoid copying large values which are only going to be read.
+        They reflect the changes made later to the value in place, like
+        L{add} does, so they shouldn't be kept around.
+        """
+        value = self._getvalue(path, soft, hard, weak)
+        if value is NOTHING:
+            return default
+        return _view(value)
+
     def set(self, path, value, soft=False, weak=False):
         assert path
         if isinstance(path, StringType):
@@ -259,7 +386,7 @@ class Persist(object):
             map = self._weakmap
         else:
             self.assert_writable()
-            self._modified = True
+            self._modify(path)
             map = self._hardmap
         self._traverse(map, path, setvalue=value)
 
@@ -273,7 +400,7 @@ class Persist(object):
             map = self._weakmap
         else:
             self.assert_writable()
-            self._modified = True
+            self._modify(path)
             map = self._hardmap
         if unique:
             current = self._traverse(map, path)
@@ -292,7 +419,7 @@ class Persist(object):
             map = self._weakmap
         else:
             self.assert_writable()
-            self._modified = True
+            self._modify(path)
             map = self._hardmap
         marker = NOTHING
         while path:
@@ -344,6 +471,444 @@ class Persist(object):
         return RootedPersist(self, path)
 
 
+class JournaledPersist(Persist):
+    """A L{Persist} which saves changes incrementally.
+
+    The first save writes the whole database, as L{Persist} does, and
+    starts a journal next to it, named C{<filepath>.journal}. As long as
+    the database file isn't bigger than C{journal_threshold}, writing it
+    again is cheap and every save does so. Past that, saves just append the
+    C{set}, C{add} and C{remove} operations made since the previous one to
+    the journal, in a single record, and loading replays them on top of the
+    database file. Once the journal grows bigger than the database file and
+    than C{compact_size}, the next save compacts them by writing the whole
+    database again.
+
+    A plain L{Persist}, like the one of an older client, only loads the
+    database file. Small databases are always complete in it, even after a
+    crash, but the changes to bigger ones may still be in the journal:
+    L{compact} should be called before handing the file over, for example
+    when the process exits.
+
+    The journal starts with the size and checksum of the database file it
+    applies to, and each record has its own length and checksum, so after
+    a crash the journal is either replayed up to the last complete record
+    or, if it belongs to another version of the database file, ignored.
+
+    The values set must be serializable with L{bpickle}, whatever the
+    backend.
+    """
+
+    journal_threshold = 65536
+    compact_size = 65536
+
+    def __init__(self, backend=None, filename=None):
+        self._pending = []
+        # The file whose journal can be appended to, if any, and the size
+        # of that file and of its journal.
+        self._journal_filepath = None
+        self._snapshot_size = 0
+        self._journal_size = 0
+        self._loaded = None
+        super(JournaledPersist, self).__init__(backend, filename)
+
+    def load(self, filepath):
+        """Load a persisted database, replaying its journal."""
+        filepath = os.path.expanduser(filepath)
+        self._pending = []
+        self._journal_filepath = None
+        self._loaded = None
+        super(JournaledPersist, self).load(filepath)
+        if self._loaded is None:
+            return
+        loaded_filepath, header = self._loaded
+        records, complete = _read_journal(filepath + ".journal")
+        if not records or records[0] != header:
+            return
+        modified, readonly = self._modified_paths, self._readonly
+        self._modified_paths = set()
+        self._readonly = False
+        try:
+            for record in records[1:]:
+                for operation in bpickle.loads(record):
+                    self._replay(operation)
+        finally:
+            self._modified_paths, self._readonly = modified, readonly
+        if complete and loaded_filepath == filepath:
+            self._journal_filepath = filepath
+            self._snapshot_size = header[0]
+            self._journal_size = sum(
+                _RECORD_HEADER.size + len(record) for record in records)
+
+    def _load_file(self, filepath):
+        super(JournaledPersist, self)._load_file(filepath)
+        self._loaded = (filepath, _checksum(filepath))
+
+    def save(self, filepath=None):
+        """Save the changes made since the last save to the given C{filepath}.
+
+        The whole database is written, as L{Persist.save} does, if the
+        C{filepath} isn't the one the database was last loaded from or
+        saved to, if the database file isn't bigger than
+        C{journal_threshold}, or if the journal is due for compaction.
+        """
+        filepath = self._get_filepath(filepath)
+        if (filepath != self._journal_filepath or
+                self._journal_size > max(self._snapshot_size,
+                                         self.compact_size) or
+                not os.path.isfile(filepath)):
+            return self.compact(filepath)
+        elif not self._pending:
+            self._save_stats["skipped-saves"] += 1
+            return 0
+        elif self._snapshot_size <= self.journal_threshold:
+            return self.compact(filepath)
+        else:
+            record = _frame(bpickle.dumps(bpickle.EncodedList(self._pending)))
+            with open(filepath + ".journal", "ab") as fd:
+                fd.write(record)
+                fd.flush()
+                os.fsync(fd.fileno())
+            self._journal_size += len(record)
+            self._pending = []
+            self._record_save(len(record))
+            return len(record)
+
+    def compact(self, filepath=None):
+        """Write the whole database to C{filepath} and start a new journal.
+
+        The journal is left empty, so a plain L{Persist} loads all the
+        changes made so far from C{filepath}.
+        """
+        filepath = self._get_filepath(filepath)
+        size = self._write(filepath)
+        header = _checksum(filepath)
+        record = _frame(bpickle.dumps(header))
+        journal = filepath + ".journal"
+        with open(journal + ".new", "wb") as fd:
+            fd.write(record)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(journal + ".new", journal)
+        self._pending = []
+        self._journal_filepath = filepath
+        self._snapshot_size = header[0]
+        self._journal_size = len(record)
+        return size
+
+    def set(self, path, value, soft=False, weak=False):
+        if soft or weak:
+            return super(JournaledPersist, self).set(path, value, soft, weak)
+        path, operation = self._encode("set", path, value)
+        super(JournaledPersist, self).set(path, value)
+        self._pending.append(operation)
+
+    def add(self, path, value, unique=False, soft=False, weak=False):
+        if soft or weak:
+            return super(JournaledPersist, self).add(
+                path, value, unique, soft, weak)
+        path, operation = self._encode("add", path, value, unique)
+        super(JournaledPersist, self).add(path, value, unique)
+        self._pending.append(operation)
+
+    def remove(self, path, value=NOTHING, soft=False, weak=False):
+        if soft or weak:
+            return super(JournaledPersist, self).remove(
+                path, value, soft, weak)
+        if value is NOTHING:
+            path, operation = self._encode("remove", path)
+        else:
+            path, operation = self._encode("remove", path, value)
+        result = super(JournaledPersist, self).remove(path, value)
+        if result:
+            self._pending.append(operation)
+        return result
+
+    def _encode(self, name, path, *args):
+        """Serialize an operation, before it's applied.
+
+        This way the journal gets the values as they were at the time of
+        the operation, and nothing changes if they can't be serialized.
+        """
+        if isinstance(path, StringType):
+            path = path_string_to_tuple(path)
+        args = tuple(arg._value if isinstance(arg, _View) else arg
+                     for arg in args)
+        return path, bpickle.dumps((name, path) + args)
+
+    def _replay(self, operation):
+        name, path, args = operation[0], tuple(operation[1]), operation[2:]
+        if name == "set":
+            Persist.set(self, path, *args)
+        elif name == "add":
+            Persist.add(self, path, *args)
+        elif name == "remove":
+            Persist.remove(self, path, *args)
+
+
+class ShardedPersist(Persist):
+    """A L{Persist} which stores each top-level key in its own file.
+
+    Next to the single file at C{filepath}, the persist is saved to a
+    C{<filepath>.shards} directory holding a C{<key>.bpickle} file for each
+    top-level key, typically the C{persist_name} of a plugin. Saves only
+    write the files of the keys changed since the previous save, and each
+    file is only loaded when its key is first accessed, so that one large
+    subtree doesn't slow down the saves and loads of the others.
+
+    L{compact} brings the single file up to date, for example when the
+    process exits, so that it can be loaded by a plain L{Persist}, like the
+    one of an older client after a downgrade. The directory records the
+    checksum of the single file it was last written with: as long as the
+    file didn't change since, the directory is loaded, without having to
+    write every key again. Otherwise, like after an older client saved the
+    file, or when there's no directory yet, the file is loaded, with its
+    journal if any, and the next save writes every key.
+
+    Top-level keys must be strings.
+    """
+
+    def __init__(self, backend=None, filename=None):
+        # The files of the keys which weren't loaded yet, the keys changed
+        # since the last save, and the count of changes which the single
+        # file was last written with, if known.
+        self._unloaded = {}
+        self._dirty = set()
+        self._compacted_changes = None
+        super(ShardedPersist, self).__init__(backend, filename)
+
+    def load(self, filepath):
+        """Load a persisted database, or prepare to load it lazily."""
+        filepath = os.path.expanduser(filepath)
+        self._unloaded = {}
+        self._dirty = set()
+        self._compacted_changes = None
+        if not self._is_synced(filepath):
+            legacy = JournaledPersist(self._backend)
+            legacy.load(filepath)
+            self._hardmap = legacy._hardmap
+            self._saved_filepath = None
+            return
+        self._hardmap = self._backend.new()
+        dirname = filepath + ".shards"
+        for name in os.listdir(dirname):
+            key = _shard_key(name)
+            if key is not None:
+                self._unloaded[key] = os.path.join(dirname, _shard_name(key))
+        self._saved_filepath = filepath
+        self._saved_changes = self._changes
+
+    def save(self, filepath=None):
+        """Save the keys changed since the last save to C{filepath}.
+
+        All of them, and the single file, are written if the persist wasn't
+        last saved to or loaded from the C{filepath} directory.
+        """
+        filepath = self._get_filepath(filepath)
+        dirname = filepath + ".shards"
+        if filepath != self._saved_filepath or not os.path.isdir(dirname):
+            return self._write(filepath)
+        elif self._dirty:
+            size = 0
+            for key in self._dirty:
+                size += self._write_shard(dirname, key)
+            self._dirty = set()
+            self._saved_changes = self._changes
+            self._record_save(size)
+            return size
+        else:
+            self._save_stats["skipped-saves"] += 1
+            return 0
+
+    def compact(self, filepath=None):
+        """Save the database, and write it whole to the single file.
+
+        The single file isn't written again if it's known to be up to date,
+        and the directory is kept, so that the next load doesn't need to
+        write every key again.
+        """
+        filepath = self._get_filepath(filepath)
+        size = self.save(filepath)
+        if self._compacted_changes == self._changes:
+            return size
+        for key in list(self._unloaded):
+            self._load_shard(key)
+        written = self._write_file(filepath, self._hardmap)
+        self._write_checksum(filepath)
+        self._compacted_changes = self._changes
+        self._record_save(written)
+        return size + written
+
+    def _write(self, filepath):
+        for key in list(self._unloaded):
+            self._load_shard(key)
+        # The single file is written first, so that if this is interrupted
+        # it doesn't match the checksum in the directory, and is loaded.
+        size = self._write_file(filepath, self._hardmap)
+        dirname = filepath + ".shards"
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        size += self._write_shards(dirname)
+        self._write_checksum(filepath)
+        self._dirty = set()
+        self._saved_filepath = filepath
+        self._saved_changes = self._changes
+        self._compacted_changes = self._changes
+        self._record_save(size)
+        return size
+
+    def _write_checksum(self, filepath):
+        """Record the checksum of C{filepath} in its directory.
+
+        A journal left by L{JournaledPersist} belongs to a previous version
+        of the file, and is removed.
+        """
+        if os.path.isfile(filepath + ".journal"):
+            os.remove(filepath + ".journal")
+        path = os.path.join(filepath + ".shards", _CHECKSUM_NAME)
+        with open(path + ".new", "w") as fd:
+            fd.write("%d %d" % _checksum(filepath))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(path + ".new", path)
+        sync_path(filepath + ".shards")
+
+    def _is_synced(self, filepath):
+        """
+        Whether the directory of C{filepath} was last written with the
+        current version of the file.
+        """
+        path = os.path.join(filepath + ".shards", _CHECKSUM_NAME)
+        if not os.path.isfile(path) or not os.path.isfile(filepath):
+            return False
+        with open(path) as fd:
+            try:
+                checksum = tuple(int(value) for value in fd.read().split())
+            except ValueError:
+                return False
+        return checksum == _checksum(filepath)
+
+    def _write_shards(self, dirname):
+        """Write all the keys to C{dirname}, and remove the stale files."""
+        size = 0
+        for key in self._hardmap:
+            size += self._write_shard(dirname, key)
+        for name in os.listdir(dirname):
+            key = _shard_key(name)
+            if key is not None and key not in self._hardmap:
+                self._write_shard(dirname, key)
+        return size
+
+    def _write_shard(self, dirname, key):
+        """Write the file of C{key}, or remove it if C{key} was removed.
+
+        @return: The number of bytes written.
+        """
+        filepath = os.path.join(dirname, _shard_name(key))
+        if key in self._hardmap:
+            return self._write_file(filepath, {key: self._hardmap[key]})
+        for path in (filepath, filepath + ".old"):
+            if os.path.isfile(path):
+                os.remove(path)
+        return 0
+
+    def _load_shard(self, key):
+        filepath = self._unloaded.pop(key)
+        for path in (filepath, filepath + ".old"):
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                try:
+                    shard = self._backend.load(path)
+                except Exception:
+                    continue
+                self._hardmap.update(shard)
+                return
+        raise PersistError("Broken persist shard at %s" % filepath)
+
+    def _traverse(self, obj, path, default=NOTHING, setvalue=NOTHING):
+        if obj is self._hardmap and self._unloaded:
+            if not path:
+                for key in list(self._unloaded):
+                    self._load_shard(key)
+            elif path[0] in self._unloaded:
+                self._load_shard(path[0])
+        return super(ShardedPersist, self)._traverse(
+            obj, path, default, setvalue)
+
+    def _modify(self, path):
+        super(ShardedPersist, self)._modify(path)
+        self._dirty.add(path[0])
+
+
+def _link(filepath, linkpath):
+    """Make C{linkpath} a hard link to C{filepath}, or a copy of it."""
+    if os.path.lexists(linkpath):
+        os.remove(linkpath)
+    try:
+        os.link(filepath, linkpath)
+    except OSError:
+        shutil.copyfile(filepath, linkpath)
+
+
+_SHARD_SUFFIX = ".bpickle"
+_CHECKSUM_NAME = "checksum"
+
+
+def _shard_name(key):
+    return quote(key, safe="") + _SHARD_SUFFIX
+
+
+def _shard_key(name):
+    """Return the key stored in a shard file, or in its backup."""
+    if name.endswith(".old"):
+        name = name[:-len(".old")]
+    if not name.endswith(_SHARD_SUFFIX):
+        return None
+    return unquote(name[:-len(_SHARD_SUFFIX)])
+
+
+# The length and CRC-32 of the journal records.
+_RECORD_HEADER = struct.Struct("<II")
+
+
+def _frame(data):
+    return _RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+
+def _read_journal(filepath):
+    """Read the records of a journal.
+
+    @return: The C{list} of the records found, and whether the journal
+        ended with a complete record.
+    """
+    if not os.path.isfile(filepath):
+        return [], False
+    with open(filepath, "rb") as fd:
+        data = fd.read()
+    records = []
+    pos = 0
+    while pos + _RECORD_HEADER.size <= len(data):
+        length, checksum = _RECORD_HEADER.unpack_from(data, pos)
+        start = pos + _RECORD_HEADER.size
+        record = data[start:start + length]
+        if (len(record) < length or
+                zlib.crc32(record) & 0xffffffff != checksum):
+            break
+        records.append(bpickle.loads(record) if not records else record)
+        pos = start + length
+    return records, pos == len(data)
+
+
+def _checksum(filepath):
+    """Return the size and the CRC-32 of the given file."""
+    checksum = 0
+    size = 0
+    with open(filepath, "rb") as fd:
+        for data in iter(lambda: fd.read(65536), b""):
+            checksum = zlib.crc32(data, checksum)
+            size += len(data)
+    return (size, checksum & 0xffffffff)
+
+
 class RootedPersist(object):
     """Root a L{Persist}'s tree at a particular branch.
 
@@ -352,7 +917,8 @@ class RootedPersist(object):
 
     The chosen branch will be viewed as the root of the tree of the
     L{RootedPersist} and all operations will be forwarded to the parent
-    L{Persist} as appropriate.
+    L{Persist} as appropriate. Its C{modified} status only reflects the
+    changes which may have affected the branch.
     """
 
     def __init__(self, parent, root):
@@ -368,11 +934,16 @@ class RootedPersist(object):
             self.root = root
 
     readonly = property(lambda self: self.parent.readonly)
-    modified = property(lambda self: self.parent.modified)
+    modified = property(lambda self: self.parent.is_modified(self.root))
 
     def assert_writable(self):
         self.parent.assert_writable()
 
+    def is_modified(self, path):
+        if isinstance(path, StringType):
+            path = path_string_to_tuple(path)
+        return self.parent.is_modified(self.root + path)
+
     def has(self, path, value=NOTHING, soft=False, hard=False, weak=False):
         if isinstance(path, StringType):
             path = path_string_to_tuple(path)
@@ -388,6 +959,11 @@ class RootedPersist(object):
             path = path_string_to_tuple(path)
         return self.parent.get(self.root + path, default, soft, hard, weak)
 
+    def view(self, path, default=None, soft=False, hard=False, weak=False):
+        if isinstance(path, StringType):
+            path = path_string_to_tuple(path)
+        return self.parent.view(self.root + path, default, soft, hard, weak)
+
     def set(self, path, value, soft=False, weak=False):
         if isinstance(path, StringType):
             path = path_string_to_tuple(path)
@@ -417,6 +993,88 @@ class RootedPersist(object):
         return self.parent.root_at(self.root + path)
 
 
+class _View(object):
+
+    __slots__ = ("_value",)
+    __hash__ = None
+
+    def __init__(self, value):
+        self._value = value
+
+    def __len__(self):
+        return len(self._value)
+
+    def __eq__(self, other):
+        if isinstance(other, _View):
+            other = other._value
+        return self._value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._value)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._value, memo)
+
+    def copy(self):
+        """Return a deep copy of the value, which can be changed."""
+        return copy.deepcopy(self._value)
+
+
+class DictView(_View, Mapping):
+    """A read-only view of a C{dict} in a L{Persist}.
+
+    Its values are views themselves, if they're dicts or lists.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return _view(self._value[key])
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def __contains__(self, key):
+        return key in self._value
+
+
+class ListView(_View, Sequence):
+    """A read-only view of a C{list} in a L{Persist}.
+
+    Its items are views themselves, if they're dicts or lists.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ListView(self._value[index])
+        return _view(self._value[index])
+
+    def __iter__(self):
+        for item in self._value:
+            yield _view(item)
+
+    def __contains__(self, item):
+        if isinstance(item, _View):
+            item = item._value
+        return item in self._value
+
+
+def _view(value):
+    if type(value) is dict:
+        return DictView(value)
+    if type(value) is list:
+        return ListView(value)
+    return value
+
+
 _splitpath = re.compile(r"(\[-?\d+\])|(?<!\\)\.").split
 
 
@@ -566,7 +1224,7 @@ class Backend(object):
 
     def copy(self, value):
         """Copy a node or a value."""
-        if type(value) in (dict, list):
+        if type(value) in (dict, list) or isinstance(value, _View):
             return copy.deepcopy(value)
         return value
 
@@ -620,9 +1278,11 @@ class BPickleBackend(Backend):
 
     def load(self, filepath):
         with open(filepath, "rb") as fd:
-            return self._bpickle.loads(fd.read())
+            return self._bpickle.load(fd)
 
     def save(self, filepath, map):
+        # The map is small enough to be serialized in one go, which is a lot
+        # faster than streaming it with bpickle.dump.
         with open(filepath, "wb") as fd:
             fd.write(self._bpickle.dumps(map))
 
@@ -1,12 +1,44 @@
-"""A schema system. Yes. Another one!"""
+"""A schema system. Yes. Another one!
+
+Schemas can be compiled with L{compile_schema} into functions coercing
+values the same way, only faster.
+"""
+from functools import partial
+
 from twisted.python.compat import iteritems, unicode, long
 
+from landscape.lib.series import FLOAT, encode_series
+
 
 class InvalidError(Exception):
     """Raised when invalid input is received."""
     pass
 
 
+def compile_schema(schema):
+    """Return a function coercing values like C{schema.coerce} does.
+
+    Schemas with a C{compile} method are compiled the first time into
+    closures which know the whole nested schema upfront, instead of walking
+    it for every value. The result is cached on the schema, which must not
+    be changed afterwards. Compiled functions hand the values they reject
+    to the C{coerce} method, so that the same errors are raised.
+    """
+    function = getattr(schema, "_compiled", None)
+    if function is None:
+        compile = getattr(schema, "compile", None)
+        if compile is not None:
+            function = compile()
+        elif hasattr(schema, "coerce"):
+            function = schema.coerce
+        else:
+            # Not a schema, like the placeholder in List(None): only fail
+            # when there's actually a value to coerce, as coerce() does.
+            return lambda value: schema.coerce(value)
+        schema._compiled = function
+    return function
+
+
 class Constant(object):
     """Something that must be equal to a constant value."""
     def __init__(self, value):
@@ -26,6 +58,23 @@ class Any(object):
     def __init__(self, *schemas):
         self.schemas = schemas
 
+    def compile(self):
+        # Only try the schemas which may accept the type of the value, as
+        # trying the others is costly.
+        candidates = [(_guard_types.get(type(schema)), compile_schema(schema))
+                      for schema in self.schemas]
+
+        def coerce(value):
+            for types, function in candidates:
+                if types is None or isinstance(value, types):
+                    try:
+                        return function(value)
+                    except InvalidError:
+                        pass
+            raise InvalidError("%r did not match any schema in %s"
+                               % (value, self.schemas))
+        return coerce
+
     def coerce(self, value):
         """
         The result of the first schema which doesn't raise
@@ -93,6 +142,15 @@ class Unicode(object):
             raise InvalidError("%r isn't a unicode" % (value,))
         return value
 
+    def compile(self):
+        reference = self.coerce
+
+        def coerce(value):
+            if type(value) is unicode:
+                return value
+            return reference(value)
+        return coerce
+
 
 class List(object):
     """Something which must be a C{list}.
@@ -102,6 +160,32 @@ class List(object):
     def __init__(self, schema):
         self.schema = schema
 
+    def compile(self):
+        reference = partial(List.coerce, self)
+        types = _leaf_types.get(type(self.schema))
+        if types is not None:
+            # The items only need to be checked.
+            def coerce(value):
+                if isinstance(value, list):
+                    for item in value:
+                        if not isinstance(item, types):
+                            break
+                    else:
+                        return list(value)
+                return reference(value)
+            return coerce
+
+        coerce_item = compile_schema(self.schema)
+
+        def coerce(value):
+            if isinstance(value, list):
+                try:
+                    return [coerce_item(item) for item in value]
+                except InvalidError:
+                    pass
+            return reference(value)
+        return coerce
+
     def coerce(self, value):
         if not isinstance(value, list):
             raise InvalidError("%r is not a list" % (value,))
@@ -126,6 +210,34 @@ class Tuple(object):
     def __init__(self, *schema):
         self.schema = schema
 
+    def compile(self):
+        reference = partial(Tuple.coerce, self)
+        length = len(self.schema)
+        types = [_leaf_types.get(type(schema)) for schema in self.schema]
+        if None not in types:
+            # The items only need to be checked.
+            def coerce(value):
+                if isinstance(value, tuple) and len(value) == length:
+                    for item, item_types in zip(value, types):
+                        if not isinstance(item, item_types):
+                            break
+                    else:
+                        return value if type(value) is tuple else tuple(value)
+                return reference(value)
+            return coerce
+
+        functions = [_compile_field(schema) for schema in self.schema]
+
+        def coerce(value):
+            if isinstance(value, tuple) and len(value) == length:
+                try:
+                    return tuple([function(item) for function, item
+                                  in zip(functions, value)])
+                except InvalidError:
+                    pass
+            return reference(value)
+        return coerce
+
     def coerce(self, value):
         if not isinstance(value, tuple):
             raise InvalidError("%r is not a tuple" % (value,))
@@ -152,6 +264,38 @@ class KeyDict(object):
         self.optional = set(optional)
         self.schema = schema
 
+    def compile(self):
+        reference = partial(KeyDict.coerce, self)
+        # The values of the keys whose schema just checks their type are
+        # checked inline, the others are coerced by their compiled schema.
+        checks = {}
+        functions = {}
+        for key, schema in iteritems(self.schema):
+            types = _leaf_types.get(type(schema))
+            if types is not None:
+                checks[key] = types
+            else:
+                functions[key] = compile_schema(schema)
+        required = set(self.schema) - self.optional
+
+        def coerce(value):
+            if isinstance(value, dict):
+                new_dict = {}
+                try:
+                    for key, item in iteritems(value):
+                        types = checks.get(key)
+                        if types is None:
+                            item = functions[key](item)
+                        elif not isinstance(item, types):
+                            return reference(value)
+                        new_dict[key] = item
+                except (KeyError, InvalidError):
+                    return reference(value)
+                if required.issubset(new_dict):
+                    return new_dict
+            return reference(value)
+        return coerce
+
     def coerce(self, value):
         new_dict = {}
         if not isinstance(value, dict):
@@ -185,6 +329,21 @@ class Dict(object):
         self.key_schema = key_schema
         self.value_schema = value_schema
 
+    def compile(self):
+        reference = partial(Dict.coerce, self)
+        coerce_key = compile_schema(self.key_schema)
+        coerce_value = compile_schema(self.value_schema)
+
+        def coerce(value):
+            if isinstance(value, dict):
+                try:
+                    return dict((coerce_key(key), coerce_value(item))
+                                for key, item in iteritems(value))
+                except InvalidError:
+                    pass
+            return reference(value)
+        return coerce
+
     def coerce(self, value):
         if not isinstance(value, dict):
             raise InvalidError("%r is not a dict." % (value,))
@@ -192,3 +351,62 @@ class Dict(object):
         for k, v in value.items():
             new_dict[self.key_schema.coerce(k)] = self.value_schema.coerce(v)
         return new_dict
+
+
+class Series(object):
+    """Something which must be a C{list} of C{(timestamp, value, ...)} tuples.
+
+    The points are coerced to the compact columnar form generated by
+    L{landscape.lib.series.encode_series}.
+
+    @param columns: A C{str} with the kind of each value of the points, as
+        accepted by L{landscape.lib.series.encode_series}.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        schemas = [Int()]
+        for column in columns:
+            schemas.append(Float() if column == FLOAT else Int())
+        self.schema = List(Tuple(*schemas))
+
+    def coerce(self, value):
+        return encode_series(self.schema.coerce(value), self.columns)
+
+    def compile(self):
+        coerce_points = compile_schema(self.schema)
+        columns = self.columns
+        return lambda value: encode_series(coerce_points(value), columns)
+
+
+def _compile_field(schema):
+    """Compile a schema applied to a single value of a container."""
+    types = _leaf_types.get(type(schema))
+    if types is None:
+        return compile_schema(schema)
+
+    def check(value):
+        if not isinstance(value, types):
+            raise InvalidError("%r isn't one of %r" % (value, types))
+        return value
+    return check
+
+
+# The types accepted by the schemas which just check the type of values.
+_leaf_types = {
+    Bool: (bool,),
+    Int: (int, long),
+    Float: (int, long, float),
+    Bytes: (bytes,),
+}
+
+# The types that the values accepted by a schema may have.
+_guard_types = dict(_leaf_types)
+_guard_types.update({
+    Unicode: (bytes, unicode),
+    List: (list,),
+    Tuple: (tuple,),
+    KeyDict: (dict,),
+    Dict: (dict,),
+    Series: (list,),
+})
@@ -0,0 +1,114 @@
+"""Compact columnar encoding of series of C{(timestamp, value, ...)} points.
+
+Metrics are accumulated on fixed step boundaries, so the timestamps of a
+series can be described by the first one and the step between them, with
+the exceptions recorded as gaps. The values are then packed column by
+column: floats as little-endian doubles and integers as zigzag varints of
+the deltas between consecutive values, which keeps slowly changing
+counters down to a byte or two per point.
+"""
+import struct
+from collections import Counter
+
+from twisted.python.compat import iterbytes
+
+
+INT = "i"
+FLOAT = "f"
+
+
+def encode_series(points, columns):
+    """Encode C{points} in the compact columnar form.
+
+    @param points: A C{list} of tuples, each one holding an integer timestamp
+        followed by a value for each of the given C{columns}.
+    @param columns: A C{str} with one character per value, either L{INT} or
+        L{FLOAT}.
+    @return: A C{dict} with the following keys:
+         - C{count}: The number of points.
+         - C{start}: The timestamp of the first point, or C{0}.
+         - C{step}: The most common interval between two points.
+         - C{gaps}: A C{list} of C{(index, interval)} tuples for the points
+           which are not C{step} seconds after the previous one.
+         - C{values}: A C{list} with the packed values of each column.
+    """
+    timestamps = [point[0] for point in points]
+    intervals = [timestamps[i] - timestamps[i - 1]
+                 for i in range(1, len(timestamps))]
+    step = Counter(intervals).most_common(1)[0][0] if intervals else 0
+    gaps = [(i + 1, interval) for i, interval in enumerate(intervals)
+            if interval != step]
+    values = []
+    for i, column in enumerate(columns, 1):
+        column_values = [point[i] for point in points]
+        if column == FLOAT:
+            values.append(_pack_floats(column_values))
+        else:
+            values.append(_pack_ints(column_values))
+    return {"count": len(points),
+            "start": timestamps[0] if timestamps else 0,
+            "step": step,
+            "gaps": gaps,
+            "values": values}
+
+
+def decode_series(series, columns):
+    """Decode the points of a C{series} generated by L{encode_series}."""
+    count = series["count"]
+    gaps = dict(series["gaps"])
+    timestamps = []
+    timestamp = series["start"]
+    for i in range(count):
+        if i:
+            timestamp += gaps.get(i, series["step"])
+        timestamps.append(timestamp)
+    values = []
+    for column, data in zip(columns, series["values"]):
+        if column == FLOAT:
+            values.append(_unpack_floats(data, count))
+        else:
+            values.append(_unpack_ints(data))
+    return list(zip(timestamps, *values))
+
+
+def _pack_floats(values):
+    return struct.pack("<%dd" % len(values), *values)
+
+
+def _unpack_floats(data, count):
+    return list(struct.unpack("<%dd" % count, data))
+
+
+def _pack_ints(values):
+    data = bytearray()
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        # Zigzag: small negative deltas become small positive numbers.
+        delta = delta * 2 if delta >= 0 else -delta * 2 - 1
+        while delta > 0x7f:
+            data.append(0x80 | (delta & 0x7f))
+            delta >>= 7
+        data.append(delta)
+    return bytes(data)
+
+
+def _unpack_ints(data):
+    values = []
+    previous = 0
+    delta = shift = 0
+    for byte in iterbytes(data):
+        byte = ord(byte)
+        delta |= (byte & 0x7f) << shift
+        shift += 7
+        if byte & 0x80:
+            continue
+        if delta & 1:
+            delta = -(delta + 1) // 2
+        else:
+            delta //= 2
+        previous += delta
+        values.append(previous)
+        delta = shift = 0
+    return values
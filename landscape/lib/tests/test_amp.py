@@ -1,16 +1,20 @@
 import unittest
 
+import mock
 from twisted.internet import reactor
 from twisted.internet.error import ConnectError, ConnectionDone
 from twisted.internet.task import Clock
+from twisted.protocols.amp import UnknownRemoteError
 from twisted.internet.defer import Deferred, inlineCallbacks
 from twisted.python.failure import Failure
 
-from landscape.lib import testing
+from landscape.lib import bpickle, testing
 from landscape.lib.amp import (
     MethodCallError, MethodCallServerProtocol, MethodCallClientProtocol,
+    MethodCallReceiver,
     MethodCallServerFactory, MethodCallClientFactory, RemoteObject,
-    MethodCallSender)
+    MethodCallSender, MethodCall, MethodCallChunk, MethodCallBatch,
+    MethodCallBatchResult)
 
 
 class FakeTransport(object):
@@ -95,7 +99,18 @@ class DummyObject(object):
 
 
 class BaseTestCase(testing.TwistedTestCase, unittest.TestCase):
-    pass
+
+    def record_commands(self, protocol):
+        """Return the list that the commands sent by C{protocol} go to."""
+        commands = []
+        call_remote = protocol.callRemote
+
+        def record_call_remote(command, **kwargs):
+            commands.append(command)
+            return call_remote(command, **kwargs)
+
+        protocol.callRemote = record_call_remote
+        return commands
 
 
 class MethodCallTest(BaseTestCase):
@@ -261,6 +276,47 @@ class MethodCallTest(BaseTestCase):
         self.connection.flush()
         self.assertTrue(self.successResultOf(deferred))
 
+    def test_with_long_argument_window(self):
+        """
+        The L{MethodCallChunk}s of a long argument are sent only as the
+        previous ones get acknowledged, with a few of them in flight.
+        """
+        commands = self.record_commands(self.connection.client)
+        self.object.method = lambda words: sum(len(word) for word in words)
+        deferred = self.sender.send_method_call(method="method",
+                                                args=[["!" * 1000] * 500],
+                                                kwargs={})
+        self.assertEqual([MethodCallChunk] * 4, commands)
+        self.connection.flush()
+        self.assertEqual([MethodCallChunk] * 7 + [MethodCall], commands)
+        self.assertEqual(500000, self.successResultOf(deferred))
+
+    def test_with_long_argument_not_serializable(self):
+        """
+        If a long argument turns out not to be serializable only after some
+        of its items, the error is raised before any chunk is sent.
+        """
+        commands = self.record_commands(self.connection.client)
+        self.object.method = lambda words: len(words)
+        self.assertRaises(ValueError, self.sender.send_method_call,
+                          method="method",
+                          args=[["!" * 100] * 5000 + [object()]], kwargs={})
+        self.assertEqual([], commands)
+
+    def test_with_long_argument_changed_after_sending(self):
+        """
+        A long argument is serialized before L{send_method_call} returns, so
+        changing it while its chunks are being sent doesn't affect the call.
+        """
+        self.object.method = lambda words: (len(words), words[-1])
+        words = ["!" * 1000] * 1500
+        deferred = self.sender.send_method_call(method="method",
+                                                args=[words], kwargs={})
+        words.append("?")
+        words[-2] = "?"
+        self.connection.flush()
+        self.assertEqual((1500, "!" * 1000), self.successResultOf(deferred))
+
     def test_with_long_argument_multiple_calls(self):
         """
         The L{MethodCall} protocol supports concurrently sending multiple
@@ -377,6 +433,243 @@ class MethodCallTest(BaseTestCase):
         [failure] = result
         failure.trap(MethodCallError)
 
+    def test_send_method_calls(self):
+        """
+        L{MethodCallSender.send_method_calls} sends several calls in a single
+        L{MethodCallBatch} and returns a deferred for each of them.
+        """
+        commands = self.record_commands(self.connection.client)
+        self.object.method = lambda word, times=2: word * times
+        deferreds = self.sender.send_method_calls(
+            [("method", ["hi"], {}), ("method", ["ho"], {"times": 3})])
+        self.connection.flush()
+        self.assertEqual([MethodCallBatch], commands)
+        self.assertEqual(["hihi", "hohoho"],
+                         [self.successResultOf(deferred)
+                          for deferred in deferreds])
+
+    def test_send_method_calls_with_error(self):
+        """
+        If a call of a L{MethodCallBatch} fails, its deferred errbacks with a
+        L{MethodCallError} while the other calls still succeed.
+        """
+        self.object.method = lambda a, b: a / b
+        deferreds = self.sender.send_method_calls(
+            [("method", [1, 0], {}), ("method", [4, 2], {}),
+             ("forbidden", [], {})])
+        self.connection.flush()
+        failure = self.failureResultOf(deferreds[0])
+        failure.trap(MethodCallError)
+        self.assertEqual("division by zero", str(failure.value))
+        self.assertEqual(2, self.successResultOf(deferreds[1]))
+        failure = self.failureResultOf(deferreds[2])
+        self.assertEqual("Forbidden method 'forbidden'", str(failure.value))
+
+    @mock.patch("landscape.lib.amp.log_failure")
+    def test_send_method_calls_with_unknown_error(self, log_failure_mock):
+        """
+        If a call of a L{MethodCallBatch} fails with an error which isn't a
+        L{MethodCallError}, its deferred errbacks with the
+        L{UnknownRemoteError} AMP reports for a single L{MethodCall}, and
+        the error is logged.
+        """
+        self.methods.append("missing")
+        self.object.method = lambda: "done"
+        deferreds = self.sender.send_method_calls(
+            [("missing", [], {}), ("method", [], {})])
+        self.connection.flush()
+        failure = self.failureResultOf(deferreds[0])
+        failure.trap(UnknownRemoteError)
+        self.assertEqual("Code<UNKNOWN>: Unknown Error", str(failure.value))
+        self.assertEqual("done", self.successResultOf(deferreds[1]))
+        [(logged, message), kwargs] = log_failure_mock.call_args
+        logged.trap(AttributeError)
+
+    def test_send_method_calls_with_unserializable_arguments(self):
+        """
+        If the arguments of a call can't be serialized, only its deferred
+        fails and the other calls are still sent.
+        """
+        self.object.method = lambda value: value
+        deferreds = self.sender.send_method_calls(
+            [("method", [1], {}), ("method", [object()], {}),
+             ("method", [3], {})])
+        self.connection.flush()
+        self.assertEqual(1, self.successResultOf(deferreds[0]))
+        self.failureResultOf(deferreds[1]).trap(ValueError)
+        self.assertEqual(3, self.successResultOf(deferreds[2]))
+
+    def test_send_method_calls_with_pending_call(self):
+        """
+        A call that doesn't complete right away doesn't hold back the other
+        calls of a L{MethodCallBatch}, its result is fetched separately with
+        a L{MethodCallBatchResult}.
+        """
+        commands = self.record_commands(self.connection.client)
+        self.object.deferred = Deferred()
+        self.object.method = lambda wait: (
+            self.object.deferred if wait else "done")
+        deferreds = self.sender.send_method_calls(
+            [("method", [True], {}), ("method", [False], {})])
+        self.connection.flush()
+        self.assertFalse(deferreds[0].called)
+        self.assertEqual("done", self.successResultOf(deferreds[1]))
+
+        self.object.deferred.callback("Hey!")
+        self.connection.flush()
+        self.assertEqual("Hey!", self.successResultOf(deferreds[0]))
+        self.assertEqual([MethodCallBatch, MethodCallBatchResult], commands)
+
+    def test_send_method_calls_with_failing_pending_call(self):
+        """
+        If a call of a L{MethodCallBatch} that didn't complete right away
+        fails, its deferred errbacks with a L{MethodCallError}.
+        """
+        self.object.deferred = Deferred()
+        self.object.method = lambda wait: (
+            self.object.deferred if wait else "done")
+        deferreds = self.sender.send_method_calls(
+            [("method", [True], {}), ("method", [False], {})])
+        self.connection.flush()
+        self.object.deferred.errback(Exception())
+        self.connection.flush()
+        self.failureResultOf(deferreds[0]).trap(MethodCallError)
+        self.assertEqual("done", self.successResultOf(deferreds[1]))
+
+    def test_pending_calls_dropped_on_connection_lost(self):
+        """
+        The results of the L{MethodCallBatch} calls which the sender didn't
+        wait for yet are dropped when the connection is lost.
+        """
+        self.object.deferred = Deferred()
+        self.object.method = lambda: self.object.deferred
+        receiver = self.connection.server.locator
+        calls = bpickle.dumps([(b"method", bpickle.dumps(((), {})))])
+        receiver.receive_method_call_batch(calls)
+        self.assertEqual(1, len(receiver._pending_results))
+        self.connection.server.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual({}, receiver._pending_results)
+
+    def test_send_method_calls_with_single_call(self):
+        """
+        A single call is sent with a plain L{MethodCall}.
+        """
+        commands = self.record_commands(self.connection.client)
+        self.object.method = lambda: "Cool"
+        [deferred] = self.sender.send_method_calls([("method", [], {})])
+        self.connection.flush()
+        self.assertEqual([MethodCall], commands)
+        self.assertEqual("Cool", self.successResultOf(deferred))
+
+    def test_send_method_calls_with_big_arguments(self):
+        """
+        Calls whose arguments don't fit in a L{MethodCallBatch} are sent with
+        their own L{MethodCall}, and the others are split in as many batches
+        as needed.
+        """
+        commands = self.record_commands(self.connection.client)
+        self.object.method = len
+        calls = [("method", ["!" * 20000], {}) for _ in range(6)]
+        calls.insert(3, ("method", ["?" * 70000], {}))
+        deferreds = self.sender.send_method_calls(calls)
+        self.connection.flush()
+        self.assertEqual(
+            [MethodCallBatch, MethodCallChunk, MethodCallBatch, MethodCall],
+            commands)
+        self.assertEqual([20000] * 3 + [70000] + [20000] * 3,
+                         [self.successResultOf(deferred)
+                          for deferred in deferreds])
+
+    def test_send_method_calls_with_big_results(self):
+        """
+        The results of a L{MethodCallBatch} can be bigger than the maximum
+        size of an AMP value.
+        """
+        self.object.method = lambda: "!" * 50000
+        deferreds = self.sender.send_method_calls(
+            [("method", [], {}) for _ in range(3)])
+        self.connection.flush()
+        self.assertEqual(["!" * 50000] * 3,
+                         [self.successResultOf(deferred)
+                          for deferred in deferreds])
+
+    def test_send_method_calls_with_timeout(self):
+        """
+        If the peer doesn't answer a L{MethodCallBatch} on time, all of its
+        calls fail with a L{MethodCallError}.
+        """
+        self.object.method = lambda: "Cool"
+        deferreds = self.sender.send_method_calls(
+            [("method", [], {}), ("method", [], {})])
+        self.clock.advance(60)
+        for deferred in deferreds:
+            self.failureResultOf(deferred).trap(MethodCallError)
+
+
+class MethodCallReceiverTest(BaseTestCase):
+
+    def setUp(self):
+        super(MethodCallReceiverTest, self).setUp()
+        self.object = DummyObject()
+        self.receiver = MethodCallReceiver(self.object, ["method"])
+
+    def test_receive_method_call_chunk(self):
+        """
+        The L{MethodCallChunk}s of a L{MethodCall} are decoded as they come
+        in, without buffering the data of the ones already received.
+        """
+        self.object.method = lambda words: len(words)
+        data = bpickle.dumps(([[u"word%d" % i for i in range(10000)]], {}))
+        chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+        for chunk in chunks[:-1]:
+            self.receiver.receive_method_call_chunk(1, chunk)
+            self.assertTrue(self.receiver._decoders[1]._size < 1000)
+        deferred = self.receiver.receive_method_call(1, b"method", chunks[-1])
+        self.assertEqual({"result": 10000}, self.successResultOf(deferred))
+        self.assertEqual({}, self.receiver._decoders)
+
+    def test_receive_method_call_truncated(self):
+        """
+        An error is raised if the arguments of a L{MethodCall} sent in
+        several chunks are incomplete.
+        """
+        data = bpickle.dumps((["foo"], {}))
+        self.receiver.receive_method_call_chunk(1, data[:5])
+        self.assertRaises(ValueError, self.receiver.receive_method_call, 1,
+                          b"method", data[5:-1])
+
+    def test_receive_method_call_corrupted_chunk(self):
+        """
+        If a L{MethodCallChunk} can't be decoded, the error is raised and the
+        arguments decoded so far are dropped.
+        """
+        data = bpickle.dumps((["foo"], {}))
+        self.receiver.receive_method_call_chunk(1, data[:5])
+        self.assertRaises(ValueError, self.receiver.receive_method_call_chunk,
+                          1, b"ix;" * 10)
+        self.assertEqual({}, self.receiver._decoders)
+
+    def test_forget_pending_results(self):
+        """
+        L{MethodCallReceiver.forget_pending_results} drops the results of
+        the batched calls which didn't complete yet, and logs their failures.
+        """
+        self.object.method = lambda: self.object.deferred
+        self.object.deferred = Deferred()
+        calls = bpickle.dumps([(b"method", bpickle.dumps(((), {})))])
+        response = self.receiver.receive_method_call_batch(calls)
+        [(success, sequence)] = response["results"]
+        self.assertIs(None, success)
+        self.receiver.forget_pending_results()
+        self.assertEqual({}, self.receiver._pending_results)
+        with mock.patch("logging.error") as error:
+            self.object.deferred.errback(RuntimeError("boom"))
+        error.assert_called_once_with("Batched method call failed",
+                                      exc_info=mock.ANY)
+        self.assertRaises(MethodCallError,
+                          self.receiver.receive_method_call_batch_result,
+                          sequence)
+
 
 class RemoteObjectTest(BaseTestCase):
 
@@ -484,6 +777,74 @@ class RemoteObjectTest(BaseTestCase):
         failure = self.failureResultOf(deferred)
         self.assertEqual("Forbidden method 'method'", str(failure.value))
 
+    def test_batch_window(self):
+        """
+        If the factory has a C{batchWindow}, the calls made during the window
+        are sent together in a L{MethodCallBatch} when it's over.
+        """
+        commands = self.record_commands(self.connector.connection.client)
+        self.factory.batchWindow = 0.1
+        self.object.method = lambda word: word.capitalize()
+        deferreds = [self.remote.method(word) for word in ["john", "paul"]]
+        self.assertFalse(deferreds[0].called)
+        self.assertEqual([], commands)
+
+        self.clock.advance(0.1)
+        self.assertEqual([MethodCallBatch], commands)
+        self.assertEqual(["John", "Paul"],
+                         [self.successResultOf(deferred)
+                          for deferred in deferreds])
+
+    def test_batch_window_with_method_call_error(self):
+        """
+        A L{MethodCallError} for one of the calls sent in a batch only fails
+        that call.
+        """
+        self.factory.batchWindow = 0
+        self.object.method = lambda: "Cool"
+        deferred1 = self.remote.method()
+        deferred2 = self.remote.forbidden()
+        self.clock.advance(0)
+        self.assertEqual("Cool", self.successResultOf(deferred1))
+        failure = self.failureResultOf(deferred2)
+        self.assertEqual("Forbidden method 'forbidden'", str(failure.value))
+
+    def test_batch_window_with_unserializable_arguments(self):
+        """
+        If the arguments of a call can't be serialized, the error is raised
+        to its caller, and the other calls of the batch are still sent.
+        """
+        self.factory.batchWindow = 0
+        self.object.method = lambda value: value
+        deferred1 = self.remote.method(1)
+        self.assertRaises(ValueError, self.remote.method, object())
+        deferred3 = self.remote.method(3)
+        self.clock.advance(0)
+        self.assertEqual(1, self.successResultOf(deferred1))
+        self.assertEqual(3, self.successResultOf(deferred3))
+
+    def test_batch_window_retry(self):
+        """
+        Batched calls that failed because of a lost connection are retried
+        together when a new connection is available.
+        """
+        self.object.method = lambda word: word.capitalize()
+        self.factory.batchWindow = 0
+        self.factory.factor = 0.19
+        self.factory.retryOnReconnect = True
+        self.connector.disconnect()
+        deferreds = [self.remote.method(word) for word in ["john", "paul"]]
+        self.clock.advance(0)
+        self.assertFalse(deferreds[0].called)
+
+        # Time passes and the factory successfully reconnects
+        self.clock.advance(1)
+        self.clock.advance(0)
+
+        self.assertEqual(["John", "Paul"],
+                         [self.successResultOf(deferred)
+                          for deferred in deferreds])
+
 
 class MethodCallClientFactoryTest(BaseTestCase):
 
@@ -1,5 +1,9 @@
+import io
+import random
 import unittest
 
+import mock
+
 from landscape.lib import bpickle
 
 
@@ -61,3 +65,355 @@ class BPickleTest(unittest.TestCase):
     def test_long(self):
         long = 99999999999999999999999999999
         self.assertEqual(bpickle.loads(bpickle.dumps(long)), long)
+
+    def test_string_length_corrupted(self):
+        """
+        Strings with a negative length, or one too big to be addressed,
+        can't be loaded or skipped.
+        """
+        for data in (b"s-1:", b"u-1:", b"s99999999999999999999:",
+                     b"u99999999999999999999:", b"ls-1:;"):
+            self.assertRaises(ValueError, bpickle.loads, data)
+            self.assertRaises(ValueError, bpickle._skip, data, 0)
+
+    def test_encoded_list(self):
+        """
+        An L{EncodedList} is serialized like a list of its items, which are
+        deserialized when accessed.
+        """
+        encoded = bpickle.EncodedList([bpickle.dumps(1), bpickle.dumps("a")])
+        self.assertEqual(bpickle.dumps([1, "a"]), bpickle.dumps(encoded))
+        self.assertEqual([1, "a"], encoded)
+        self.assertEqual("a", encoded[1])
+        self.assertEqual(2, len(encoded))
+
+    def test_dumps_chunks(self):
+        """
+        L{bpickle.dumps_chunks} generates chunks which joined together are
+        the same as L{bpickle.dumps}.
+        """
+        obj = {"b": [1, 2], "a": bpickle.EncodedList([bpickle.dumps(3)]),
+               "c": {"d": None}}
+        chunks = list(bpickle.dumps_chunks(obj))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(bpickle.dumps(obj), b"".join(chunks))
+        self.assertEqual({"a": [3], "b": [1, 2], "c": {"d": None}},
+                         bpickle.loads(b"".join(chunks)))
+
+    def test_dumps_chunks_list(self):
+        """
+        Lists holding other containers are serialized one item at a time.
+        """
+        obj = [{"a": 1}, [2, (3,)], b"foo", None]
+        chunks = list(bpickle.dumps_chunks(obj))
+        self.assertTrue(len(chunks) > 4)
+        self.assertEqual(bpickle.dumps(obj), b"".join(chunks))
+
+    def test_dumps_chunks_tuple(self):
+        """
+        Tuples holding other containers are serialized one item at a time.
+        """
+        obj = (["foo", {"a": 1}], {"b": (2,)})
+        chunks = list(bpickle.dumps_chunks(obj))
+        self.assertTrue(len(chunks) > 4)
+        self.assertEqual(bpickle.dumps(obj), b"".join(chunks))
+
+    def test_dumps_chunks_limit(self):
+        """
+        Containers holding at most C{limit} items, nested ones included, are
+        serialized in one go while larger ones are still serialized one item
+        at a time.
+        """
+        small = {"a": [1, 2], "b": (3,)}
+        obj = ([small] * 3, {"c": small})
+        chunks = list(bpickle.dumps_chunks(obj, limit=5))
+        self.assertEqual(bpickle.dumps(obj), b"".join(chunks))
+        data = bpickle.dumps(small)
+        self.assertEqual(
+            [b"t", b"l", data, data, data, b";", b"d", b"u1:c", data, b";",
+             b";"], chunks)
+        self.assertEqual([bpickle.dumps(obj)],
+                         list(bpickle.dumps_chunks(obj, limit=100)))
+
+    def test_dump(self):
+        """
+        L{bpickle.dump} writes the serialized object to a file, in chunks
+        of about the given size.
+        """
+        obj = {"items": [{"number": i} for i in range(100)]}
+        fileobj = io.BytesIO()
+        writes = []
+
+        def write(data):
+            writes.append(len(data))
+            return io.BytesIO.write(fileobj, data)
+        fileobj.write = write
+        bpickle.dump(obj, fileobj, buffer_size=100, limit=10)
+        self.assertEqual(bpickle.dumps(obj), fileobj.getvalue())
+        self.assertTrue(len(writes) > 5)
+        self.assertTrue(max(writes) < 200)
+
+    def test_dump_small_containers(self):
+        """
+        By default, L{bpickle.dump} serializes containers holding at most
+        1000 items in one go.
+        """
+        obj = {"items": [{"number": i} for i in range(100)]}
+        with mock.patch.object(bpickle, "dumps",
+                               wraps=bpickle.dumps) as dumps:
+            bpickle.dump(obj, io.BytesIO())
+        dumps.assert_called_once_with(obj)
+
+    def test_load(self):
+        """L{bpickle.load} loads an object from a file."""
+        fileobj = io.BytesIO()
+        bpickle.dump({"a": [b"b"]}, fileobj)
+        fileobj.seek(0)
+        self.assertEqual({"a": [b"b"]}, bpickle.load(fileobj))
+
+    def test_incremental_decoder(self):
+        """
+        L{bpickle.IncrementalDecoder} decodes the objects of a stream as
+        soon as the chunks completing them come in.
+        """
+        objects = [{"a": [1, 2.5]}, b"foo", None, [u"\xc0", (True,)]]
+        data = b"".join(bpickle.dumps(obj) for obj in objects)
+        decoder = bpickle.IncrementalDecoder()
+        decoded = []
+        for i in range(len(data)):
+            decoded.extend(decoder.decode(data[i:i + 1]))
+        decoded.extend(decoder.decode(b"", final=True))
+        self.assertEqual(objects, decoded)
+
+    def test_incremental_decoder_large_object(self):
+        """
+        A large object is decoded once it's complete, at the latest at the
+        end of the stream.
+        """
+        obj = {b"data": [b"x" * 100] * 100}
+        data = bpickle.dumps(obj)
+        decoder = bpickle.IncrementalDecoder(as_is=True)
+        decoded = []
+        for i in range(0, len(data), 10):
+            decoded.extend(decoder.decode(data[i:i + 10]))
+        decoded.extend(decoder.decode(b"", final=True))
+        self.assertEqual([obj], decoded)
+
+    def test_incremental_decoder_streams_containers(self):
+        """
+        The items of an incomplete container are decoded as they come in, so
+        the decoder only keeps the data of the item being received.
+        """
+        obj = ([{b"name": ("package%d" % i).encode("ascii"), b"id": i}
+                for i in range(1000)],
+               {b"key": b"x" * 5000})
+        data = bpickle.dumps(obj)
+        decoder = bpickle.IncrementalDecoder(as_is=True)
+        decoded = []
+        for i in range(0, len(data), 100):
+            decoded.extend(decoder.decode(data[i:i + 100]))
+            self.assertTrue(decoder._size < 5100)
+        decoded.extend(decoder.decode(b"", final=True))
+        self.assertEqual([obj], decoded)
+
+    def test_incremental_decoder_dict_keys(self):
+        """
+        The keys of dicts decoded item by item are reinterpreted as str,
+        unless C{as_is} is set.
+        """
+        data = bpickle.dumps({b"a": {b"b": 1}})
+        decoder = bpickle.IncrementalDecoder()
+        self.assertEqual([], decoder.decode(data[:6]))
+        self.assertEqual([{"a": {"b": 1}}], decoder.decode(data[6:]))
+        decoder = bpickle.IncrementalDecoder(as_is=True)
+        self.assertEqual([], decoder.decode(data[:6]))
+        self.assertEqual([{b"a": {b"b": 1}}], decoder.decode(data[6:]))
+
+    def test_incremental_decoder_truncated(self):
+        """
+        An error is raised if the stream ends in the middle of an object.
+        """
+        data = bpickle.dumps([1, b"foo"])
+        decoder = bpickle.IncrementalDecoder()
+        self.assertEqual([], decoder.decode(data[:-1]))
+        self.assertRaises(ValueError, decoder.decode, b"", final=True)
+        decoder = bpickle.IncrementalDecoder()
+        self.assertEqual([], decoder.decode(data[:-3]))
+        self.assertRaises(ValueError, decoder.decode, b"", final=True)
+
+    def test_loads_memoryview(self):
+        """A memoryview of serialized data can be loaded too."""
+        data = bpickle.dumps({"a": [b"foo", 1]})
+        self.assertEqual({"a": [b"foo", 1]},
+                         bpickle.loads(memoryview(data)[:len(data)]))
+
+    def test_loads_lazy(self):
+        """
+        L{bpickle.loads_lazy} loads dicts whose values are decoded only when
+        they're accessed.
+        """
+        obj = {"type": "foo", "data": [1, (2.5, None)], "bytes": b"bar"}
+        lazy = bpickle.loads_lazy(bpickle.dumps(obj))
+        self.assertIsInstance(lazy, bpickle.LazyDict)
+        self.assertEqual(3, len(lazy))
+        self.assertTrue("data" in lazy)
+        self.assertEqual(b"bar", lazy["bytes"])
+        self.assertEqual(obj, lazy)
+        self.assertEqual(obj, lazy.copy())
+
+    def test_loads_lazy_not_dict(self):
+        """Anything but a dict is loaded as usual."""
+        self.assertEqual([1, 2], bpickle.loads_lazy(bpickle.dumps([1, 2])))
+
+    def test_loads_lazy_as_is(self):
+        """
+        Like L{bpickle.loads}, L{bpickle.loads_lazy} can keep byte dict
+        keys, also in the nested dicts.
+        """
+        data = bpickle.dumps({b"a": {b"b": 1}})
+        self.assertEqual({b"a": {b"b": 1}},
+                         bpickle.loads_lazy(data, as_is=True))
+        self.assertEqual({"a": {"b": 1}}, bpickle.loads_lazy(data))
+
+    def test_loads_lazy_corrupted(self):
+        """
+        A truncated dict can't be loaded, while a value that can't be
+        decoded is only reported when it's accessed.
+        """
+        data = bpickle.dumps({"a": 1, "b": 2})
+        self.assertRaises(ValueError, bpickle.loads_lazy, data[:-3])
+        lazy = bpickle.loads_lazy(data.replace(b"i2;", b"ix;"))
+        self.assertEqual(1, lazy["a"])
+        self.assertRaises(ValueError, lambda: lazy["b"])
+
+    def test_dumps_lazy_dict(self):
+        """
+        A L{bpickle.LazyDict} is serialized like the dict it stands for,
+        also after it's been changed.
+        """
+        data = bpickle.dumps({"a": [1], "b": 2})
+        lazy = bpickle.loads_lazy(data, as_is=True)
+        lazy["b"]
+        self.assertEqual(data, bpickle.dumps(lazy))
+        lazy["a"].append(2)
+        lazy["c"] = 3
+        self.assertEqual(bpickle.dumps({"a": [1, 2], "b": 2, "c": 3}),
+                         bpickle.dumps(lazy))
+        self.assertEqual(bpickle.dumps({"a": [1], "b": 2}),
+                         bpickle.dumps(bpickle.loads_lazy(data)))
+
+
+class PurePythonBPickleTest(BPickleTest):
+    """The pure-Python codec passes the same tests as the default one."""
+
+    def setUp(self):
+        super(PurePythonBPickleTest, self).setUp()
+        dumps, loads, skip = bpickle.dumps, bpickle.loads, bpickle._skip
+        bpickle.dumps, bpickle.loads = bpickle.py_dumps, bpickle.py_loads
+        bpickle._skip = bpickle.py_skip
+
+        def restore():
+            bpickle.dumps, bpickle.loads, bpickle._skip = dumps, loads, skip
+        self.addCleanup(restore)
+
+
+@unittest.skipIf(bpickle._bpickle is None, "compiled codec not built")
+class CompiledBPickleFuzzTest(unittest.TestCase):
+    """
+    The compiled codec produces the very same results as the pure-Python
+    one, which is what's used when it isn't built.
+    """
+
+    def setUp(self):
+        super(CompiledBPickleFuzzTest, self).setUp()
+        self.random = random.Random(42)
+
+    def make_object(self, depth=0):
+        kinds = ["none", "bool", "int", "float", "bytes", "unicode"]
+        if depth < 4:
+            kinds += ["list", "tuple", "dict"]
+        kind = self.random.choice(kinds)
+        if kind == "none":
+            return None
+        if kind == "bool":
+            return self.random.random() < 0.5
+        if kind == "int":
+            return self.random.choice(
+                [0, -1, self.random.randint(-2 ** 70, 2 ** 70),
+                 self.random.randint(-1000, 1000)])
+        if kind == "float":
+            return self.random.choice(
+                [0.1, -0.0, 1e-300, 1e300, float("inf"), 0.00005,
+                 self.random.uniform(-1e6, 1e6)])
+        if kind == "bytes":
+            return bytes(bytearray(self.random.randint(0, 255)
+                                   for _ in range(self.random.randint(0, 8))))
+        if kind == "unicode":
+            return u"".join(self.random.choice(u"a;:\xc0\u3042\U0001f600")
+                            for _ in range(self.random.randint(0, 8)))
+        items = [self.make_object(depth + 1)
+                 for _ in range(self.random.randint(0, 5))]
+        if kind == "list":
+            return items
+        if kind == "tuple":
+            return tuple(items)
+        keys = [u"key%d" % i for i in range(len(items))]
+        if self.random.random() < 0.5:
+            keys = [key.encode("ascii") for key in keys]
+        return dict(zip(keys, items))
+
+    def load(self, loads, *args, **kwargs):
+        try:
+            return loads(*args, **kwargs)
+        except Exception as error:
+            return type(error)
+
+    def test_round_trip(self):
+        """
+        Random objects are serialized to the same bytes and loaded back to
+        the same objects, also when they're truncated.
+        """
+        for _ in range(500):
+            obj = self.make_object()
+            data = bpickle.dumps(obj)
+            self.assertEqual(bpickle.py_dumps(obj), data)
+            for as_is in (False, True):
+                self.assertEqual(bpickle.py_loads(data, as_is=as_is),
+                                 bpickle.loads(data, as_is=as_is))
+            self.assertEqual(bpickle.loads(data), bpickle.loads_lazy(data))
+            for end in range(len(data)):
+                self.assertEqual(self.load(bpickle.py_loads, data[:end]),
+                                 self.load(bpickle.loads, data[:end]))
+                self.assertEqual(self.load(bpickle.py_skip, data[:end], 0),
+                                 self.load(bpickle._skip, data[:end], 0))
+
+    def test_corrupted_string_length(self):
+        """
+        Both codecs fail in the same way on string lengths which can't be
+        right.
+        """
+        for length in (b"-1", b"-0", b"x", b"", b"9223372036854775807",
+                       b"99999999999999999999"):
+            data = b"s" + length + b":abc"
+            self.assertEqual(self.load(bpickle.py_loads, data),
+                             self.load(bpickle.loads, data))
+            self.assertEqual(self.load(bpickle.py_skip, data, 0),
+                             self.load(bpickle._skip, data, 0))
+
+    def test_unsupported_type(self):
+        """Subclasses of the supported types aren't supported either."""
+
+        class Integer(int):
+            pass
+
+        self.assertRaises(ValueError, bpickle.dumps, [Integer(1)])
+        self.assertRaises(ValueError, bpickle.dumps, {"a": object()})
+
+    def test_encoded_list(self):
+        """
+        The types which aren't built in, like L{bpickle.EncodedList}, are
+        serialized by the functions in the dumps table.
+        """
+        encoded = bpickle.EncodedList([bpickle.dumps(u"a")])
+        self.assertEqual(bpickle.py_dumps({"a": encoded}),
+                         bpickle.dumps({"a": encoded}))
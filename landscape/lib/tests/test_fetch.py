@@ -148,6 +148,27 @@ class FetchTest(testing.FSTestCase, testing.TwistedTestCase,
                           pycurl.DNS_CACHE_TIMEOUT: 0,
                           pycurl.ENCODING: b"gzip,deflate"})
 
+    def test_post_data_chunks(self):
+        """
+        If the data is a C{list} of byte strings, they're read one after the
+        other without being joined first.
+        """
+        curl = CurlStub(b"result")
+        result = fetch("http://example.com", post=True,
+                       data=[b"da", b"", b"ta"], curl=curl)
+        self.assertEqual(result, b"result")
+        self.assertEqual(curl.options[pycurl.POSTFIELDSIZE], 4)
+        read = curl.options[pycurl.READFUNCTION]
+        self.assertEqual(read(3), b"dat")
+        self.assertEqual(read(3), b"a")
+        self.assertEqual(read(3), b"")
+
+    def test_dns_cache_timeout(self):
+        curl = CurlStub(b"result")
+        result = fetch("http://example.com", curl=curl, dns_cache_timeout=60)
+        self.assertEqual(result, b"result")
+        self.assertEqual(curl.options[pycurl.DNS_CACHE_TIMEOUT], 60)
+
     def test_cainfo(self):
         curl = CurlStub(b"result")
         result = fetch("https://example.com", cainfo="cainfo", curl=curl)
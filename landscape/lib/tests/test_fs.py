@@ -10,6 +10,7 @@ from twisted.python.compat import long
 from landscape.lib import testing
 from landscape.lib.fs import append_text_file, append_binary_file, touch_file
 from landscape.lib.fs import read_text_file, read_binary_file
+from landscape.lib.fs import create_binary_file, sync_path
 
 
 class BaseTestCase(testing.FSTestCase, unittest.TestCase):
@@ -145,6 +146,33 @@ class TouchFileTest(BaseTestCase):
         self.assertFileContent(path, b"")
 
 
+class CreateFileTest(BaseTestCase):
+
+    def test_create_binary_file(self):
+        """L{create_binary_file} writes the given content to a new file."""
+        path = self.makeFile()
+        create_binary_file(path, b"foo")
+        self.assertEqual(b"foo", read_binary_file(path))
+
+    @patch("os.fsync")
+    def test_create_binary_file_with_sync(self, fsync_mock):
+        """
+        If the C{sync} parameter is C{True}, L{create_binary_file} flushes
+        the file content to disk.
+        """
+        path = self.makeFile()
+        create_binary_file(path, b"foo", sync=True)
+        self.assertEqual(1, fsync_mock.call_count)
+        self.assertEqual(b"foo", read_binary_file(path))
+
+    @patch("os.fsync")
+    def test_sync_path(self, fsync_mock):
+        """L{sync_path} flushes both files and directories to disk."""
+        sync_path(self.makeFile("foo"))
+        sync_path(self.makeDir())
+        self.assertEqual(2, fsync_mock.call_count)
+
+
 class AppendFileTest(BaseTestCase):
 
     def test_append_existing_text_file(self):
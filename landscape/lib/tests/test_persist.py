@@ -2,10 +2,13 @@ import os
 import pprint
 import unittest
 
+import mock
+
 from landscape.lib import testing
 from landscape.lib.persist import (
     path_string_to_tuple, path_tuple_to_string, Persist, RootedPersist,
-    PickleBackend, PersistError, PersistReadOnlyError)
+    JournaledPersist, ShardedPersist, PickleBackend, PersistError,
+    PersistReadOnlyError, DictView, ListView, MAX_MODIFIED_PATHS)
 
 
 class PersistHelpersTest(unittest.TestCase):
@@ -270,11 +273,91 @@ class GeneralPersistTest(BasePersistTest):
         d["c"] = 2
         self.assertEqual(self.persist.get("a"), d_orig)
 
+    def test_view(self):
+        """
+        Views of persisted values are equal to them, and give views of the
+        dicts and lists they contain.
+        """
+        for path in self.set_result:
+            self.persist.set(path, self.set_result[path])
+        for path, value in self.get_items:
+            result = self.persist.view(path)
+            self.assertEqual(result, value)
+            self.assertEqual(value, result)
+        view = self.persist.view("cd")
+        self.assertIsInstance(view, DictView)
+        self.assertIsInstance(view["ij"], DictView)
+        self.assertIsInstance(view["ij"]["mn"], ListView)
+        self.assertIsInstance(view["ij"]["mn"][3], ListView)
+        self.assertEqual((6,), view["ij"]["mn"][4])
+        self.assertEqual([[5], (6,)], view["ij"]["mn"][-2:])
+        self.assertEqual(sorted(["ef", "gh", "ij"]), sorted(view))
+        self.assertIn([5], view["ij"]["mn"])
+        self.assertEqual(3, len(view))
+
+    def test_view_default(self):
+        self.assertIs(None, self.persist.view("a"))
+        self.assertEqual(1, self.persist.view("a", 1))
+
+    def test_views_are_read_only(self):
+        self.persist.set("a", {"b": [1]})
+        view = self.persist.view("a")
+
+        def set_item(obj, key, value):
+            obj[key] = value
+
+        self.assertRaises(TypeError, set_item, view, "c", 2)
+        self.assertRaises(TypeError, set_item, view["b"], 0, 2)
+        self.assertRaises(AttributeError, getattr, view["b"], "append")
+        self.assertEqual({"b": [1]}, self.persist.get("a"))
+
+    def test_view_copy(self):
+        """Copies of views are independent of the persist."""
+        self.persist.set("a", {"b": [1]})
+        value = self.persist.view("a").copy()
+        self.assertEqual({"b": [1]}, value)
+        value["b"].append(2)
+        self.assertEqual({"b": [1]}, self.persist.get("a"))
+
+    def test_set_view(self):
+        """Views are set as copies of what they're a view of."""
+        self.persist.set("a", {"b": [1]})
+        self.persist.set("c", self.persist.view("a"))
+        self.persist.add("c.b", 2)
+        self.assertEqual(dict, type(self.persist.get("c")))
+        self.assertEqual({"b": [1, 2]}, self.persist.get("c"))
+        self.assertEqual({"b": [1]}, self.persist.get("a"))
+
     def test_root_at(self):
         rooted = self.persist.root_at("my-module")
         rooted.set("option", 1)
         self.assertEqual(self.persist.get("my-module.option"), 1)
 
+    def test_is_modified(self):
+        """
+        Paths are modified if they, their parents or their children changed.
+        """
+        self.persist.set("a.b.c", 1)
+        self.persist.add("d.e", 1)
+        self.persist.remove("f")
+        for path in ["a", "a.b", "a.b.c", "a.b.c.g", "d", "d.e", "f.g"]:
+            self.assertTrue(self.persist.is_modified(path), path)
+        for path in ["a.c", "d.f", "g"]:
+            self.assertFalse(self.persist.is_modified(path), path)
+        self.persist.set("x", 1, soft=True)
+        self.assertFalse(self.persist.is_modified("x"))
+
+    def test_modified_paths_are_bounded(self):
+        """
+        Past L{MAX_MODIFIED_PATHS} changed paths, everything is considered
+        changed, rather than tracking more paths.
+        """
+        for i in range(MAX_MODIFIED_PATHS):
+            self.persist.set(("a", str(i)), i)
+        self.assertFalse(self.persist.is_modified("b"))
+        self.persist.set("a.last", 1)
+        self.assertTrue(self.persist.is_modified("b"))
+
 
 class SaveLoadPersistTest(testing.FSTestCase, BasePersistTest):
 
@@ -346,6 +429,78 @@ class SaveLoadPersistTest(testing.FSTestCase, BasePersistTest):
         self.persist.save(filename)
         self.assertTrue(os.path.isfile(filename))
 
+    def test_save_without_changes(self):
+        """
+        Nothing is written if nothing changed since the last save to the
+        same file.
+        """
+        filename = self.makePersistFile()
+        self.persist.set("a", 1)
+        size = self.persist.save(filename)
+        self.assertEqual(os.path.getsize(filename), size)
+        self.assertEqual(0, self.persist.save(filename))
+        self.assertFalse(os.path.exists(filename + ".old"))
+        self.assertEqual({"saves": 1, "skipped-saves": 1,
+                          "bytes-written": os.path.getsize(filename),
+                          "last-bytes-written": os.path.getsize(filename)},
+                         self.persist.get_save_stats())
+
+    def test_save_after_load_without_changes(self):
+        """
+        Nothing is written if nothing changed since the persist was loaded
+        from the file.
+        """
+        filename = self.makePersistFile()
+        self.persist.set("a", 1)
+        self.persist.save(filename)
+        persist = self.build_persist(filename=filename)
+        persist.save(filename)
+        self.assertEqual(0, persist.get_save_stats()["saves"])
+
+    def test_save_with_changes(self):
+        filename = self.makePersistFile()
+        self.persist.save(filename)
+        self.persist.set("a", 1)
+        self.persist.save(filename)
+        self.assertEqual(2, self.persist.get_save_stats()["saves"])
+        self.assertEqual(1, self.build_persist(filename=filename).get("a"))
+
+    def test_save_to_another_file(self):
+        filename = self.makePersistFile()
+        self.persist.save(filename)
+        other_filename = self.makePersistFile()
+        self.persist.save(other_filename)
+        self.assertTrue(os.path.isfile(other_filename))
+
+    def test_save_removed_file(self):
+        """The file is written again if it's been removed meanwhile."""
+        filename = self.makePersistFile()
+        self.persist.set("a", 1)
+        self.persist.save(filename)
+        os.unlink(filename)
+        self.persist.save(filename)
+        self.assertEqual(1, self.build_persist(filename=filename).get("a"))
+
+    def test_save_is_atomic(self):
+        """
+        The persist is written to a temporary file first, so a failure while
+        writing it leaves the previous file alone.
+        """
+        filename = self.makePersistFile()
+        self.persist.set("a", 1)
+        self.persist.save(filename)
+
+        def save(filepath, map):
+            with open(filepath, "wb") as fd:
+                fd.write(b"garbage")
+            raise IOError("No space left on device")
+
+        persist = self.build_persist()
+        persist._backend.save = save
+        persist.set("a", 2)
+        self.assertRaises(IOError, persist.save, filename)
+        self.assertEqual(1, self.build_persist(filename=filename).get("a"))
+
     def test_save_creates_backup(self):
         filename = self.makePersistFile("foobar")
         filename_old = filename + ".old"
@@ -441,6 +596,49 @@ class SaveLoadPersistTest(testing.FSTestCase, BasePersistTest):
 
         self.assertEqual(persist.get("a"), 1)
 
+    def test_constructor_restores_backup(self):
+        """
+        If the file doesn't exist but its backup does, as after a crash in
+        the middle of a save, the backup is loaded when the persist is
+        constructed.
+        """
+        filename = self.makePersistFile("")
+        os.unlink(filename)
+        self.persist.set("a", 1)
+        self.persist.save(filename + ".old")
+
+        persist = self.build_persist(filename=filename)
+
+        self.assertEqual(1, persist.get("a"))
+
+    def test_save_keeps_previous_file_in_place(self):
+        """
+        The previous version of the file is kept as a backup without being
+        moved away, so the file exists at any point of the save.
+        """
+        filename = self.makePersistFile()
+        persist = self.build_persist()
+        persist.set("a", 1)
+        persist.save(filename)
+        renames = []
+        original_rename = os.rename
+
+        def rename(source, destination):
+            renames.append((source, destination))
+            self.assertTrue(os.path.isfile(filename))
+            original_rename(source, destination)
+
+        self.persist.set("a", 2)
+        with mock.patch("os.rename", side_effect=rename):
+            self.persist.save(filename)
+
+        self.assertIn((filename + ".new", filename), renames)
+        self.assertNotIn(filename, [source for source, _ in renames])
+        self.assertEqual(2, self.build_persist(filename=filename).get("a"))
+        persist = self.build_persist()
+        persist.load(filename + ".old")
+        self.assertEqual(1, persist.get("a"))
+
 
 class PicklePersistTest(GeneralPersistTest, SaveLoadPersistTest):
 
@@ -448,6 +646,440 @@ class PicklePersistTest(GeneralPersistTest, SaveLoadPersistTest):
         return Persist(PickleBackend(), *args, **kwargs)
 
 
+class JournaledPersistTest(GeneralPersistTest, SaveLoadPersistTest):
+
+    def build_persist(self, *args, **kwargs):
+        return JournaledPersist(*args, **kwargs)
+
+    def makePersistFile(self, *args, **kwargs):
+        # Keep the journals in a directory which gets removed.
+        return super(JournaledPersistTest, self).makePersistFile(
+            *args, dirname=self.makeDir(), **kwargs)
+
+
+class JournalTest(testing.FSTestCase, unittest.TestCase):
+
+    def build_persist(self, *args, **kwargs):
+        persist = JournaledPersist(*args, **kwargs)
+        # Journal the changes, however small the database is.
+        persist.journal_threshold = 0
+        return persist
+
+    def setUp(self):
+        super(JournalTest, self).setUp()
+        self.filename = os.path.join(self.makeDir(), "persist.bpickle")
+        self.journal = self.filename + ".journal"
+        self.persist = self.build_persist(filename=self.filename)
+        self.persist.set("a", 1)
+        self.persist.save()
+
+    def read(self, filename):
+        with open(filename, "rb") as fd:
+            return fd.read()
+
+    def reload(self):
+        return self.build_persist(filename=self.filename).get((), hard=True)
+
+    def test_first_save_writes_everything(self):
+        """
+        The first save writes the whole database, and starts a journal.
+        """
+        self.assertEqual({"a": 1},
+                         Persist(filename=self.filename).get((), hard=True))
+        self.assertTrue(os.path.isfile(self.journal))
+
+    def test_save_appends_changes_to_journal(self):
+        """
+        Later saves only append the changes to the journal, which is replayed
+        when loading.
+        """
+        database = self.read(self.filename)
+        journal = self.read(self.journal)
+        self.persist.set("b.c", [1, 2])
+        self.persist.add("b.c", (3,))
+        self.persist.root_at("d").set("e", "f")
+        self.persist.remove("a")
+        self.persist.move("d", "g")
+        self.persist.save()
+        self.assertEqual(database, self.read(self.filename))
+        self.assertTrue(self.read(self.journal).startswith(journal))
+        self.assertEqual({"b": {"c": [1, 2, (3,)]}, "g": {"e": "f"}},
+                         self.reload())
+
+    def test_save_without_changes(self):
+        """Nothing is written if nothing changed since the last save."""
+        journal = self.read(self.journal)
+        self.persist.set("b", 1, soft=True)
+        self.persist.remove("missing")
+        self.persist.save()
+        self.assertEqual(journal, self.read(self.journal))
+
+    def test_values_are_journaled_as_they_were_set(self):
+        """
+        Changing a value after setting it doesn't affect what was
+        journaled.
+        """
+        value = [1]
+        self.persist.set("b", value)
+        value.append(2)
+        self.persist.save()
+        self.assertEqual({"a": 1, "b": [1]}, self.reload())
+
+    def test_unserializable_values(self):
+        """
+        Values that can't be serialized are rejected before changing
+        anything.
+        """
+        self.assertRaises(ValueError, self.persist.set, "b", object())
+        self.assertIs(None, self.persist.get("b"))
+
+    def test_compaction(self):
+        """
+        The whole database is written again, and the journal restarted, once
+        it grows bigger than C{compact_size} and than the database.
+        """
+        self.persist.compact_size = 0
+        self.persist.set("b", "x" * 100)
+        self.persist.save()
+        self.persist.set("c", "y" * 200)
+        self.persist.save()
+        journal = self.read(self.journal)
+        self.persist.save()
+        result = {"a": 1, "b": "x" * 100, "c": "y" * 200}
+        self.assertEqual(result,
+                         Persist(filename=self.filename).get((), hard=True))
+        self.assertTrue(len(self.read(self.journal)) < len(journal))
+        self.assertEqual(result, self.reload())
+
+    def test_small_database_is_written_whole(self):
+        """
+        Every save writes the whole database while it isn't bigger than
+        C{journal_threshold}, so a plain L{Persist} loads all the changes even
+        if the process crashes before compacting.
+        """
+        persist = JournaledPersist(filename=self.filename)
+        persist.set("b", 2)
+        persist.save()
+        journal = self.read(self.journal)
+        persist.set("c", 3)
+        persist.save()
+        del persist
+        self.assertEqual({"a": 1, "b": 2, "c": 3},
+                         Persist(filename=self.filename).get((), hard=True))
+        self.assertEqual(len(journal), len(self.read(self.journal)))
+
+    def test_big_database_is_journaled(self):
+        """
+        Once the database file is bigger than C{journal_threshold}, saves
+        append to the journal instead.
+        """
+        persist = JournaledPersist(filename=self.filename)
+        persist.journal_threshold = 10
+        persist.set("b", "x" * 20)
+        persist.save()
+        database = self.read(self.filename)
+        persist.set("c", 3)
+        persist.save()
+        self.assertEqual(database, self.read(self.filename))
+        self.assertEqual({"a": 1, "b": "x" * 20, "c": 3}, self.reload())
+
+    def test_compact(self):
+        """
+        After L{JournaledPersist.compact}, a plain L{Persist} loads all the
+        changes which were journaled.
+        """
+        self.persist.set("b", 2)
+        self.persist.save()
+        self.persist.remove("a")
+        self.persist.save()
+        self.persist.compact()
+        self.assertEqual({"b": 2},
+                         Persist(filename=self.filename).get((), hard=True))
+        self.assertEqual({"b": 2}, self.reload())
+
+    def test_torn_record_is_ignored(self):
+        """
+        An incomplete record, as left by a crash while saving, is ignored and
+        the next save writes the whole database again.
+        """
+        self.persist.set("b", 2)
+        self.persist.save()
+        self.persist.set("c", 3)
+        self.persist.save()
+        data = self.read(self.journal)
+        with open(self.journal, "wb") as fd:
+            fd.write(data[:-1])
+        persist = self.build_persist(filename=self.filename)
+        self.assertEqual({"a": 1, "b": 2}, persist.get((), hard=True))
+        persist.set("d", 4)
+        persist.save()
+        self.assertEqual({"a": 1, "b": 2, "d": 4},
+                         Persist(filename=self.filename).get((), hard=True))
+        self.assertEqual({"a": 1, "b": 2, "d": 4}, self.reload())
+
+    def test_journal_of_another_database_is_ignored(self):
+        """
+        A journal is ignored if it doesn't start with the checksum of the
+        database file, like when a crash happens after writing the database
+        but before starting the new journal.
+        """
+        self.persist.set("b", 2)
+        self.persist.save()
+        persist = Persist(filename=self.filename)
+        persist.set("c", 3)
+        persist.save()
+        self.assertEqual({"a": 1, "c": 3}, self.reload())
+
+    def test_journal_replayed_on_backup(self):
+        """
+        If a crash happens while writing the database, the backup is loaded
+        with the journal which still belongs to it.
+        """
+        self.persist.set("b", 2)
+        self.persist.save()
+        os.rename(self.filename, self.filename + ".old")
+        with open(self.filename, "wb") as fd:
+            fd.write(b"d1:")
+        persist = self.build_persist(filename=self.filename)
+        self.assertEqual({"a": 1, "b": 2}, persist.get((), hard=True))
+        persist.save()
+        self.assertEqual({"a": 1, "b": 2},
+                         Persist(filename=self.filename).get((), hard=True))
+
+    def test_replay_keeps_flags(self):
+        """Replaying the journal doesn't mark the database as modified."""
+        self.persist.set("b", 2)
+        self.persist.save()
+        persist = self.build_persist()
+        persist.readonly = True
+        persist.load(self.filename)
+        self.assertEqual(2, persist.get("b"))
+        self.assertFalse(persist.modified)
+        self.assertTrue(persist.readonly)
+
+
+class ShardedPersistTest(GeneralPersistTest):
+
+    def build_persist(self, *args, **kwargs):
+        return ShardedPersist(*args, **kwargs)
+
+
+class ShardTest(testing.FSTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        self.dirname = self.makeDir()
+        self.filename = os.path.join(self.dirname, "monitor.bpickle")
+        self.persist = ShardedPersist(filename=self.filename)
+        self.persist.set("cpu-usage.points", [1, 2])
+        self.persist.set("users.snapshot", {"root": 0})
+        self.persist.save()
+
+    def shard(self, key):
+        return os.path.join(self.filename + ".shards", key + ".bpickle")
+
+    def test_save(self):
+        """
+        Each top-level key is saved to its own file, in a directory, and the
+        first save writes the whole database to the single file as well.
+        """
+        self.assertEqual(["checksum", "cpu-usage.bpickle", "users.bpickle"],
+                         sorted(os.listdir(self.filename + ".shards")))
+        persist = Persist(filename=self.shard("users"))
+        self.assertEqual({"users": {"snapshot": {"root": 0}}},
+                         persist.get((), hard=True))
+        self.assertEqual({"cpu-usage": {"points": [1, 2]},
+                          "users": {"snapshot": {"root": 0}}},
+                         Persist(filename=self.filename).get((), hard=True))
+
+    def test_save_changed_keys(self):
+        """Only the files of the keys which changed are written."""
+        self.persist.set("users.snapshot.bin", 1)
+        self.persist.save()
+        self.assertTrue(os.path.isfile(self.shard("users") + ".old"))
+        self.assertFalse(os.path.isfile(self.shard("cpu-usage") + ".old"))
+        stats = self.persist.get_save_stats()
+        self.assertEqual(os.path.getsize(self.shard("users")),
+                         stats["last-bytes-written"])
+
+    def test_save_without_changes(self):
+        self.persist.save()
+        self.assertEqual(1, self.persist.get_save_stats()["skipped-saves"])
+
+    def test_save_removed_key(self):
+        """The file of a removed key is removed."""
+        self.persist.remove("users")
+        self.persist.save()
+        self.assertEqual(["checksum", "cpu-usage.bpickle"],
+                         sorted(os.listdir(self.filename + ".shards")))
+        persist = ShardedPersist(filename=self.filename)
+        self.assertEqual({"cpu-usage": {"points": [1, 2]}},
+                         persist.get((), hard=True))
+
+    def test_save_escapes_keys(self):
+        self.persist.set("a/b", 1)
+        self.persist.save()
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.filename + ".shards", "a%2Fb.bpickle")))
+        self.assertEqual(1, ShardedPersist(filename=self.filename).get("a/b"))
+
+    def test_lazy_load(self):
+        """Files are only loaded once their key is accessed."""
+        with open(self.shard("users"), "wb") as fd:
+            fd.write(b"garbage")
+        persist = ShardedPersist(filename=self.filename)
+        self.assertEqual([1, 2], persist.get("cpu-usage.points"))
+        self.assertRaises(PersistError, persist.get, "users")
+        self.assertIs(None, persist.get("users"))
+
+    def test_lazy_load_backup(self):
+        """
+        The backup of a file is loaded if the file itself is missing, like
+        after a crash while writing it.
+        """
+        self.persist.set("users.snapshot.bin", 1)
+        self.persist.save()
+        os.unlink(self.shard("users"))
+        persist = ShardedPersist(filename=self.filename)
+        self.assertEqual({"root": 0}, persist.get("users.snapshot"))
+
+    def test_load_all(self):
+        """Accessing the whole persist loads all the files."""
+        persist = ShardedPersist(filename=self.filename)
+        self.assertEqual(["cpu-usage", "users"],
+                         sorted(persist.keys((), hard=True)))
+
+    def test_save_to_another_directory(self):
+        """All the keys are written when saving to another directory."""
+        persist = ShardedPersist(filename=self.filename)
+        persist.set("users.snapshot.bin", 1)
+        filename = os.path.join(self.dirname, "other")
+        persist.save(filename)
+        self.assertEqual(
+            {"cpu-usage": {"points": [1, 2]},
+             "users": {"snapshot": {"root": 0, "bin": 1}}},
+            ShardedPersist(filename=filename).get((), hard=True))
+
+    def test_migration(self):
+        """
+        A persist saved to a single file, and its journal, get a directory
+        the next time they're saved.
+        """
+        filename = os.path.join(self.dirname, "legacy.bpickle")
+        persist = JournaledPersist(filename=filename)
+        persist.compact_size = persist.journal_threshold = 0
+        persist.set("cpu-usage.points", [1, 2])
+        persist.save()
+        persist.set("users.snapshot", {"root": 0})
+        persist.save()
+
+        persist = ShardedPersist(filename=filename)
+        self.assertEqual({"root": 0}, persist.get("users.snapshot"))
+        persist.save()
+        self.assertEqual(["checksum", "cpu-usage.bpickle", "users.bpickle"],
+                         sorted(os.listdir(filename + ".shards")))
+        self.assertFalse(os.path.exists(filename + ".journal"))
+        result = {"cpu-usage": {"points": [1, 2]},
+                  "users": {"snapshot": {"root": 0}}}
+        self.assertEqual(result,
+                         ShardedPersist(filename=filename).get((), hard=True))
+        self.assertEqual(result, Persist(filename=filename).get((), hard=True))
+
+    def test_interrupted_migration(self):
+        """
+        If the migration is interrupted while writing the single file, it's
+        loaded from its backup, with its journal.
+        """
+        filename = os.path.join(self.dirname, "legacy.bpickle")
+        persist = JournaledPersist(filename=filename)
+        persist.compact_size = persist.journal_threshold = 0
+        persist.set("a", 1)
+        persist.save()
+        persist.set("b", 2)
+        persist.save()
+        os.rename(filename, filename + ".old")
+        persist = ShardedPersist()
+        persist.load(filename)
+        self.assertEqual({"a": 1, "b": 2}, persist.get((), hard=True))
+
+    def test_compact(self):
+        """
+        L{ShardedPersist.compact} saves the keys changed since the last save
+        to the directory, and writes the whole database to the single file,
+        which a plain L{Persist}, like the one of an older client, loads.
+        """
+        persist = ShardedPersist(filename=self.filename)
+        persist.set("users.snapshot.bin", 1)
+        persist.compact()
+        self.assertTrue(os.path.isfile(self.shard("users") + ".old"))
+        self.assertFalse(os.path.isfile(self.shard("cpu-usage") + ".old"))
+        self.assertEqual({"cpu-usage": {"points": [1, 2]},
+                          "users": {"snapshot": {"root": 0, "bin": 1}}},
+                         Persist(filename=self.filename).get((), hard=True))
+
+    def test_compact_without_changes(self):
+        """
+        Nothing is written by L{ShardedPersist.compact} if the single file
+        is up to date.
+        """
+        self.persist.set("users.snapshot.bin", 1)
+        self.persist.compact()
+        self.assertEqual(0, self.persist.compact())
+
+    def test_load_after_compact(self):
+        """
+        After L{ShardedPersist.compact}, the next load uses the directory,
+        and the next save only writes the keys which changed.
+        """
+        self.persist.set("users.snapshot.bin", 1)
+        self.persist.compact()
+        persist = ShardedPersist(filename=self.filename)
+        persist.set("users.snapshot.bin", 2)
+        persist.save()
+        self.assertFalse(os.path.isfile(self.shard("cpu-usage") + ".old"))
+        self.assertEqual(os.path.getsize(self.shard("users")),
+                         persist.get_save_stats()["last-bytes-written"])
+        self.assertEqual({"root": 0, "bin": 2},
+                         ShardedPersist(filename=self.filename).get(
+                             "users.snapshot"))
+
+    def test_load_without_compact(self):
+        """
+        If the process stops without compacting, like after a crash, the
+        directory is loaded with the changes saved since the last
+        compaction, which a plain L{Persist} doesn't see.
+        """
+        self.persist.set("users.snapshot.bin", 1)
+        self.persist.save()
+        persist = ShardedPersist(filename=self.filename)
+        self.assertEqual(1, persist.get("users.snapshot.bin"))
+        self.assertIs(None, Persist(filename=self.filename).get(
+            "users.snapshot.bin"))
+
+    def test_downgrade(self):
+        """
+        Once compacted, the persist can be loaded and saved by a plain
+        L{Persist}, like the one of an older client after a downgrade. The
+        single file is then loaded when upgrading again, instead of the
+        directory which is now out of date.
+        """
+        self.persist.set("users.snapshot.bin", 1)
+        self.persist.compact()
+        persist = Persist(filename=self.filename)
+        self.assertEqual(1, persist.get("users.snapshot.bin"))
+        persist.set("users.snapshot.bin", 2)
+        persist.remove("cpu-usage")
+        persist.save()
+        persist = ShardedPersist(filename=self.filename)
+        self.assertEqual({"users": {"snapshot": {"root": 0, "bin": 2}}},
+                         persist.get((), hard=True))
+        persist.save()
+        self.assertFalse(os.path.exists(self.shard("cpu-usage")))
+        self.assertEqual({"root": 0, "bin": 2},
+                         ShardedPersist(filename=self.filename).get(
+                             "users.snapshot"))
+
+
 class RootedPersistTest(GeneralPersistTest):
 
     def build_persist(self, *args, **kwargs):
@@ -466,6 +1098,19 @@ class RootedPersistTest(GeneralPersistTest):
         self.persist.parent.readonly = True
         self.assertRaises(PersistReadOnlyError, self.persist.assert_writable)
 
+    def test_modified_branch(self):
+        """
+        Rooted persists are only modified by changes to their branch.
+        """
+        other = self.persist.parent.root_at("root.other")
+        self.persist.parent.set("elsewhere", 1)
+        other.set("ab", 1)
+        self.assertFalse(self.persist.modified)
+        self.assertTrue(other.modified)
+        self.persist.parent.set("root", {})
+        self.assertTrue(self.persist.modified)
+        self.assertTrue(self.persist.root_at("ab").is_modified("cd"))
+
     def test_modified(self):
         self.assertFalse(self.persist.modified)
         self.persist.set("ab", 1)
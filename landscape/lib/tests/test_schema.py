@@ -2,7 +2,10 @@ import unittest
 
 from landscape.lib.schema import (
     InvalidError, Constant, Bool, Int, Float, Bytes, Unicode, List, KeyDict,
-    Dict, Tuple, Any)
+    Dict, Tuple, Any, Series, compile_schema)
+from landscape.lib.series import decode_series
+
+from collections import namedtuple
 
 from twisted.python.compat import long
 
@@ -201,3 +204,97 @@ class BasicTypesTest(unittest.TestCase):
 
     def test_dict_wrong_type(self):
         self.assertRaises(InvalidError, Dict(Int(), Int()).coerce, 32)
+
+    def test_series(self):
+        """
+        L{Series} coerces a list of points to their compact columnar form.
+        """
+        points = [(60, 1.5, 3), (120, 2.5, 4)]
+        series = Series("fi").coerce(points)
+        self.assertEqual(60, series["start"])
+        self.assertEqual(points, decode_series(series, "fi"))
+
+    def test_series_bad_point(self):
+        """L{Series} requires the values of the points to match the columns.
+        """
+        self.assertRaises(InvalidError, Series("i").coerce, [(60, 1.5)])
+        self.assertRaises(InvalidError, Series("f").coerce, [(60, 1.5, 2.0)])
+
+
+class CompiledSchemaTest(unittest.TestCase):
+    """
+    Compiled schemas coerce values the same way as the schemas themselves.
+    """
+
+    def assertCoercesLikeSchema(self, schema, value):
+        compiled = compile_schema(schema)
+        try:
+            expected = schema.coerce(value)
+        except InvalidError as error:
+            with self.assertRaises(InvalidError) as context:
+                compiled(value)
+            self.assertEqual(str(error), str(context.exception))
+        else:
+            self.assertEqual(expected, compiled(value))
+            self.assertEqual(type(expected), type(compiled(value)))
+
+    def test_cached(self):
+        """Schemas are compiled only once."""
+        schema = List(Int())
+        self.assertIs(compile_schema(schema), compile_schema(schema))
+
+    def test_not_compilable(self):
+        """Schemas which can't be compiled are just applied."""
+        self.assertEqual("hello!", compile_schema(DummySchema())(1))
+
+    def test_placeholder(self):
+        """
+        Placeholders which aren't schemas, like the one in C{List(None)}, are
+        only an error if there is a value to apply them to.
+        """
+        compiled = compile_schema(List(None))
+        self.assertEqual([], compiled([]))
+        self.assertRaises(AttributeError, compiled, [1])
+
+    def test_list(self):
+        for value in [[], [1, 2], [1, "2"], (1,), [(1, 2)], "foo"]:
+            self.assertCoercesLikeSchema(List(Int()), value)
+        for value in [[b"foo", u"bar"], [b"\xff"], [1]]:
+            self.assertCoercesLikeSchema(List(Unicode()), value)
+
+    def test_tuple(self):
+        Point = namedtuple("Point", ["x", "y"])
+        for value in [(1, 2.5), (1,), (1, 2, 3), (1, "2"), [1, 2],
+                      Point(1, 2)]:
+            self.assertCoercesLikeSchema(Tuple(Int(), Float()), value)
+        for value in [(1, b"foo"), (1, 2)]:
+            self.assertCoercesLikeSchema(Tuple(Int(), Unicode()), value)
+
+    def test_key_dict(self):
+        schema = KeyDict({"a": Int(), "b": Unicode()}, optional=["b"])
+        for value in [{"a": 1}, {"a": 1, "b": b"x"}, {"b": u"x"},
+                      {"a": 1, "c": 2}, {"a": "1"}, [("a", 1)]]:
+            self.assertCoercesLikeSchema(schema, value)
+
+    def test_dict(self):
+        schema = Dict(Bytes(), List(Int()))
+        for value in [{}, {b"a": [1]}, {"a": [1]}, {b"a": [1.5]}, []]:
+            self.assertCoercesLikeSchema(schema, value)
+
+    def test_any(self):
+        schema = Any(Tuple(Int(), Int()), Int(), Constant(None))
+        for value in [1, (1, 2), None, (1, "2"), "1", 1.5]:
+            self.assertCoercesLikeSchema(schema, value)
+
+    def test_nested(self):
+        schema = List(KeyDict({"name": Unicode(),
+                               "relations": List(Tuple(Int(), Unicode())),
+                               "size": Any(Int(), Constant(None))}))
+        for value in [[{"name": b"foo", "relations": [(1, b"bar")],
+                        "size": None}],
+                      [{"name": u"foo", "relations": [(1, 2)], "size": 1}]]:
+            self.assertCoercesLikeSchema(schema, value)
+
+    def test_series(self):
+        for value in [[(60, 1.5), (120, 2.5)], [(60, "1")]]:
+            self.assertCoercesLikeSchema(Series("f"), value)
@@ -0,0 +1,67 @@
+import unittest
+
+from landscape.lib import bpickle
+from landscape.lib.series import INT, FLOAT, encode_series, decode_series
+
+
+class SeriesTest(unittest.TestCase):
+
+    def test_encode(self):
+        """
+        The timestamps of evenly spaced points are described by the first
+        one and the step between them.
+        """
+        series = encode_series([(300, 1), (330, 2), (360, 3)], INT)
+        self.assertEqual(
+            {"count": 3, "start": 300, "step": 30, "gaps": [],
+             "values": [b"\x02\x02\x02"]},
+            series)
+
+    def test_encode_empty(self):
+        """An empty series has no points and no values."""
+        series = encode_series([], FLOAT)
+        self.assertEqual(
+            {"count": 0, "start": 0, "step": 0, "gaps": [],
+             "values": [b""]},
+            series)
+        self.assertEqual([], decode_series(series, FLOAT))
+
+    def test_gaps(self):
+        """
+        The points which aren't a step after the previous one are recorded
+        as gaps.
+        """
+        points = [(300, 1.0), (330, 2.0), (420, 3.0), (450, 4.0), (451, 5.0)]
+        series = encode_series(points, FLOAT)
+        self.assertEqual(30, series["step"])
+        self.assertEqual([(2, 90), (4, 1)], series["gaps"])
+        self.assertEqual(points, decode_series(series, FLOAT))
+
+    def test_columns(self):
+        """Each value of the points gets its own packed column."""
+        points = [(300, 1.5, 10, -3), (330, -0.25, 2 ** 40, 7)]
+        series = encode_series(points, FLOAT + INT + INT)
+        self.assertEqual(3, len(series["values"]))
+        self.assertEqual(points, decode_series(series, "fii"))
+
+    def test_int_deltas(self):
+        """
+        Integers are packed as the varint of their delta with the previous
+        value, so slowly changing values only take a byte.
+        """
+        values = [10 ** 9 + i for i in range(100)]
+        series = encode_series([(i, value) for i, value in enumerate(values)],
+                               INT)
+        self.assertEqual(5 + 99, len(series["values"][0]))
+
+    def test_smaller_than_tuples(self):
+        """
+        The serialized series is considerably smaller than the serialized
+        list of points.
+        """
+        points = [(1500000000 + i * 300, i / 7.0) for i in range(100)]
+        series = encode_series(points, FLOAT)
+        self.assertTrue(
+            len(bpickle.dumps(series)) * 2 < len(bpickle.dumps(points)))
+        self.assertEqual(
+            points, decode_series(bpickle.loads(bpickle.dumps(series)), FLOAT))
@@ -1,5 +1,6 @@
 
-from landscape.lib.schema import KeyDict, Float, Bytes, Constant, Any
+from landscape.lib.schema import (
+    KeyDict, Float, Bytes, Constant, Any, compile_schema)
 
 
 class Message(KeyDict):
@@ -15,10 +16,16 @@ class Message(KeyDict):
     @param optional: An optional list of keys that should be optional.
     @param api: The server API version needed to send this message,
         if C{None} any version is fine.
+    @param coalesce: If C{True}, messages of this type carry a complete
+        snapshot of some data and only the latest one matters, so a new
+        message replaces the one of the same type still waiting in the
+        message store, if any.
     """
-    def __init__(self, type, schema, optional=None, api=None):
+    def __init__(self, type, schema, optional=None, api=None,
+                 coalesce=False):
         self.type = type
         self.api = api
+        self.coalesce = coalesce
         schema["timestamp"] = Float()
         schema["api"] = Any(Bytes(), Constant(None))
         schema["type"] = Constant(type)
@@ -36,4 +43,4 @@ class Message(KeyDict):
                 # in a message talks to an older server, that don't understand
                 # the new field yet.
                 value.pop(k)
-        return super(Message, self).coerce(value)
+        return compile_schema(self)(value)
@@ -2,22 +2,25 @@
 
 from landscape.lib.schema import (
     KeyDict, Dict, List, Tuple,
-    Bool, Int, Float, Bytes, Unicode, Constant, Any)
+    Bool, Int, Float, Bytes, Unicode, Constant, Any, Series)
 from .message import Message
 
 
 __all__ = [
     "ACTIVE_PROCESS_INFO", "COMPUTER_UPTIME", "CLIENT_UPTIME",
     "OPERATION_RESULT", "COMPUTER_INFO", "DISTRIBUTION_INFO",
-    "HARDWARE_INVENTORY", "HARDWARE_INFO", "LOAD_AVERAGE", "MEMORY_INFO",
+    "HARDWARE_INVENTORY", "HARDWARE_INFO", "LOAD_AVERAGE", "LOAD_AVERAGE_3_4",
+    "MEMORY_INFO", "MEMORY_INFO_3_4",
     "RESYNCHRONIZE", "MOUNT_ACTIVITY", "MOUNT_INFO", "FREE_SPACE",
     "REGISTER", "REGISTER_3_3",
-    "TEMPERATURE", "PROCESSOR_INFO", "USERS", "PACKAGES", "PACKAGE_LOCKS",
+    "TEMPERATURE", "TEMPERATURE_3_4", "PROCESSOR_INFO", "USERS", "PACKAGES",
+    "PACKAGE_LOCKS",
     "CHANGE_PACKAGES_RESULT", "UNKNOWN_PACKAGE_HASHES",
     "ADD_PACKAGES", "PACKAGE_REPORTER_RESULT", "TEXT_MESSAGE", "TEST",
     "CUSTOM_GRAPH", "REBOOT_REQUIRED", "APT_PREFERENCES",
-    "NETWORK_DEVICE", "NETWORK_ACTIVITY",
+    "NETWORK_DEVICE", "NETWORK_ACTIVITY", "NETWORK_ACTIVITY_3_4",
     "REBOOT_REQUIRED_INFO", "UPDATE_MANAGER_INFO", "CPU_USAGE",
+    "CPU_USAGE_3_4",
     "CEPH_USAGE", "SWIFT_USAGE", "SWIFT_DEVICE_INFO", "KEYSTONE_TOKEN",
     "JUJU_UNITS_INFO", "CLOUD_METADATA",
     ]
@@ -139,6 +142,16 @@ CPU_USAGE = Message("cpu-usage", {
     "cpu-usages": List(Tuple(Int(), Float())),
     })
 
+# From API 3.4 the points of metric messages are sent in the compact columnar
+# form of landscape.lib.series, instead of as a list of tuples.
+LOAD_AVERAGE_3_4 = Message("load-average", {
+    "load-averages": Series("f"),
+    }, api=b"3.4")
+
+CPU_USAGE_3_4 = Message("cpu-usage", {
+    "cpu-usages": Series("f"),
+    }, api=b"3.4")
+
 CEPH_USAGE = Message("ceph-usage", {
     "ring-id": Unicode(),
     # Usage data points in the form (timestamp, size, avail, used)
@@ -157,12 +170,16 @@ SWIFT_USAGE = Message("swift-usage", {
 
 KEYSTONE_TOKEN = Message("keystone-token", {
     "data": Any(Bytes(), Constant(None))
-})
+}, coalesce=True)
 
 MEMORY_INFO = Message("memory-info", {
     "memory-info": List(Tuple(Float(), Int(), Int())),
     })
 
+MEMORY_INFO_3_4 = Message("memory-info", {
+    "memory-info": Series("ii"),
+    }, api=b"3.4")
+
 RESYNCHRONIZE = Message(
     "resynchronize",
     {"operation-id": Int()},
@@ -263,6 +280,11 @@ TEMPERATURE = Message("temperature", {
     "temperatures": List(Tuple(Int(), Float())),
     })
 
+TEMPERATURE_3_4 = Message("temperature", {
+    "thermal-zone": Unicode(),
+    "temperatures": Series("f"),
+    }, api=b"3.4")
+
 PROCESSOR_INFO = Message(
     "processor-info",
     {"processors": List(KeyDict({"processor-id": Int(),
@@ -459,7 +481,8 @@ REBOOT_REQUIRED_INFO = Message(
 
 APT_PREFERENCES = Message(
     "apt-preferences",
-    {"data": Any(Dict(Unicode(), Unicode()), Constant(None))})
+    {"data": Any(Dict(Unicode(), Unicode()), Constant(None))},
+    coalesce=True)
 
 EUCALYPTUS_INFO = Message(
     "eucalyptus-info",
@@ -491,7 +514,7 @@ NETWORK_DEVICE = Message(
      "device-speeds": List(KeyDict({"interface": Bytes(),
                                     "speed": Int(),
                                     "duplex": Bool()}))},
-    optional=["device-speeds"])
+    optional=["device-speeds"], coalesce=True)
 
 
 NETWORK_ACTIVITY = Message(
@@ -502,20 +525,27 @@ NETWORK_ACTIVITY = Message(
     # interval.
     {"activities": Dict(Bytes(), List(Tuple(Int(), Int(), Int())))})
 
-UPDATE_MANAGER_INFO = Message("update-manager-info", {"prompt": Unicode()})
+NETWORK_ACTIVITY_3_4 = Message(
+    "network-activity",
+    {"activities": Dict(Bytes(), Series("ii"))},
+    api=b"3.4")
+
+UPDATE_MANAGER_INFO = Message("update-manager-info", {"prompt": Unicode()},
+                              coalesce=True)
 
 
 message_schemas = (
     ACTIVE_PROCESS_INFO, COMPUTER_UPTIME, CLIENT_UPTIME,
     OPERATION_RESULT, COMPUTER_INFO, DISTRIBUTION_INFO,
-    HARDWARE_INVENTORY, HARDWARE_INFO, LOAD_AVERAGE, MEMORY_INFO,
-    RESYNCHRONIZE, MOUNT_ACTIVITY, MOUNT_INFO, FREE_SPACE,
+    HARDWARE_INVENTORY, HARDWARE_INFO, LOAD_AVERAGE, LOAD_AVERAGE_3_4,
+    MEMORY_INFO, MEMORY_INFO_3_4, RESYNCHRONIZE, MOUNT_ACTIVITY, MOUNT_INFO,
+    FREE_SPACE,
     REGISTER, REGISTER_3_3,
-    TEMPERATURE, PROCESSOR_INFO, USERS, PACKAGES, PACKAGE_LOCKS,
-    CHANGE_PACKAGES_RESULT, UNKNOWN_PACKAGE_HASHES,
+    TEMPERATURE, TEMPERATURE_3_4, PROCESSOR_INFO, USERS, PACKAGES,
+    PACKAGE_LOCKS, CHANGE_PACKAGES_RESULT, UNKNOWN_PACKAGE_HASHES,
     ADD_PACKAGES, PACKAGE_REPORTER_RESULT, TEXT_MESSAGE, TEST,
     CUSTOM_GRAPH, REBOOT_REQUIRED, APT_PREFERENCES,
-    NETWORK_DEVICE, NETWORK_ACTIVITY,
-    REBOOT_REQUIRED_INFO, UPDATE_MANAGER_INFO, CPU_USAGE,
+    NETWORK_DEVICE, NETWORK_ACTIVITY, NETWORK_ACTIVITY_3_4,
+    REBOOT_REQUIRED_INFO, UPDATE_MANAGER_INFO, CPU_USAGE, CPU_USAGE_3_4,
     CEPH_USAGE, SWIFT_USAGE, SWIFT_DEVICE_INFO, KEYSTONE_TOKEN,
     JUJU_UNITS_INFO, CLOUD_METADATA)
@@ -34,6 +34,11 @@ class MessageTest(unittest.TestCase):
             schema.coerce({"type": "baz", "api": None}),
             {"type": "baz", "api": None})
 
+    def test_coalesce(self):
+        """L{Message} schemas aren't coalesced unless asked to."""
+        self.assertFalse(Message("foo", {}).coalesce)
+        self.assertTrue(Message("foo", {}, coalesce=True).coalesce)
+
     def test_optional(self):
         """The L{Message} schema should allow additional optional keys."""
         schema = Message("foo", {"data": Int()}, optional=["data"])
@@ -62,4 +62,5 @@ if __name__ == "__main__":
         packages=PACKAGES,
         modules=MODULES,
         scripts=SCRIPTS,
+        ext_modules=setup_lib.EXT_MODULES,
         )
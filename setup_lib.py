@@ -1,7 +1,9 @@
 #!/usr/bin/python
+import sys
+from distutils.core import Extension
 
 
-NAME = "landscape-lib",
+NAME = "landscape-lib"
 DESCRIPTION = "Common code used by Landscape applications"
 PACKAGES = [
         "landscape.lib",
@@ -14,6 +16,13 @@ MODULES = [
         "landscape.constants",
         ]
 SCRIPTS = []
+EXT_MODULES = []
+if sys.version_info[0] >= 3:
+    # landscape.lib.bpickle falls back to its pure-Python codec when the
+    # compiled one can't be built.
+    EXT_MODULES.append(Extension("landscape.lib._bpickle",
+                                 ["landscape/lib/_bpickle.c"],
+                                 optional=True))
 
 # Dependencies
 
@@ -29,7 +38,12 @@ REQUIRES = [
         ]
 
 
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:2] == ["build_ext"]:
+    # Building the compiled modules, e.g. in place to run the tests, only
+    # needs distutils.
+    from distutils.core import setup
+    setup(name=NAME, ext_modules=EXT_MODULES)
+elif __name__ == "__main__":
     from setup import setup_landscape
     setup_landscape(
         name=NAME,
@@ -37,4 +51,5 @@ if __name__ == "__main__":
         packages=PACKAGES,
         modules=MODULES,
         scripts=SCRIPTS,
+        ext_modules=EXT_MODULES,
         )